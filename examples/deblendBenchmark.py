@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""Benchmark the deblender on synthetic blends
+
+Each scene is a reproducible blend of point sources and extended sources,
+made with the fake image helpers in `portionFigureWithMissingSrc`.  The scenes
+vary one property at a time (number of peaks, footprint area, number of bands,
+PSF size, proximity to the image edge and fraction of point sources) around a
+default scene.  For every scene this times
+
+- ``baseline.deblend`` (single band) and ``baseline.newDeblend`` (all bands),
+  with the plugins configured as in `SourceDeblendTask`,
+- each of the deblender plugins, using the statistics recorded by ``newDeblend``,
+- the C++ ``BaselineUtils`` kernels, run on the templates of the deblended parent.
+
+Each benchmark reports the minimum time over ``--repeat`` runs.  The results
+can be written to a JSON file with ``--output`` and compared with a previous
+run with ``--compare``, in which case the script exits with a nonzero status
+if any benchmark is slower than the previous run by more than ``--tolerance``.
+
+The sources of a scene are placed at random, and a scene can end up with
+fewer peaks than requested (when no position far enough from the other
+sources is found, or when a source is not in the detected footprint).
+The number of peaks and pixels of each scene is printed and written to the
+JSON file, and the scenes that differ from the ``--compare`` run are not
+compared.
+
+Run it from the top-level directory of the package with::
+
+    python -m examples.deblendBenchmark --output results.json
+"""
+import argparse
+from collections import OrderedDict
+import contextlib
+import io
+import json
+import sys
+import time
+
+import numpy as np
+
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+from lsst.log import Log
+import lsst.meas.algorithms as measAlg
+from lsst.meas.deblender import SourceDeblendTask
+from lsst.meas.deblender.baseline import deblend, newDeblend, makeDeblendPlugins
+from lsst.meas.deblender.baselineUtils import BaselineUtilsF as bUtils
+
+from .portionFigureWithMissingSrc import makeFakeImage, randomCoords
+
+# Properties of the default scene
+DEFAULT_SCENE = dict(
+    nPeaks=5,         # number of sources in the blend
+    size=100,         # width and height of the image, in pixels
+    nBands=1,         # number of bands
+    psfFwhm=3.,       # FWHM of the PSF, in pixels
+    edge=False,       # whether or not the blend is cut by the edge of the image
+    pointFraction=0.5,  # fraction of the sources that are point sources
+)
+
+# Each scene changes a single property of the default scene
+SCENES = OrderedDict([
+    ("default", dict()),
+    ("crowded", dict(nPeaks=30, size=200)),
+    ("large", dict(size=400)),
+    ("multiband", dict(nBands=5)),
+    ("widePsf", dict(psfFwhm=8.)),
+    ("edge", dict(edge=True)),
+    ("pointSources", dict(pointFraction=1.)),
+    ("galaxies", dict(pointFraction=0.)),
+    # Few, large templates (200x200 pixels and more)
+    ("largeGalaxies", dict(nPeaks=3, size=400, psfFwhm=8., pointFraction=0.)),
+])
+
+
+class Scene:
+    """A synthetic blend
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the scene.
+    seed: `int`
+        Seed for the random number generator.
+    **kwargs
+        Properties of the scene that differ from `DEFAULT_SCENE`.
+    """
+
+    def __init__(self, name, seed=1, **kwargs):
+        self.name = name
+        props = dict(DEFAULT_SCENE, **kwargs)
+        for key, value in props.items():
+            setattr(self, key, value)
+
+        np.random.seed(seed)
+        # Keep the sources roughly a PSF FWHM apart for any number of peaks
+        minSep = 0.5/np.sqrt(self.nPeaks)
+        # randomCoords prints its progress, which is not useful here
+        with contextlib.redirect_stdout(io.StringIO()):
+            xys = randomCoords(self.nPeaks, minSep=minSep, maxSep=min(2*minSep, 0.4))
+        if self.edge:
+            # Move the blend so that the leftmost source is on the edge of the image
+            shift = min(x for x, y in xys) - 0.5/self.size
+            xys = [(x - shift, y) for x, y in xys]
+        isPoint = np.random.uniform(size=self.nPeaks) < self.pointFraction
+        fwhms = [self.psfFwhm if point else self.psfFwhm*np.random.uniform(1.5, 3.)
+                 for point in isPoint]
+        fluxes = 10**np.random.uniform(3, 5, size=self.nPeaks)
+
+        self.filters = ["b{0}".format(n) for n in range(self.nBands)]
+        self.psfs = []
+        self.psfFwhms = []
+        self.maskedImages = []
+        for n in range(self.nBands):
+            # The PSF is a little wider in the redder bands
+            scale = 1 + 0.05*n
+            self.psfFwhms.append(self.psfFwhm*scale)
+            sigma = self.psfFwhms[-1]/2.35
+            psfSize = 2*int(4*sigma) + 1
+            self.psfs.append(measAlg.DoubleGaussianPsf(psfSize, psfSize, sigma))
+            sed = np.random.uniform(0.5, 1.5, size=self.nPeaks)
+            mimg = makeFakeImage(self.size, self.size, xys, fluxes*sed, [f*scale for f in fwhms])
+            # makeFakeImage uses a unit variance
+            mimg.getImage().getArray()[:] += np.random.normal(size=(self.size, self.size))
+            self.maskedImages.append(mimg)
+
+        # Detect the blend in the first band and use the true positions of the sources as peaks
+        fpSet = afwDet.FootprintSet(self.maskedImages[0], afwDet.Threshold(5.), "DETECTED", 1)
+        self.spans = max((fp.getSpans() for fp in fpSet.getFootprints()), key=lambda s: s.getArea())
+        self.peaks = []
+        for x, y in xys:
+            ix, iy = int(x*self.size), int(y*self.size)
+            if self.spans.contains(afwGeom.Point2I(ix, iy)):
+                self.peaks.append((ix, iy, float(self.maskedImages[0].getImage().getArray()[iy, ix])))
+        self.peakSchema = afwDet.PeakTable.makeMinimalSchema()
+
+    def makeFootprint(self):
+        """Return a new copy of the parent footprint
+
+        The deblender modifies the footprint and its peaks,
+        so every run needs its own copy.
+        """
+        fp = afwDet.Footprint(self.spans, self.peakSchema)
+        for x, y, value in self.peaks:
+            fp.addPeak(x, y, value)
+        return fp
+
+    def makeMultibandImage(self):
+        return afwImage.MultibandMaskedImage.fromImages(self.filters, self.maskedImages)
+
+    def getProperties(self):
+        """Return the actual properties of the blend, recorded with the results"""
+        return OrderedDict([("nPeaks", self.nPeaks), ("peaks", len(self.peaks)),
+                            ("pixels", self.spans.getArea()), ("nBands", self.nBands)])
+
+    def __str__(self):
+        requested = ""
+        if len(self.peaks) != self.nPeaks:
+            requested = " (of {0} requested)".format(self.nPeaks)
+        return "{0}: {1} peaks{2}, {3} pixels, {4} bands".format(
+            self.name, len(self.peaks), requested, self.spans.getArea(), self.nBands)
+
+
+def timeCall(func, setup=None, repeat=3):
+    """Return the minimum time of ``func(*setup())`` over ``repeat`` runs
+
+    The time spent in ``setup`` is not included.
+    """
+    times = []
+    for i in range(repeat):
+        args = setup() if setup is not None else ()
+        t0 = time.time()
+        func(*args)
+        times.append(time.time() - t0)
+    return min(times)
+
+
+def benchmarkDeblend(scene, options, log, repeat):
+    """Time the single band and multiband deblender and each of its plugins"""
+    results = OrderedDict()
+    mimg = scene.maskedImages[0]
+    sigma1 = 1.
+
+    def runSingle(fp):
+        return deblend(fp, mimg, scene.psfs[0], scene.psfFwhms[0], log=log, sigma1=sigma1, **options)
+
+    results["deblend"] = timeCall(runSingle, lambda: (scene.makeFootprint(),), repeat)
+
+    multiband = scene.makeMultibandImage()
+    pluginTimes = OrderedDict()
+    debResult = None
+    for i in range(repeat):
+        fp = scene.makeFootprint()
+        t0 = time.time()
+        debResult = newDeblend(makeDeblendPlugins(**options), fp, multiband, scene.psfs, scene.psfFwhms,
+                               log=log, avgNoise=[sigma1]*scene.nBands)
+        runtime = time.time() - t0
+        results["newDeblend"] = min(results.get("newDeblend", runtime), runtime)
+        for name, stats in debResult.pluginStatistics.items():
+            pluginTimes[name] = min(pluginTimes.get(name, stats.time), stats.time)
+    for name, runtime in pluginTimes.items():
+        results["plugin." + name] = runtime
+    return results, debResult
+
+
+def benchmarkKernels(scene, debResult, repeat):
+    """Time the `BaselineUtils` kernels on the templates of ``debResult``"""
+    results = OrderedDict()
+    dp = list(debResult.deblendedParents.values())[0]
+    peaks = [pkres for pkres in dp.peaks if not pkres.skip]
+    if not peaks:
+        return results
+    fp = dp.fp
+    sigma1 = 1.
+
+    def symmetrize():
+        for pkres in peaks:
+            bUtils.symmetrizeFootprint(fp, pkres.peak.getIx(), pkres.peak.getIy())
+
+    def buildTemplates():
+        for pkres in peaks:
+            bUtils.buildSymmetricTemplate(dp.maskedImage, fp, pkres.peak, sigma1, True, False)
+
+    def copyTemplates():
+        return ([pkres.templateImage.Factory(pkres.templateImage, True) for pkres in peaks],)
+
+    def medianFilter(templates):
+        for pkres, timg in zip(peaks, templates):
+            if timg.getWidth() >= 5 and timg.getHeight() >= 5:
+                bUtils.medianFilter(pkres.templateImage, timg, 2)
+
+    def makeMonotonic(templates):
+        for pkres, timg in zip(peaks, templates):
+            bUtils.makeMonotonic(timg, pkres.peak)
+
+    def makeMonotonicRadial(templates):
+        for pkres, timg in zip(peaks, templates):
+            bUtils.makeMonotonicRadial(timg, pkres.peak)
+
+    strayopts = bUtils.ASSIGN_STRAYFLUX | bUtils.STRAYFLUX_TO_POINT_SOURCES_WHEN_NECESSARY
+
+    def apportionFlux():
+        bUtils.apportionFlux(dp.maskedImage, fp, [pkres.templateImage for pkres in peaks],
+                             [pkres.templateFootprint for pkres in peaks], afwImage.ImageF(fp.getBBox()),
+                             [pkres.deblendedAsPsf for pkres in peaks],
+                             [pkres.peak.getIx() for pkres in peaks], [pkres.peak.getIy() for pkres in peaks],
+                             strayopts, 0.001)
+
+    def edgePixels():
+        for pkres in peaks:
+            bUtils.getSignificantEdgePixels(pkres.templateImage, pkres.templateFootprint, sigma1)
+
+    results["kernel.symmetrizeFootprint"] = timeCall(symmetrize, repeat=repeat)
+    results["kernel.buildSymmetricTemplate"] = timeCall(buildTemplates, repeat=repeat)
+    results["kernel.medianFilter"] = timeCall(medianFilter, copyTemplates, repeat)
+    results["kernel.makeMonotonic"] = timeCall(makeMonotonic, copyTemplates, repeat)
+    results["kernel.makeMonotonicRadial"] = timeCall(makeMonotonicRadial, copyTemplates, repeat)
+    results["kernel.apportionFlux"] = timeCall(apportionFlux, repeat=repeat)
+    results["kernel.getSignificantEdgePixels"] = timeCall(edgePixels, repeat=repeat)
+    return results
+
+
+def compareResults(results, previous, tolerance, minTime):
+    """Print the ratio of each time to the ``previous`` time
+
+    Returns
+    -------
+    regressions: list of `str`
+        Names of the benchmarks that are slower than ``previous``
+        by more than ``tolerance``.
+    """
+    regressions = []
+    print("\n%-48s %10s %10s %8s" % ("benchmark", "before (s)", "after (s)", "ratio"))
+    for key, runtime in results.items():
+        if key not in previous:
+            continue
+        before = previous[key]
+        if max(before, runtime) < minTime:
+            continue
+        ratio = runtime/before if before > 0 else np.inf
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print("%-48s %10.4f %10.4f %8.2f%s" % (key, before, runtime, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenes", nargs="+", choices=list(SCENES.keys()), default=list(SCENES.keys()),
+                        help="Scenes to benchmark")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times each benchmark is run")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed used to generate the scenes")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results to this JSON file written by --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fractional slowdown relative to --compare that counts as a regression")
+    parser.add_argument("--minTime", type=float, default=1e-3,
+                        help="Ignore benchmarks faster than this (in seconds) when comparing")
+    args = parser.parse_args()
+
+    log = Log.getLogger("meas.deblender.deblendBenchmark")
+    log.setLevel(Log.WARN)
+    # Use the plugins configured as they are for the single band task
+    schema = afwTable.SourceTable.makeMinimalSchema()
+    options = SourceDeblendTask(schema)._getPluginOptions()
+
+    results = OrderedDict()
+    scenes = OrderedDict()
+    for name in args.scenes:
+        scene = Scene(name, args.seed, **SCENES[name])
+        print(scene)
+        scenes[name] = scene.getProperties()
+        sceneResults, debResult = benchmarkDeblend(scene, options, log, args.repeat)
+        sceneResults.update(benchmarkKernels(scene, debResult, args.repeat))
+        for key, runtime in sceneResults.items():
+            print("    %-40s %10.4f s" % (key, runtime))
+            results["{0}.{1}".format(name, key)] = runtime
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(seed=args.seed, repeat=args.repeat, scenes=scenes, results=results), f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous["seed"] != args.seed:
+            print("Warning: %s was made with a different seed" % args.compare)
+        # Only compare the scenes that have the same blend as in the previous run
+        previousScenes = previous.get("scenes", {})
+        for name, props in scenes.items():
+            if name in previousScenes and previousScenes[name] != props:
+                print("Warning: scene %s differs from %s (%s), it is not compared" %
+                      (name, args.compare, previousScenes[name]))
+                results = OrderedDict((key, runtime) for key, runtime in results.items()
+                                      if not key.startswith(name + "."))
+        regressions = compareResults(results, previous["results"], args.tolerance, args.minTime)
+        if regressions:
+            print("\n%d benchmarks are slower than in %s" % (len(regressions), args.compare))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
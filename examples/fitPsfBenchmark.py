@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Time the neighbour lookup used when fitting PSF models to peaks
+
+Builds synthetic footprints containing an increasing number of peaks at a
+fixed density, so that each peak has roughly the same number of neighbours,
+and times setting up the PSF fits for all of the peaks with a brute force
+search for the neighbours of each peak and with the grid index of peaks
+built by `fitPsfs`.  The brute force search scales as N^2 in the number of
+peaks, while the indexed search scales as N.
+"""
+import argparse
+import time
+
+import numpy as np
+
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.log import Log
+import lsst.meas.algorithms as measAlg
+from lsst.meas.deblender.baseline import DeblendedPeak, CachingPsf
+from lsst.meas.deblender.plugins import _buildPsfFit, _PeakIndex
+
+
+def makeScene(nPeaks, psf, spacing=12., sig1=10., seed=1):
+    """Make a square footprint containing ``nPeaks`` point sources
+    separated by ``spacing`` pixels on average
+    """
+    rng = np.random.RandomState(seed)
+    size = int(np.ceil(np.sqrt(nPeaks)*spacing)) + 20
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(size, size))
+    fp = afwDet.Footprint(afwGeom.SpanSet(bbox))
+    img = afwImage.ImageF(bbox)
+    img.getArray()[:] = rng.normal(0, sig1, size=(size, size))
+    varimg = afwImage.ImageF(bbox)
+    varimg.set(sig1**2)
+
+    peaks = afwDet.PeakCatalog(afwDet.PeakTable.makeMinimalSchema())
+    for x, y in rng.uniform(10, size - 10, size=(nPeaks, 2)):
+        pk = peaks.addNew()
+        pk.setFx(x)
+        pk.setFy(y)
+        pk.setIx(int(x))
+        pk.setIy(int(y))
+        psfim = psf.computeImage(afwGeom.Point2D(x, y)).convertF()
+        psfim *= rng.uniform(1000., 10000.)
+        overlap = psfim.getBBox()
+        overlap.clip(bbox)
+        img[overlap] += psfim[overlap]
+    return fp, img, varimg, peaks
+
+
+def timeBuild(fp, img, varimg, peaks, psf, psffwhm, log, useIndex):
+    """Time setting up the PSF fit of every peak in ``fp``"""
+    fbb = fp.getBBox()
+    fmask = afwImage.Mask(fbb)
+    fp.spans.setMask(fmask, 1)
+    peaksF = [pk.getF() for pk in peaks]
+    cpsf = CachingPsf(psf)
+
+    t0 = time.time()
+    peakIndex = _PeakIndex(peaksF, 3*psffwhm) if useIndex else None
+    nOthers = 0
+    for i, (pk, pkF) in enumerate(zip(peaks, peaksF)):
+        pkres = DeblendedPeak(pk, i, None)
+        fit = _buildPsfFit(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, cpsf, psffwhm,
+                           img, varimg, peakIndex=peakIndex)
+        if fit is not None:
+            nOthers += fit.nOthers
+    return time.time() - t0, nOthers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--peaks", type=int, nargs="+", default=[100, 250, 500, 1000, 2000],
+                        help="Number of peaks in each footprint")
+    parser.add_argument("--spacing", type=float, default=12.,
+                        help="Mean separation between peaks, in pixels")
+    parser.add_argument("--psfSigma", type=float, default=1.5,
+                        help="Width of the PSF, in pixels")
+    args = parser.parse_args()
+
+    log = Log.getLogger("meas.deblender.fitPsfBenchmark")
+    log.setLevel(Log.WARN)
+    psf = measAlg.DoubleGaussianPsf(11, 11, args.psfSigma)
+    psffwhm = args.psfSigma*2.35
+
+    print("%8s %12s %12s %8s" % ("nPeaks", "brute (s)", "indexed (s)", "speedup"))
+    for nPeaks in args.peaks:
+        fp, img, varimg, peaks = makeScene(nPeaks, psf, args.spacing)
+        tBrute, nBrute = timeBuild(fp, img, varimg, peaks, psf, psffwhm, log, False)
+        tIndex, nIndex = timeBuild(fp, img, varimg, peaks, psf, psffwhm, log, True)
+        assert nBrute == nIndex, "Indexed search found different neighbours"
+        print("%8i %12.3f %12.3f %8.1f" % (nPeaks, tBrute, tIndex, tBrute/tIndex))
+
+
+if __name__ == "__main__":
+    main()
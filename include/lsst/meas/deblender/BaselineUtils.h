@@ -50,6 +50,17 @@ namespace lsst {
                                        bool patchEdges,
                                        bool* patchedEdges);
 
+                static
+                std::vector<int>
+                buildSymmetricTemplates(MaskedImageT const& img,
+                                        lsst::afw::detection::Footprint const& foot,
+                                        std::vector<int> const& peakIndices,
+                                        bool minZero,
+                                        bool patchEdges,
+                                        std::vector<ImagePtrT> & templates,
+                                        std::vector<FootprintPtrT> & tfoots,
+                                        double denseFraction=0.5);
+
                 static void
                 medianFilter(ImageT const& img,
                              ImageT & outimg,
@@ -59,6 +70,10 @@ namespace lsst {
                 makeMonotonic(ImageT & img,
                               lsst::afw::detection::PeakRecord const& pk);
 
+                static void
+                makeMonotonicRadial(ImageT & img,
+                                    lsst::afw::detection::PeakRecord const& pk);
+
                 static const int ASSIGN_STRAYFLUX                          = 0x1;
                 static const int STRAYFLUX_TO_POINT_SOURCES_WHEN_NECESSARY = 0x2;
                 static const int STRAYFLUX_TO_POINT_SOURCES_ALWAYS         = 0x4;
@@ -68,6 +83,15 @@ namespace lsst {
                 static const int STRAYFLUX_NEAREST_FOOTPRINT              = 0x10;
                 static const int STRAYFLUX_TRIM                           = 0x20;
 
+                // options and status of buildTemplates
+                static const int MONOTONIC_CONE                           = 0x1;
+                static const int MONOTONIC_RADIAL                         = 0x2;
+                static const int TEMPLATE_OUT_OF_BOUNDS                   = 0x1;
+                static const int TEMPLATE_FAILED_SYMMETRIC                = 0x2;
+                static const int TEMPLATE_PATCHED                         = 0x4;
+                static const int TEMPLATE_RAMPED                          = 0x8;
+                static const int TEMPLATE_NO_PSF                          = 0x10;
+
                 // swig doesn't seem to understand std::vector<MaskedImagePtrT>...
                 static
                 std::vector<typename PTR(lsst::afw::image::MaskedImage<ImagePixelT, MaskPixelT, VariancePixelT>)>
@@ -85,6 +109,12 @@ namespace lsst {
                               double clipStrayFluxFraction
                      );
 
+                static
+                HeavyFootprintPtrT
+                mergeFluxPortion(MaskedImageT const& portion,
+                                 lsst::afw::detection::Footprint const& tfoot,
+                                 HeavyFootprintT const& stray);
+
                 static
                 bool
                 hasSignificantFluxAtEdge(ImagePtrT,
@@ -97,6 +127,30 @@ namespace lsst {
                                          std::shared_ptr<lsst::afw::detection::Footprint>,
                                          ImagePixelT threshold);
 
+                static
+                void
+                rampEdgePixels(ImageT const& img,
+                               lsst::afw::detection::Footprint const& edgepix,
+                               lsst::afw::image::Image<double> const& psf,
+                               int cx, int cy, int radius,
+                               ImageT & ramped);
+
+                static
+                std::vector<int>
+                buildTemplates(MaskedImageT const& img,
+                               lsst::afw::detection::Footprint const& foot,
+                               std::vector<int> const& peakIndices,
+                               double sigma1,
+                               bool patchEdges,
+                               int rampRadius,
+                               std::shared_ptr<lsst::afw::image::Image<double>> psf,
+                               int psfX, int psfY,
+                               int medianFilterHalfsize,
+                               int monotonicOptions,
+                               bool clipToNonzero,
+                               std::vector<ImagePtrT> & templates,
+                               std::vector<FootprintPtrT> & tfoots);
+
 
                 static
                 void
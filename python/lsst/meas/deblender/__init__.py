@@ -26,4 +26,8 @@ from .version import *
 from .baselineUtils import *
 from .baseline import *
 from .plugins import *
+from .payload import *
+from .sink import *
+from .cache import *
+from .checkpoint import *
 from .deblend import *
@@ -20,15 +20,22 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from collections import OrderedDict
+import resource
+import sys
+import threading
+import time
+
 import numpy as np
 
 import lsst.pex.exceptions
 import lsst.afw.image as afwImage
 import lsst.afw.detection as afwDet
 import lsst.afw.geom as afwGeom
+import lsst.afw.geom.ellipses as afwEll
 import lsst.afw.math as afwMath
 
 from . import plugins
+from .baselineUtils import BaselineUtilsF as bUtils
 
 DEFAULT_PLUGINS = [
     plugins.DeblenderPlugin(plugins.fitPsfs),
@@ -36,7 +43,7 @@ DEFAULT_PLUGINS = [
     plugins.DeblenderPlugin(plugins.medianSmoothTemplates),
     plugins.DeblenderPlugin(plugins.makeTemplatesMonotonic),
     plugins.DeblenderPlugin(plugins.clipFootprintsToNonzero),
-    plugins.DeblenderPlugin(plugins.reconstructTemplates, onReset=5),
+    plugins.DeblenderPlugin(plugins.reconstructTemplates),
     plugins.DeblenderPlugin(plugins.apportionFlux),
 ]
 
@@ -46,7 +53,8 @@ class DeblenderResult:
     """
 
     def __init__(self, footprint, mMaskedImage, psfs, psffwhms, log,
-                 maxNumberOfPeaks=0, avgNoise=None):
+                 maxNumberOfPeaks=0, avgNoise=None, numThreads=1, psfCaches=None,
+                 saveDebugTemplates=True):
         """ Initialize a DeblededParent
 
         Parameters
@@ -68,9 +76,22 @@ class DeblenderResult:
             then only the first ``maxNumberOfPeaks`` sources are deblended.
             The default is 0, which deblends all of the peaks.
         avgNoise: `float`or list of `float`s, optional
-            Average noise level in each ``maskedImage``.
+            Average noise level in each ``maskedImage``.  Each entry can also
+            be the `NoiseModel` of the exposure in the band.
             The default is ``None``, which estimates the noise from the median value of the
             variance plane of ``maskedImage`` for each filter.
+        numThreads: `int`, optional
+            Maximum number of threads used by the plugins to process
+            the bands in parallel. The default is 1 (no threads).
+        psfCaches: `CachingPsf` or list of `CachingPsf`s, optional
+            Cache of the PSF model images in each band, which can be shared
+            between parents. The default is ``None``, which creates a new
+            cache for each band.
+        saveDebugTemplates: `bool`, optional
+            If True, the peaks keep copies of their intermediate templates
+            (``origTemplate``, ``rampedTemplate``, ``medianFilteredTemplate``
+            and ``psfTemplate``) for debugging.  If False, these attributes
+            are left as ``None``.  The default is True.
         Returns
         -------
         None
@@ -96,8 +117,12 @@ class DeblenderResult:
                 avgNoise = [None]*len(psfs)
             else:
                 avgNoise = [avgNoise]
+        if psfCaches is None:
+            psfCaches = [None]*len(psfs)
+        elif isinstance(psfCaches, CachingPsf):
+            psfCaches = [psfCaches]
         # Now check that all of the parameters have the same number of entries
-        if any([len(self.filters) != len(p) for p in [psfs, psffwhms, avgNoise]]):
+        if any([len(self.filters) != len(p) for p in [psfs, psffwhms, avgNoise, psfCaches]]):
             raise ValueError("To use the multi-color deblender, "
                              "'maskedImage', 'psf', 'psffwhm', 'avgNoise'"
                              "must have the same length, but instead have lengths: "
@@ -110,6 +135,8 @@ class DeblenderResult:
         self.mMaskedImage = mMaskedImage
         self.footprint = footprint
         self.psfs = psfs
+        self.numThreads = numThreads
+        self.saveDebugTemplates = saveDebugTemplates
 
         self.peakCount = len(footprint.getPeaks())
         if maxNumberOfPeaks > 0 and maxNumberOfPeaks < self.peakCount:
@@ -120,7 +147,7 @@ class DeblenderResult:
         for n, f in enumerate(self.filters):
             f = self.filters[n]
             dp = DeblendedParent(f, footprint, mMaskedImage[f], psfs[n],
-                                 psffwhms[n], avgNoise[n], maxNumberOfPeaks, self)
+                                 psffwhms[n], avgNoise[n], maxNumberOfPeaks, self, psfCaches[n])
             self.deblendedParents[self.filters[n]] = dp
 
         # Group the peaks in each color
@@ -134,6 +161,12 @@ class DeblenderResult:
         self.blend = None
         self.failed = False
 
+        # Time spent in each plugin (`plugins.PluginStatistics`, by plugin name)
+        # and the high-water mark of the memory of the process after deblending
+        # (see `getProcessMaxRss`), filled in by `newDeblend`
+        self.pluginStatistics = OrderedDict()
+        self.maxRss = None
+
     def getParentProperty(self, propertyName):
         """Get the footprint in each filter"""
         return [getattr(dp, propertyName) for dp in self.deblendedParents]
@@ -152,8 +185,12 @@ class DeblendedParent:
     Convenience class to store useful objects used by the deblender for a single band,
     such as the maskedImage, psf, etc as well as the results from the deblender.
     """
+    __slots__ = ("filter", "fp", "maskedImage", "psf", "psfCache", "psffwhm", "img", "imbb", "varimg",
+                 "mask", "_avgNoise", "debResult", "peakCount", "templateSum", "peaks",
+                 "bb", "W", "H", "x0", "y0", "x1", "y1")
+
     def __init__(self, filterName, footprint, maskedImage, psf, psffwhm, avgNoise,
-                 maxNumberOfPeaks, debResult):
+                 maxNumberOfPeaks, debResult, psfCache=None):
         """Create a DeblendedParent to store a deblender result
 
         Parameters
@@ -168,10 +205,11 @@ class DeblendedParent:
             Psf of the ``maskedImage`` for each band.
         psffwhm: list of `float`s
             FWHM of the ``maskedImage``'s ``psf`` in each band.
-        avgNoise: `float`or list of `float`s, optional
-            Average noise level in each ``maskedImage``.
+        avgNoise: `float` or `NoiseModel`, optional
+            Average noise level in ``maskedImage``, or the noise model of the
+            exposure, which gives the noise level at the parent footprint.
             The default is ``None``, which estimates the noise from the median value of the
-            variance plane of ``maskedImage`` for each filter.
+            variance plane of ``maskedImage``.
         maxNumberOfPeaks: `int`, optional
             If positive, the maximum number of peaks to deblend.
             If the total number of peaks is greater than ``maxNumberOfPeaks``,
@@ -179,35 +217,44 @@ class DeblendedParent:
             The default is 0, which deblends all of the peaks.
         debResult: `DeblenderResult`
             The ``DeblenderResult`` that contains this ``DeblendedParent``.
+        psfCache: `CachingPsf`, optional
+            Cache of the images of ``psf``. If ``None`` a new cache is created.
         """
         self.filter = filterName
         self.fp = footprint
         self.maskedImage = maskedImage
         self.psf = psf
+        self.psfCache = CachingPsf(psf) if psfCache is None else psfCache
         self.psffwhm = psffwhm
         self.img = maskedImage.getImage()
         self.imbb = self.img.getBBox()
         self.varimg = maskedImage.getVariance()
         self.mask = maskedImage.getMask()
-        self.avgNoise = avgNoise
         self.updateFootprintBbox()
+        # If ``avgNoise`` is None it is only estimated when it is first used
+        if isinstance(avgNoise, NoiseModel):
+            avgNoise = avgNoise.computeSigma(self.bb)
+        self._avgNoise = avgNoise
         self.debResult = debResult
         self.peakCount = debResult.peakCount
         self.templateSum = None
 
-        # avgNoise is an estiamte of the average noise level for the image in this filter
-        if avgNoise is None:
-            stats = afwMath.makeStatistics(self.varimg, self.mask, afwMath.MEDIAN)
-            avgNoise = np.sqrt(stats.getValue(afwMath.MEDIAN))
-            debResult.log.trace('Estimated avgNoise for filter %s = %f', self.filter, avgNoise)
-        self.avgNoise = avgNoise
-
         # Store all of the peak information in a single object
-        self.peaks = []
         peaks = self.fp.getPeaks()
-        for idx in range(self.peakCount):
-            deblendedPeak = DeblendedPeak(peaks[idx], idx, self)
-            self.peaks.append(deblendedPeak)
+        self.peaks = [DeblendedPeak(peaks[idx], idx, self) for idx in range(self.peakCount)]
+
+    @property
+    def avgNoise(self):
+        """Estimate of the average noise level for the image in this filter
+
+        If it was not given when the `DeblendedParent` was created, it is
+        estimated from the median of the variance plane the first time it is used.
+        """
+        if self._avgNoise is None:
+            stats = afwMath.makeStatistics(self.varimg, self.mask, afwMath.MEDIAN)
+            self._avgNoise = np.sqrt(stats.getValue(afwMath.MEDIAN))
+            self.debResult.log.trace('Estimated avgNoise for filter %s = %f', self.filter, self._avgNoise)
+        return self._avgNoise
 
     def updateFootprintBbox(self):
         """Update the bounding box of the parent footprint
@@ -229,6 +276,7 @@ class MultiColorPeak:
 
     There is one of these objects for each Peak in the footprint.
     """
+    __slots__ = ("filters", "deblendedPeaks", "parent", "pki", "skip", "deblendedAsPsf", "x", "y")
 
     def __init__(self, peaks, pki, parent):
         """Create a collection for deblender results in each band.
@@ -267,7 +315,25 @@ class DeblendedPeak:
     """Result of deblending a single Peak within a parent Footprint.
 
     There is one of these objects for each Peak in the Footprint.
+
+    The attributes in ``_lazyAttributes`` (the results of the PSF fit,
+    its debugging outputs and the debugging copies of the template) are
+    only allocated when they are set, and are None until then.
     """
+    _lazyAttributes = frozenset([
+        "psfFit1", "psfFit2", "psfFit3", "psfFitR0", "psfFitR1", "psfFitStampExtent", "psfFitCenter",
+        "psfFitBest", "psfFitParams", "psfFitFlux", "psfFitNOthers",
+        "psfFitDebugPsf0Img", "psfFitDebugPsfImg", "psfFitDebugPsfDerivImg", "psfFitDebugPsfModel",
+        "psfFitDebugStamp", "psfFitDebugValidPix", "psfFitDebugVar", "psfFitDebugWeight",
+        "psfFitDebugRampWeight",
+        "origTemplate", "origFootprint", "rampedTemplate", "medianFilteredTemplate",
+        "psfTemplate", "psfFootprint",
+    ])
+    __slots__ = ("peak", "pki", "parent", "multiColorPeak", "skip", "outOfBounds", "tinyFootprint",
+                 "noValidPixels", "deblendedAsPsf", "degenerate", "psfFitFailed", "psfFitBadDof",
+                 "psfFitBigDecenter", "psfFitWithDecenter", "failedSymmetricTemplate",
+                 "templateImage", "templateFootprint", "fluxPortion", "strayFlux",
+                 "hasRampedTemplate", "patched", "templateWeight") + tuple(sorted(_lazyAttributes))
 
     def __init__(self, peak, pki, parent, multiColorPeak=None):
         """Initialize a new deblended peak in a single filter band
@@ -305,31 +371,14 @@ class DeblendedPeak:
         # Field set during _fitPsf:
         self.psfFitFailed = False
         self.psfFitBadDof = False
-        # (chisq, dof) for PSF fit without decenter
-        self.psfFit1 = None
-        # (chisq, dof) for PSF fit with decenter
-        self.psfFit2 = None
-        # (chisq, dof) for PSF fit after applying decenter
-        self.psfFit3 = None
         # decentered PSF fit wanted to move the center too much
         self.psfFitBigDecenter = False
         # was the fit with decenter better?
         self.psfFitWithDecenter = False
-        #
-        self.psfFitR0 = None
-        self.psfFitR1 = None
-        self.psfFitStampExtent = None
-        self.psfFitCenter = None
-        self.psfFitBest = None
-        self.psfFitParams = None
-        self.psfFitFlux = None
-        self.psfFitNOthers = None
-
-        # Things only set in _fitPsf when debugging is turned on:
-        self.psfFitDebugPsf0Img = None
-        self.psfFitDebugPsfImg = None
-        self.psfFitDebugPsfDerivImg = None
-        self.psfFitDebugPsfModel = None
+        # The other results of the fit (psfFit1: (chisq, dof) without decenter,
+        # psfFit2: with decenter, psfFit3: after applying decenter, psfFitR0, ...)
+        # and the things only set in _fitPsf when debugging is turned on
+        # (psfFitDebugPsf0Img, ...) are lazy attributes.
 
         self.failedSymmetricTemplate = False
 
@@ -347,17 +396,18 @@ class DeblendedPeak:
 
         self.patched = False
 
-        # debug -- a copy of the original symmetric template
-        self.origTemplate = None
-        self.origFootprint = None
-        # MaskedImage
-        self.rampedTemplate = None
-        # MaskedImage
-        self.medianFilteredTemplate = None
+        # The debugging copies of the templates (origTemplate, origFootprint,
+        # rampedTemplate, medianFilteredTemplate, ...) are lazy attributes.
 
         # when least-squares fitting templates, the template weight.
         self.templateWeight = 1.0
 
+    def __getattr__(self, name):
+        # Only called for attributes that have not been set
+        if name in DeblendedPeak._lazyAttributes:
+            return None
+        raise AttributeError("'DeblendedPeak' object has no attribute '%s'" % name)
+
     def __str__(self):
         return (('deblend result: outOfBounds: %s, deblendedAsPsf: %s') %
                 (self.outOfBounds, self.deblendedAsPsf))
@@ -372,6 +422,10 @@ class DeblendedPeak:
         chisq, dof = self.psfFitBest
         return dof
 
+    @property
+    def hasStrayFlux(self):
+        return self.strayFlux is not None
+
     def getFluxPortion(self, strayFlux=True):
         """!
         Return a HeavyFootprint containing the flux apportioned to this peak.
@@ -380,12 +434,18 @@ class DeblendedPeak:
         """
         if self.templateFootprint is None or self.fluxPortion is None:
             return None
-        heavy = afwDet.makeHeavyFootprint(self.templateFootprint, self.fluxPortion)
-        if strayFlux:
-            if self.strayFlux is not None:
-                heavy = afwDet.mergeHeavyFootprints(heavy, self.strayFlux)
+        if strayFlux and self.strayFlux is not None:
+            # Write the flux portion and the stray flux into a single HeavyFootprint
+            return bUtils.mergeFluxPortion(self.fluxPortion, self.templateFootprint, self.strayFlux)
+        return afwDet.makeHeavyFootprint(self.templateFootprint, self.fluxPortion)
 
-        return heavy
+    def getTemplateHeavy(self):
+        """!
+        Return a HeavyFootprint containing the template for this peak.
+        """
+        if self.templateFootprint is None:
+            return None
+        return afwDet.makeHeavyFootprint(self.templateFootprint, afwImage.MaskedImageF(self.templateImage))
 
     def setStrayFlux(self, stray):
         self.strayFlux = stray
@@ -400,20 +460,30 @@ class DeblendedPeak:
         self.patched = True
 
     # DEBUG
+    # The copies of the intermediate templates are only made if the
+    # `DeblenderResult` was created with ``saveDebugTemplates=True``.
+    @property
+    def _saveDebugTemplates(self):
+        return self.parent.debResult.saveDebugTemplates
+
     def setOrigTemplate(self, t, tfoot):
-        self.origTemplate = t.Factory(t, True)
+        if self._saveDebugTemplates:
+            self.origTemplate = t.Factory(t, True)
         self.origFootprint = tfoot
 
     def setRampedTemplate(self, t, tfoot):
         self.hasRampedTemplate = True
-        self.rampedTemplate = t.Factory(t, True)
+        if self._saveDebugTemplates:
+            self.rampedTemplate = t.Factory(t, True)
 
     def setMedianFilteredTemplate(self, t, tfoot):
-        self.medianFilteredTemplate = t.Factory(t, True)
+        if self._saveDebugTemplates:
+            self.medianFilteredTemplate = t.Factory(t, True)
 
     def setPsfTemplate(self, tim, tfoot):
-        self.psfFootprint = afwDet.Footprint(tfoot)
-        self.psfTemplate = tim.Factory(tim, True)
+        if self._saveDebugTemplates:
+            self.psfFootprint = afwDet.Footprint(tfoot)
+            self.psfTemplate = tim.Factory(tim, True)
 
     def setOutOfBounds(self):
         self.outOfBounds = True
@@ -453,8 +523,8 @@ def deblend(footprint, maskedImage, psf, psffwhm,
             assignStrayFlux=True, strayFluxToPointSources='necessary', strayFluxAssignment='r-to-peak',
             rampFluxAtEdge=False, patchEdges=False, tinyFootprintSize=2,
             getTemplateSum=False, clipStrayFluxFraction=0.001, clipFootprintToNonzero=True,
-            removeDegenerateTemplates=False, maxTempDotProd=0.5
-            ):
+            removeDegenerateTemplates=False, maxTempDotProd=0.5, psfCache=None,
+            monotonicAlgorithm='cone', saveDebugTemplates=True, nativeTemplates=False):
     """Deblend a parent ``Footprint`` in a ``MaskedImageF``.
 
     Deblending assumes that ``footprint`` has multiple peaks, as it will still create a
@@ -564,8 +634,9 @@ def deblend(footprint, maskedImage, psf, psffwhm,
     verbose: `bool`, optional
         Whether or not to show a more verbose output.
         The default is ``False``.
-    sigma1: `float`, optional
-        Average noise level in ``maskedImage``.
+    sigma1: `float` or `NoiseModel`, optional
+        Average noise level in ``maskedImage``, or the noise model of the
+        exposure, which can be shared by all of its parents.
         The default is ``None``, which estimates the noise from the median value of ``maskedImage``.
     maxNumberOfPeaks: `int`, optional
         If nonzero, the maximum number of peaks to deblend.
@@ -621,6 +692,26 @@ def deblend(footprint, maskedImage, psf, psffwhm,
         All dot products between templates greater than ``maxTempDotProduct`` will result in one
         of the templates removed. This parameter is only used when ``removeDegenerateTempaltes==True``.
         The default is 0.5.
+    psfCache: `CachingPsf`, optional
+        Cache of the images of ``psf``, which can be shared between parents.
+        The default is ``None``, which creates a new cache for this footprint.
+    monotonicAlgorithm: `string`, optional
+        Algorithm used to make the templates monotonic when ``monotonicTemplate==True``,
+        either 'cone' or 'radial' (see `plugins.makeTemplatesMonotonic`).
+        The default is 'cone'.
+    saveDebugTemplates: `bool`, optional
+        If True, keep a copy of the intermediate templates of each peak
+        (``origTemplate``, ``rampedTemplate``, ``medianFilteredTemplate`` and
+        ``psfTemplate``) in the result.  If False, only the final templates are
+        kept, which uses much less memory for large parents.
+        The default is True.
+    nativeTemplates: `bool`, optional
+        If True, the symmetric templates are built, ramped, median filtered,
+        made monotonic and clipped for all of the peaks with a single native call
+        (see `plugins.buildTemplates`), instead of running a plugin for each step.
+        The intermediate templates (other than ``psfTemplate``) are then not
+        kept, whatever the value of ``saveDebugTemplates``.
+        The default is False.
 
     Returns
     -------
@@ -630,6 +721,40 @@ def deblend(footprint, maskedImage, psf, psffwhm,
     """
     avgNoise = sigma1
 
+    debPlugins = makeDeblendPlugins(
+        psfChisqCut1=psfChisqCut1, psfChisqCut2=psfChisqCut2, psfChisqCut2b=psfChisqCut2b, fitPsfs=fitPsfs,
+        medianSmoothTemplate=medianSmoothTemplate, medianFilterHalfsize=medianFilterHalfsize,
+        monotonicTemplate=monotonicTemplate, weightTemplates=weightTemplates,
+        assignStrayFlux=assignStrayFlux, strayFluxToPointSources=strayFluxToPointSources,
+        strayFluxAssignment=strayFluxAssignment, rampFluxAtEdge=rampFluxAtEdge, patchEdges=patchEdges,
+        tinyFootprintSize=tinyFootprintSize, getTemplateSum=getTemplateSum,
+        clipStrayFluxFraction=clipStrayFluxFraction, clipFootprintToNonzero=clipFootprintToNonzero,
+        removeDegenerateTemplates=removeDegenerateTemplates, maxTempDotProd=maxTempDotProd,
+        monotonicAlgorithm=monotonicAlgorithm, nativeTemplates=nativeTemplates)
+
+    debResult = newDeblend(debPlugins, footprint, maskedImage, psf, psffwhm, log, verbose, avgNoise,
+                           psfCaches=psfCache, saveDebugTemplates=saveDebugTemplates)
+
+    return debResult
+
+
+def makeDeblendPlugins(psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.5, fitPsfs=True,
+                       medianSmoothTemplate=True, medianFilterHalfsize=2,
+                       monotonicTemplate=True, weightTemplates=False,
+                       assignStrayFlux=True, strayFluxToPointSources='necessary',
+                       strayFluxAssignment='r-to-peak', rampFluxAtEdge=False, patchEdges=False,
+                       tinyFootprintSize=2, getTemplateSum=False, clipStrayFluxFraction=0.001,
+                       clipFootprintToNonzero=True, removeDegenerateTemplates=False, maxTempDotProd=0.5,
+                       monotonicAlgorithm='cone', nativeTemplates=False):
+    """Create the plugins used by the old deblender API
+
+    See `deblend` for a description of the parameters.
+
+    Returns
+    -------
+    debPlugins: list of `meas.deblender.plugins.DeblenderPlugins`
+        Plugins to execute (in order of execution) with ``newDeblend``.
+    """
     debPlugins = []
 
     # Add activated deblender plugins
@@ -639,23 +764,34 @@ def deblend(footprint, maskedImage, psf, psffwhm,
                                                   psfChisqCut2=psfChisqCut2,
                                                   psfChisqCut2b=psfChisqCut2b,
                                                   tinyFootprintSize=tinyFootprintSize))
-    debPlugins.append(plugins.DeblenderPlugin(plugins.buildSymmetricTemplates, patchEdges=patchEdges))
-    if rampFluxAtEdge:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.rampFluxAtEdge, patchEdges=patchEdges))
-    if medianSmoothTemplate:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.medianSmoothTemplates,
-                                                  medianFilterHalfsize=medianFilterHalfsize))
-    if monotonicTemplate:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.makeTemplatesMonotonic))
-    if clipFootprintToNonzero:
-        debPlugins.append(plugins.DeblenderPlugin(plugins.clipFootprintsToNonzero))
+    if nativeTemplates:
+        # All of the template steps are run by a single plugin
+        debPlugins.append(plugins.DeblenderPlugin(
+            plugins.buildTemplates, patchEdges=patchEdges, rampFluxAtEdge=rampFluxAtEdge,
+            medianFilterHalfsize=medianFilterHalfsize if medianSmoothTemplate else None,
+            monotonicAlgorithm=monotonicAlgorithm if monotonicTemplate else None,
+            clipFootprintToNonzero=clipFootprintToNonzero))
+    else:
+        debPlugins.append(plugins.DeblenderPlugin(plugins.buildSymmetricTemplates, patchEdges=patchEdges))
+        if rampFluxAtEdge:
+            debPlugins.append(plugins.DeblenderPlugin(plugins.rampFluxAtEdge, patchEdges=patchEdges))
+        if medianSmoothTemplate:
+            debPlugins.append(plugins.DeblenderPlugin(plugins.medianSmoothTemplates,
+                                                      medianFilterHalfsize=medianFilterHalfsize))
+        if monotonicTemplate:
+            debPlugins.append(plugins.DeblenderPlugin(plugins.makeTemplatesMonotonic,
+                                                      monotonicAlgorithm=monotonicAlgorithm))
+        if clipFootprintToNonzero:
+            debPlugins.append(plugins.DeblenderPlugin(plugins.clipFootprintsToNonzero))
     if weightTemplates:
         debPlugins.append(plugins.DeblenderPlugin(plugins.weightTemplates))
     if removeDegenerateTemplates:
+        # All of the degenerate templates are removed in a single pass,
+        # so only the template weights need to be recalculated
         if weightTemplates:
             onReset = len(debPlugins)-1
         else:
-            onReset = len(debPlugins)
+            onReset = None
         debPlugins.append(plugins.DeblenderPlugin(plugins.reconstructTemplates,
                                                   onReset=onReset,
                                                   maxTempDotProd=maxTempDotProd))
@@ -666,13 +802,12 @@ def deblend(footprint, maskedImage, psf, psffwhm,
                                               strayFluxToPointSources=strayFluxToPointSources,
                                               getTemplateSum=getTemplateSum))
 
-    debResult = newDeblend(debPlugins, footprint, maskedImage, psf, psffwhm, log, verbose, avgNoise)
-
-    return debResult
+    return debPlugins
 
 
 def newDeblend(debPlugins, footprint, mMaskedImage, psfs, psfFwhms,
-               log=None, verbose=False, avgNoise=None, maxNumberOfPeaks=0):
+               log=None, verbose=False, avgNoise=None, maxNumberOfPeaks=0, numThreads=1, psfCaches=None,
+               saveDebugTemplates=True):
     """Deblend a parent ``Footprint`` in a ``MaskedImageF``.
 
     Deblending assumes that ``footprint`` has multiple peaks, as it will still create a
@@ -702,13 +837,26 @@ def newDeblend(debPlugins, footprint, mMaskedImage, psfs, psfFwhms,
         Whether or not to show a more verbose output.
         The default is ``False``.
     avgNoise: `float`or list of `float`s, optional
-        Average noise level in each ``maskedImage``.
+        Average noise level in each ``maskedImage``, or the `NoiseModel`
+        of the exposure in each band.
         The default is ``None``, which estimates the noise from the median value of the
         variance plane of ``maskedImage`` for each filter.
     maxNumberOfPeaks: `int`, optional
         If nonzero, the maximum number of peaks to deblend.
         If the total number of peaks is greater than ``maxNumberOfPeaks``,
         then only the first ``maxNumberOfPeaks`` sources are deblended.
+    numThreads: `int`, optional
+        Maximum number of threads used to run the plugins on each band in parallel.
+        The plugins release the GIL in the C++ and numpy routines that do most of the work,
+        so this speeds up the deblending of multiband images.
+        The default is 1, which processes the bands serially.
+    psfCaches: `CachingPsf` or list of `CachingPsf`s, optional
+        Cache of the PSF model images in each band, which can be shared between parents.
+        The default is ``None``, which creates a new cache for each band.
+    saveDebugTemplates: `bool`, optional
+        If True, keep a copy of the intermediate templates of each peak
+        in the result (see `DeblenderResult`).
+        The default is True.
 
     Returns
     -------
@@ -729,7 +877,9 @@ def newDeblend(debPlugins, footprint, mMaskedImage, psfs, psfFwhms,
 
     # get object that will hold our results
     debResult = DeblenderResult(footprint, mMaskedImage, psfs, psfFwhms, log,
-                                maxNumberOfPeaks=maxNumberOfPeaks, avgNoise=avgNoise)
+                                maxNumberOfPeaks=maxNumberOfPeaks, avgNoise=avgNoise,
+                                numThreads=numThreads, psfCaches=psfCaches,
+                                saveDebugTemplates=saveDebugTemplates)
 
     step = 0
     while step < len(debPlugins):
@@ -737,18 +887,47 @@ def newDeblend(debPlugins, footprint, mMaskedImage, psfs, psfFwhms,
         # the result is flagged as `failed`
         # and the remaining steps are skipped
         if not debResult.failed:
+            t0 = time.time()
             reset = debPlugins[step].run(debResult, log)
+            _updatePluginStatistics(debResult, debPlugins[step], time.time() - t0, reset)
         else:
             log.warn("Skipping steps {0}".format(debPlugins[step:]))
-            return debResult
+            break
         if reset:
             step = debPlugins[step].onReset
         else:
             step += 1
 
+    debResult.maxRss = getProcessMaxRss()
     return debResult
 
 
+def _updatePluginStatistics(debResult, plugin, runtime, reset):
+    """Add a call to ``plugin`` to the statistics in ``debResult``"""
+    name = plugin.func.__name__
+    stats = debResult.pluginStatistics.get(name)
+    if stats is None:
+        stats = debResult.pluginStatistics[name] = plugins.PluginStatistics(name)
+    stats.time += runtime
+    stats.calls += 1
+    if reset:
+        stats.resets += 1
+
+
+def getProcessMaxRss():
+    """Return the high-water mark of the resident memory of the current process, in MiB
+
+    This is the largest memory used by the process since it started, not the
+    memory used to deblend the current parent: every parent deblended after
+    the largest one reports the same value.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kiB elsewhere
+    if sys.platform == "darwin":
+        return maxrss/2**20
+    return maxrss/2**10
+
+
 class CachingPsf:
     """Cache the PSF models
 
@@ -756,19 +935,298 @@ class CachingPsf:
     the one being fit.  This was turning out to be quite expensive in
     some cases.  Here, we cache the PSF models to bring the cost down
     closer to O(N) rather than O(N^2).
+
+    The deblender tasks keep a single cache for each PSF and share it
+    between all of the parents in an exposure, so the cache is bounded:
+    when the cached images use more than ``maxBytes`` the least recently
+    used images are discarded.
+
+    Parameters
+    ----------
+    psf: `afw.detection.Psf`
+        PSF model to evaluate.
+    tolerance: `float`, optional
+        If positive, positions are rounded to the nearest multiple of
+        ``tolerance`` (in pixels) and the PSF is evaluated at the rounded
+        position, so that nearby requests share a single image.
+        The default is 0, which only reuses an image if the position
+        is exactly the same.
+    maxBytes: `int`, optional
+        Maximum number of bytes used by the cached images,
+        or 0 (the default) for no limit.
+
+    Notes
+    -----
+    The images returned by `computeImage` are shared with the cache and
+    must not be modified by the caller.
     """
 
-    def __init__(self, psf):
-        self.cache = {}
+    def __init__(self, psf, tolerance=0., maxBytes=0):
+        self.cache = OrderedDict()
         self.psf = psf
-
-    def computeImage(self, cx, cy):
-        im = self.cache.get((cx, cy), None)
-        if im is not None:
-            return im
+        self.tolerance = tolerance
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Keys of the images that are the PSF at the default position,
+        # because the PSF could not be evaluated at the requested position
+        self._fallbacks = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def computeImage(self, cx, cy, fallback=True):
+        """Return the PSF model image centered on ``(cx, cy)``
+
+        If the PSF cannot be evaluated at ``(cx, cy)`` the image at the
+        default position of the PSF is returned, unless ``fallback``
+        is ``False``, in which case the exception is raised.
+        """
+        if self.tolerance > 0:
+            key = (int(round(cx/self.tolerance)), int(round(cy/self.tolerance)))
+            cx, cy = key[0]*self.tolerance, key[1]*self.tolerance
+        else:
+            key = (cx, cy)
+        with self._lock:
+            im = self.cache.get(key, None)
+            if im is not None and (fallback or key not in self._fallbacks):
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return im
+            self.misses += 1
+        isFallback = False
         try:
             im = self.psf.computeImage(afwGeom.Point2D(cx, cy))
         except lsst.pex.exceptions.Exception:
+            if not fallback:
+                raise
             im = self.psf.computeImage()
-        self.cache[(cx, cy)] = im
+            isFallback = True
+        with self._lock:
+            if key not in self.cache:
+                self.cache[key] = im
+                self.nbytes += im.getArray().nbytes
+                if isFallback:
+                    self._fallbacks.add(key)
+                # Always keep the newest image, even if it is larger than the limit
+                while self.maxBytes > 0 and self.nbytes > self.maxBytes and len(self.cache) > 1:
+                    oldKey, old = self.cache.popitem(last=False)
+                    self.nbytes -= old.getArray().nbytes
+                    self._fallbacks.discard(oldKey)
         return im
+
+    def clear(self):
+        """Remove all of the images from the cache and reset the counters
+        """
+        with self._lock:
+            self.cache.clear()
+            self._fallbacks.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+class PsfPropertyMap:
+    """Properties of a PSF model on a coarse grid over an exposure
+
+    Evaluating the shape of a PSF model (in particular a ``CoaddPsf``)
+    is expensive, so the deblender tasks evaluate it at the nodes of a grid
+    that covers the exposure, the first time that each node is needed,
+    and interpolate between the nodes to obtain the PSF properties of
+    each parent.
+
+    Parameters
+    ----------
+    psf: `afw.detection.Psf`
+        PSF model of the exposure.
+    bbox: `afw.geom.Box2I`
+        Bounding box of the exposure.
+    gridSize: `int`, optional
+        Approximate spacing between the grid nodes, in pixels.
+        If ``gridSize <= 0`` the properties of the PSF at its default
+        position are used everywhere.
+    """
+
+    def __init__(self, psf, bbox, gridSize=512):
+        self.psf = psf
+        self.bbox = afwGeom.Box2I(bbox)
+        self.gridSize = gridSize
+        if gridSize > 0:
+            nx = max(2, int(np.ceil(bbox.getWidth()/gridSize)) + 1)
+            ny = max(2, int(np.ceil(bbox.getHeight()/gridSize)) + 1)
+            self.xNodes = np.linspace(bbox.getMinX(), bbox.getMaxX(), nx)
+            self.yNodes = np.linspace(bbox.getMinY(), bbox.getMaxY(), ny)
+        else:
+            self.xNodes = self.yNodes = None
+        # Properties of each node that has been evaluated, as
+        # ``(fwhm, ixx, iyy, ixy)``, and kernel images of each node
+        self._nodes = {}
+        self._kernels = {}
+
+    def _getPosition(self, i, j):
+        if self.xNodes is None:
+            return None
+        return afwGeom.Point2D(self.xNodes[i], self.yNodes[j])
+
+    def _getNode(self, i, j):
+        node = self._nodes.get((i, j))
+        if node is None:
+            position = self._getPosition(i, j)
+            try:
+                shape = self.psf.computeShape() if position is None else self.psf.computeShape(position)
+            except lsst.pex.exceptions.Exception:
+                shape = self.psf.computeShape()
+            node = (shape.getDeterminantRadius()*2.35, shape.getIxx(), shape.getIyy(), shape.getIxy())
+            self._nodes[(i, j)] = node
+        return node
+
+    def _locate(self, nodes, x):
+        """Find the cell of the grid that contains ``x`` and the
+        fractional position of ``x`` in the cell
+        """
+        i = int(np.clip(np.searchsorted(nodes, x) - 1, 0, len(nodes) - 2))
+        t = (x - nodes[i])/(nodes[i + 1] - nodes[i])
+        return i, min(max(t, 0.), 1.)
+
+    def _interpolate(self, position):
+        """Bilinear interpolation of the node properties at ``position``
+        """
+        if self.xNodes is None:
+            return np.array(self._getNode(0, 0))
+        i, tx = self._locate(self.xNodes, position.getX())
+        j, ty = self._locate(self.yNodes, position.getY())
+        v00 = np.array(self._getNode(i, j))
+        v10 = np.array(self._getNode(i + 1, j))
+        v01 = np.array(self._getNode(i, j + 1))
+        v11 = np.array(self._getNode(i + 1, j + 1))
+        # Written as differences so that a constant PSF gives exactly the node values
+        v0 = v00 + tx*(v10 - v00)
+        v1 = v01 + tx*(v11 - v01)
+        return v0 + ty*(v1 - v0)
+
+    def computeFwhm(self, position):
+        """FWHM of the PSF at ``position`` (`afw.geom.Point2D`), in pixels
+        """
+        return float(self._interpolate(position)[0])
+
+    def computeShape(self, position):
+        """Second moments of the PSF at ``position``
+
+        Returns
+        -------
+        shape: `afw.geom.ellipses.Quadrupole`
+            Interpolated second moments of the PSF.
+        """
+        _, ixx, iyy, ixy = self._interpolate(position)
+        return afwEll.Quadrupole(ixx, iyy, ixy)
+
+    def computeKernelImage(self, position):
+        """Kernel image of the PSF at the grid node nearest to ``position``
+        """
+        if self.xNodes is None:
+            i = j = 0
+        else:
+            i = int(np.argmin(np.abs(self.xNodes - position.getX())))
+            j = int(np.argmin(np.abs(self.yNodes - position.getY())))
+        kernel = self._kernels.get((i, j))
+        if kernel is None:
+            nodePosition = self._getPosition(i, j)
+            try:
+                if nodePosition is None:
+                    kernel = self.psf.computeKernelImage()
+                else:
+                    kernel = self.psf.computeKernelImage(nodePosition)
+            except lsst.pex.exceptions.Exception:
+                kernel = self.psf.computeKernelImage()
+            self._kernels[(i, j)] = kernel
+        return kernel
+
+
+class NoiseModel:
+    """Noise level of an exposure, measured once and shared by all of its parents
+
+    The median of the variance plane is measured over the whole exposure,
+    and optionally in the cells of a coarse grid, so that each parent
+    can use the local noise level (interpolated between the centers of
+    the cells) without computing statistics on its own sub-image.
+
+    Parameters
+    ----------
+    maskedImage: `afw.image.MaskedImageF`
+        Masked image of the exposure.
+    maskPlanes: list of `str`, optional
+        Mask planes of the pixels that are ignored when measuring the noise.
+    gridSize: `int`, optional
+        Approximate size of the cells of the grid, in pixels.
+        If ``gridSize <= 0`` (the default) the median noise of the
+        exposure is used for every parent.
+    """
+
+    def __init__(self, maskedImage, maskPlanes=(), gridSize=0):
+        mask = maskedImage.getMask()
+        andMask = mask.getPlaneBitMask(maskPlanes) if maskPlanes else 0
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setAndMask(andMask)
+        stats = afwMath.makeStatistics(maskedImage.getVariance(), mask, afwMath.MEDIAN, statsCtrl)
+        self.sigma = float(np.sqrt(stats.getValue(afwMath.MEDIAN)))
+        self.bbox = afwGeom.Box2I(maskedImage.getBBox())
+        self.gridSize = gridSize
+        self.xNodes = self.yNodes = self.sigmaGrid = None
+        if gridSize > 0:
+            self._measureGrid(maskedImage, andMask)
+
+    def _measureGrid(self, maskedImage, andMask):
+        """Measure the median noise in each cell of the grid
+        """
+        variance = maskedImage.getVariance().getArray()
+        good = (maskedImage.getMask().getArray() & andMask) == 0
+        height, width = variance.shape
+        xEdges = np.linspace(0, width, max(1, int(round(width/self.gridSize))) + 1).astype(int)
+        yEdges = np.linspace(0, height, max(1, int(round(height/self.gridSize))) + 1).astype(int)
+        self.sigmaGrid = np.empty((len(yEdges) - 1, len(xEdges) - 1))
+        for j in range(len(yEdges) - 1):
+            for i in range(len(xEdges) - 1):
+                cell = np.s_[yEdges[j]:yEdges[j + 1], xEdges[i]:xEdges[i + 1]]
+                values = variance[cell][good[cell]]
+                values = values[np.isfinite(values)]
+                # Cells without any valid pixels use the noise of the exposure
+                self.sigmaGrid[j, i] = np.sqrt(np.median(values)) if len(values) > 0 else self.sigma
+        self.xNodes = self.bbox.getMinX() + 0.5*(xEdges[:-1] + xEdges[1:]) - 0.5
+        self.yNodes = self.bbox.getMinY() + 0.5*(yEdges[:-1] + yEdges[1:]) - 0.5
+
+    @staticmethod
+    def _locate(nodes, x):
+        """Find the interval between ``nodes`` that contains ``x`` and the
+        fractional position of ``x`` in the interval
+        """
+        if len(nodes) == 1:
+            return 0, 0, 0.
+        i = int(np.clip(np.searchsorted(nodes, x) - 1, 0, len(nodes) - 2))
+        t = (x - nodes[i])/(nodes[i + 1] - nodes[i])
+        return i, i + 1, min(max(t, 0.), 1.)
+
+    def computeSigma(self, bbox=None):
+        """Noise level of a parent
+
+        Parameters
+        ----------
+        bbox: `afw.geom.Box2I`, optional
+            Bounding box of the parent footprint.
+
+        Returns
+        -------
+        sigma: `float`
+            Noise level interpolated from the grid at the center of ``bbox``,
+            or the noise level of the exposure if there is no grid or
+            ``bbox`` is None.
+        """
+        if self.sigmaGrid is None or bbox is None:
+            return self.sigma
+        center = afwGeom.Box2D(bbox).getCenter()
+        i0, i1, tx = self._locate(self.xNodes, center.getX())
+        j0, j1, ty = self._locate(self.yNodes, center.getY())
+        s0 = self.sigmaGrid[j0, i0] + tx*(self.sigmaGrid[j0, i1] - self.sigmaGrid[j0, i0])
+        s1 = self.sigmaGrid[j1, i0] + tx*(self.sigmaGrid[j1, i1] - self.sigmaGrid[j1, i0])
+        return float(s0 + ty*(s1 - s0))
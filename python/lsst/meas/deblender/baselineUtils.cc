@@ -47,7 +47,10 @@ void declareBaselineUtils(py::module& mod, const std::string& suffix) {
     using Class = BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>;
 
     py::class_<Class, std::shared_ptr<Class>> cls(mod, ("BaselineUtils" + suffix).c_str());
-    cls.def_static("symmetrizeFootprint", &Class::symmetrizeFootprint, "foot"_a, "cx"_a, "cy"_a);
+    // The deblender plugins may call these functions from several threads (one per band),
+    // so the GIL is released while the C++ code is running.
+    cls.def_static("symmetrizeFootprint", &Class::symmetrizeFootprint, "foot"_a, "cx"_a, "cy"_a,
+                   py::call_guard<py::gil_scoped_release>());
     // The C++ function returns a std::pair return value but also takes a referenced boolean
     // (patchedEdges) that is modified by the function and used by the python API,
     // so we wrap this in a lambda to combine the std::pair and patchedEdges in a tuple
@@ -59,11 +62,35 @@ void declareBaselineUtils(py::module& mod, const std::string& suffix) {
         bool patchedEdges;
         std::pair<ImagePtrT, FootprintPtrT> result;
 
-        result = Class::buildSymmetricTemplate(img, foot, pk, sigma1, minZero, patchEdges, &patchedEdges);
+        {
+            py::gil_scoped_release release;
+            result = Class::buildSymmetricTemplate(img, foot, pk, sigma1, minZero, patchEdges,
+                                                   &patchedEdges);
+        }
         return py::make_tuple(result.first, result.second, patchedEdges);
     });
-    cls.def_static("medianFilter", &Class::medianFilter, "img"_a, "outimg"_a, "halfsize"_a);
-    cls.def_static("makeMonotonic", &Class::makeMonotonic, "img"_a, "pk"_a);
+    // As for apportionFlux, the output vectors of buildSymmetricTemplates are created in the lambda
+    // and included in the return value.
+    cls.def_static("buildSymmetricTemplates", [](MaskedImageT const& img,
+                                                 lsst::afw::detection::Footprint const& foot,
+                                                 std::vector<int> const& peakIndices, bool minZero,
+                                                 bool patchEdges, double denseFraction) {
+        std::vector<ImagePtrT> templates;
+        std::vector<FootprintPtrT> tfoots;
+        std::vector<int> status;
+        {
+            py::gil_scoped_release release;
+            status = Class::buildSymmetricTemplates(img, foot, peakIndices, minZero, patchEdges, templates,
+                                                    tfoots, denseFraction);
+        }
+        return py::make_tuple(templates, tfoots, status);
+    }, "img"_a, "foot"_a, "peakIndices"_a, "minZero"_a, "patchEdges"_a, "denseFraction"_a = 0.5);
+    cls.def_static("medianFilter", &Class::medianFilter, "img"_a, "outimg"_a, "halfsize"_a,
+                   py::call_guard<py::gil_scoped_release>());
+    cls.def_static("makeMonotonic", &Class::makeMonotonic, "img"_a, "pk"_a,
+                   py::call_guard<py::gil_scoped_release>());
+    cls.def_static("makeMonotonicRadial", &Class::makeMonotonicRadial, "img"_a, "pk"_a,
+                   py::call_guard<py::gil_scoped_release>());
     // apportionFlux expects an empty vector containing HeavyFootprint pointers that is modified
     // in the function. But when a list is passed to pybind11 in place of the vector,
     // the changes are not passed back to python. So instead we create the vector in this lambda and
@@ -82,15 +109,40 @@ void declareBaselineUtils(py::module& mod, const std::string& suffix) {
         std::vector<std::shared_ptr<lsst::afw::image::MaskedImage<ImagePixelT, MaskPixelT, VariancePixelT>>>
                 result;
         HeavyFootprintPtrList strays;
-        result = Class::apportionFlux(img, foot, templates, templ_footprints, templ_sum, ispsf, pkx, pky,
-                                      strays, strayFluxOptions, clipStrayFluxFraction);
+        {
+            py::gil_scoped_release release;
+            result = Class::apportionFlux(img, foot, templates, templ_footprints, templ_sum, ispsf, pkx, pky,
+                                          strays, strayFluxOptions, clipStrayFluxFraction);
+        }
 
         return py::make_tuple(result, strays);
     });
+    cls.def_static("mergeFluxPortion", &Class::mergeFluxPortion, "portion"_a, "tfoot"_a, "stray"_a,
+                   py::call_guard<py::gil_scoped_release>());
     cls.def_static("hasSignificantFluxAtEdge", &Class::hasSignificantFluxAtEdge, "img"_a, "sfoot"_a,
-                   "thresh"_a);
+                   "thresh"_a, py::call_guard<py::gil_scoped_release>());
     cls.def_static("getSignificantEdgePixels", &Class::getSignificantEdgePixels, "img"_a, "sfoot"_a,
-                   "thresh"_a);
+                   "thresh"_a, py::call_guard<py::gil_scoped_release>());
+    cls.def_static("rampEdgePixels", &Class::rampEdgePixels, "img"_a, "edgepix"_a, "psf"_a, "cx"_a, "cy"_a,
+                   "radius"_a, "ramped"_a, py::call_guard<py::gil_scoped_release>());
+    // The output vectors of buildTemplates are also returned to python.
+    cls.def_static("buildTemplates", [](MaskedImageT const& img, lsst::afw::detection::Footprint const& foot,
+                                        std::vector<int> const& peakIndices, double sigma1, bool patchEdges,
+                                        int rampRadius, std::shared_ptr<lsst::afw::image::Image<double>> psf,
+                                        int psfX, int psfY, int medianFilterHalfsize, int monotonicOptions,
+                                        bool clipToNonzero) {
+        std::vector<ImagePtrT> templates;
+        std::vector<FootprintPtrT> tfoots;
+        std::vector<int> status;
+        {
+            py::gil_scoped_release release;
+            status = Class::buildTemplates(img, foot, peakIndices, sigma1, patchEdges, rampRadius, psf, psfX,
+                                           psfY, medianFilterHalfsize, monotonicOptions, clipToNonzero,
+                                           templates, tfoots);
+        }
+        return py::make_tuple(templates, tfoots, status);
+    }, "img"_a, "foot"_a, "peakIndices"_a, "sigma1"_a, "patchEdges"_a, "rampRadius"_a, "psf"_a, "psfX"_a,
+       "psfY"_a, "medianFilterHalfsize"_a, "monotonicOptions"_a, "clipToNonzero"_a);
     // There appears to be an issue binding to a static const member of a templated type, so for now
     // we just use the values constants
     cls.attr("ASSIGN_STRAYFLUX") = py::cast(Class::ASSIGN_STRAYFLUX);
@@ -100,6 +152,13 @@ void declareBaselineUtils(py::module& mod, const std::string& suffix) {
     cls.attr("STRAYFLUX_R_TO_FOOTPRINT") = py::cast(Class::STRAYFLUX_R_TO_FOOTPRINT);
     cls.attr("STRAYFLUX_NEAREST_FOOTPRINT") = py::cast(Class::STRAYFLUX_NEAREST_FOOTPRINT);
     cls.attr("STRAYFLUX_TRIM") = py::cast(Class::STRAYFLUX_TRIM);
+    cls.attr("MONOTONIC_CONE") = py::cast(Class::MONOTONIC_CONE);
+    cls.attr("MONOTONIC_RADIAL") = py::cast(Class::MONOTONIC_RADIAL);
+    cls.attr("TEMPLATE_OUT_OF_BOUNDS") = py::cast(Class::TEMPLATE_OUT_OF_BOUNDS);
+    cls.attr("TEMPLATE_FAILED_SYMMETRIC") = py::cast(Class::TEMPLATE_FAILED_SYMMETRIC);
+    cls.attr("TEMPLATE_PATCHED") = py::cast(Class::TEMPLATE_PATCHED);
+    cls.attr("TEMPLATE_RAMPED") = py::cast(Class::TEMPLATE_RAMPED);
+    cls.attr("TEMPLATE_NO_PSF") = py::cast(Class::TEMPLATE_NO_PSF);
 };
 
 }  // <anonymous>
@@ -0,0 +1,189 @@
+# This file is part of meas_deblender.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""On-disk cache of the deblender results
+
+When a patch is reprocessed, most of its parents have the same pixels,
+peaks and PSF as in the previous run.  The deblender tasks can store the
+result of each parent (a `DeblendedParentPayload` or
+`DeblenderResultPayload`) in a `ResultCache`, keyed on a hash of all of
+the inputs of the deblender (see `makeResultKey`), and restore it instead
+of deblending the parent again.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+from .payload import spansToArray, _recordToTuple
+
+__all__ = ["makeResultKey", "ResultCache"]
+
+# Changed whenever the inputs of the key or the cached payloads change,
+# so that the results of an older version are not restored
+_KEY_VERSION = b"meas_deblender-result-1"
+
+
+def makeResultKey(footprint, maskedImages, psfImages, parameters=()):
+    """Hash the inputs of the deblender for a parent
+
+    Parameters
+    ----------
+    footprint: `afw.detection.Footprint`
+        Parent footprint, before it is deblended.
+    maskedImages: list of `afw.image.MaskedImageF`
+        Pixels used to deblend the parent, in each band.
+    psfImages: list of `afw.image.Image`
+        PSF model image of the parent in each band.
+    parameters: `tuple`, optional
+        Any other values (configuration, PSF FWHM, noise level, ...)
+        that change the result.  They are hashed with `repr`.
+
+    Returns
+    -------
+    key: `str`
+        Hexadecimal SHA-256 digest of the inputs.
+    """
+    h = hashlib.sha256(_KEY_VERSION)
+    h.update(spansToArray(footprint.getSpans()).tobytes())
+    h.update(repr([_recordToTuple(pk) for pk in footprint.getPeaks()]).encode())
+    for mi in maskedImages:
+        bbox = mi.getBBox()
+        h.update(repr((bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight())).encode())
+        h.update(repr(sorted(mi.getMask().getMaskPlaneDict().items())).encode())
+        for arr in (mi.getImage().getArray(), mi.getMask().getArray(), mi.getVariance().getArray()):
+            h.update(np.ascontiguousarray(arr).tobytes())
+    for im in psfImages:
+        h.update(repr(im.getArray().shape).encode())
+        h.update(np.ascontiguousarray(im.getArray()).tobytes())
+    h.update(repr(parameters).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Size-bounded on-disk cache of the deblender results
+
+    Each result is pickled to ``<key>.pickle`` in ``directory``.
+    The cache can be shared by several processes, and it persists
+    between runs: the results already in ``directory`` are used when the
+    cache is created.  When the results use more than ``maxBytes``, the
+    least recently used results are removed.
+
+    Parameters
+    ----------
+    directory: `str`
+        Directory of the cache; it is created if it does not exist.
+    maxBytes: `int`, optional
+        Maximum number of bytes used by the cached results,
+        or 0 (the default) for no limit.
+    """
+
+    def __init__(self, directory, maxBytes=0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Size of each result, least recently used first
+        self._entries = OrderedDict()
+        found = []
+        for name in os.listdir(directory):
+            if name.endswith(".pickle"):
+                stat = os.stat(os.path.join(directory, name))
+                found.append((stat.st_mtime, name[:-len(".pickle")], stat.st_size))
+        for mtime, key, size in sorted(found):
+            self._entries[key] = size
+        self.nbytes = sum(self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hitRate(self):
+        """Fraction of the calls to `get` that found a result"""
+        calls = self.hits + self.misses
+        return self.hits/calls if calls > 0 else 0.
+
+    def _getPath(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """Return the result stored with ``key``, or None if there is none
+        """
+        path = self._getPath(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            # The modification time orders the results when the cache is reopened
+            os.utime(path)
+        except FileNotFoundError:
+            self._forget(key)
+            self.misses += 1
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # A result written by an incompatible version
+            self._remove(key)
+            self.misses += 1
+            return None
+        if key not in self._entries:
+            # Written by another process
+            self._entries[key] = os.path.getsize(path)
+            self.nbytes += self._entries[key]
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Store ``result`` with ``key``, removing the least recently used
+        results if the cache is full
+        """
+        fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            # Readers in other processes never see a partially written result
+            os.replace(tmpPath, self._getPath(key))
+        except Exception:
+            os.remove(tmpPath)
+            raise
+        self._forget(key)
+        self._entries[key] = os.path.getsize(self._getPath(key))
+        self.nbytes += self._entries[key]
+        # Always keep the newest result, even if it is larger than the limit
+        while self.maxBytes > 0 and self.nbytes > self.maxBytes and len(self._entries) > 1:
+            oldKey = next(iter(self._entries))
+            self._remove(oldKey)
+            self.evictions += 1
+
+    def _forget(self, key):
+        self.nbytes -= self._entries.pop(key, 0)
+
+    def _remove(self, key):
+        self._forget(key)
+        try:
+            os.remove(self._getPath(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,167 @@
+# This file is part of meas_deblender.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Checkpoints of long deblender runs
+
+A patch with many parents can take hours to deblend, and all of the work
+is lost if the process is stopped before the output catalogs are
+returned.  The deblender tasks can periodically append the results of the
+parents that they have deblended to a `DeblendCheckpoint` file and, when
+the task is run again on the same patch, restore those results instead of
+deblending the parents again.
+"""
+
+from collections import OrderedDict
+import os
+import pickle
+import time
+
+__all__ = ["DeblendCheckpoint"]
+
+# Changed whenever the format of the file or the checkpointed payloads change
+_CHECKPOINT_VERSION = "meas_deblender-checkpoint-1"
+
+
+class DeblendCheckpoint:
+    """Append-only file of the results of the parents deblended by a task
+
+    The file is a sequence of pickles: a header, followed by one
+    ``{parentId: result}`` dict each time the checkpoint is flushed.
+    Each flush is synced to disk, and a flush that was interrupted
+    (for example when the node running the task is preempted) is
+    discarded when the file is read, so the file always contains the
+    results of complete parents.
+
+    Parameters
+    ----------
+    filename: `str`
+        Name of the checkpoint file.
+    header: `tuple`
+        Description of the run (configuration, filters, ...).  The results
+        in an existing file are only restored if it was written with an
+        equal header.
+    interval: `float`, optional
+        Minimum time (in seconds) between two flushes of the results
+        added with `add`.  0 flushes the file after each parent.
+    resume: `bool`, optional
+        Restore the results in an existing file (see `get`).  If False,
+        or if the header of the file is different, the file is replaced.
+    """
+
+    def __init__(self, filename, header, interval=300., resume=False):
+        self.filename = filename
+        self.header = (_CHECKPOINT_VERSION,) + tuple(header)
+        self.interval = interval
+        self.restored = 0
+        # Results read from the file that have not been restored yet
+        self._results = {}
+        # Ids of all of the parents in the file
+        self._ids = set()
+        self._pending = OrderedDict()
+        if not resume or not self._read():
+            self._create()
+        self._lastFlush = time.time()
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending)
+
+    def __contains__(self, parentId):
+        return parentId in self._ids or parentId in self._pending
+
+    def _read(self):
+        """Read the results in an existing file
+
+        Returns
+        -------
+        valid: `bool`
+            True if the file exists and was written with the same header.
+        """
+        if not os.path.exists(self.filename):
+            return False
+        results = {}
+        with open(self.filename, "r+b") as f:
+            try:
+                header = pickle.load(f)
+            except Exception:
+                return False
+            if header != self.header:
+                return False
+            end = f.tell()
+            while True:
+                try:
+                    results.update(pickle.load(f))
+                except Exception:
+                    # The end of the file, or a flush that was interrupted
+                    # (which raises EOFError if it was cut early enough)
+                    break
+                end = f.tell()
+            if end != os.fstat(f.fileno()).st_size:
+                # The last flush was interrupted: remove it, so that the
+                # next results are appended after the last complete flush
+                f.truncate(end)
+        self._results = results
+        self._ids = set(results)
+        return True
+
+    def _create(self):
+        """Replace the file with an empty checkpoint"""
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmpName = self.filename + ".tmp"
+        with open(tmpName, "wb") as f:
+            pickle.dump(self.header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpName, self.filename)
+        self._results = {}
+        self._ids = set()
+
+    def get(self, parentId):
+        """Return the checkpointed result of a parent, or None if there is none
+
+        Each result is only kept in memory until it has been restored.
+        """
+        result = self._results.pop(parentId, None)
+        if result is not None:
+            self.restored += 1
+        return result
+
+    def add(self, parentId, result):
+        """Add the result of a parent, and flush the file if the last flush
+        was more than ``interval`` seconds ago
+        """
+        if parentId in self:
+            return
+        self._pending[parentId] = result
+        if time.time() - self._lastFlush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Append the results added since the last flush to the file"""
+        if self._pending:
+            with open(self.filename, "ab") as f:
+                pickle.dump(dict(self._pending), f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            self._ids.update(self._pending)
+            self._pending.clear()
+        self._lastFlush = time.time()
@@ -19,22 +19,32 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import math
+from collections import OrderedDict
+import hashlib
+import heapq
+import itertools
+import multiprocessing
 import numpy as np
 import time
+import traceback
 
 import scarlet
 
 import lsst.log
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
-import lsst.afw.math as afwMath
 import lsst.afw.geom as afwGeom
 import lsst.afw.geom.ellipses as afwEll
 import lsst.afw.image as afwImage
 import lsst.afw.detection as afwDet
 import lsst.afw.table as afwTable
 
+from .cache import ResultCache, makeResultKey
+from .checkpoint import DeblendCheckpoint
+from .payload import DeblendedParentPayload, DeblenderResultPayload
+from .plugins import PluginStatistics, getRampSize
+from .sink import CatalogSink
+
 logger = lsst.log.Log.getLogger("meas.deblender.deblend")
 
 __all__ = 'SourceDeblendConfig', 'SourceDeblendTask', 'MultibandDeblendConfig', 'MultibandDeblendTask'
@@ -72,8 +82,8 @@ class SourceDeblendConfig(pexConfig.Config):
         dtype=str, default='trim',
         allowed={
             'r-to-peak': '~ 1/(1+R^2) to the peak',
-            'r-to-footprint': ('~ 1/(1+R^2) to the closest pixel in the footprint.  '
-                               'CAUTION: this can be computationally expensive on large footprints!'),
+            'r-to-footprint': ('~ 1/(1+R^2) to the closest pixel in the footprint, '
+                               'using a distance transform of each template footprint'),
             'nearest-footprint': ('Assign 100% to the nearest footprint (using L-1 norm aka '
                                   'Manhattan distance)'),
             'trim': ('Shrink the parent footprint to pixels that are not assigned to children')
@@ -139,8 +149,76 @@ class SourceDeblendConfig(pexConfig.Config):
              "describing the same object (i.e. they are degenerate).  If one of the objects has been "
              "labeled as a PSF it will be removed, otherwise the template with the lowest value will "
              "be removed."))
+    monotonicAlgorithm = pexConfig.ChoiceField(
+        doc='Algorithm used to make the templates monotonic',
+        dtype=str, default='cone',
+        allowed={
+            'cone': 'Each pixel casts a cone-shaped shadow on the pixels further from the peak',
+            'radial': ('Clip each pixel to the interpolated value of its neighbours in the direction of '
+                       'the peak, in a single pass (much faster for large templates)'),
+        }
+    )
     medianSmoothTemplate = pexConfig.Field(dtype=bool, default=True,
                                            doc="Apply a smoothing filter to all of the template images")
+    nativeTemplates = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("Build, ramp, smooth, make monotonic and clip the templates of all of the peaks of a parent "
+             "in a single native call (see `lsst.meas.deblender.plugins.buildTemplates`) instead of "
+             "running a plugin for each step.  The intermediate templates (``origTemplate``, "
+             "``rampedTemplate`` and ``medianFilteredTemplate``) are then not saved, even if "
+             "``saveDebugTemplates`` is True."))
+    numProcesses = pexConfig.RangeField(
+        dtype=int, default=1, min=1,
+        doc=("Number of processes used to deblend the parents.  If greater than 1, independent parents "
+             "are deblended by a pool of worker processes and their children are added to the catalog "
+             "in parent order, giving the same result as the serial deblender.  "
+             "``preSingleDeblendHook`` is then called for all parents before deblending starts and "
+             "``postSingleDeblendHook`` receives ``res=None``."))
+    psfCacheTolerance = pexConfig.RangeField(
+        dtype=float, default=0.0, min=0.0,
+        doc=("Positions at which the PSF model is evaluated are rounded to a multiple of this value "
+             "(in pixels), so that the cached PSF images can be reused for nearby peaks.  "
+             "0 only reuses an image for exactly the same position."))
+    psfCacheSize = pexConfig.RangeField(
+        dtype=int, default=256, min=0,
+        doc=("Maximum memory (in MiB) used by the cache of PSF model images, which is shared by all "
+             "of the parents in an exposure; 0 means no limit."))
+    psfGridSize = pexConfig.RangeField(
+        dtype=int, default=512, min=0,
+        doc=("Spacing (in pixels) of the grid on which the PSF FWHM is evaluated once per exposure; "
+             "the FWHM of each parent is interpolated from the grid at the center of its footprint.  "
+             "0 uses the FWHM at the default position of the PSF for all parents."))
+    noiseGridSize = pexConfig.RangeField(
+        dtype=int, default=0, min=0,
+        doc=("Size (in pixels) of the cells of the grid on which the median noise is measured once per "
+             "exposure (see `lsst.meas.deblender.NoiseModel`); the noise level of each parent, used for "
+             "the symmetric templates and the edge thresholds, is interpolated from the grid at the "
+             "center of its footprint.  0 uses the median noise of the exposure for all parents."))
+    addTimingFields = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("Add fields with the time spent in each deblender plugin (deblend_time_<plugin>) "
+             "to each deblended parent.  "
+             "The totals for each plugin and the high-water mark of the resident memory of the "
+             "deblending processes (processMaxRss) are always written to the task metadata."))
+    saveDebugTemplates = pexConfig.Field(
+        dtype=bool, default=True,
+        doc=("Keep a copy of the intermediate templates of each peak (``origTemplate``, "
+             "``rampedTemplate``, ``medianFilteredTemplate`` and ``psfTemplate``) in the deblender "
+             "result, for diagnostics.  Set to False to only keep the final templates, which uses "
+             "3-4 times less memory for the templates of each parent.  If ``nativeTemplates`` is "
+             "True, only ``psfTemplate`` is saved."))
+    resultCacheDir = pexConfig.Field(
+        dtype=str, default=None, optional=True,
+        doc=("Directory of an on-disk cache of the deblender results (see "
+             "`lsst.meas.deblender.ResultCache`).  The result of each parent is stored with a hash of "
+             "its footprint, peaks, pixels, PSF image and of the deblender configuration, and is "
+             "restored instead of deblending the parent again when all of them are unchanged, "
+             "for example when a patch is reprocessed.  If None, no results are cached."))
+    resultCacheSize = pexConfig.RangeField(
+        dtype=int, default=4096, min=0,
+        doc=("Maximum disk space (in MiB) used by the result cache; the least recently used results "
+             "are removed when it is full.  0 means no limit."))
+
 
 ## \addtogroup LSST_task_documentation
 ## \{
@@ -174,6 +252,12 @@ class SourceDeblendTask(pipeBase.Task):
         """
         pipeBase.Task.__init__(self, **kwargs)
         self.schema = schema
+        self.psfCache = None
+        self.psfMap = None
+        self.noiseModel = None
+        self.resultCache = None
+        self.pluginStatistics = OrderedDict()
+        self.maxRss = None
         self.toCopyFromParent = [item.key for item in self.schema
                                  if item.field.getName().startswith("merge_footprint")]
         peakMinimalSchema = afwDet.PeakTable.makeMinimalSchema()
@@ -236,6 +320,13 @@ class SourceDeblendTask(pipeBase.Task):
                        self.nChildKey, self.psfKey, self.psfCenterKey, self.psfFluxKey,
                        self.tooManyPeaksKey, self.tooBigKey)))
 
+        self.pluginTimeKeys = None
+        if self.config.addTimingFields:
+            from lsst.meas.deblender.baseline import makeDeblendPlugins
+
+            names = [plugin.func.__name__ for plugin in makeDeblendPlugins(**self._getPluginOptions())]
+            self.pluginTimeKeys = _addPluginStatisticsKeys(schema, names)
+
     @pipeBase.timeMethod
     def run(self, exposure, sources):
         """!
@@ -253,8 +344,54 @@ class SourceDeblendTask(pipeBase.Task):
     def _getPsfFwhm(self, psf, bbox):
         # It should be easier to get a PSF's fwhm;
         # https://dev.lsstcorp.org/trac/ticket/3030
+        if self.psfMap is not None and self.psfMap.psf is psf:
+            return self.psfMap.computeFwhm(afwGeom.Box2D(bbox).getCenter())
         return psf.computeShape().getDeterminantRadius() * 2.35
 
+    def _getPsfMap(self, psf, bbox):
+        """Return the map of the properties of ``psf`` over an exposure with bounding box ``bbox``
+
+        The map is kept for the lifetime of the task and is only replaced
+        when the task is run with a different PSF or exposure bounding box.
+        """
+        from lsst.meas.deblender.baseline import PsfPropertyMap
+
+        if self.psfMap is None or self.psfMap.psf is not psf or self.psfMap.bbox != bbox:
+            self.psfMap = PsfPropertyMap(psf, bbox, self.config.psfGridSize)
+        return self.psfMap
+
+    def _makeNoiseModel(self, maskedImage):
+        """Measure the noise in ``maskedImage`` once for all of its parents
+
+        @return a `lsst.meas.deblender.baseline.NoiseModel`
+        """
+        from lsst.meas.deblender.baseline import NoiseModel
+
+        return NoiseModel(maskedImage, self.config.maskPlanes, self.config.noiseGridSize)
+
+    def _getSigma(self, bbox, sigma1):
+        """Return the noise level of the parent with bounding box ``bbox``
+
+        @return the noise level from the noise model of the exposure,
+                or ``sigma1`` if there is no noise model
+        """
+        if self.noiseModel is None:
+            return sigma1
+        return self.noiseModel.computeSigma(bbox)
+
+    def _getPsfCache(self, psf):
+        """Return the cache of the images of ``psf``
+
+        The cache is kept for the lifetime of the task and is only replaced
+        when the task is run with a different PSF.
+        """
+        from lsst.meas.deblender.baseline import CachingPsf
+
+        if self.psfCache is None or self.psfCache.psf is not psf:
+            self.psfCache = CachingPsf(psf, tolerance=self.config.psfCacheTolerance,
+                                       maxBytes=self.config.psfCacheSize*2**20)
+        return self.psfCache
+
     @pipeBase.timeMethod
     def deblend(self, exposure, srcs, psf):
         """!
@@ -268,73 +405,74 @@ class SourceDeblendTask(pipeBase.Task):
         """
         self.log.info("Deblending %d sources" % len(srcs))
 
-        from lsst.meas.deblender.baseline import deblend
-
         # find the median stdev in the image...
-        mi = exposure.getMaskedImage()
-        statsCtrl = afwMath.StatisticsControl()
-        statsCtrl.setAndMask(mi.getMask().getPlaneBitMask(self.config.maskPlanes))
-        stats = afwMath.makeStatistics(mi.getVariance(), mi.getMask(), afwMath.MEDIAN, statsCtrl)
-        sigma1 = math.sqrt(stats.getValue(afwMath.MEDIAN))
+        # The noise model is created before any worker processes are started, so that they inherit it
+        self.noiseModel = self._makeNoiseModel(exposure.getMaskedImage())
+        sigma1 = self.noiseModel.sigma
         self.log.trace('sigma1: %g', sigma1)
 
+        # Create the PSF cache before any worker processes are started, so that they inherit it
+        psfCache = self._getPsfCache(psf)
+        self._getPsfMap(psf, exposure.getBBox())
+        hits, misses = psfCache.hits, psfCache.misses
+        resultCounts = _getResultCacheCounts(self)
+        self.pluginStatistics = OrderedDict()
+        self.maxRss = None
+
         n0 = len(srcs)
+        if self.config.numProcesses > 1:
+            nparents = self._deblendParallel(exposure, srcs, psf, sigma1)
+        else:
+            nparents = self._deblendSerial(exposure, srcs, psf, sigma1)
+
+        n1 = len(srcs)
+        self.log.info('Deblended: of %i sources, %i were deblended, creating %i children, total %i sources'
+                      % (n0, nparents, n1-n0, n1))
+        # The cache statistics of worker processes are not collected
+        self.metadata.set("psfCacheHits", psfCache.hits - hits)
+        self.metadata.set("psfCacheMisses", psfCache.misses - misses)
+        self.log.debug('PSF image cache: %d hits, %d misses, %d images (%d bytes)',
+                       psfCache.hits - hits, psfCache.misses - misses, len(psfCache), psfCache.nbytes)
+        _writeResultCacheStatistics(self, resultCounts)
+        _writePluginStatistics(self)
+
+    def _deblendSerial(self, exposure, srcs, psf, sigma1):
+        """Deblend each parent in ``srcs`` in turn, adding its children as we go
+
+        @return the number of parents that were deblended
+        """
+        mi = exposure.getMaskedImage()
         nparents = 0
         for i, src in enumerate(srcs):
             # t0 = time.clock()
-
-            fp = src.getFootprint()
-            pks = fp.getPeaks()
-
-            # Since we use the first peak for the parent object, we should propagate its flags
-            # to the parent source.
-            src.assign(pks[0], self.peakSchemaMapper)
-
-            if len(pks) < 2:
-                continue
-
-            if self.isLargeFootprint(fp):
-                src.set(self.tooBigKey, True)
-                self.skipParent(src, mi.getMask())
-                self.log.trace('Parent %i: skipping large footprint', int(src.getId()))
-                continue
-            if self.isMasked(fp, exposure.getMaskedImage().getMask()):
-                src.set(self.maskedKey, True)
-                self.skipParent(src, mi.getMask())
-                self.log.trace('Parent %i: skipping masked footprint', int(src.getId()))
+            if not self._prepareParent(exposure, src):
                 continue
 
             nparents += 1
-            bb = fp.getBBox()
-            psf_fwhm = self._getPsfFwhm(psf, bb)
+            fp = src.getFootprint()
+            psf_fwhm = self._getPsfFwhm(psf, fp.getBBox())
+            sigma = self._getSigma(fp.getBBox(), sigma1)
 
-            self.log.trace('Parent %i: deblending %i peaks', int(src.getId()), len(pks))
+            self.log.trace('Parent %i: deblending %i peaks', int(src.getId()), len(fp.getPeaks()))
 
-            self.preSingleDeblendHook(exposure, srcs, i, fp, psf, psf_fwhm, sigma1)
+            self.preSingleDeblendHook(exposure, srcs, i, fp, psf, psf_fwhm, sigma)
             npre = len(srcs)
 
             # This should really be set in deblend, but deblend doesn't have access to the src
             src.set(self.tooManyPeaksKey, len(fp.getPeaks()) > self.config.maxNumberOfPeaks)
 
+            key, cached = self._lookupResult(fp, mi, psf, psf_fwhm, sigma)
+            if cached is not None:
+                # The result of a previous run; the full deblender result is not available
+                if self.config.catchFailures:
+                    src.set(self.deblendFailedKey, False)
+                cached.attach(fp)
+                kids = self._addChildren(srcs, src, cached.peaks)
+                self.postSingleDeblendHook(exposure, srcs, i, npre, kids, fp, psf, psf_fwhm, sigma, None)
+                continue
+
             try:
-                res = deblend(
-                    fp, mi, psf, psf_fwhm, sigma1=sigma1,
-                    psfChisqCut1=self.config.psfChisq1,
-                    psfChisqCut2=self.config.psfChisq2,
-                    psfChisqCut2b=self.config.psfChisq2b,
-                    maxNumberOfPeaks=self.config.maxNumberOfPeaks,
-                    strayFluxToPointSources=self.config.strayFluxToPointSources,
-                    assignStrayFlux=self.config.assignStrayFlux,
-                    strayFluxAssignment=self.config.strayFluxRule,
-                    rampFluxAtEdge=(self.config.edgeHandling == 'ramp'),
-                    patchEdges=(self.config.edgeHandling == 'noclip'),
-                    tinyFootprintSize=self.config.tinyFootprintSize,
-                    clipStrayFluxFraction=self.config.clipStrayFluxFraction,
-                    weightTemplates=self.config.weightTemplates,
-                    removeDegenerateTemplates=self.config.removeDegenerateTemplates,
-                    maxTempDotProd=self.config.maxTempDotProd,
-                    medianSmoothTemplate=self.config.medianSmoothTemplate
-                )
+                res = self._deblendFootprint(fp, mi, psf, psf_fwhm, sigma)
                 if self.config.catchFailures:
                     src.set(self.deblendFailedKey, False)
             except Exception as e:
@@ -347,71 +485,245 @@ class SourceDeblendTask(pipeBase.Task):
                 else:
                     raise
 
-            kids = []
-            nchild = 0
-            for j, peak in enumerate(res.deblendedParents[0].peaks):
-                heavy = peak.getFluxPortion()
-                if heavy is None or peak.skip:
-                    src.set(self.deblendSkippedKey, True)
-                    if not self.config.propagateAllPeaks:
-                        # Don't care
-                        continue
-                    # We need to preserve the peak: make sure we have enough info to create a minimal
-                    # child src
-                    self.log.trace("Peak at (%i,%i) failed.  Using minimal default info for child.",
-                                   pks[j].getIx(), pks[j].getIy())
-                    if heavy is None:
-                        # copy the full footprint and strip out extra peaks
-                        foot = afwDet.Footprint(src.getFootprint())
-                        peakList = foot.getPeaks()
-                        peakList.clear()
-                        peakList.append(peak.peak)
-                        zeroMimg = afwImage.MaskedImageF(foot.getBBox())
-                        heavy = afwDet.makeHeavyFootprint(foot, zeroMimg)
-                    if peak.deblendedAsPsf:
-                        if peak.psfFitFlux is None:
-                            peak.psfFitFlux = 0.0
-                        if peak.psfFitCenter is None:
-                            peak.psfFitCenter = (peak.peak.getIx(), peak.peak.getIy())
-
-                assert(len(heavy.getPeaks()) == 1)
+            if key is not None:
+                self.resultCache.put(key, DeblendedParentPayload(res.deblendedParents[0]))
+            _recordPluginStatistics(self, [src], res.pluginStatistics, res.maxRss)
+            kids = self._addChildren(srcs, src, res.deblendedParents[0].peaks)
 
-                src.set(self.deblendSkippedKey, False)
-                child = srcs.addNew()
-                nchild += 1
-                for key in self.toCopyFromParent:
-                    child.set(key, src.get(key))
-                child.assign(heavy.getPeaks()[0], self.peakSchemaMapper)
-                child.setParent(src.getId())
-                child.setFootprint(heavy)
-                child.set(self.psfKey, peak.deblendedAsPsf)
-                child.set(self.hasStrayFluxKey, peak.strayFlux is not None)
-                if peak.deblendedAsPsf:
-                    (cx, cy) = peak.psfFitCenter
-                    child.set(self.psfCenterKey, afwGeom.Point2D(cx, cy))
-                    child.set(self.psfFluxKey, peak.psfFitFlux)
-                child.set(self.deblendRampedTemplateKey, peak.hasRampedTemplate)
-                child.set(self.deblendPatchedTemplateKey, peak.patched)
-                kids.append(child)
-
-            # Child footprints may extend beyond the full extent of their parent's which
-            # results in a failure of the replace-by-noise code to reinstate these pixels
-            # to their original values.  The following updates the parent footprint
-            # in-place to ensure it contains the full union of itself and all of its
-            # children's footprints.
-            spans = src.getFootprint().spans
-            for child in kids:
-                spans = spans.union(child.getFootprint().spans)
-            src.getFootprint().setSpans(spans)
-
-            src.set(self.nChildKey, nchild)
-
-            self.postSingleDeblendHook(exposure, srcs, i, npre, kids, fp, psf, psf_fwhm, sigma1, res)
+            self.postSingleDeblendHook(exposure, srcs, i, npre, kids, fp, psf, psf_fwhm, sigma, res)
             # print('Deblending parent id', src.getId(), 'took', time.clock() - t0)
+        return nparents
 
-        n1 = len(srcs)
-        self.log.info('Deblended: of %i sources, %i were deblended, creating %i children, total %i sources'
-                      % (n0, nparents, n1-n0, n1))
+    def _deblendParallel(self, exposure, srcs, psf, sigma1):
+        """Deblend the parents in ``srcs`` using a pool of worker processes
+
+        The parents are deblended independently by ``config.numProcesses`` worker
+        processes, which return a `DeblendedParentPayload` for each parent.
+        The children are added to ``srcs`` in the same order as the parents,
+        so the output is identical to that of the serial deblender.
+        All of the calls to `preSingleDeblendHook` are made before deblending starts,
+        and `postSingleDeblendHook` is called with ``res=None``, as the full
+        deblender result is only available in the worker process.
+
+        @return the number of parents that were deblended
+        """
+        toDeblend = []
+        fwhms = {}
+        sigmas = {}
+        for i in range(len(srcs)):
+            src = srcs[i]
+            if not self._prepareParent(exposure, src):
+                continue
+            fp = src.getFootprint()
+            fwhms[i] = self._getPsfFwhm(psf, fp.getBBox())
+            sigmas[i] = self._getSigma(fp.getBBox(), sigma1)
+            self.log.trace('Parent %i: deblending %i peaks', int(src.getId()), len(fp.getPeaks()))
+            self.preSingleDeblendHook(exposure, srcs, i, fp, psf, fwhms[i], sigmas[i])
+            src.set(self.tooManyPeaksKey, len(fp.getPeaks()) > self.config.maxNumberOfPeaks)
+            toDeblend.append(i)
+
+        # The parents whose results are in the result cache are not sent to the workers
+        keys = {}
+        cached = {}
+        for i in toDeblend:
+            keys[i], result = self._lookupResult(srcs[i].getFootprint(), exposure.getMaskedImage(), psf,
+                                                 fwhms[i], sigmas[i])
+            if result is not None:
+                cached[i] = result
+        toRun = [i for i in toDeblend if i not in cached]
+
+        self.log.info("Deblending %d parents with %d processes" % (len(toRun), self.config.numProcesses))
+        state = dict(task=self, srcs=srcs, maskedImage=exposure.getMaskedImage(), psf=psf,
+                     fwhms=fwhms, sigmas=sigmas)
+        results = []
+        if toRun:
+            results = _mapParents(_deblendSingleBandParent, state, toRun, self.config.numProcesses)
+        # Both the worker and the cached results are in parent order
+        for i, result in heapq.merge(cached.items(), results, key=lambda item: item[0]):
+            src = srcs[i]
+            fp = src.getFootprint()
+            if isinstance(result, _WorkerFailure):
+                if self.config.catchFailures:
+                    self.log.warn("Unable to deblend source %d: %s" % (src.getId(), result.message))
+                    src.set(self.deblendFailedKey, True)
+                    self.log.debug(result.traceback)
+                    continue
+                raise RuntimeError("Unable to deblend source %d: %s\n%s" %
+                                   (src.getId(), result.message, result.traceback))
+            if self.config.catchFailures:
+                src.set(self.deblendFailedKey, False)
+
+            if i not in cached and keys[i] is not None:
+                self.resultCache.put(keys[i], result)
+            result.attach(fp)
+            if i not in cached:
+                _recordPluginStatistics(self, [src], result.pluginStatistics, result.maxRss)
+            npre = len(srcs)
+            kids = self._addChildren(srcs, src, result.peaks)
+            self.postSingleDeblendHook(exposure, srcs, i, npre, kids, fp, psf, fwhms[i], sigmas[i], None)
+        return len(toDeblend)
+
+    def _prepareParent(self, exposure, src):
+        """Propagate the peak flags to the parent and check whether it should be deblended
+
+        @return True if the parent should be deblended
+        """
+        mi = exposure.getMaskedImage()
+        fp = src.getFootprint()
+        pks = fp.getPeaks()
+
+        # Since we use the first peak for the parent object, we should propagate its flags
+        # to the parent source.
+        src.assign(pks[0], self.peakSchemaMapper)
+
+        if len(pks) < 2:
+            return False
+
+        if self.isLargeFootprint(fp):
+            src.set(self.tooBigKey, True)
+            self.skipParent(src, mi.getMask())
+            self.log.trace('Parent %i: skipping large footprint', int(src.getId()))
+            return False
+        if self.isMasked(fp, mi.getMask()):
+            src.set(self.maskedKey, True)
+            self.skipParent(src, mi.getMask())
+            self.log.trace('Parent %i: skipping masked footprint', int(src.getId()))
+            return False
+        return True
+
+    def _deblendFootprint(self, fp, mi, psf, psf_fwhm, sigma1):
+        """Run the baseline deblender on a single parent footprint
+
+        @return the `DeblenderResult` for the parent
+        """
+        from lsst.meas.deblender.baseline import deblend
+
+        return deblend(
+            fp, mi, psf, psf_fwhm, sigma1=sigma1,
+            maxNumberOfPeaks=self.config.maxNumberOfPeaks,
+            psfCache=self._getPsfCache(psf),
+            saveDebugTemplates=self.config.saveDebugTemplates,
+            **self._getPluginOptions()
+        )
+
+    def _lookupResult(self, fp, mi, psf, psf_fwhm, sigma1):
+        """Look for the result of a parent footprint in the result cache
+
+        The key of the result is a hash of the footprint and its peaks, the pixels
+        used by the deblender, the PSF image at the center of the footprint, the PSF
+        FWHM, the noise level and the configuration.  It must be computed before the
+        footprint is deblended, as the deblender modifies the footprint.
+
+        @return (key, payload): the key of the result (None if there is no result cache)
+                and the cached `DeblendedParentPayload` (None if it is not in the cache)
+        """
+        if self.resultCache is None:
+            return None, None
+        bbox = fp.getBBox()
+        if self.config.edgeHandling == 'ramp':
+            # The ramped templates extend outside of the footprint
+            bbox.grow(getRampSize(psf_fwhm))
+            bbox.clip(mi.getBBox())
+        center = afwGeom.Box2D(fp.getBBox()).getCenter()
+        psfImage = self._getPsfCache(psf).computeImage(center.getX(), center.getY())
+        key = makeResultKey(fp, [mi.Factory(mi, bbox, afwImage.PARENT)], [psfImage],
+                            _getConfigParameters(self.config) + (psf_fwhm, sigma1))
+        return key, self.resultCache.get(key)
+
+    def _getPluginOptions(self):
+        """!
+        Return the options of the deblender plugins
+
+        @return dict of keyword arguments for lsst.meas.deblender.baseline.makeDeblendPlugins
+        """
+        return dict(
+            psfChisqCut1=self.config.psfChisq1,
+            psfChisqCut2=self.config.psfChisq2,
+            psfChisqCut2b=self.config.psfChisq2b,
+            strayFluxToPointSources=self.config.strayFluxToPointSources,
+            assignStrayFlux=self.config.assignStrayFlux,
+            strayFluxAssignment=self.config.strayFluxRule,
+            rampFluxAtEdge=(self.config.edgeHandling == 'ramp'),
+            patchEdges=(self.config.edgeHandling == 'noclip'),
+            tinyFootprintSize=self.config.tinyFootprintSize,
+            clipStrayFluxFraction=self.config.clipStrayFluxFraction,
+            weightTemplates=self.config.weightTemplates,
+            removeDegenerateTemplates=self.config.removeDegenerateTemplates,
+            maxTempDotProd=self.config.maxTempDotProd,
+            medianSmoothTemplate=self.config.medianSmoothTemplate,
+            monotonicAlgorithm=self.config.monotonicAlgorithm,
+            nativeTemplates=self.config.nativeTemplates,
+        )
+
+    def _addChildren(self, srcs, src, peaks):
+        """Add the deblended children of ``src`` to ``srcs``
+
+        @param[in,out] srcs   SourceCatalog to add the children to.
+        @param[in,out] src    Parent source.
+        @param[in]     peaks  List of `DeblendedPeak` (or `DeblendedPeakPayload`) for each peak.
+
+        @return list of the child sources that were added
+        """
+        pks = src.getFootprint().getPeaks()
+        kids = []
+        nchild = 0
+        for j, peak in enumerate(peaks):
+            heavy = peak.getFluxPortion()
+            if heavy is None or peak.skip:
+                src.set(self.deblendSkippedKey, True)
+                if not self.config.propagateAllPeaks:
+                    # Don't care
+                    continue
+                # We need to preserve the peak: make sure we have enough info to create a minimal
+                # child src
+                self.log.trace("Peak at (%i,%i) failed.  Using minimal default info for child.",
+                               pks[j].getIx(), pks[j].getIy())
+                if heavy is None:
+                    # copy the full footprint and strip out extra peaks
+                    foot = afwDet.Footprint(src.getFootprint())
+                    peakList = foot.getPeaks()
+                    peakList.clear()
+                    peakList.append(peak.peak)
+                    zeroMimg = afwImage.MaskedImageF(foot.getBBox())
+                    heavy = afwDet.makeHeavyFootprint(foot, zeroMimg)
+                if peak.deblendedAsPsf:
+                    if peak.psfFitFlux is None:
+                        peak.psfFitFlux = 0.0
+                    if peak.psfFitCenter is None:
+                        peak.psfFitCenter = (peak.peak.getIx(), peak.peak.getIy())
+
+            assert(len(heavy.getPeaks()) == 1)
+
+            src.set(self.deblendSkippedKey, False)
+            child = srcs.addNew()
+            nchild += 1
+            for key in self.toCopyFromParent:
+                child.set(key, src.get(key))
+            child.assign(heavy.getPeaks()[0], self.peakSchemaMapper)
+            child.setParent(src.getId())
+            child.setFootprint(heavy)
+            child.set(self.psfKey, peak.deblendedAsPsf)
+            child.set(self.hasStrayFluxKey, peak.hasStrayFlux)
+            if peak.deblendedAsPsf:
+                (cx, cy) = peak.psfFitCenter
+                child.set(self.psfCenterKey, afwGeom.Point2D(cx, cy))
+                child.set(self.psfFluxKey, peak.psfFitFlux)
+            child.set(self.deblendRampedTemplateKey, peak.hasRampedTemplate)
+            child.set(self.deblendPatchedTemplateKey, peak.patched)
+            kids.append(child)
+
+        # Child footprints may extend beyond the full extent of their parent's which
+        # results in a failure of the replace-by-noise code to reinstate these pixels
+        # to their original values.  The following updates the parent footprint
+        # in-place to ensure it contains the full union of itself and all of its
+        # children's footprints.
+        spans = src.getFootprint().spans
+        for child in kids:
+            spans = spans.union(child.getFootprint().spans)
+        src.getFootprint().setSpans(spans)
+
+        src.set(self.nChildKey, nchild)
+        return kids
 
     def preSingleDeblendHook(self, exposure, srcs, i, fp, psf, psf_fwhm, sigma1):
         pass
@@ -621,6 +933,10 @@ class MultibandDeblendConfig(pexConfig.Config):
         dtype=bool, default=False,
         doc=("If true, a least-squares fit of the templates will be done to the "
              "full image. The templates will be re-weighted based on this fit."))
+    weightTemplatesJointly = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("If true (and weightTemplates is true), fit a single weight for each template "
+             "to the images in all of the bands, instead of a weight in each band."))
     strayFluxToPointSources = pexConfig.ChoiceField(
         doc='When the deblender should attribute stray flux to point sources',
         dtype=str, default='necessary',
@@ -641,8 +957,8 @@ class MultibandDeblendConfig(pexConfig.Config):
         dtype=str, default='trim',
         allowed={
             'r-to-peak': '~ 1/(1+R^2) to the peak',
-            'r-to-footprint': ('~ 1/(1+R^2) to the closest pixel in the footprint.  '
-                               'CAUTION: this can be computationally expensive on large footprints!'),
+            'r-to-footprint': ('~ 1/(1+R^2) to the closest pixel in the footprint, '
+                               'using a distance transform of each template footprint'),
             'nearest-footprint': ('Assign 100% to the nearest footprint (using L-1 norm aka '
                                   'Manhattan distance)'),
             'trim': ('Shrink the parent footprint to pixels that are not assigned to children')
@@ -656,6 +972,88 @@ class MultibandDeblendConfig(pexConfig.Config):
                                      doc=("As part of the flux calculation, the sum of the templates is"
                                           "calculated. If 'getTemplateSum==True' then the sum of the"
                                           "templates is stored in the result (a 'PerFootprint')."))
+    numProcesses = pexConfig.RangeField(
+        dtype=int, default=1, min=1,
+        doc=("Number of processes used to deblend the parents.  If greater than 1, the parents are "
+             "dispatched to a pool of worker processes, most expensive first (footprint area x "
+             "number of peaks x number of bands), and their children are added to the catalogs in "
+             "parent order, giving the same result as the serial deblender.  "
+             "``postSingleDeblendHook`` then receives ``result=None``."))
+    numBandThreads = pexConfig.RangeField(
+        dtype=int, default=1, min=1,
+        doc=("Number of threads used by the deblender plugins to process the bands of a parent in "
+             "parallel.  When combined with ``numProcesses``, each process uses this many threads."))
+    psfCacheTolerance = pexConfig.RangeField(
+        dtype=float, default=0.0, min=0.0,
+        doc=("Positions at which the PSF model is evaluated are rounded to a multiple of this value "
+             "(in pixels), so that the cached PSF images can be reused for nearby peaks.  "
+             "0 only reuses an image for exactly the same position."))
+    psfCacheSize = pexConfig.RangeField(
+        dtype=int, default=256, min=0,
+        doc=("Maximum memory (in MiB) used by the cache of PSF model images in each band, which is "
+             "shared by all of the parents; 0 means no limit."))
+    psfGridSize = pexConfig.RangeField(
+        dtype=int, default=512, min=0,
+        doc=("Spacing (in pixels) of the grid on which the PSF FWHM is evaluated once per exposure; "
+             "the FWHM of each parent is interpolated from the grid at the center of its footprint.  "
+             "0 uses the FWHM at the default position of the PSF for all parents."))
+    noiseGridSize = pexConfig.RangeField(
+        dtype=int, default=0, min=0,
+        doc=("Size (in pixels) of the cells of the grid on which the median noise is measured once per "
+             "exposure (see `lsst.meas.deblender.NoiseModel`); the noise level of each parent, used for "
+             "the symmetric templates and the edge thresholds, is interpolated from the grid at the "
+             "center of its footprint.  0 uses the median noise of the exposure for all parents."))
+    addTimingFields = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("Add fields with the time spent in each deblender plugin (deblend_time_<plugin>) "
+             "to each deblended parent.  "
+             "The totals for each plugin and the high-water mark of the resident memory of the "
+             "deblending processes (processMaxRss) are always written to the task metadata."))
+    outputDir = pexConfig.Field(
+        dtype=str, default=None, optional=True,
+        doc=("Directory to which the output catalogs are written in batches of ``outputBatchSize`` "
+             "parents (see `lsst.meas.deblender.CatalogSink`).  The children of a batch are only kept "
+             "in memory until the batch has been written, and ``deblend`` returns the sinks instead of "
+             "the catalogs.  If None, all of the output catalogs are kept in memory."))
+    outputBatchSize = pexConfig.RangeField(
+        dtype=int, default=1000, min=1,
+        doc=("Number of parents in each batch written to ``outputDir``.  When ``numProcesses`` > 1, "
+             "the parents in each batch are deblended by a new pool of worker processes."))
+    saveDebugTemplates = pexConfig.Field(
+        dtype=bool, default=True,
+        doc=("Keep a copy of the intermediate templates of each peak (``origTemplate``, "
+             "``rampedTemplate``, ``medianFilteredTemplate`` and ``psfTemplate``) in the deblender "
+             "result, for diagnostics.  Set to False to only keep the final templates, which uses "
+             "3-4 times less memory for the templates of each parent."))
+    resultCacheDir = pexConfig.Field(
+        dtype=str, default=None, optional=True,
+        doc=("Directory of an on-disk cache of the deblender results (see "
+             "`lsst.meas.deblender.ResultCache`).  The result of each parent is stored with a hash of "
+             "its footprint, peaks, pixels, PSF image and of the deblender configuration, and is "
+             "restored instead of deblending the parent again when all of them are unchanged, "
+             "for example when a patch is reprocessed.  If None, no results are cached."))
+    resultCacheSize = pexConfig.RangeField(
+        dtype=int, default=4096, min=0,
+        doc=("Maximum disk space (in MiB) used by the result cache; the least recently used results "
+             "are removed when it is full.  0 means no limit."))
+    checkpointFile = pexConfig.Field(
+        dtype=str, default=None, optional=True,
+        doc=("File to which the results of the deblended parents are periodically appended (see "
+             "`lsst.meas.deblender.DeblendCheckpoint`), so that a run that is interrupted, for example "
+             "when the node running it is preempted, can be resumed with ``resumeFromCheckpoint``.  "
+             "If None, no checkpoints are written."))
+    checkpointInterval = pexConfig.RangeField(
+        dtype=float, default=300., min=0.,
+        doc=("Minimum time (in seconds) between two writes of the checkpoint file.  "
+             "0 writes the result of each parent as soon as it has been deblended."))
+    resumeFromCheckpoint = pexConfig.Field(
+        dtype=bool, default=False,
+        doc=("Restore the results of the parents in an existing ``checkpointFile`` instead of "
+             "deblending them again.  The checkpoint is only used if it was written for the same "
+             "parents, filters and configuration, and for inputs with the same bounding boxes, the "
+             "same image pixel at the center of each parent and the same PSF on the ``psfGridSize`` "
+             "grid (other changes to the input pixels are not detected); otherwise, or if this is "
+             "False, it is replaced."))
 
 
 class MultibandDeblendTask(pipeBase.Task):
@@ -688,6 +1086,13 @@ class MultibandDeblendTask(pipeBase.Task):
         from lsst.meas.deblender import plugins
 
         pipeBase.Task.__init__(self, **kwargs)
+        self.psfCaches = {}
+        self.psfMaps = {}
+        self.noiseModels = {}
+        self.resultCache = None
+        self.checkpoint = None
+        self.pluginStatistics = OrderedDict()
+        self.maxRss = None
         if not self.config.conserveFlux and not self.config.saveTemplates:
             raise ValueError("Either `conserveFlux` or `saveTemplates` must be True")
 
@@ -778,7 +1183,8 @@ class MultibandDeblendTask(pipeBase.Task):
             self.plugins.append(plugins.DeblenderPlugin(plugins.clipFootprintsToNonzero))
         if self.config.conserveFlux:
             if self.config.weightTemplates:
-                self.plugins.append(plugins.DeblenderPlugin(plugins.weightTemplates))
+                self.plugins.append(plugins.DeblenderPlugin(plugins.weightTemplates,
+                                                            jointBands=self.config.weightTemplatesJointly))
             self.plugins.append(plugins.DeblenderPlugin(
                 plugins.apportionFlux,
                 clipStrayFluxFraction=self.config.clipStrayFluxFraction,
@@ -787,6 +1193,11 @@ class MultibandDeblendTask(pipeBase.Task):
                 strayFluxToPointSources=self.config.strayFluxToPointSources,
                 getTemplateSum=self.config.getTemplateSum))
 
+        self.pluginTimeKeys = None
+        if self.config.addTimingFields:
+            names = [plugin.func.__name__ for plugin in self.plugins]
+            self.pluginTimeKeys = _addPluginStatisticsKeys(schema, names)
+
     def _addSchemaKeys(self, schema):
         """Add deblender specific keys to the schema
         """
@@ -865,8 +1276,64 @@ class MultibandDeblendTask(pipeBase.Task):
         return self.deblend(mExposure, mergedSources, psfs)
 
     def _getPsfFwhm(self, psf, bbox):
+        for psfMap in self.psfMaps.values():
+            if psfMap.psf is psf:
+                return psfMap.computeFwhm(afwGeom.Box2D(bbox).getCenter())
         return psf.computeShape().getDeterminantRadius() * 2.35
 
+    def _getPsfMap(self, f, psf, bbox):
+        """Return the map of the properties of ``psf`` in filter ``f``
+        over an exposure with bounding box ``bbox``
+
+        The maps are kept for the lifetime of the task and the map for a
+        filter is only replaced when the task is run with a different PSF
+        or exposure bounding box.
+        """
+        from lsst.meas.deblender.baseline import PsfPropertyMap
+
+        psfMap = self.psfMaps.get(f)
+        if psfMap is None or psfMap.psf is not psf or psfMap.bbox != bbox:
+            psfMap = PsfPropertyMap(psf, bbox, self.config.psfGridSize)
+            self.psfMaps[f] = psfMap
+        return psfMap
+
+    def _makeNoiseModel(self, maskedImage):
+        """Measure the noise in ``maskedImage`` once for all of its parents
+
+        Returns
+        -------
+        noiseModel: `lsst.meas.deblender.baseline.NoiseModel`
+            Noise model of the exposure.
+        """
+        from lsst.meas.deblender.baseline import NoiseModel
+
+        return NoiseModel(maskedImage, self.config.maskPlanes, self.config.noiseGridSize)
+
+    def _getSigmas(self, bbox, sigmas):
+        """Return the noise level in each band of the parent with bounding box ``bbox``
+
+        The noise levels are taken from the noise models of the exposures,
+        falling back to the median noise ``sigmas`` of the bands that do not
+        have a noise model.
+        """
+        return {f: self.noiseModels[f].computeSigma(bbox) if f in self.noiseModels else sigma
+                for f, sigma in sigmas.items()}
+
+    def _getPsfCache(self, f, psf):
+        """Return the cache of the images of ``psf`` in filter ``f``
+
+        The caches are kept for the lifetime of the task and the cache for a
+        filter is only replaced when the task is run with a different PSF.
+        """
+        from lsst.meas.deblender.baseline import CachingPsf
+
+        cache = self.psfCaches.get(f)
+        if cache is None or cache.psf is not psf:
+            cache = CachingPsf(psf, tolerance=self.config.psfCacheTolerance,
+                               maxBytes=self.config.psfCacheSize*2**20)
+            self.psfCaches[f] = cache
+        return cache
+
     def _addChild(self, parentId, peak, sources, heavy):
         """Add a child to a catalog
 
@@ -881,7 +1348,7 @@ class MultibandDeblendTask(pipeBase.Task):
         src.setParent(parentId)
         src.setFootprint(heavy)
         src.set(self.psfKey, peak.deblendedAsPsf)
-        src.set(self.hasStrayFluxKey, peak.strayFlux is not None)
+        src.set(self.hasStrayFluxKey, peak.hasStrayFlux)
         src.set(self.deblendRampedTemplateKey, peak.hasRampedTemplate)
         src.set(self.deblendPatchedTemplateKey, peak.patched)
         src.set(self.runtimeKey, 0)
@@ -918,9 +1385,16 @@ class MultibandDeblendTask(pipeBase.Task):
             These are catalogs with heavy footprints that are the templates
             created by the multiband templates.
             If `self.config.saveTemplates` is `False`, then this item will be None
-        """
-        from lsst.meas.deblender.baseline import newDeblend
 
+        If ``self.config.outputDir`` is set, the catalogs are written to
+        disk and ``fluxCatalogs`` and ``templateCatalogs`` are the
+        `CatalogSink`'s (or None) to which they were written.
+
+        If ``self.config.checkpointFile`` is set, the results of the
+        deblended parents are periodically written to the checkpoint file,
+        and (if ``self.config.resumeFromCheckpoint`` is True) the parents
+        that were deblended by an interrupted run are restored from it.
+        """
         if tuple(psfs.keys()) != mExposure.filters:
             msg = "PSF keys must be the same as mExposure.filters ({0}), got {1}"
             raise ValueError(msg.format(mExposure.filters, psfs.keys()))
@@ -930,39 +1404,174 @@ class MultibandDeblendTask(pipeBase.Task):
                                                      mask=mExposure.mask, variance=mExposure.variance)
         self.log.info("Deblending {0} sources in {1} exposures".format(len(sources), len(mExposure)))
 
-        # find the median stdev in each image
+        # find the median stdev in each image.
+        # The noise models are created before any worker processes are started, so that they inherit them
         sigmas = {}
+        self.noiseModels = {}
         for f in filters:
             exposure = mExposure[f]
-            mi = exposure.getMaskedImage()
-            statsCtrl = afwMath.StatisticsControl()
-            statsCtrl.setAndMask(mi.getMask().getPlaneBitMask(self.config.maskPlanes))
-            stats = afwMath.makeStatistics(mi.getVariance(), mi.getMask(), afwMath.MEDIAN, statsCtrl)
-            sigma1 = math.sqrt(stats.getValue(afwMath.MEDIAN))
+            self.noiseModels[f] = self._makeNoiseModel(exposure.getMaskedImage())
+            sigma1 = self.noiseModels[f].sigma
             self.log.trace('Exposure {0}, sigma1: {1}'.format(f, sigma1))
             sigmas[f] = sigma1
 
-        # Create the output catalogs
-        if self.config.conserveFlux:
-            fluxCatalogs = {}
-            for f in filters:
-                _catalog = afwTable.SourceCatalog(sources.table.clone())
-                _catalog.extend(sources)
-                fluxCatalogs[f] = _catalog
-        else:
-            fluxCatalogs = None
-        if self.config.saveTemplates:
-            templateCatalogs = {}
-            for f in filters:
-                _catalog = afwTable.SourceCatalog(sources.table.clone())
-                _catalog.extend(sources)
-                templateCatalogs[f] = _catalog
+        # Create the PSF caches before any worker processes are started, so that they inherit them
+        psfCaches = {f: self._getPsfCache(f, psfs[f]) for f in filters}
+        for f in filters:
+            self._getPsfMap(f, psfs[f], mExposure[f].getBBox())
+        cacheCounts = {f: (cache.hits, cache.misses) for f, cache in psfCaches.items()}
+        resultCounts = _getResultCacheCounts(self)
+        self.pluginStatistics = OrderedDict()
+        self.maxRss = None
+        self.checkpoint = self._openCheckpoint(mExposure, sources, psfs)
+
+        # Create the output catalogs.  If they are written to disk, the catalogs are created
+        # for one batch of parents at a time, and each batch is written once it has been deblended.
+        n0 = len(sources)
+        fluxSink = templateSink = None
+        if self.config.outputDir is not None:
+            batchSize = self.config.outputBatchSize
+            if self.config.conserveFlux:
+                fluxSink = CatalogSink(self.config.outputDir, "flux", filters, sources.table)
+            if self.config.saveTemplates:
+                templateSink = CatalogSink(self.config.outputDir, "template", filters, sources.table)
         else:
-            templateCatalogs = None
+            batchSize = max(n0, 1)
 
-        n0 = len(sources)
         nparents = 0
-        for pk, src in enumerate(sources):
+        n1 = 0
+        try:
+            for start in range(0, max(n0, 1), batchSize):
+                stop = min(start + batchSize, n0)
+                parents = sources[start:stop]
+                fluxCatalogs = None
+                if self.config.conserveFlux:
+                    fluxCatalogs = self._makeOutputCatalogs(parents, filters, fluxSink)
+                templateCatalogs = None
+                if self.config.saveTemplates:
+                    templateCatalogs = self._makeOutputCatalogs(parents, filters, templateSink)
+
+                nparents += self._deblendBatch(mExposure, mMaskedImage, sources, start, stop, psfs, sigmas,
+                                               exposure, fluxCatalogs, templateCatalogs)
+
+                if fluxCatalogs is not None:
+                    n1 += len(list(fluxCatalogs.values())[0])
+                else:
+                    n1 += len(list(templateCatalogs.values())[0])
+                for sink, catalogs in ((fluxSink, fluxCatalogs), (templateSink, templateCatalogs)):
+                    if sink is not None:
+                        sink.write(catalogs)
+                if self.config.outputDir is not None:
+                    self.log.debug("Wrote the output catalogs of parents %d to %d to %s",
+                                   start, stop - 1, self.config.outputDir)
+        finally:
+            # Keep the results of the parents deblended so far if the run is interrupted
+            if self.checkpoint is not None:
+                self.checkpoint.flush()
+
+        self.log.info('Deblended: of %i sources, %i were deblended, creating %i children, total %i sources'
+                      % (n0, nparents, n1-n0, n1))
+        # The cache statistics of worker processes are not collected
+        hits = sum(cache.hits - cacheCounts[f][0] for f, cache in psfCaches.items())
+        misses = sum(cache.misses - cacheCounts[f][1] for f, cache in psfCaches.items())
+        self.metadata.set("psfCacheHits", hits)
+        self.metadata.set("psfCacheMisses", misses)
+        self.log.debug('PSF image cache: %d hits, %d misses', hits, misses)
+        _writeResultCacheStatistics(self, resultCounts)
+        if self.checkpoint is not None:
+            self.metadata.set("checkpointRestored", self.checkpoint.restored)
+            self.log.info("Restored %d parents from the checkpoint %s, which contains %d parents" %
+                          (self.checkpoint.restored, self.checkpoint.filename, len(self.checkpoint)))
+        _writePluginStatistics(self)
+        if self.config.outputDir is not None:
+            return fluxSink, templateSink
+        return fluxCatalogs, templateCatalogs
+
+    def _openCheckpoint(self, mExposure, sources, psfs):
+        """Open the checkpoint file of a call to ``deblend``
+
+        The checkpoint is identified by the ids of the parents, the filters,
+        the configuration and a digest of the inputs, so that only the
+        results of an interrupted run on the same parents are restored.
+        The digest is computed from the bounding box of each exposure, the
+        image pixel at the center of each parent and the PSF kernel images
+        at the nodes of the ``psfGridSize`` grid: it is cheap, but changes
+        to the pixels away from the parent centers are not detected.
+
+        Returns
+        -------
+        checkpoint: `DeblendCheckpoint` or None
+            The checkpoint, or None if ``config.checkpointFile`` is None.
+        """
+        if self.config.checkpointFile is None:
+            return None
+        filters = mExposure.filters
+        ids = hashlib.sha256(np.array([src.getId() for src in sources], dtype=np.int64).tobytes())
+        centers = [afwGeom.Box2D(src.getFootprint().getBBox()).getCenter() for src in sources]
+        digest = hashlib.sha256()
+        for f in filters:
+            exposure = mExposure[f]
+            bbox = exposure.getBBox()
+            digest.update(np.array([bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight()],
+                                   dtype=np.int64).tobytes())
+            xs = np.array([int(center.getX()) for center in centers], dtype=int) - bbox.getMinX()
+            ys = np.array([int(center.getY()) for center in centers], dtype=int) - bbox.getMinY()
+            inside = (xs >= 0) & (xs < bbox.getWidth()) & (ys >= 0) & (ys < bbox.getHeight())
+            image = exposure.getMaskedImage().getImage().getArray()
+            digest.update(np.ascontiguousarray(image[ys[inside], xs[inside]]).tobytes())
+            # The PSF is only evaluated at the nodes of the PSF property map
+            psfMap = self._getPsfMap(f, psfs[f], bbox)
+            if psfMap.xNodes is None:
+                positions = [afwGeom.Box2D(bbox).getCenter()]
+            else:
+                positions = [afwGeom.Point2D(x, y) for y in psfMap.yNodes for x in psfMap.xNodes]
+            for position in positions:
+                digest.update(psfMap.computeKernelImage(position).getArray().tobytes())
+        header = (_getConfigParameters(self.config) + tuple(filters) +
+                  (len(sources), ids.hexdigest(), digest.hexdigest()))
+        checkpoint = DeblendCheckpoint(self.config.checkpointFile, header,
+                                       interval=self.config.checkpointInterval,
+                                       resume=self.config.resumeFromCheckpoint)
+        if len(checkpoint) > 0:
+            self.log.info("Resuming from the checkpoint %s: %d parents were already deblended" %
+                          (checkpoint.filename, len(checkpoint)))
+        return checkpoint
+
+    def _makeOutputCatalogs(self, parents, filters, sink=None):
+        """Create the output catalog in each band, containing the parents
+
+        If ``sink`` is not None, the catalogs are created by the sink
+        (see `CatalogSink.makeCatalogs`).
+        """
+        if sink is not None:
+            return sink.makeCatalogs(parents)
+        catalogs = {}
+        for f in filters:
+            _catalog = afwTable.SourceCatalog(parents.table.clone())
+            _catalog.extend(parents)
+            catalogs[f] = _catalog
+        return catalogs
+
+    def _deblendBatch(self, mExposure, mMaskedImage, sources, start, stop, psfs, sigmas, exposure,
+                      fluxCatalogs, templateCatalogs):
+        """Deblend the parents ``sources[start:stop]``
+
+        The children are added to the output catalogs, which contain the
+        parents in the batch, so the parent ``sources[pk]`` is the record
+        ``pk - start`` of the output catalogs.
+
+        Returns
+        -------
+        nparents: int
+            Number of parents that were deblended.
+        """
+        filters = mExposure.filters
+        nparents = 0
+        toDeblend = []
+        fwhms = {}
+        parentSigmas = {}
+        for pk in range(start, stop):
+            src = sources[pk]
             foot = src.getFootprint()
             logger.info("id: {0}".format(src["id"]))
             peaks = foot.getPeaks()
@@ -975,9 +1584,9 @@ class MultibandDeblendTask(pipeBase.Task):
             if len(peaks) < 2 and not self.config.processSingles:
                 for f in filters:
                     if self.config.saveTemplates:
-                        templateCatalogs[f][pk].set(self.runtimeKey, 0)
+                        templateCatalogs[f][pk - start].set(self.runtimeKey, 0)
                     if self.config.conserveFlux:
-                        fluxCatalogs[f][pk].set(self.runtimeKey, 0)
+                        fluxCatalogs[f][pk - start].set(self.runtimeKey, 0)
                 continue
             if self.isLargeFootprint(foot):
                 src.set(self.tooBigKey, True)
@@ -986,7 +1595,7 @@ class MultibandDeblendTask(pipeBase.Task):
                 continue
             if self.isMasked(foot, exposure.getMaskedImage().getMask()):
                 src.set(self.maskedKey, True)
-                self.skipParent(src, mi.getMask())
+                self.skipParent(src, [mi.getMask() for mi in mMaskedImage])
                 self.log.trace('Parent %i: skipping masked footprint', int(src.getId()))
                 continue
             if len(peaks) > self.config.maxNumberOfPeaks:
@@ -997,27 +1606,31 @@ class MultibandDeblendTask(pipeBase.Task):
             nparents += 1
             bbox = foot.getBBox()
             psf_fwhms = {f: self._getPsfFwhm(psf, bbox) for f, psf in psfs.items()}
+            local_sigmas = self._getSigmas(bbox, sigmas)
             self.log.trace('Parent %i: deblending %i peaks', int(src.getId()), len(peaks))
-            self.preSingleDeblendHook(mExposure.singles, sources, pk, foot, psfs, psf_fwhms, sigmas)
+            self.preSingleDeblendHook(mExposure.singles, sources, pk, foot, psfs, psf_fwhms, local_sigmas)
+            if self.config.numProcesses > 1:
+                # The parents are deblended by the worker pool once all of them have been selected
+                toDeblend.append(pk)
+                fwhms[pk] = psf_fwhms
+                parentSigmas[pk] = local_sigmas
+                continue
+
             npre = len(sources)
-            # Run the deblender
+            # Run the deblender, unless the result of the parent is in the checkpoint
+            # of an interrupted run or in the result cache
+            key, cached = None, None
+            if self.checkpoint is not None:
+                cached = self.checkpoint.get(src.getId())
+            if cached is None:
+                key, cached = self._lookupResult(foot, mMaskedImage, psfs, psf_fwhms, local_sigmas)
             try:
-                t0 = time.time()
-                # Build the parameter lists with the same ordering
-                images = mMaskedImage[:, bbox]
-                psf_list = [psfs[f] for f in filters]
-                fwhm_list = [psf_fwhms[f] for f in filters]
-                avgNoise = [sigmas[f] for f in filters]
-
-                result = newDeblend(debPlugins=self.plugins,
-                                    footprint=foot,
-                                    mMaskedImage=images,
-                                    psfs=psf_list,
-                                    psfFwhms=fwhm_list,
-                                    avgNoise=avgNoise,
-                                    maxNumberOfPeaks=self.config.maxNumberOfPeaks)
-                tf = time.time()
-                runtime = (tf-t0)*1000
+                if cached is not None:
+                    result, runtime = cached
+                    self._storeResult(src.getId(), result, runtime)
+                else:
+                    result, runtime = self._deblendParent(foot, mMaskedImage, psfs, psf_fwhms, local_sigmas)
+                    self._storeResult(src.getId(), result, runtime, key)
                 if result.failed:
                     src.set(self.deblendFailedKey, False)
                     src.set(self.runtimeKey, 0)
@@ -1027,103 +1640,345 @@ class MultibandDeblendTask(pipeBase.Task):
                     self.log.warn("Unable to deblend source %d: %s" % (src.getId(), e))
                     src.set(self.deblendFailedKey, True)
                     src.set(self.runtimeKey, 0)
-                    import traceback
                     traceback.print_exc()
                     continue
                 else:
                     raise
 
-            # Add the merged source as a parent in the catalog for each band
-            templateParents = {}
-            fluxParents = {}
-            parentId = src.getId()
-            for f in filters:
-                if self.config.saveTemplates:
-                    templateParents[f] = templateCatalogs[f][pk]
-                    templateParents[f].set(self.runtimeKey, runtime)
-                if self.config.conserveFlux:
-                    fluxParents[f] = fluxCatalogs[f][pk]
-                    fluxParents[f].set(self.runtimeKey, runtime)
-
-            # Add each source to the catalogs in each band
-            templateSpans = {f: afwGeom.SpanSet() for f in filters}
-            fluxSpans = {f: afwGeom.SpanSet() for f in filters}
-            nchild = 0
-            for j, multiPeak in enumerate(result.peaks):
-                heavy = {f: peak.getFluxPortion() for f, peak in multiPeak.deblendedPeaks.items()}
-                no_flux = all([v is None for v in heavy.values()])
-                skip_peak = all([peak.skip for peak in multiPeak.deblendedPeaks.values()])
-                if no_flux or skip_peak:
-                    src.set(self.deblendSkippedKey, True)
-                    if not self.config.propagateAllPeaks:
-                        # We don't care
+            if cached is not None:
+                # The full deblender result is not available
+                result.attach(foot)
+                self._addChildren(pk - start, src, result.peaks, runtime, filters, fluxCatalogs,
+                                  templateCatalogs)
+                self.postSingleDeblendHook(exposure, fluxCatalogs, templateCatalogs,
+                                           pk - start, npre, foot, psfs, psf_fwhms, local_sigmas, None)
+                continue
+            records = self._getParentRecords(pk - start, fluxCatalogs, templateCatalogs)
+            _recordPluginStatistics(self, records, result.pluginStatistics, result.maxRss)
+            self._addChildren(pk - start, src, result.peaks, runtime, filters, fluxCatalogs,
+                              templateCatalogs)
+            self.postSingleDeblendHook(exposure, fluxCatalogs, templateCatalogs,
+                                       pk - start, npre, foot, psfs, psf_fwhms, local_sigmas, result)
+
+        if toDeblend:
+            self._deblendParallel(toDeblend, exposure, mMaskedImage, sources, psfs, fwhms, parentSigmas,
+                                  fluxCatalogs, templateCatalogs, start)
+        return nparents
+
+    def _deblendParallel(self, toDeblend, exposure, mMaskedImage, sources, psfs, fwhms, sigmas,
+                         fluxCatalogs, templateCatalogs, start=0):
+        """Deblend parents using a pool of worker processes
+
+        The parents are dispatched to ``config.numProcesses`` worker processes
+        in order of decreasing cost (see `estimateCost`), so that the largest
+        blends do not end up running on their own at the end of the patch.
+        The children are added to the output catalogs in the original parent
+        order as soon as all of the preceding parents have been deblended,
+        so the catalogs are identical to the ones created by the serial
+        deblender.  `postSingleDeblendHook` is called with ``result=None``,
+        as the full deblender result is only available in the worker process.
+
+        Parameters
+        ----------
+        toDeblend: list of int
+            Indices in ``sources`` of the parents to deblend, in catalog order.
+        exposure: `lsst.afw.image.Exposure`
+            Exposure passed to `postSingleDeblendHook`.
+        mMaskedImage: `MultibandMaskedImage`
+            Masked images of the exposures in each band.
+        sources: `SourceCatalog`
+            The merged `SourceCatalog` that contains the parent footprints.
+        psfs: dict
+            PSF in each band.
+        fwhms: dict
+            PSF FWHM in each band (a dict keyed by filter) for each parent index.
+        sigmas: dict
+            Noise level in each band (a dict keyed by filter) for each parent index.
+        fluxCatalogs: dict or None
+            Flux conserved output catalog in each band.
+        templateCatalogs: dict or None
+            Template output catalog in each band.
+        start: int, optional
+            Index in ``sources`` of the first parent in the output catalogs.
+        """
+        filters = mMaskedImage.filters
+        # The parents whose results are in the checkpoint or the result cache are not sent to the workers
+        keys = {}
+        cached = {}
+        for pk in toDeblend:
+            keys[pk], result = None, None
+            if self.checkpoint is not None:
+                result = self.checkpoint.get(sources[pk].getId())
+            if result is None:
+                keys[pk], result = self._lookupResult(sources[pk].getFootprint(), mMaskedImage, psfs,
+                                                      fwhms[pk], sigmas[pk])
+            if result is not None:
+                cached[pk] = result
+        order = sorted([pk for pk in toDeblend if pk not in cached],
+                       key=lambda pk: self.estimateCost(sources[pk].getFootprint(), len(filters)),
+                       reverse=True)
+        self.log.info("Deblending %d parents with %d processes" % (len(order), self.config.numProcesses))
+
+        state = dict(task=self, sources=sources, mMaskedImage=mMaskedImage, psfs=psfs, fwhms=fwhms,
+                     sigmas=sigmas)
+        results = []
+        if order:
+            results = _mapParents(_deblendMultibandParent, state, order, self.config.numProcesses,
+                                  ordered=False)
+        pending = {}
+        nextParent = 0
+        npre = len(sources)
+        for index, result in itertools.chain(cached.items(), results):
+            pending[index] = result
+            while nextParent < len(toDeblend) and toDeblend[nextParent] in pending:
+                pk = toDeblend[nextParent]
+                result = pending.pop(pk)
+                nextParent += 1
+
+                src = sources[pk]
+                foot = src.getFootprint()
+                if isinstance(result, _WorkerFailure):
+                    if self.config.catchFailures:
+                        self.log.warn("Unable to deblend source %d: %s" % (src.getId(), result.message))
+                        src.set(self.deblendFailedKey, True)
+                        src.set(self.runtimeKey, 0)
+                        self.log.debug(result.traceback)
                         continue
-                    # We need to preserve the peak: make sure we have enough info to create a minimal
-                    # child src
-                    msg = "Peak at {0} failed deblending.  Using minimal default info for child."
-                    self.log.trace(msg.format(multiPeak.x, multiPeak.y))
+                    raise RuntimeError("Unable to deblend source %d: %s\n%s" %
+                                       (src.getId(), result.message, result.traceback))
+                payload, runtime = result
+                self._storeResult(src.getId(), payload, runtime, None if pk in cached else keys[pk])
+                if payload.failed:
+                    src.set(self.deblendFailedKey, False)
+                    src.set(self.runtimeKey, 0)
+                    continue
 
-                    # copy the full footprint and strip out extra peaks
-                    pfoot = afwDet.Footprint(foot)
-                    peakList = pfoot.getPeaks()
-                    peakList.clear()
-                    pfoot.addPeak(multiPeak.x, multiPeak.y, 0)
-                    zeroMimg = afwImage.MaskedImageF(pfoot.getBBox())
-                    for f in filters:
-                        heavy[f] = afwDet.makeHeavyFootprint(pfoot, zeroMimg)
-                else:
-                    src.set(self.deblendSkippedKey, False)
+                payload.attach(foot)
+                if pk not in cached:
+                    records = self._getParentRecords(pk - start, fluxCatalogs, templateCatalogs)
+                    _recordPluginStatistics(self, records, payload.pluginStatistics, payload.maxRss)
+                self._addChildren(pk - start, src, payload.peaks, runtime, filters, fluxCatalogs,
+                                  templateCatalogs)
+                self.postSingleDeblendHook(exposure, fluxCatalogs, templateCatalogs,
+                                           pk - start, npre, foot, psfs, fwhms[pk], sigmas[pk], None)
+
+    def estimateCost(self, footprint, nBands):
+        """Estimate the relative cost of deblending a parent
+
+        The cost of fitting the multiband model scales with the number
+        of pixels in the footprint, the number of peaks that are deblended
+        and the number of bands.
+
+        Parameters
+        ----------
+        footprint: `afw.detection.Footprint`
+            Parent footprint.
+        nBands: int
+            Number of bands.
+
+        Returns
+        -------
+        cost: int
+            Estimated cost, in arbitrary units.
+        """
+        nPeaks = len(footprint.getPeaks())
+        if self.config.maxNumberOfPeaks > 0:
+            nPeaks = min(nPeaks, self.config.maxNumberOfPeaks)
+        return footprint.getArea()*nPeaks*nBands
+
+    def _deblendParent(self, foot, mMaskedImage, psfs, psf_fwhms, sigmas):
+        """Run the multiband deblender on a single parent footprint
+
+        Returns
+        -------
+        result: `lsst.meas.deblender.baseline.DeblenderResult`
+            Deblender result for the parent.
+        runtime: float
+            Time taken to deblend the parent, in ms.
+        """
+        from lsst.meas.deblender.baseline import newDeblend
+
+        filters = mMaskedImage.filters
+        t0 = time.time()
+        # Build the parameter lists with the same ordering
+        images = mMaskedImage[:, foot.getBBox()]
+        psf_list = [psfs[f] for f in filters]
+        cache_list = [self._getPsfCache(f, psfs[f]) for f in filters]
+        fwhm_list = [psf_fwhms[f] for f in filters]
+        avgNoise = [sigmas[f] for f in filters]
+
+        result = newDeblend(debPlugins=self.plugins,
+                            footprint=foot,
+                            mMaskedImage=images,
+                            psfs=psf_list,
+                            psfFwhms=fwhm_list,
+                            avgNoise=avgNoise,
+                            maxNumberOfPeaks=self.config.maxNumberOfPeaks,
+                            numThreads=self.config.numBandThreads,
+                            psfCaches=cache_list,
+                            saveDebugTemplates=self.config.saveDebugTemplates)
+        tf = time.time()
+        runtime = (tf-t0)*1000
+        return result, runtime
+
+    def _lookupResult(self, foot, mMaskedImage, psfs, psf_fwhms, sigmas):
+        """Look for the result of a parent footprint in the result cache
+
+        The key of the result is a hash of the footprint and its peaks, the pixels in
+        its bounding box, the PSF image at its center, the PSF FWHM and the noise level
+        in each band, and the configuration.  When ``config.edgeHandling`` is ``'ramp'``,
+        the bounding box is grown by the ramp size of the largest PSF FWHM, as the ramped
+        templates extend outside of the footprint.  The key must be computed before the
+        footprint is deblended, as the deblender modifies the footprint.
+
+        Returns
+        -------
+        key: `str` or None
+            Key of the result, or None if there is no result cache.
+        result: `tuple` or None
+            The cached `DeblenderResultPayload` and runtime of the parent,
+            or None if it is not in the cache.
+        """
+        if self.resultCache is None:
+            return None, None
+        filters = mMaskedImage.filters
+        bbox = foot.getBBox()
+        if self.config.edgeHandling == 'ramp':
+            bbox.grow(getRampSize(max(psf_fwhms[f] for f in filters)))
+            bbox.clip(mMaskedImage.getBBox())
+        center = afwGeom.Box2D(foot.getBBox()).getCenter()
+        psfImages = [self._getPsfCache(f, psfs[f]).computeImage(center.getX(), center.getY())
+                     for f in filters]
+        parameters = (_getConfigParameters(self.config) + tuple(filters) +
+                      tuple(psf_fwhms[f] for f in filters) + tuple(sigmas[f] for f in filters))
+        key = makeResultKey(foot, list(mMaskedImage[:, bbox]), psfImages, parameters)
+        return key, self.resultCache.get(key)
+
+    def _storeResult(self, parentId, result, runtime, key=None):
+        """Store the result of a parent in the checkpoint (if there is one)
+        and in the result cache (if ``key`` is not None)
+
+        ``result`` is either the `DeblenderResult` of the parent or its
+        `DeblenderResultPayload`.
+        """
+        if self.checkpoint is None and key is None:
+            return
+        if not isinstance(result, DeblenderResultPayload):
+            result = DeblenderResultPayload(result, self.config.saveTemplates)
+        if self.checkpoint is not None:
+            self.checkpoint.add(parentId, (result, runtime))
+        if key is not None:
+            self.resultCache.put(key, (result, runtime))
+
+    def _getParentRecords(self, pk, fluxCatalogs, templateCatalogs):
+        """Return the records of the parent with index ``pk`` in all of the output catalogs
+        """
+        records = []
+        for catalogs in (fluxCatalogs, templateCatalogs):
+            if catalogs is not None:
+                records += [catalog[pk] for catalog in catalogs.values()]
+        return records
+
+    def _addChildren(self, pk, src, peaks, runtime, filters, fluxCatalogs, templateCatalogs):
+        """Add the deblended children of a parent to the catalogs in each band
+
+        Parameters
+        ----------
+        pk: int
+            Index of the parent in the catalogs.
+        src: `lsst.afw.table.source.source.SourceRecord`
+            The parent in the merged catalog.
+        peaks: list of `MultiColorPeak` (or `MultiColorPeakPayload`)
+            Deblender result for each peak in the parent.
+        runtime: float
+            Time taken to deblend the parent, in ms.
+        filters: list of str
+            Names of the filters.
+        fluxCatalogs: dict or None
+            Flux conserved output catalog in each band.
+        templateCatalogs: dict or None
+            Template output catalog in each band.
+        """
+        foot = src.getFootprint()
 
-                # Add the peak to the source catalog in each band
+        # Add the merged source as a parent in the catalog for each band
+        templateParents = {}
+        fluxParents = {}
+        parentId = src.getId()
+        for f in filters:
+            if self.config.saveTemplates:
+                templateParents[f] = templateCatalogs[f][pk]
+                templateParents[f].set(self.runtimeKey, runtime)
+            if self.config.conserveFlux:
+                fluxParents[f] = fluxCatalogs[f][pk]
+                fluxParents[f].set(self.runtimeKey, runtime)
+
+        # Add each source to the catalogs in each band
+        templateSpans = {f: afwGeom.SpanSet() for f in filters}
+        fluxSpans = {f: afwGeom.SpanSet() for f in filters}
+        nchild = 0
+        for j, multiPeak in enumerate(peaks):
+            heavy = {f: peak.getFluxPortion() for f, peak in multiPeak.deblendedPeaks.items()}
+            no_flux = all([v is None for v in heavy.values()])
+            skip_peak = all([peak.skip for peak in multiPeak.deblendedPeaks.values()])
+            if no_flux or skip_peak:
+                src.set(self.deblendSkippedKey, True)
+                if not self.config.propagateAllPeaks:
+                    # We don't care
+                    continue
+                # We need to preserve the peak: make sure we have enough info to create a minimal
+                # child src
+                msg = "Peak at {0} failed deblending.  Using minimal default info for child."
+                self.log.trace(msg.format(multiPeak.x, multiPeak.y))
+
+                # copy the full footprint and strip out extra peaks
+                pfoot = afwDet.Footprint(foot)
+                peakList = pfoot.getPeaks()
+                peakList.clear()
+                pfoot.addPeak(multiPeak.x, multiPeak.y, 0)
+                zeroMimg = afwImage.MaskedImageF(pfoot.getBBox())
                 for f in filters:
-                    if len(heavy[f].getPeaks()) != 1:
-                        err = "Heavy footprint should have a single peak, got {0}"
-                        raise ValueError(err.format(len(heavy[f].getPeaks())))
-                    peak = multiPeak.deblendedPeaks[f]
-                    if self.config.saveTemplates:
-                        cat = templateCatalogs[f]
-                        tfoot = peak.templateFootprint
-                        timg = afwImage.MaskedImageF(peak.templateImage)
-                        tHeavy = afwDet.makeHeavyFootprint(tfoot, timg)
-                        child = self._addChild(parentId, peak, cat, tHeavy)
-                        if parentId == 0:
-                            child.setId(src.getId())
-                            child.set(self.runtimeKey, runtime)
-                        else:
-                            templateSpans[f] = templateSpans[f].union(tHeavy.getSpans())
-                    if self.config.conserveFlux:
-                        cat = fluxCatalogs[f]
-                        child = self._addChild(parentId, peak, cat, heavy[f])
-                        if parentId == 0:
-                            child.setId(src.getId())
-                            child.set(self.runtimeKey, runtime)
-                        else:
-                            fluxSpans[f] = fluxSpans[f].union(heavy[f].getSpans())
-                    nchild += 1
-
-            # Child footprints may extend beyond the full extent of their parent's which
-            # results in a failure of the replace-by-noise code to reinstate these pixels
-            # to their original values.  The following updates the parent footprint
-            # in-place to ensure it contains the full union of itself and all of its
-            # children's footprints.
+                    heavy[f] = afwDet.makeHeavyFootprint(pfoot, zeroMimg)
+            else:
+                src.set(self.deblendSkippedKey, False)
+
+            # Add the peak to the source catalog in each band
             for f in filters:
+                if len(heavy[f].getPeaks()) != 1:
+                    err = "Heavy footprint should have a single peak, got {0}"
+                    raise ValueError(err.format(len(heavy[f].getPeaks())))
+                peak = multiPeak.deblendedPeaks[f]
                 if self.config.saveTemplates:
-                    templateParents[f].set(self.nChildKey, nchild)
-                    templateParents[f].getFootprint().setSpans(templateSpans[f])
+                    cat = templateCatalogs[f]
+                    tHeavy = peak.getTemplateHeavy()
+                    child = self._addChild(parentId, peak, cat, tHeavy)
+                    if parentId == 0:
+                        child.setId(src.getId())
+                        child.set(self.runtimeKey, runtime)
+                    else:
+                        templateSpans[f] = templateSpans[f].union(tHeavy.getSpans())
                 if self.config.conserveFlux:
-                    fluxParents[f].set(self.nChildKey, nchild)
-                    fluxParents[f].getFootprint().setSpans(fluxSpans[f])
-
-            self.postSingleDeblendHook(exposure, fluxCatalogs, templateCatalogs,
-                                       pk, npre, foot, psfs, psf_fwhms, sigmas, result)
+                    cat = fluxCatalogs[f]
+                    child = self._addChild(parentId, peak, cat, heavy[f])
+                    if parentId == 0:
+                        child.setId(src.getId())
+                        child.set(self.runtimeKey, runtime)
+                    else:
+                        fluxSpans[f] = fluxSpans[f].union(heavy[f].getSpans())
+                nchild += 1
 
-        if fluxCatalogs is not None:
-            n1 = len(list(fluxCatalogs.values())[0])
-        else:
-            n1 = len(list(templateCatalogs.values())[0])
-        self.log.info('Deblended: of %i sources, %i were deblended, creating %i children, total %i sources'
-                      % (n0, nparents, n1-n0, n1))
-        return fluxCatalogs, templateCatalogs
+        # Child footprints may extend beyond the full extent of their parent's which
+        # results in a failure of the replace-by-noise code to reinstate these pixels
+        # to their original values.  The following updates the parent footprint
+        # in-place to ensure it contains the full union of itself and all of its
+        # children's footprints.
+        for f in filters:
+            if self.config.saveTemplates:
+                templateParents[f].set(self.nChildKey, nchild)
+                templateParents[f].getFootprint().setSpans(templateSpans[f])
+            if self.config.conserveFlux:
+                fluxParents[f].set(self.nChildKey, nchild)
+                fluxParents[f].getFootprint().setSpans(fluxSpans[f])
 
     def preSingleDeblendHook(self, exposures, sources, pk, fp, psfs, psf_fwhms, sigmas):
         pass
@@ -1183,3 +2038,206 @@ class MultibandDeblendTask(pipeBase.Task):
             for mask in masks:
                 mask.addMaskPlane(self.config.notDeblendedMask)
                 fp.spans.setMask(mask, mask.getPlaneBitMask(self.config.notDeblendedMask))
+
+
+# State shared with the worker processes.
+# The pool is created with the "fork" start method, so the workers inherit this
+# module-level state (the exposure, catalog, etc) without it having to be pickled.
+_workerState = None
+
+
+def _addPluginStatisticsKeys(schema, pluginNames):
+    """Add the fields that record the time spent in each deblender plugin to ``schema``
+
+    Parameters
+    ----------
+    schema: `lsst.afw.table.Schema`
+        Schema to add the fields to.
+    pluginNames: list of `str`
+        Names of the plugin functions.
+
+    Returns
+    -------
+    timeKeys: `OrderedDict`
+        Key of the time field of each plugin.
+    """
+    timeKeys = OrderedDict()
+    for name in pluginNames:
+        if name not in timeKeys:
+            timeKeys[name] = schema.addField("deblend_time_" + name, type=np.float32, units="s",
+                                             doc="Time spent in the {0} deblender plugin".format(name))
+    return timeKeys
+
+
+def _recordPluginStatistics(task, records, pluginStatistics, maxRss):
+    """Add the plugin statistics of a parent to the totals of ``task``
+    and (if configured) to the parent ``records``
+
+    ``maxRss`` is the high-water mark of the memory of the process that
+    deblended the parent.  It includes the memory used by all of the
+    previous parents of that process, so it is only kept as the maximum of
+    the task, not recorded for each parent.
+    """
+    for name, stats in pluginStatistics.items():
+        if name not in task.pluginStatistics:
+            task.pluginStatistics[name] = PluginStatistics(name)
+        task.pluginStatistics[name].add(stats)
+    if maxRss is not None:
+        task.maxRss = maxRss if task.maxRss is None else max(task.maxRss, maxRss)
+    if task.pluginTimeKeys is None:
+        return
+    for record in records:
+        for name, key in task.pluginTimeKeys.items():
+            stats = pluginStatistics.get(name)
+            record.set(key, 0 if stats is None else stats.time)
+
+
+def _writePluginStatistics(task):
+    """Write the plugin statistics of ``task`` to its metadata and log
+    """
+    if not task.pluginStatistics:
+        return
+    lines = ["{0:<28} {1:>10} {2:>8} {3:>8}".format("plugin", "time (s)", "calls", "resets")]
+    for name, stats in task.pluginStatistics.items():
+        task.metadata.set("pluginTime_" + name, stats.time)
+        task.metadata.set("pluginCalls_" + name, stats.calls)
+        task.metadata.set("pluginResets_" + name, stats.resets)
+        lines.append("{0:<28} {1:>10.3f} {2:>8d} {3:>8d}".format(name, stats.time, stats.calls,
+                                                                 stats.resets))
+    if task.maxRss is not None:
+        task.metadata.set("processMaxRss", task.maxRss)
+        lines.append("process memory high-water mark: {0:.1f} MiB".format(task.maxRss))
+    task.log.info("Deblender plugin statistics:\n" + "\n".join(lines))
+
+
+# Configuration fields that do not change the deblender results, and are
+# not included in the keys of the result cache or the checkpoint headers
+_EXECUTION_CONFIG_FIELDS = frozenset([
+    "numProcesses", "numBandThreads", "psfCacheSize", "addTimingFields", "catchFailures",
+    "saveDebugTemplates", "outputDir", "outputBatchSize", "resultCacheDir", "resultCacheSize",
+    "checkpointFile", "checkpointInterval", "resumeFromCheckpoint",
+])
+
+
+def _getConfigParameters(config):
+    """Return the configuration values that are included in the keys of the result cache
+    and the checkpoint headers
+    """
+    return tuple((name, repr(value)) for name, value in sorted(config.toDict().items())
+                 if name not in _EXECUTION_CONFIG_FIELDS)
+
+
+def _getResultCache(task):
+    """Return the result cache of ``task``
+
+    The cache is created when ``config.resultCacheDir`` is set and is kept
+    for the lifetime of the task, unless the directory is changed.
+    """
+    directory = task.config.resultCacheDir
+    if directory is None:
+        task.resultCache = None
+    elif task.resultCache is None or task.resultCache.directory != directory:
+        task.resultCache = ResultCache(directory, maxBytes=task.config.resultCacheSize*2**20)
+    return task.resultCache
+
+
+def _getResultCacheCounts(task):
+    """Create the result cache of ``task`` (if configured) and return its
+    current ``(hits, misses, evictions)``, for `_writeResultCacheStatistics`
+    """
+    cache = _getResultCache(task)
+    if cache is None:
+        return None
+    return cache.hits, cache.misses, cache.evictions
+
+
+def _writeResultCacheStatistics(task, counts):
+    """Write the result cache statistics of a call to ``deblend`` to the metadata and log
+
+    ``counts`` are the values returned by `_getResultCacheCounts` before the call.
+    """
+    cache = task.resultCache
+    if cache is None or counts is None:
+        return
+    hits = cache.hits - counts[0]
+    misses = cache.misses - counts[1]
+    evictions = cache.evictions - counts[2]
+    task.metadata.set("resultCacheHits", hits)
+    task.metadata.set("resultCacheMisses", misses)
+    task.metadata.set("resultCacheEvictions", evictions)
+    hitRate = hits/(hits + misses) if hits + misses > 0 else 0.
+    task.log.info("Result cache: %d hits, %d misses (hit rate %.1f%%), %d evictions, "
+                  "%d results (%d bytes)" % (hits, misses, 100*hitRate, evictions, len(cache), cache.nbytes))
+
+
+class _WorkerFailure:
+    """Exception raised while deblending a parent in a worker process"""
+
+    def __init__(self, exc):
+        self.message = str(exc)
+        self.traceback = traceback.format_exc()
+
+
+def _mapParents(func, state, indices, numProcesses, ordered=True):
+    """Run ``func`` on each parent index in a pool of worker processes
+
+    Parameters
+    ----------
+    func: callable
+        Module level function that takes a parent index and returns
+        ``(index, result)``. It can access ``state`` as ``_workerState``.
+    state: `dict`
+        State shared with the workers.
+    indices: list of `int`
+        Indices of the parents to deblend, in the order they are dispatched.
+    numProcesses: `int`
+        Number of worker processes.
+    ordered: `bool`, optional
+        If True, the results are yielded in the same order as ``indices``,
+        otherwise they are yielded as soon as they are completed.
+
+    Yields
+    ------
+    index: `int`
+        Index of the parent
+    result: object
+        The value returned by ``func`` for the parent.
+    """
+    global _workerState
+    _workerState = state
+    try:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(numProcesses) as pool:
+            mapper = pool.imap if ordered else pool.imap_unordered
+            for index, result in mapper(func, indices, chunksize=1):
+                yield index, result
+    finally:
+        _workerState = None
+
+
+def _deblendSingleBandParent(index):
+    """Deblend a single parent of a `SourceDeblendTask` in a worker process
+    """
+    task = _workerState["task"]
+    src = _workerState["srcs"][index]
+    fp = src.getFootprint()
+    try:
+        res = task._deblendFootprint(fp, _workerState["maskedImage"], _workerState["psf"],
+                                     _workerState["fwhms"][index], _workerState["sigmas"][index])
+        return index, DeblendedParentPayload(res.deblendedParents[0])
+    except Exception as e:
+        return index, _WorkerFailure(e)
+
+
+def _deblendMultibandParent(index):
+    """Deblend a single parent of a `MultibandDeblendTask` in a worker process
+    """
+    task = _workerState["task"]
+    src = _workerState["sources"][index]
+    try:
+        result, runtime = task._deblendParent(src.getFootprint(), _workerState["mMaskedImage"],
+                                              _workerState["psfs"], _workerState["fwhms"][index],
+                                              _workerState["sigmas"][index])
+        return index, (DeblenderResultPayload(result, task.config.saveTemplates), runtime)
+    except Exception as e:
+        return index, _WorkerFailure(e)
@@ -0,0 +1,255 @@
+# This file is part of meas_deblender.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Picklable summaries of deblender results
+
+The deblender results (`DeblenderResult`, `DeblendedPeak`, ...) hold afw
+images, footprints and peak records that cannot be sent between processes
+or written to disk cheaply.  The classes in this module store only the
+information that the deblender tasks need to create child sources, as
+numpy arrays and python scalars, and rebuild the afw objects on demand.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+
+__all__ = ["spansToArray", "arrayToSpans", "HeavyFootprintPayload", "DeblendedPeakPayload",
+           "DeblendedParentPayload", "MultiColorPeakPayload", "DeblenderResultPayload"]
+
+
+def spansToArray(spans):
+    """Convert a `SpanSet` into an ``(N, 3)`` array of ``(y, x0, x1)``
+    """
+    return np.array([(s.getY(), s.getX0(), s.getX1()) for s in spans], dtype=np.int32).reshape(-1, 3)
+
+
+def arrayToSpans(arr):
+    """Convert an ``(N, 3)`` array of ``(y, x0, x1)`` into a `SpanSet`
+    """
+    return afwGeom.SpanSet([afwGeom.Span(int(y), int(x0), int(x1)) for y, x0, x1 in arr])
+
+
+def _recordToTuple(record):
+    """Extract the values of all of the fields in a `PeakRecord`"""
+    return tuple(record.get(item.key) for item in record.getSchema())
+
+
+def _tupleToRecord(values, catalog):
+    """Add a new `PeakRecord` to ``catalog`` using ``values``
+    extracted with `_recordToTuple`.
+    """
+    record = catalog.addNew()
+    for item, value in zip(catalog.getSchema(), values):
+        record.set(item.key, value)
+    return record
+
+
+class HeavyFootprintPayload:
+    """Compact, picklable copy of a `HeavyFootprintF`
+
+    The pixels are stored in the same (span) order used by the
+    ``HeavyFootprint``, so the footprint rebuilt by `makeHeavyFootprint`
+    is identical to the original.
+
+    Parameters
+    ----------
+    heavy: `afw.detection.HeavyFootprintF`
+        HeavyFootprint to copy.
+    """
+    __slots__ = ("spans", "image", "mask", "variance", "peaks")
+
+    def __init__(self, heavy):
+        self.spans = spansToArray(heavy.getSpans())
+        self.image = np.array(heavy.getImageArray(), copy=True)
+        self.mask = np.array(heavy.getMaskArray(), copy=True)
+        self.variance = np.array(heavy.getVarianceArray(), copy=True)
+        self.peaks = [_recordToTuple(pk) for pk in heavy.getPeaks()]
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the arrays in the payload"""
+        return self.spans.nbytes + self.image.nbytes + self.mask.nbytes + self.variance.nbytes
+
+    def makeHeavyFootprint(self, peakSchema):
+        """Rebuild the `HeavyFootprintF`
+
+        Parameters
+        ----------
+        peakSchema: `afw.table.Schema`
+            Schema of the peaks in the original footprint.
+
+        Returns
+        -------
+        heavy: `afw.detection.HeavyFootprintF`
+            The HeavyFootprint described by this payload.
+        """
+        spans = arrayToSpans(self.spans)
+        foot = afwDet.Footprint(spans, peakSchema)
+        for values in self.peaks:
+            _tupleToRecord(values, foot.getPeaks())
+        mimg = afwImage.MaskedImageF(spans.getBBox())
+        if len(self.spans) > 0:
+            mimg.getImage().getArray()[:] = spans.unflatten(self.image)
+            mimg.getMask().getArray()[:] = spans.unflatten(self.mask)
+            mimg.getVariance().getArray()[:] = spans.unflatten(self.variance)
+        return afwDet.makeHeavyFootprint(foot, mimg)
+
+
+class DeblendedPeakPayload:
+    """Picklable summary of a `DeblendedPeak`
+
+    This stores the flags and the flux portion that the deblender tasks use to
+    create a child source, with the same attribute names as `DeblendedPeak`,
+    so that either class can be used to add children to a catalog.
+
+    Parameters
+    ----------
+    pkres: `lsst.meas.deblender.baseline.DeblendedPeak`
+        Deblender result for a single peak.
+    saveTemplate: `bool`, optional
+        Whether or not to also store the template of the peak.
+    """
+
+    def __init__(self, pkres, saveTemplate=False):
+        self.skip = pkres.skip
+        self.deblendedAsPsf = pkres.deblendedAsPsf
+        self.psfFitFlux = pkres.psfFitFlux
+        self.psfFitCenter = pkres.psfFitCenter
+        self.hasStrayFlux = pkres.hasStrayFlux
+        self.hasRampedTemplate = pkres.hasRampedTemplate
+        self.patched = pkres.patched
+        self.center = (pkres.peak.getFx(), pkres.peak.getFy(), pkres.peak.getIx(), pkres.peak.getIy())
+        heavy = pkres.getFluxPortion()
+        self.fluxPortion = None if heavy is None else HeavyFootprintPayload(heavy)
+        heavy = pkres.getTemplateHeavy() if saveTemplate else None
+        self.template = None if heavy is None else HeavyFootprintPayload(heavy)
+        # Set by `DeblendedParentPayload.attach` in the receiving process
+        self.peak = None
+        self.peakSchema = None
+
+    def attach(self, peak):
+        """Associate the summary with the peak record in the parent footprint
+
+        The peak position is updated to the value found by the deblender,
+        exactly as it would have been if the deblender had run in this process.
+        """
+        fx, fy, ix, iy = self.center
+        peak.setFx(fx)
+        peak.setFy(fy)
+        peak.setIx(ix)
+        peak.setIy(iy)
+        self.peak = peak
+        self.peakSchema = peak.getSchema()
+
+    def getFluxPortion(self):
+        """Return a HeavyFootprint containing the flux apportioned to this peak
+        """
+        if self.fluxPortion is None:
+            return None
+        return self.fluxPortion.makeHeavyFootprint(self.peakSchema)
+
+    def getTemplateHeavy(self):
+        """Return a HeavyFootprint containing the template for this peak
+        """
+        if self.template is None:
+            return None
+        return self.template.makeHeavyFootprint(self.peakSchema)
+
+
+class DeblendedParentPayload:
+    """Picklable summary of the single band deblender result for a parent
+
+    Parameters
+    ----------
+    dp: `lsst.meas.deblender.baseline.DeblendedParent`
+        Deblender result for the parent footprint in a single band.
+    """
+
+    def __init__(self, dp):
+        self.spans = spansToArray(dp.fp.getSpans())
+        self.peaks = [DeblendedPeakPayload(pkres) for pkres in dp.peaks]
+        self.pluginStatistics = dp.debResult.pluginStatistics
+        self.maxRss = dp.debResult.maxRss
+
+    def attach(self, footprint):
+        """Copy the deblender modifications into ``footprint``
+
+        The spans of the parent ``footprint`` are replaced with the spans
+        after deblending (for example when the stray flux is trimmed) and
+        each peak summary is associated with its peak record.
+        """
+        footprint.setSpans(arrayToSpans(self.spans))
+        for pk, peak in zip(footprint.getPeaks(), self.peaks):
+            peak.attach(pk)
+
+
+class MultiColorPeakPayload:
+    """Picklable summary of a `MultiColorPeak`
+
+    Parameters
+    ----------
+    multiPeak: `lsst.meas.deblender.baseline.MultiColorPeak`
+        Deblender result for a single peak in all bands.
+    saveTemplates: `bool`, optional
+        Whether or not to also store the template of the peak in each band.
+    """
+
+    def __init__(self, multiPeak, saveTemplates=False):
+        self.x = multiPeak.x
+        self.y = multiPeak.y
+        self.deblendedPeaks = OrderedDict([(f, DeblendedPeakPayload(pkres, saveTemplates))
+                                           for f, pkres in multiPeak.deblendedPeaks.items()])
+
+
+class DeblenderResultPayload:
+    """Picklable summary of the multiband deblender result for a parent
+
+    Parameters
+    ----------
+    debResult: `lsst.meas.deblender.baseline.DeblenderResult`
+        Deblender result for the parent footprint in all bands.
+    saveTemplates: `bool`, optional
+        Whether or not to also store the template of each peak.
+    """
+
+    def __init__(self, debResult, saveTemplates=False):
+        self.failed = debResult.failed
+        self.spans = spansToArray(debResult.footprint.getSpans())
+        self.peaks = [MultiColorPeakPayload(multiPeak, saveTemplates) for multiPeak in debResult.peaks]
+        self.pluginStatistics = debResult.pluginStatistics
+        self.maxRss = debResult.maxRss
+
+    def attach(self, footprint):
+        """Copy the deblender modifications into ``footprint``
+
+        See `DeblendedParentPayload.attach`.  The peak records are shared
+        by all of the bands, so each record is updated once per band with
+        the same values.
+        """
+        footprint.setSpans(arrayToSpans(self.spans))
+        for pk, multiPeak in zip(footprint.getPeaks(), self.peaks):
+            for peak in multiPeak.deblendedPeaks.values():
+                peak.attach(pk)
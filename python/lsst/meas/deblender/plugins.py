@@ -19,6 +19,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 import scarlet
@@ -117,6 +120,62 @@ class DeblenderPlugin:
         return self.__str__()
 
 
+class PluginStatistics:
+    """Time spent running a deblender plugin
+
+    Parameters
+    ----------
+    name: `str`
+        Name of the plugin function.
+    """
+    __slots__ = ("name", "time", "calls", "resets")
+
+    def __init__(self, name):
+        self.name = name
+        self.time = 0.
+        self.calls = 0
+        self.resets = 0
+
+    def add(self, other):
+        """Add the statistics of ``other`` (for the same plugin) to this one"""
+        self.time += other.time
+        self.calls += other.calls
+        self.resets += other.resets
+
+    def __repr__(self):
+        return ("<PluginStatistics: name={0}, time={1:.3f}s, calls={2}, resets={3}>".format(
+            self.name, self.time, self.calls, self.resets))
+
+
+def _mapFilters(debResult, func, *args, **kwargs):
+    """Run ``func`` on the `DeblendedParent` in each filter
+
+    The deblender results in each filter are independent, so when
+    ``debResult.numThreads > 1`` the filters are processed by a pool of threads.
+    Most of the time is spent in C++ and numpy routines that release the GIL.
+
+    Parameters
+    ----------
+    debResult: `lsst.meas.deblender.baseline.DeblenderResult`
+        Container for the final deblender results.
+    func: `function`
+        Function that takes a `DeblendedParent` as its first argument,
+        followed by ``args`` and ``kwargs``.
+
+    Returns
+    -------
+    results: `list`
+        Value returned by ``func`` for each filter, in the same order as ``debResult.filters``.
+    """
+    dps = [debResult.deblendedParents[fidx] for fidx in debResult.filters]
+    numThreads = min(debResult.numThreads, len(dps))
+    if numThreads < 2:
+        return [func(dp, *args, **kwargs) for dp in dps]
+    with ThreadPoolExecutor(numThreads) as executor:
+        futures = [executor.submit(func, dp, *args, **kwargs) for dp in dps]
+        return [future.result() for future in futures]
+
+
 def _setPeakError(debResult, log, pk, cx, cy, filters, msg, flag):
     """Update the peak in each band with an error
 
@@ -342,6 +401,10 @@ def fitPsfs(debResult, log, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.
     This will likely be replaced in the future with a function that compares the psf chi-squared cuts
     so that peaks flagged as point sources will be considered point sources in all bands.
 
+    The least-squares fits for all of the peaks in a band are solved together (see `_fitPsfBatch`),
+    unless the ``lsstDebug`` ``plots`` or ``psf`` outputs are requested, which are only produced
+    when the peaks are fit one at a time by `_fitPsf`.
+
     Parameters
     ----------
     debResult: `lsst.meas.deblender.baseline.DeblenderResult`
@@ -373,35 +436,61 @@ def fitPsfs(debResult, log, psfChisqCut1=1.5, psfChisqCut2=1.5, psfChisqCut2b=1.
         If any templates have been assigned to PSF point sources then ``modified`` is ``True``,
         otherwise it is ``False``.
     """
-    from .baseline import CachingPsf
-    modified = False
-    # Loop over all of the filters to build the PSF
-    for fidx in debResult.filters:
-        dp = debResult.deblendedParents[fidx]
-        peaks = dp.fp.getPeaks()
-        cpsf = CachingPsf(dp.psf)
+    # Fit the PSF to the peaks in each filter
+    modified = _mapFilters(debResult, _fitPsfs, log, psfChisqCut1, psfChisqCut2, psfChisqCut2b,
+                           tinyFootprintSize)
+    return any(modified)
 
-        # create mask image for pixels within the footprint
-        fmask = afwImage.Mask(dp.bb)
-        fmask.setXY0(dp.bb.getMinX(), dp.bb.getMinY())
-        dp.fp.spans.setMask(fmask, 1)
 
-        # pk.getF() -- retrieving the floating-point location of the peak
-        # -- actually shows up in the profile if we do it in the loop, so
-        # grab them all here.
-        peakF = [pk.getF() for pk in peaks]
+def _fitPsfs(dp, log, psfChisqCut1, psfChisqCut2, psfChisqCut2b, tinyFootprintSize):
+    """Fit a PSF + smooth background model to each peak in a single filter
 
+    See `fitPsfs` for a description of the parameters.
+    """
+    import lsstDebug
+    modified = False
+    peaks = dp.fp.getPeaks()
+    cpsf = dp.psfCache
+
+    # create mask image for pixels within the footprint
+    fmask = afwImage.Mask(dp.bb)
+    fmask.setXY0(dp.bb.getMinX(), dp.bb.getMinY())
+    dp.fp.spans.setMask(fmask, 1)
+
+    # pk.getF() -- retrieving the floating-point location of the peak
+    # -- actually shows up in the profile if we do it in the loop, so
+    # grab them all here.
+    peakF = [pk.getF() for pk in peaks]
+    # Index the peaks so that the neighbours of each peak can be found without
+    # looping over all of the other peaks
+    peakIndex = _PeakIndex(peakF, 3*dp.psffwhm)
+
+    debugInfo = lsstDebug.Info(__name__)
+    if debugInfo.plots or debugInfo.psf:
+        # The debugging outputs are only produced when fitting one peak at a time
         for pki, (pk, pkres, pkF) in enumerate(zip(peaks, dp.peaks, peakF)):
-            log.trace('Filter %s, Peak %i', fidx, pki)
+            log.trace('Filter %s, Peak %i', dp.filter, pki)
             ispsf = _fitPsf(dp.fp, fmask, pk, pkF, pkres, dp.bb, peaks, peakF, log, cpsf, dp.psffwhm,
-                            dp.img, dp.varimg, psfChisqCut1, psfChisqCut2, psfChisqCut2b, tinyFootprintSize)
+                            dp.img, dp.varimg, psfChisqCut1, psfChisqCut2, psfChisqCut2b, tinyFootprintSize,
+                            peakIndex=peakIndex)
             modified = modified or ispsf
-    return modified
+        return modified
+
+    # Build the least-squares systems for all of the peaks and solve them together
+    fits = []
+    for pki, (pk, pkres, pkF) in enumerate(zip(peaks, dp.peaks, peakF)):
+        log.trace('Filter %s, Peak %i', dp.filter, pki)
+        fit = _buildPsfFit(dp.fp, fmask, pk, pkF, pkres, dp.bb, peaks, peakF, log, cpsf, dp.psffwhm,
+                           dp.img, dp.varimg, tinyFootprintSize, peakIndex)
+        if fit is not None:
+            fits.append(fit)
+    return _fitPsfBatch(fits, dp.fp, dp.bb, log, cpsf, dp.img, dp.varimg,
+                        psfChisqCut1, psfChisqCut2, psfChisqCut2b)
 
 
 def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
             img, varimg, psfChisqCut1, psfChisqCut2, psfChisqCut2b,
-            tinyFootprintSize=2,
+            tinyFootprintSize=2, peakIndex=None,
             ):
     """Fit a PSF + smooth background model (linear) to a small region around a peak.
 
@@ -433,6 +522,9 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
         The image that contains the footprint.
     varimg: `afw.image.ImageF`
         The variance of the image that contains the footprint.
+    peakIndex: `_PeakIndex`, optional
+        Index of ``peaksF``, used to find the neighbours of the peak.
+        If ``None``, all of the peaks are checked.
 
     Results
     -------
@@ -445,6 +537,161 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     debugPlots = lsstDebug.Info(__name__).plots
     debugPsf = lsstDebug.Info(__name__).psf
 
+    fit = _buildPsfFit(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
+                       img, varimg, tinyFootprintSize, peakIndex)
+    if fit is None:
+        return
+
+    A, b, w, ipixes = fit.A, fit.b, fit.w, fit.ipixes
+    xlo, xhi, ylo, yhi = fit.xlo, fit.xhi, fit.ylo, fit.yhi
+    NT2 = fit.NT2
+    if debugPlots:
+        import pylab as plt
+        plt.clf()
+        N = NT2 + 2
+        R, C = 2, (N+1)/2
+        for i in range(NT2):
+            im1 = np.zeros((1+yhi-ylo, 1+xhi-xlo))
+            im1[ipixes[:, 1], ipixes[:, 0]] = A[:, i]
+            plt.subplot(R, C, i+1)
+            plt.imshow(im1, interpolation='nearest', origin='lower')
+        plt.subplot(R, C, NT2+1)
+        im1 = np.zeros((1+yhi-ylo, 1+xhi-xlo))
+        im1[ipixes[:, 1], ipixes[:, 0]] = b
+        plt.imshow(im1, interpolation='nearest', origin='lower')
+        plt.subplot(R, C, NT2+2)
+        im1 = np.zeros((1+yhi-ylo, 1+xhi-xlo))
+        im1[ipixes[:, 1], ipixes[:, 0]] = w
+        plt.imshow(im1, interpolation='nearest', origin='lower')
+        plt.savefig('A.png')
+
+    # We do fits with and without the decenter (dx,dy) terms.
+    # Since the dx,dy terms are at the end of the matrix,
+    # we can do that just by trimming off those elements.
+    #
+    # The SVD can fail if there are NaNs in the matrices; this should
+    # really be handled upstream
+    try:
+        # NT1 is number of terms without dx,dy;
+        # X1 is the result without decenter
+        X1, r1, rank1, s1 = np.linalg.lstsq(fit.Aw[:, :fit.NT1], fit.bw, rcond=-1)
+        # X2 is with decenter
+        X2, r2, rank2, s2 = np.linalg.lstsq(fit.Aw, fit.bw, rcond=-1)
+    except np.linalg.LinAlgError as e:
+        log.warn("Failed to fit PSF to child: %s", e)
+        pkres.setPsfFitFailed()
+        return
+
+    log.debug('r1 r2 %s %s', r1, r2)
+
+    # r is weighted chi-squared = sum over pixels: ramp * (model -
+    # data)**2/sigma**2
+    if len(r1) > 0:
+        chisq1 = r1[0]
+    else:
+        chisq1 = 1e30
+    if len(r2) > 0:
+        chisq2 = r2[0]
+    else:
+        chisq2 = 1e30
+
+    if not _checkPsfFits(fit, log, X1, chisq1, X2, chisq2, psfChisqCut1, psfChisqCut2):
+        return
+
+    # Looks like a shifted PSF: try actually shifting the PSF by that amount
+    # and re-evaluate the fit.
+    if fit.ispsf2 and _buildShiftedPsfFit(fit, psf, fbb):
+        # re-solve...
+        Xb, rb, rankb, sb = np.linalg.lstsq(fit.Awb, fit.bw, rcond=-1)
+        if len(rb) > 0:
+            chisqb = rb[0]
+        else:
+            chisqb = 1e30
+        _checkShiftedPsfFit(fit, log, Xb, chisqb, psfChisqCut2b)
+
+    return _finishPsfFit(fit, fp, log, psf, img, varimg, debugPsf)
+
+
+class _PsfFit:
+    """Weighted least-squares system used to fit a PSF model to a single peak
+
+    This holds the state shared by `_buildPsfFit`, `_checkPsfFits`,
+    `_buildShiftedPsfFit`, `_checkShiftedPsfFit` and `_finishPsfFit`,
+    which allows the systems for all of the peaks in a footprint to be
+    solved together (see `_fitPsfBatch`).
+    """
+    # indices of columns in the "A" matrix.
+    I_psf = 0
+    I_sky = 1
+    I_sky_ramp_x = 2
+    I_sky_ramp_y = 3
+    # offset of other psf fluxes:
+    I_opsf = 4
+
+    def __init__(self, pkres, cx, cy):
+        self.pkres = pkres
+        self.cx = cx
+        self.cy = cy
+
+
+class _PeakIndex:
+    """Grid of peak positions used to find the peaks near a given position
+
+    The peaks are sorted into square cells, so that finding the neighbours
+    of a peak only requires checking the peaks in the nearby cells,
+    rather than all of the peaks in the footprint.
+
+    Parameters
+    ----------
+    peaksF: list of `afw.geom.Point2D`
+        Floating point coordinates of the peaks.
+    cellSize: `float`
+        Width of a cell in the grid.  Queries are fastest when this is
+        similar to the query radius.
+    """
+
+    def __init__(self, peaksF, cellSize):
+        self.xy = np.array([(pkF.getX(), pkF.getY()) for pkF in peaksF], dtype=float).reshape(-1, 2)
+        self.cellSize = max(float(cellSize), 1.)
+        self.cells = defaultdict(list)
+        for i, (ix, iy) in enumerate(np.floor(self.xy/self.cellSize).astype(int)):
+            self.cells[(ix, iy)].append(i)
+
+    def query(self, x, y, radius):
+        """Find the peaks within ``radius`` of ``(x, y)``
+
+        Returns
+        -------
+        indices: `numpy.ndarray`
+            Indices of the peaks in increasing order.
+            The peak at ``(x, y)`` (if any) is included.
+        """
+        n = int(np.ceil(radius/self.cellSize))
+        ix = int(np.floor(x/self.cellSize))
+        iy = int(np.floor(y/self.cellSize))
+        candidates = []
+        for cy in range(iy - n, iy + n + 1):
+            for cx in range(ix - n, ix + n + 1):
+                candidates.extend(self.cells.get((cx, cy), ()))
+        candidates = np.sort(np.array(candidates, dtype=int))
+        dxy = self.xy[candidates] - (x, y)
+        return candidates[np.sum(dxy**2, axis=1) <= radius**2]
+
+
+def _buildPsfFit(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
+                 img, varimg, tinyFootprintSize=2, peakIndex=None):
+    """Build the least-squares system for fitting a PSF model to a peak
+
+    See `_fitPsf` for a description of the parameters.
+
+    Returns
+    -------
+    fit: `_PsfFit`
+        The weighted design matrix ``Aw`` and data vector ``bw``,
+        along with the information needed to interpret the fit,
+        or ``None`` if the peak cannot be fit (in which case the reason
+        is recorded in ``pkres``).
+    """
     # The small region is a disk out to R0, plus a ramp with
     # decreasing weight down to R1.
     R0 = int(np.ceil(psffwhm*1.))
@@ -463,7 +710,7 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     # "Cannot compute CoaddPsf at point (xx,yy); no input images at that point."
     if not pbb.contains(afwGeom.Point2I(int(cx), int(cy))):
         pkres.setOutOfBounds()
-        return
+        return None
 
     # The bounding-box of the local region we are going to fit ("stamp")
     xlo = int(np.floor(cx - R1))
@@ -477,7 +724,7 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     if xlo > xhi or ylo > yhi:
         log.trace('Skipping this peak: out of bounds')
         pkres.setOutOfBounds()
-        return
+        return None
 
     # drop tiny footprints too?
     if min(stampbb.getWidth(), stampbb.getHeight()) <= max(tinyFootprintSize, 2):
@@ -485,11 +732,16 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
         # by one pixel to the left and right.
         log.trace('Skipping this peak: tiny footprint / close to edge')
         pkres.setTinyFootprint()
-        return
+        return None
 
     # find other peaks within range...
+    if peakIndex is None:
+        candidates = range(len(peaksF))
+    else:
+        candidates = peakIndex.query(cx, cy, R2)
     otherpeaks = []
-    for pk2, pkF2 in zip(peaks, peaksF):
+    for j in candidates:
+        pk2, pkF2 = peaks[j], peaksF[j]
         if pk2 == pk:
             continue
         if pkF.distanceSquared(pkF2) > R2**2:
@@ -510,12 +762,12 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     # Number of pixels -- at most
     NP = (1 + yhi - ylo)*(1 + xhi - xlo)
     # indices of columns in the "A" matrix.
-    I_psf = 0
-    I_sky = 1
-    I_sky_ramp_x = 2
-    I_sky_ramp_y = 3
+    I_psf = _PsfFit.I_psf
+    I_sky = _PsfFit.I_sky
+    I_sky_ramp_x = _PsfFit.I_sky_ramp_x
+    I_sky_ramp_y = _PsfFit.I_sky_ramp_y
     # offset of other psf fluxes:
-    I_opsf = 4
+    I_opsf = _PsfFit.I_opsf
     I_dx = NT1 + 0
     I_dy = NT1 + 1
 
@@ -545,7 +797,7 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     if NP == 0:
         log.warn('Skipping peak at (%.1f, %.1f): no unmasked pixels nearby', cx, cy)
         pkres.setNoValidPixels()
-        return
+        return None
 
     # pixel coords of valid pixels
     XX, YY = np.meshgrid(xx, yy)
@@ -560,17 +812,6 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     del inpsfx
     del inpsfy
 
-    def _overlap(xlo, xhi, xmin, xmax):
-        assert((xlo <= xmax) and (xhi >= xmin) and
-               (xlo <= xhi) and (xmin <= xmax))
-        xloclamp = max(xlo, xmin)
-        Xlo = xloclamp - xlo
-        xhiclamp = min(xhi, xmax)
-        Xhi = Xlo + (xhiclamp - xloclamp)
-        assert(xloclamp >= 0)
-        assert(Xlo >= 0)
-        return (xloclamp, xhiclamp+1, Xlo, Xhi+1)
-
     A = np.zeros((NP, NT2))
     # Constant term
     A[:, I_sky] = 1.
@@ -636,58 +877,60 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
 
     del ii
 
-    Aw = A*w[:, np.newaxis]
-    bw = b*w
-
-    if debugPlots:
-        import pylab as plt
-        plt.clf()
-        N = NT2 + 2
-        R, C = 2, (N+1)/2
-        for i in range(NT2):
-            im1 = np.zeros((1+yhi-ylo, 1+xhi-xlo))
-            im1[ipixes[:, 1], ipixes[:, 0]] = A[:, i]
-            plt.subplot(R, C, i+1)
-            plt.imshow(im1, interpolation='nearest', origin='lower')
-        plt.subplot(R, C, NT2+1)
-        im1 = np.zeros((1+yhi-ylo, 1+xhi-xlo))
-        im1[ipixes[:, 1], ipixes[:, 0]] = b
-        plt.imshow(im1, interpolation='nearest', origin='lower')
-        plt.subplot(R, C, NT2+2)
-        im1 = np.zeros((1+yhi-ylo, 1+xhi-xlo))
-        im1[ipixes[:, 1], ipixes[:, 0]] = w
-        plt.imshow(im1, interpolation='nearest', origin='lower')
-        plt.savefig('A.png')
-
-    # We do fits with and without the decenter (dx,dy) terms.
-    # Since the dx,dy terms are at the end of the matrix,
-    # we can do that just by trimming off those elements.
-    #
-    # The SVD can fail if there are NaNs in the matrices; this should
-    # really be handled upstream
-    try:
-        # NT1 is number of terms without dx,dy;
-        # X1 is the result without decenter
-        X1, r1, rank1, s1 = np.linalg.lstsq(Aw[:, :NT1], bw, rcond=-1)
-        # X2 is with decenter
-        X2, r2, rank2, s2 = np.linalg.lstsq(Aw, bw, rcond=-1)
-    except np.linalg.LinAlgError as e:
-        log.warn("Failed to fit PSF to child: %s", e)
-        pkres.setPsfFitFailed()
-        return
+    fit = _PsfFit(pkres, cx, cy)
+    fit.R0, fit.R1 = R0, R1
+    fit.psfimg = psfimg
+    fit.stampbb = stampbb
+    fit.xlo, fit.xhi, fit.ylo, fit.yhi = xlo, xhi, ylo, yhi
+    fit.NT1, fit.NT2, fit.NP = NT1, NT2, NP
+    fit.I_dx, fit.I_dy = I_dx, I_dy
+    fit.nOthers = len(otherpeaks)
+    fit.valid = valid
+    fit.ipixes = ipixes
+    fit.A, fit.b, fit.w = A, b, w
+    fit.rw = rw
+    fit.sumr = sumr
+    fit.Aw = A*w[:, np.newaxis]
+    fit.bw = b*w
+    return fit
+
+
+def _overlap(xlo, xhi, xmin, xmax):
+    assert((xlo <= xmax) and (xhi >= xmin) and
+           (xlo <= xhi) and (xmin <= xmax))
+    xloclamp = max(xlo, xmin)
+    Xlo = xloclamp - xlo
+    xhiclamp = min(xhi, xmax)
+    Xhi = Xlo + (xhiclamp - xloclamp)
+    assert(xloclamp >= 0)
+    assert(Xlo >= 0)
+    return (xloclamp, xhiclamp+1, Xlo, Xhi+1)
+
+
+def _checkPsfFits(fit, log, X1, chisq1, X2, chisq2, psfChisqCut1, psfChisqCut2):
+    """Apply the chi-squared cuts to the unshifted and shifted PSF fits
 
-    log.debug('r1 r2 %s %s', r1, r2)
+    Parameters
+    ----------
+    fit: `_PsfFit`
+        The PSF fit for a single peak.
+    log: `log.Log`
+        LSST logger for logging purposes.
+    X1, X2: `numpy.ndarray`
+        Best fit parameters without and with the decenter terms.
+    chisq1, chisq2: `float`
+        Chi-squared of the fit without and with the decenter terms.
+    psfChisqCut1, psfChisqCut2: `float`
+        See `fitPsfs`.
 
-    # r is weighted chi-squared = sum over pixels: ramp * (model -
-    # data)**2/sigma**2
-    if len(r1) > 0:
-        chisq1 = r1[0]
-    else:
-        chisq1 = 1e30
-    if len(r2) > 0:
-        chisq2 = r2[0]
-    else:
-        chisq2 = 1e30
+    Returns
+    -------
+    result: `bool`
+        ``False`` if the fit has no degrees of freedom (and
+        so the peak is skipped), ``True`` otherwise.
+    """
+    pkres = fit.pkres
+    sumr = fit.sumr
     dof1 = sumr - len(X1)
     dof2 = sumr - len(X2)
     log.debug('dof1, dof2 %g %g', dof1, dof2)
@@ -696,7 +939,7 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     if dof1 <= 0 or dof2 <= 0:
         log.trace('Skipping this peak: bad DOF %g, %g', dof1, dof2)
         pkres.setBadPsfDof()
-        return
+        return False
 
     q1 = chisq1/dof1
     q2 = chisq2/dof2
@@ -709,8 +952,8 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
 
     # check that the fit PSF spatial derivative terms aren't too big
     if ispsf2:
-        fdx, fdy = X2[I_dx], X2[I_dy]
-        f0 = X2[I_psf]
+        fdx, fdy = X2[fit.I_dx], X2[fit.I_dy]
+        f0 = X2[fit.I_psf]
         # as a fraction of the PSF flux
         dx = fdx/f0
         dy = fdy/f0
@@ -718,70 +961,124 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
         log.trace('isPSF2 -- checking derivatives: dx,dy = %g, %g -> %s', dx, dy, str(ispsf2))
         if not ispsf2:
             pkres.psfFitBigDecenter = True
+        fit.dx, fit.dy = dx, dy
 
-    # Looks like a shifted PSF: try actually shifting the PSF by that amount
-    # and re-evaluate the fit.
-    if ispsf2:
-        psfimg2 = psf.computeImage(cx + dx, cy + dy)
-        # clip
-        pbb2 = psfimg2.getBBox()
-        pbb2.clip(fbb)
-
-        # Make sure we haven't been given a substitute PSF that's nowhere near where we want, as may occur if
-        # "Cannot compute CoaddPsf at point (xx,yy); no input images at that point."
-        if not pbb2.contains(afwGeom.Point2I(int(cx + dx), int(cy + dy))):
-            ispsf2 = False
-        else:
-            # clip image to bbox
-            px0, py0 = psfimg2.getX0(), psfimg2.getY0()
-            psfarr = psfimg2.getArray()[pbb2.getMinY()-py0:1+pbb2.getMaxY()-py0,
-                                        pbb2.getMinX()-px0:1+pbb2.getMaxX()-px0]
-            px0, py0 = pbb2.getMinX(), pbb2.getMinY()
-            px1, py1 = pbb2.getMaxX(), pbb2.getMaxY()
-
-            # yuck!  Update the PSF terms in the least-squares fit matrix.
-            Ab = A[:, :NT1]
-
-            sx1, sx2, sx3, sx4 = _overlap(xlo, xhi, px0, px1)
-            sy1, sy2, sy3, sy4 = _overlap(ylo, yhi, py0, py1)
-            dpx0, dpy0 = px0 - xlo, py0 - ylo
-            psfsub = psfarr[sy3-dpy0:sy4-dpy0, sx3-dpx0:sx4-dpx0]
-            vsub = valid[sy1-ylo:sy2-ylo, sx1-xlo:sx2-xlo]
-            xx, yy = np.arange(xlo, xhi+1), np.arange(ylo, yhi+1)
-            inpsf = np.outer((yy >= py0)*(yy <= py1), (xx >= px0)*(xx <= px1))
-            Ab[inpsf[valid], I_psf] = psfsub[vsub]
-
-            Aw = Ab*w[:, np.newaxis]
-            # re-solve...
-            Xb, rb, rankb, sb = np.linalg.lstsq(Aw, bw, rcond=-1)
-            if len(rb) > 0:
-                chisqb = rb[0]
-            else:
-                chisqb = 1e30
-            dofb = sumr - len(Xb)
-            qb = chisqb/dofb
-            ispsf2 = (qb < psfChisqCut2b)
-            q2 = qb
-            X2 = Xb
-            log.trace('shifted PSF: new chisq/dof = %g; good? %s', qb, ispsf2)
-            pkres.psfFit3 = (chisqb, dofb)
+    fit.X1, fit.X2 = X1, X2
+    fit.chisq1, fit.chisq2 = chisq1, chisq2
+    fit.dof1, fit.dof2 = dof1, dof2
+    fit.q1, fit.q2 = q1, q2
+    fit.ispsf1, fit.ispsf2 = ispsf1, ispsf2
+    return True
+
+
+def _buildShiftedPsfFit(fit, psf, fbb):
+    """Update the PSF term of the fit using the PSF at the shifted position
+
+    The PSF is re-evaluated at the position given by the decenter terms of
+    the shifted fit and the weighted design matrix is stored as ``fit.Awb``.
+
+    Returns
+    -------
+    result: `bool`
+        ``False`` if the PSF cannot be evaluated at the shifted position
+        (in which case the peak is not a shifted PSF), ``True`` otherwise.
+    """
+    cx, cy = fit.cx, fit.cy
+    dx, dy = fit.dx, fit.dy
+    xlo, xhi, ylo, yhi = fit.xlo, fit.xhi, fit.ylo, fit.yhi
+    valid = fit.valid
+
+    psfimg2 = psf.computeImage(cx + dx, cy + dy)
+    # clip
+    pbb2 = psfimg2.getBBox()
+    pbb2.clip(fbb)
+
+    # Make sure we haven't been given a substitute PSF that's nowhere near where we want, as may occur if
+    # "Cannot compute CoaddPsf at point (xx,yy); no input images at that point."
+    if not pbb2.contains(afwGeom.Point2I(int(cx + dx), int(cy + dy))):
+        fit.ispsf2 = False
+        return False
+
+    # clip image to bbox
+    px0, py0 = psfimg2.getX0(), psfimg2.getY0()
+    psfarr = psfimg2.getArray()[pbb2.getMinY()-py0:1+pbb2.getMaxY()-py0,
+                                pbb2.getMinX()-px0:1+pbb2.getMaxX()-px0]
+    px0, py0 = pbb2.getMinX(), pbb2.getMinY()
+    px1, py1 = pbb2.getMaxX(), pbb2.getMaxY()
+
+    # yuck!  Update the PSF terms in the least-squares fit matrix.
+    Ab = fit.A[:, :fit.NT1]
+
+    sx1, sx2, sx3, sx4 = _overlap(xlo, xhi, px0, px1)
+    sy1, sy2, sy3, sy4 = _overlap(ylo, yhi, py0, py1)
+    dpx0, dpy0 = px0 - xlo, py0 - ylo
+    psfsub = psfarr[sy3-dpy0:sy4-dpy0, sx3-dpx0:sx4-dpx0]
+    vsub = valid[sy1-ylo:sy2-ylo, sx1-xlo:sx2-xlo]
+    xx, yy = np.arange(xlo, xhi+1), np.arange(ylo, yhi+1)
+    inpsf = np.outer((yy >= py0)*(yy <= py1), (xx >= px0)*(xx <= px1))
+    Ab[inpsf[valid], fit.I_psf] = psfsub[vsub]
+
+    fit.Awb = Ab*fit.w[:, np.newaxis]
+    return True
+
+
+def _checkShiftedPsfFit(fit, log, Xb, chisqb, psfChisqCut2b):
+    """Apply the chi-squared cut to the fit using the shifted PSF
+
+    Parameters
+    ----------
+    fit: `_PsfFit`
+        The PSF fit for a single peak.
+    log: `log.Log`
+        LSST logger for logging purposes.
+    Xb: `numpy.ndarray`
+        Best fit parameters using the shifted PSF.
+    chisqb: `float`
+        Chi-squared of the fit using the shifted PSF.
+    psfChisqCut2b: `float`
+        See `fitPsfs`.
+    """
+    dofb = fit.sumr - len(Xb)
+    qb = chisqb/dofb
+    fit.ispsf2 = (qb < psfChisqCut2b)
+    fit.q2 = qb
+    fit.X2 = Xb
+    log.trace('shifted PSF: new chisq/dof = %g; good? %s', qb, fit.ispsf2)
+    fit.pkres.psfFit3 = (chisqb, dofb)
+
+
+def _finishPsfFit(fit, fp, log, psf, img, varimg, debugPsf=False):
+    """Choose the best PSF fit for a peak and save the results
+
+    If the peak is a PSF, its template is replaced by the PSF model.
+
+    Returns
+    -------
+    ispsf: `bool`
+        Whether or not the peak matches a PSF model.
+    """
+    pkres = fit.pkres
+    cx, cy = fit.cx, fit.cy
+    ispsf1, ispsf2 = fit.ispsf1, fit.ispsf2
+    q1, q2 = fit.q1, fit.q2
+    I_psf = fit.I_psf
 
     # Which one do we keep?
     if (((ispsf1 and ispsf2) and (q2 < q1)) or
             (ispsf2 and not ispsf1)):
-        Xpsf = X2
-        chisq = chisq2
-        dof = dof2
+        Xpsf = fit.X2
+        chisq = fit.chisq2
+        dof = fit.dof2
         log.debug('dof %g', dof)
         log.trace('Keeping shifted-PSF model')
-        cx += dx
-        cy += dy
+        cx += fit.dx
+        cy += fit.dy
         pkres.psfFitWithDecenter = True
     else:
         # (arbitrarily set to X1 when neither fits well)
-        Xpsf = X1
-        chisq = chisq1
-        dof = dof1
+        Xpsf = fit.X1
+        chisq = fit.chisq1
+        dof = fit.dof1
         log.debug('dof %g', dof)
         log.trace('Keeping unshifted PSF model')
 
@@ -789,6 +1086,9 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
 
     # Save the PSF models in images for posterity.
     if debugPsf:
+        xlo, xhi, ylo, yhi = fit.xlo, fit.xhi, fit.ylo, fit.yhi
+        A, ipixes, valid = fit.A, fit.ipixes, fit.valid
+        I_dx, I_dy = fit.I_dx, fit.I_dy
         SW, SH = 1+xhi-xlo, 1+yhi-ylo
         psfmod = afwImage.ImageF(SW, SH)
         psfmod.setXY0(xlo, ylo)
@@ -803,7 +1103,7 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
                 model.set(ix, iy, model.get(ix, iy) + float(v))
                 if i in [I_psf, I_dx, I_dy]:
                     psfderivmod.set(ix, iy, psfderivmod.get(ix, iy) + float(v))
-        for ii in range(NP):
+        for ii in range(fit.NP):
             x, y = ipixes[ii, :]
             psfmod.set(int(x), int(y), float(A[ii, I_psf]*Xpsf[I_psf]))
         modelfp = afwDet.Footprint(fp.getPeaks().getSchema())
@@ -811,28 +1111,28 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
             modelfp.addSpan(int(y+ylo), int(x+xlo), int(x+xlo))
         modelfp.normalize()
 
-        pkres.psfFitDebugPsf0Img = psfimg
+        pkres.psfFitDebugPsf0Img = fit.psfimg
         pkres.psfFitDebugPsfImg = psfmod
         pkres.psfFitDebugPsfDerivImg = psfderivmod
         pkres.psfFitDebugPsfModel = model
-        pkres.psfFitDebugStamp = img.Factory(img, stampbb, True)
+        pkres.psfFitDebugStamp = img.Factory(img, fit.stampbb, True)
         pkres.psfFitDebugValidPix = valid  # numpy array
-        pkres.psfFitDebugVar = varimg.Factory(varimg, stampbb, True)
+        pkres.psfFitDebugVar = varimg.Factory(varimg, fit.stampbb, True)
         ww = np.zeros(valid.shape, np.float)
-        ww[valid] = w
+        ww[valid] = fit.w
         pkres.psfFitDebugWeight = ww  # numpy
-        pkres.psfFitDebugRampWeight = rw
+        pkres.psfFitDebugRampWeight = fit.rw
 
     # Save things we learned about this peak for posterity...
-    pkres.psfFitR0 = R0
-    pkres.psfFitR1 = R1
-    pkres.psfFitStampExtent = (xlo, xhi, ylo, yhi)
+    pkres.psfFitR0 = fit.R0
+    pkres.psfFitR1 = fit.R1
+    pkres.psfFitStampExtent = (fit.xlo, fit.xhi, fit.ylo, fit.yhi)
     pkres.psfFitCenter = (cx, cy)
     log.debug('saving chisq,dof %g %g', chisq, dof)
     pkres.psfFitBest = (chisq, dof)
     pkres.psfFitParams = Xpsf
     pkres.psfFitFlux = Xpsf[I_psf]
-    pkres.psfFitNOthers = len(otherpeaks)
+    pkres.psfFitNOthers = fit.nOthers
 
     if ispsf:
         pkres.setDeblendedAsPsf()
@@ -843,7 +1143,8 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
 
         # Instantiate the PSF model and clip it to the footprint
         psfimg = psf.computeImage(cx, cy)
-        # Scale by fit flux.
+        # Copy the cached image before scaling it by the fit flux.
+        psfimg = psfimg.Factory(psfimg, True)
         psfimg *= Xpsf[I_psf]
         psfimg = psfimg.convertF()
 
@@ -866,6 +1167,130 @@ def _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, psf, psffwhm,
     return ispsf
 
 
+def _fitPsfBatch(fits, fp, fbb, log, psf, img, varimg, psfChisqCut1, psfChisqCut2, psfChisqCut2b):
+    """Fit PSF models to all of the peaks in a footprint at once
+
+    This gives the same results as calling `_fitPsf` for each peak, but
+    the least-squares systems for all of the peaks are solved together
+    by `_lstsqBatch`, once for the unshifted, shifted and re-centered fits.
+
+    Parameters
+    ----------
+    fits: list of `_PsfFit`
+        Least-squares systems built by `_buildPsfFit` for each peak.
+
+    See `_fitPsf` for a description of the other parameters.
+
+    Returns
+    -------
+    modified: `bool`
+        Whether or not any of the peaks matches a PSF model.
+    """
+    if len(fits) == 0:
+        return False
+    X1, chisq1, failed1 = _lstsqBatch([fit.Aw[:, :fit.NT1] for fit in fits], [fit.bw for fit in fits])
+    X2, chisq2, failed2 = _lstsqBatch([fit.Aw for fit in fits], [fit.bw for fit in fits])
+
+    good = []
+    shifted = []
+    for i, fit in enumerate(fits):
+        if failed1[i] or failed2[i]:
+            log.warn("Failed to fit PSF to child at (%.1f, %.1f)", fit.cx, fit.cy)
+            fit.pkres.setPsfFitFailed()
+            continue
+        if not _checkPsfFits(fit, log, X1[i], chisq1[i], X2[i], chisq2[i], psfChisqCut1, psfChisqCut2):
+            continue
+        good.append(fit)
+        # Looks like a shifted PSF: try actually shifting the PSF by that amount
+        # and re-evaluate the fit.
+        if fit.ispsf2 and _buildShiftedPsfFit(fit, psf, fbb):
+            shifted.append(fit)
+
+    if len(shifted) > 0:
+        Xb, chisqb, failedb = _lstsqBatch([fit.Awb for fit in shifted], [fit.bw for fit in shifted])
+        if np.any(failedb):
+            raise np.linalg.LinAlgError("Failed to fit the shifted PSF model")
+        for i, fit in enumerate(shifted):
+            _checkShiftedPsfFit(fit, log, Xb[i], chisqb[i], psfChisqCut2b)
+
+    modified = False
+    for fit in good:
+        ispsf = _finishPsfFit(fit, fp, log, psf, img, varimg)
+        modified = modified or ispsf
+    return modified
+
+
+def _lstsqBatch(As, bs):
+    """Solve a set of independent linear least-squares problems
+
+    The matrices are zero-padded to a common shape and solved together
+    with a single stacked SVD, using the same rank cut as
+    ``numpy.linalg.lstsq(A, b, rcond=-1)``.  Padding with zeros does not
+    change the non-zero singular values, so each solution is the same as
+    solving the problem on its own.
+
+    Parameters
+    ----------
+    As: list of `numpy.ndarray`
+        Design matrix of each problem, with shape ``(M_i, N_i)``.
+    bs: list of `numpy.ndarray`
+        Data vector of each problem, with length ``M_i``.
+
+    Returns
+    -------
+    X: list of `numpy.ndarray`
+        Least-squares solution of each problem, with length ``N_i``.
+    chisq: `numpy.ndarray`
+        Sum of the squared residuals of each problem.
+        As with ``lstsq``, this is only computed if ``A`` has full rank
+        and ``M_i > N_i``; otherwise it is set to ``1e30``.
+    failed: `numpy.ndarray`
+        ``True`` for problems that could not be solved
+        (for example because they contain NaNs).
+    """
+    nProblems = len(As)
+    nRows = np.array([A.shape[0] for A in As])
+    nCols = np.array([A.shape[1] for A in As])
+    failed = np.array([not (np.all(np.isfinite(A)) and np.all(np.isfinite(b))) for A, b in zip(As, bs)])
+
+    Ab = np.zeros((nProblems, nRows.max(), nCols.max()))
+    bb = np.zeros((nProblems, nRows.max()))
+    for i, (A, b) in enumerate(zip(As, bs)):
+        if not failed[i]:
+            Ab[i, :A.shape[0], :A.shape[1]] = A
+            bb[i, :len(b)] = b
+
+    try:
+        u, s, vt = np.linalg.svd(Ab, full_matrices=False)
+    except np.linalg.LinAlgError:
+        # Fall back to solving the problems one at a time
+        X = []
+        chisq = np.full(nProblems, 1e30)
+        for i, (A, b) in enumerate(zip(As, bs)):
+            try:
+                x, r, rank, sv = np.linalg.lstsq(A, b, rcond=-1)
+            except np.linalg.LinAlgError:
+                failed[i] = True
+                x = np.zeros(A.shape[1])
+            else:
+                if len(r) > 0:
+                    chisq[i] = r[0]
+            X.append(x)
+        return X, chisq, failed
+
+    # Singular values are sorted in decreasing order.  ``rcond=-1`` makes LAPACK
+    # use its machine precision, which is half of numpy's ``eps``.
+    large = s > 0.5*np.finfo(s.dtype).eps*s[:, :1]
+    sinv = np.zeros_like(s)
+    sinv[large] = 1./s[large]
+    x = np.einsum('nki,nk->ni', vt, sinv*np.einsum('nmk,nm->nk', u, bb))
+    resid = bb - np.einsum('nmi,ni->nm', Ab, x)
+    rank = np.sum(large, axis=1)
+    chisq = np.where((rank == nCols) & (nRows > nCols), np.sum(resid**2, axis=1), 1e30)
+    X = [x[i, :nCols[i]] for i in range(nProblems)]
+    return X, chisq, failed
+
+
 def buildSymmetricTemplates(debResult, log, patchEdges=False, setOrigTemplate=True):
     """Build a symmetric template for each peak in each filter
 
@@ -889,42 +1314,48 @@ def buildSymmetricTemplates(debResult, log, patchEdges=False, setOrigTemplate=Tr
         If any peaks are not skipped or marked as point sources, ``modified`` is ``True.
         Otherwise ``modified`` is ``False``.
     """
-    modified = False
     # Create the Templates for each peak in each filter
-    for fidx in debResult.filters:
-        dp = debResult.deblendedParents[fidx]
-        imbb = dp.img.getBBox()
-        log.trace('Creating templates for footprint at x0,y0,W,H = %i, %i, %i, %i)', dp.x0, dp.y0, dp.W, dp.H)
-
-        for peaki, pkres in enumerate(dp.peaks):
-            log.trace('Deblending peak %i of %i', peaki, len(dp.peaks))
-            # TODO: Check debResult to see if the peak is deblended as a point source
-            # when comparing all bands, not just a single band
-            if pkres.skip or pkres.deblendedAsPsf:
-                continue
-            modified = True
-            pk = pkres.peak
-            cx, cy = pk.getIx(), pk.getIy()
-            if not imbb.contains(afwGeom.Point2I(cx, cy)):
-                log.trace('Peak center is not inside image; skipping %i', pkres.pki)
-                pkres.setOutOfBounds()
-                continue
-            log.trace('computing template for peak %i at (%i, %i)', pkres.pki, cx, cy)
-            timg, tfoot, patched = bUtils.buildSymmetricTemplate(dp.maskedImage, dp.fp, pk, dp.avgNoise,
-                                                                 True, patchEdges)
-            if timg is None:
-                log.trace('Peak %i at (%i, %i): failed to build symmetric template', pkres.pki, cx, cy)
-                pkres.setFailedSymmetricTemplate()
-                continue
+    modified = _mapFilters(debResult, _buildSymmetricTemplates, log, patchEdges, setOrigTemplate)
+    return any(modified)
 
-            if patched:
-                pkres.setPatched()
 
-            # possibly save the original symmetric template
-            if setOrigTemplate:
-                pkres.setOrigTemplate(timg, tfoot)
-            pkres.setTemplate(timg, tfoot)
-    return modified
+def _buildSymmetricTemplates(dp, log, patchEdges, setOrigTemplate):
+    """Build a symmetric template for each peak in a single filter
+
+    See `buildSymmetricTemplates` for a description of the parameters.
+    The templates of all of the peaks are built by a single call to
+    ``BaselineUtils.buildSymmetricTemplates``.
+    """
+    log.trace('Creating templates for footprint at x0,y0,W,H = %i, %i, %i, %i)', dp.x0, dp.y0, dp.W, dp.H)
+
+    # TODO: Check debResult to see if the peak is deblended as a point source
+    # when comparing all bands, not just a single band
+    peaks = [pkres for pkres in dp.peaks if not (pkres.skip or pkres.deblendedAsPsf)]
+    if not peaks:
+        return False
+    templates, tfoots, status = bUtils.buildSymmetricTemplates(
+        dp.maskedImage, dp.fp, [pkres.pki for pkres in peaks], True, patchEdges)
+
+    for pkres, timg, tfoot, flags in zip(peaks, templates, tfoots, status):
+        pk = pkres.peak
+        cx, cy = pk.getIx(), pk.getIy()
+        if flags & bUtils.TEMPLATE_OUT_OF_BOUNDS:
+            log.trace('Peak center is not inside image; skipping %i', pkres.pki)
+            pkres.setOutOfBounds()
+            continue
+        if flags & bUtils.TEMPLATE_FAILED_SYMMETRIC:
+            log.trace('Peak %i at (%i, %i): failed to build symmetric template', pkres.pki, cx, cy)
+            pkres.setFailedSymmetricTemplate()
+            continue
+
+        if flags & bUtils.TEMPLATE_PATCHED:
+            pkres.setPatched()
+
+        # possibly save the original symmetric template
+        if setOrigTemplate:
+            pkres.setOrigTemplate(timg, tfoot)
+        pkres.setTemplate(timg, tfoot)
+    return True
 
 
 def rampFluxAtEdge(debResult, log, patchEdges=False):
@@ -950,39 +1381,101 @@ def rampFluxAtEdge(debResult, log, patchEdges=False):
         If any peaks have their templates modified to include flux at the edges,
         ``modified`` is ``True``.
     """
-    modified = False
     # Loop over all filters
-    for fidx in debResult.filters:
-        dp = debResult.deblendedParents[fidx]
-        log.trace('Checking for significant flux at edge: sigma1=%g', dp.avgNoise)
+    modified = _mapFilters(debResult, _rampFluxAtEdge, log, patchEdges)
+    return any(modified)
 
-        for peaki, pkres in enumerate(dp.peaks):
-            if pkres.skip or pkres.deblendedAsPsf:
-                continue
-            timg, tfoot = pkres.templateImage, pkres.templateFootprint
-            if bUtils.hasSignificantFluxAtEdge(timg, tfoot, 3*dp.avgNoise):
-                log.trace("Template %i has significant flux at edge: ramping", pkres.pki)
-                try:
-                    (timg2, tfoot2, patched) = _handle_flux_at_edge(log, dp.psffwhm, timg, tfoot, dp.fp,
-                                                                    dp.maskedImage, dp.x0, dp.x1,
-                                                                    dp.y0, dp.y1, dp.psf, pkres.peak,
-                                                                    dp.avgNoise, patchEdges)
-                except lsst.pex.exceptions.Exception as exc:
-                    if (isinstance(exc, lsst.pex.exceptions.InvalidParameterError) and
-                            "CoaddPsf" in str(exc)):
-                        pkres.setOutOfBounds()
-                        continue
-                    raise
-                pkres.setRampedTemplate(timg2, tfoot2)
-                if patched:
-                    pkres.setPatched()
-                pkres.setTemplate(timg2, tfoot2)
-                modified = True
+
+def _rampFluxAtEdge(dp, log, patchEdges):
+    """Adjust flux on the edges of the template footprints in a single filter
+
+    See `rampFluxAtEdge` for a description of the parameters.
+    """
+    modified = False
+    # dp.avgNoise is not logged here, so that it is only estimated if a template is checked
+    log.trace('Checking for significant flux at edge')
+
+    # The dilated parent footprint and the image within it are shared by all of the peaks
+    padded = None
+    for peaki, pkres in enumerate(dp.peaks):
+        if pkres.skip or pkres.deblendedAsPsf:
+            continue
+        timg, tfoot = pkres.templateImage, pkres.templateFootprint
+        if bUtils.hasSignificantFluxAtEdge(timg, tfoot, 3*dp.avgNoise):
+            log.trace("Template %i has significant flux at edge: ramping", pkres.pki)
+            if padded is None:
+                padded = _makePaddedParent(dp.fp, dp.maskedImage, getRampSize(dp.psffwhm))
+            try:
+                (timg2, tfoot2, patched) = _handle_flux_at_edge(log, dp.psffwhm, timg, tfoot, dp.fp,
+                                                                dp.maskedImage, dp.x0, dp.x1,
+                                                                dp.y0, dp.y1, dp.psfCache, pkres.peak,
+                                                                dp.avgNoise, patchEdges, padded)
+            except lsst.pex.exceptions.Exception as exc:
+                if (isinstance(exc, lsst.pex.exceptions.InvalidParameterError) and
+                        "CoaddPsf" in str(exc)):
+                    pkres.setOutOfBounds()
+                    continue
+                raise
+            pkres.setRampedTemplate(timg2, tfoot2)
+            if patched:
+                pkres.setPatched()
+            pkres.setTemplate(timg2, tfoot2)
+            modified = True
     return modified
 
 
+def getRampSize(psffwhm):
+    """Number of pixels by which the templates are grown by `_handle_flux_at_edge`
+
+    Parameters
+    ----------
+    psffwhm: `float`
+        FWHM of the PSF, in pixels.
+
+    Returns
+    -------
+    S: `int`
+        Size of the ramp, an odd number of pixels.  The ramped templates
+        (and the flux portions) of a parent use the pixels up to ``S``
+        pixels outside of its footprint.
+    """
+    # make it an odd integer
+    S = psffwhm*1.5
+    return int((S + 0.5)/2)*2 + 1
+
+
+def _makePaddedParent(fp, maskedImage, S):
+    """Dilate the parent footprint by ``S`` pixels and copy the image within it
+
+    Parameters
+    ----------
+    fp: `afw.detection.Footprint`
+        Parent Footprint that is being deblended.
+    maskedImage: `afw.image.MaskedImageF`
+        Full MaskedImage containing the parent footprint ``fp``.
+    S: `int`
+        Number of pixels by which the footprint is dilated
+        (see `getRampSize`).
+
+    Returns
+    -------
+    fpDilated: `afw.detection.Footprint`
+        Dilated parent footprint.
+    padim: `afw.image.MaskedImageF`
+        Image of the dilated footprint, which is zero outside of
+        ``fpDilated`` and of ``maskedImage``.
+    """
+    fpDilated = afwDet.Footprint(fp)
+    fpDilated.dilate(S)
+    bbox = fp.getBBox()
+    bbox.grow(S)
+    padim = maskedImage.Factory(bbox)
+    fpDilated.spans.clippedTo(maskedImage.getBBox()).copyMaskedImage(maskedImage, padim)
+    return fpDilated, padim
+
+
 def _handle_flux_at_edge(log, psffwhm, t1, tfoot, fp, maskedImage,
-                         x0, x1, y0, y1, psf, pk, sigma1, patchEdges):
+                         x0, x1, y0, y1, psf, pk, sigma1, patchEdges, padded=None):
     """Extend a template by the PSF to fill in the footprint.
 
     Using the PSF, a footprint that touches the edge is passed to the function
@@ -1006,8 +1499,8 @@ def _handle_flux_at_edge(log, psffwhm, t1, tfoot, fp, maskedImage,
         Minimum x,y for the bounding box of the footprint ``fp``.
     x1,y1: `int`
         Maximum x,y for the bounding box of the footprint ``fp``.
-    psf: `afw.detection.Psf`
-        PSF of the image.
+    psf: `lsst.meas.deblender.baseline.CachingPsf`
+        Cache of the PSF images of the image.
     pk: `afw.detection.PeakRecord`
         The peak within the Footprint whose footprint is being extended.
     sigma1: `float`
@@ -1017,6 +1510,10 @@ def _handle_flux_at_edge(log, psffwhm, t1, tfoot, fp, maskedImage,
         ``EDGE`` bit set, then for spans whose symmetric mirror are outside the
         image, the symmetric footprint is grown to include them and their
         pixel values are stored.
+    padded: `tuple`, optional
+        The dilated parent footprint and its image, as returned by
+        `_makePaddedParent`, which can be shared by all of the peaks
+        in the parent.  If ``None`` they are created for this peak.
 
     Results
     -------
@@ -1036,60 +1533,38 @@ def _handle_flux_at_edge(log, psffwhm, t1, tfoot, fp, maskedImage,
     # Then find the symmetric template of that image.
 
     # The size we'll grow by
-    S = psffwhm*1.5
-    # make it an odd integer
-    S = int((S + 0.5)/2)*2 + 1
+    S = getRampSize(psffwhm)
 
     tbb = tfoot.getBBox()
     tbb.grow(S)
 
     # (footprint+margin)-clipped image;
     # we need the pixels OUTSIDE the footprint to be 0.
-    fpcopy = afwDet.Footprint(fp)
-    fpcopy.dilate(S)
-    fpcopy.setSpans(fpcopy.spans.clippedTo(tbb))
+    if padded is None:
+        padded = _makePaddedParent(fp, maskedImage, S)
+    fpDilated, parentPadim = padded
+    fpcopy = afwDet.Footprint(fpDilated)
+    fpcopy.setSpans(fpDilated.spans.clippedTo(tbb))
     fpcopy.removeOrphanPeaks()
-    padim = maskedImage.Factory(tbb)
-    fpcopy.spans.clippedTo(maskedImage.getBBox()).copyMaskedImage(maskedImage, padim)
+    if parentPadim.getBBox().contains(tbb):
+        padim = parentPadim.Factory(parentPadim, tbb, afwImage.PARENT, True)
+    else:
+        padim = maskedImage.Factory(tbb)
+        fpcopy.spans.clippedTo(maskedImage.getBBox()).copyMaskedImage(maskedImage, padim)
 
     # find pixels on the edge of the template
     edgepix = bUtils.getSignificantEdgePixels(t1, tfoot, -1e6)
 
-    # instantiate PSF image
+    # instantiate PSF image (it is shared with the cache and not modified)
     xc = int((x0 + x1)/2)
     yc = int((y0 + y1)/2)
-    psfim = psf.computeImage(afwGeom.Point2D(xc, yc))
-    pbb = psfim.getBBox()
-    # shift PSF image to be centered on zero
-    lx, ly = pbb.getMinX(), pbb.getMinY()
-    psfim.setXY0(lx - xc, ly - yc)
-    pbb = psfim.getBBox()
-    # clip PSF to S, if necessary
-    Sbox = afwGeom.Box2I(afwGeom.Point2I(-S, -S), afwGeom.Extent2I(2*S+1, 2*S+1))
-    if not Sbox.contains(pbb):
-        # clip PSF image
-        psfim = psfim.Factory(psfim, Sbox, afwImage.PARENT, True)
-        pbb = psfim.getBBox()
-    px0 = pbb.getMinX()
-    px1 = pbb.getMaxX()
-    py0 = pbb.getMinY()
-    py1 = pbb.getMaxY()
-
-    # Compute the ramped-down edge pixels
+    psfim = psf.computeImage(xc, yc, fallback=False)
+
+    # Compute the ramped-down edge pixels:
+    # for each edge pixel, ramped = max(ramped, edgepix * PSF),
+    # using the PSF clipped to S and normalized to a peak of 1
     ramped = t1.Factory(tbb)
-    Tout = ramped.getArray()
-    Tin = t1.getArray()
-    tx0, ty0 = t1.getX0(), t1.getY0()
-    ox0, oy0 = ramped.getX0(), ramped.getY0()
-    P = psfim.getArray()
-    P /= P.max()
-    # For each edge pixel, Tout = max(Tout, edgepix * PSF)
-    for span in edgepix.getSpans():
-        y = span.getY()
-        for x in range(span.getX0(), span.getX1()+1):
-            slc = (slice(y+py0 - oy0, y+py1+1 - oy0),
-                   slice(x+px0 - ox0, x+px1+1 - ox0))
-            Tout[slc] = np.maximum(Tout[slc], Tin[y-ty0, x-tx0]*P)
+    bUtils.rampEdgePixels(t1, edgepix, psfim, xc, yc, S, ramped)
 
     # Fill in the "padim" (which has the right variance and
     # mask planes) with the ramped pixels, outside the footprint
@@ -1130,32 +1605,37 @@ def medianSmoothTemplates(debResult, log, medianFilterHalfsize=2):
         Whether or not any templates were modified.
         This will be ``True`` as long as there is at least one source that is not flagged as a PSF.
     """
-    modified = False
     # Loop over all filters
-    for fidx in debResult.filters:
-        dp = debResult.deblendedParents[fidx]
-        for peaki, pkres in enumerate(dp.peaks):
-            if pkres.skip or pkres.deblendedAsPsf:
-                continue
-            modified = True
-            timg, tfoot = pkres.templateImage, pkres.templateFootprint
-            filtsize = medianFilterHalfsize*2 + 1
-            if timg.getWidth() >= filtsize and timg.getHeight() >= filtsize:
-                log.trace('Median filtering template %i', pkres.pki)
-                # We want the output to go in "t1", so copy it into
-                # "inimg" for input
-                inimg = timg.Factory(timg, True)
-                bUtils.medianFilter(inimg, timg, medianFilterHalfsize)
-                # possible save this median-filtered template
-                pkres.setMedianFilteredTemplate(timg, tfoot)
-            else:
-                log.trace('Not median-filtering template %i: size %i x %i smaller than required %i x %i',
-                          pkres.pki, timg.getWidth(), timg.getHeight(), filtsize, filtsize)
-            pkres.setTemplate(timg, tfoot)
+    modified = _mapFilters(debResult, _medianSmoothTemplates, log, medianFilterHalfsize)
+    return any(modified)
+
+
+def _medianSmoothTemplates(dp, log, medianFilterHalfsize):
+    """Apply a median smoothing filter to the templates in a single filter
+
+    See `medianSmoothTemplates` for a description of the parameters.
+    """
+    modified = False
+    for peaki, pkres in enumerate(dp.peaks):
+        if pkres.skip or pkres.deblendedAsPsf:
+            continue
+        modified = True
+        timg, tfoot = pkres.templateImage, pkres.templateFootprint
+        filtsize = medianFilterHalfsize*2 + 1
+        if timg.getWidth() >= filtsize and timg.getHeight() >= filtsize:
+            log.trace('Median filtering template %i', pkres.pki)
+            # The median filter can write its output over its input
+            bUtils.medianFilter(timg, timg, medianFilterHalfsize)
+            # possible save this median-filtered template
+            pkres.setMedianFilteredTemplate(timg, tfoot)
+        else:
+            log.trace('Not median-filtering template %i: size %i x %i smaller than required %i x %i',
+                      pkres.pki, timg.getWidth(), timg.getHeight(), filtsize, filtsize)
+        pkres.setTemplate(timg, tfoot)
     return modified
 
 
-def makeTemplatesMonotonic(debResult, log):
+def makeTemplatesMonotonic(debResult, log, monotonicAlgorithm='cone'):
     """Make the templates monotonic.
 
     The pixels in the templates are modified such that pixels further from the peak will
@@ -1167,6 +1647,13 @@ def makeTemplatesMonotonic(debResult, log):
         Container for the final deblender results.
     log: `log.Log`
         LSST logger for logging purposes.
+    monotonicAlgorithm: `string`, optional
+        Algorithm used to make the templates monotonic:
+        'cone': each pixel casts a cone-shaped shadow on the pixels further from the peak
+        ('BaselineUtils.makeMonotonic').
+        'radial': each pixel is clipped to the (interpolated) value of the pixels next to it
+        in the direction of the peak, in a single pass ('BaselineUtils.makeMonotonicRadial').
+        This is much faster for large templates.
 
     Returns
     -------
@@ -1174,19 +1661,34 @@ def makeTemplatesMonotonic(debResult, log):
         Whether or not any templates were modified.
         This will be ``True`` as long as there is at least one source that is not flagged as a PSF.
     """
-    modified = False
+    validAlgorithms = ['cone', 'radial']
+    if monotonicAlgorithm not in validAlgorithms:
+        raise ValueError((('monotonicAlgorithm: value \"%s\" not in the set of allowed values: ') %
+                          monotonicAlgorithm) + str(validAlgorithms))
     # Loop over all filters
-    for fidx in debResult.filters:
-        dp = debResult.deblendedParents[fidx]
-        for peaki, pkres in enumerate(dp.peaks):
-            if pkres.skip or pkres.deblendedAsPsf:
-                continue
-            modified = True
-            timg, tfoot = pkres.templateImage, pkres.templateFootprint
-            pk = pkres.peak
-            log.trace('Making template %i monotonic', pkres.pki)
-            bUtils.makeMonotonic(timg, pk)
-            pkres.setTemplate(timg, tfoot)
+    modified = _mapFilters(debResult, _makeTemplatesMonotonic, log, monotonicAlgorithm)
+    return any(modified)
+
+
+def _makeTemplatesMonotonic(dp, log, monotonicAlgorithm='cone'):
+    """Make the templates in a single filter monotonic
+
+    See `makeTemplatesMonotonic` for a description of the parameters.
+    """
+    if monotonicAlgorithm == 'radial':
+        makeMonotonic = bUtils.makeMonotonicRadial
+    else:
+        makeMonotonic = bUtils.makeMonotonic
+    modified = False
+    for peaki, pkres in enumerate(dp.peaks):
+        if pkres.skip or pkres.deblendedAsPsf:
+            continue
+        modified = True
+        timg, tfoot = pkres.templateImage, pkres.templateFootprint
+        pk = pkres.peak
+        log.trace('Making template %i monotonic', pkres.pki)
+        makeMonotonic(timg, pk)
+        pkres.setTemplate(timg, tfoot)
     return modified
 
 
@@ -1211,25 +1713,133 @@ def clipFootprintsToNonzero(debResult, log):
         This will be ``True`` as long as there is at least one source that is not flagged as a PSF.
     """
     # Loop over all filters
-    for fidx in debResult.filters:
-        dp = debResult.deblendedParents[fidx]
-        for peaki, pkres in enumerate(dp.peaks):
-            if pkres.skip or pkres.deblendedAsPsf:
-                continue
-            timg, tfoot = pkres.templateImage, pkres.templateFootprint
-            clipFootprintToNonzeroImpl(tfoot, timg)
-            if not tfoot.getBBox().isEmpty() and tfoot.getBBox() != timg.getBBox(afwImage.PARENT):
-                timg = timg.Factory(timg, tfoot.getBBox(), afwImage.PARENT, True)
-            pkres.setTemplate(timg, tfoot)
+    _mapFilters(debResult, _clipFootprintsToNonzero)
     return False
 
 
-def weightTemplates(debResult, log):
+def _clipFootprintsToNonzero(dp):
+    """Clip non-zero spans in the template footprints in a single filter
+    """
+    for peaki, pkres in enumerate(dp.peaks):
+        if pkres.skip or pkres.deblendedAsPsf:
+            continue
+        timg, tfoot = pkres.templateImage, pkres.templateFootprint
+        clipFootprintToNonzeroImpl(tfoot, timg)
+        if not tfoot.getBBox().isEmpty() and tfoot.getBBox() != timg.getBBox(afwImage.PARENT):
+            timg = timg.Factory(timg, tfoot.getBBox(), afwImage.PARENT, True)
+        pkres.setTemplate(timg, tfoot)
+
+
+def buildTemplates(debResult, log, patchEdges=False, rampFluxAtEdge=False, medianFilterHalfsize=None,
+                   monotonicAlgorithm=None, clipFootprintToNonzero=True):
+    """Build the templates of all of the peaks of the parent in each filter with a single native call
+
+    This runs the same steps as the `buildSymmetricTemplates`, `rampFluxAtEdge`,
+    `medianSmoothTemplates`, `makeTemplatesMonotonic` and `clipFootprintsToNonzero` plugins,
+    but all of the peaks in a filter are processed by a single call to
+    ``BaselineUtils.buildTemplates``, so the images and footprints of the peaks are
+    not passed back and forth to Python between the steps.
+    The intermediate templates (``origTemplate``, ``rampedTemplate``, ...) are not kept.
+
+    Parameters
+    ----------
+    debResult: `lsst.meas.deblender.baseline.DeblenderResult`
+        Container for the final deblender results.
+    log: `log.Log`
+        LSST logger for logging purposes.
+    patchEdges: `bool`, optional
+        If True and if the parent Footprint touches pixels with the ``EDGE`` bit set,
+        then grow the parent Footprint to include all symmetric templates.
+    rampFluxAtEdge: `bool`, optional
+        If True, ramp the templates with significant flux at their edges down with the PSF
+        (see `rampFluxAtEdge`).
+    medianFilterHalfsize: `int`, optional
+        Half the box size of the median filter applied to the templates,
+        or ``None`` (the default) to not filter the templates.
+    monotonicAlgorithm: `string`, optional
+        Algorithm used to make the templates monotonic ('cone' or 'radial',
+        see `makeTemplatesMonotonic`), or ``None`` (the default) to leave
+        them as they are.
+    clipFootprintToNonzero: `bool`, optional
+        If True, clip the template footprints to their non-zero pixels.
+
+    Returns
+    -------
+    modified: `bool`
+        Whether or not any templates were built.
+    """
+    monotonicOptions = {None: 0, 'cone': bUtils.MONOTONIC_CONE, 'radial': bUtils.MONOTONIC_RADIAL}
+    if monotonicAlgorithm not in monotonicOptions:
+        raise ValueError((('monotonicAlgorithm: value \"%s\" not in the set of allowed values: ') %
+                          monotonicAlgorithm) + str(['cone', 'radial']))
+    modified = _mapFilters(debResult, _buildTemplates, log, patchEdges, rampFluxAtEdge,
+                           medianFilterHalfsize, monotonicOptions[monotonicAlgorithm],
+                           clipFootprintToNonzero)
+    return any(modified)
+
+
+def _buildTemplates(dp, log, patchEdges, rampFluxAtEdge, medianFilterHalfsize, monotonicOptions,
+                    clipFootprintToNonzero):
+    """Build the templates of all of the peaks in a single filter
+
+    See `buildTemplates` for a description of the parameters.
+    """
+    peaks = [pkres for pkres in dp.peaks if not (pkres.skip or pkres.deblendedAsPsf)]
+    if not peaks:
+        return False
+    log.trace('Creating %i templates for footprint at x0,y0,W,H = %i, %i, %i, %i)',
+              len(peaks), dp.x0, dp.y0, dp.W, dp.H)
+
+    rampRadius = 0
+    psfim = None
+    psfError = None
+    if rampFluxAtEdge:
+        rampRadius = getRampSize(dp.psffwhm)
+        xc = int((dp.x0 + dp.x1)/2)
+        yc = int((dp.y0 + dp.y1)/2)
+        # The PSF is only needed if a template has to be ramped,
+        # so an error is only raised for the peaks that need it
+        try:
+            psfim = dp.psfCache.computeImage(xc, yc, fallback=False)
+        except lsst.pex.exceptions.Exception as exc:
+            psfError = exc
+    else:
+        xc = yc = 0
+
+    templates, tfoots, status = bUtils.buildTemplates(
+        dp.maskedImage, dp.fp, [pkres.pki for pkres in peaks], dp.avgNoise, patchEdges, rampRadius,
+        psfim, xc, yc, medianFilterHalfsize if medianFilterHalfsize is not None else 0,
+        monotonicOptions, clipFootprintToNonzero)
+
+    for pkres, timg, tfoot, flags in zip(peaks, templates, tfoots, status):
+        if flags & bUtils.TEMPLATE_OUT_OF_BOUNDS:
+            log.trace('Peak center is not inside image; skipping %i', pkres.pki)
+            pkres.setOutOfBounds()
+            continue
+        if flags & bUtils.TEMPLATE_NO_PSF:
+            if (isinstance(psfError, lsst.pex.exceptions.InvalidParameterError) and
+                    "CoaddPsf" in str(psfError)):
+                pkres.setOutOfBounds()
+                continue
+            raise psfError
+        if flags & bUtils.TEMPLATE_PATCHED:
+            pkres.setPatched()
+        if flags & bUtils.TEMPLATE_FAILED_SYMMETRIC:
+            log.trace('Peak %i: failed to build symmetric template', pkres.pki)
+            pkres.setFailedSymmetricTemplate()
+            continue
+        if flags & bUtils.TEMPLATE_RAMPED:
+            pkres.hasRampedTemplate = True
+        pkres.setTemplate(timg, tfoot)
+    return True
+
+
+def weightTemplates(debResult, log, jointBands=False):
     """Weight the templates to best fit the observed image in each filter
 
     This function re-weights the templates so that their linear combination best represents
-    the observed image in that filter.
-    In the future it may be useful to simultaneously weight all of the filters together.
+    the observed image in that filter, or in all of the filters together if ``jointBands``
+    is ``True``.
 
     Parameters
     ----------
@@ -1237,6 +1847,8 @@ def weightTemplates(debResult, log):
         Container for the final deblender results.
     log: `log.Log`
         LSST logger for logging purposes.
+    jointBands: `bool`, optional
+        If ``True``, fit a single weight for each template to the images in all of the filters.
 
     Returns
     -------
@@ -1246,15 +1858,108 @@ def weightTemplates(debResult, log):
     """
     # Weight the templates by doing a least-squares fit to the image
     log.trace('Weighting templates')
-    for fidx in debResult.filters:
-        _weightTemplates(debResult.deblendedParents[fidx])
+    if not jointBands or len(debResult.filters) == 1:
+        _mapFilters(debResult, _weightTemplates)
+        return False
+
+    # Add the normal equations of all of the filters, indexed by peak
+    normalEquations = _mapFilters(debResult, _templateNormalEquations)
+    AtA = np.zeros((debResult.peakCount, debResult.peakCount))
+    Atb = np.zeros(debResult.peakCount)
+    for peaks, _AtA, _Atb in normalEquations:
+        pki = [pkres.pki for pkres in peaks]
+        AtA[np.ix_(pki, pki)] += _AtA
+        Atb[pki] += _Atb
+    used = sorted(set(pkres.pki for peaks, _, _ in normalEquations for pkres in peaks))
+    X = np.zeros(debResult.peakCount)
+    X[used] = np.linalg.lstsq(AtA[np.ix_(used, used)], Atb[used], rcond=-1)[0]
+    for peaks, _, _ in normalEquations:
+        _setTemplateWeights(peaks, X[[pkres.pki for pkres in peaks]])
     return False
 
 
+def _templateNormalEquations(dp):
+    """Build the normal equations for the weights of the templates in a single filter
+
+    The model of the image inside the parent footprint is the sum of the weighted
+    templates, so the design matrix ``A`` has one column for each template.
+    Only ``A^T A`` and ``A^T b`` are calculated, from the pixels where pairs of
+    templates overlap, so the memory used does not depend on the size of the parent.
+
+    Parameters
+    ----------
+    dp: `DeblendedParent`
+        The deblended parent to re-weight
+
+    Returns
+    -------
+    peaks: list of `DeblendedPeak`
+        The peaks that are weighted (the ones that are not skipped).
+    AtA: `numpy.ndarray`
+        ``(N, N)`` matrix of the dot products of the templates in the parent footprint.
+    Atb: `numpy.ndarray`
+        Dot products of the templates with the image in the parent footprint.
+    """
+    peaks = [pkres for pkres in dp.peaks if not pkres.skip]
+    nchild = len(peaks)
+
+    fmask = afwImage.Mask(dp.bb)
+    fmask.setXY0(dp.bb.getMinX(), dp.bb.getMinY())
+    dp.fp.spans.setMask(fmask, 1)
+    inFootprint = fmask.getArray() > 0
+    parentImage = dp.img.Factory(dp.img, dp.bb, afwImage.PARENT)
+    b = np.where(inFootprint, parentImage.getArray(), 0).astype(np.float64)
+
+    # The template pixels in the parent footprint and their bounding boxes
+    # (inclusive, relative to the parent bounding box)
+    templates = []
+    boxes = np.zeros((nchild, 4), dtype=int)
+    for k, pkres in enumerate(peaks):
+        tbb = pkres.templateImage.getBBox()
+        tbb.clip(dp.bb)
+        if tbb.isEmpty():
+            templates.append(None)
+            boxes[k] = (0, -1, 0, -1)
+            continue
+        x0, y0 = tbb.getMinX() - dp.x0, tbb.getMinY() - dp.y0
+        x1, y1 = tbb.getMaxX() - dp.x0, tbb.getMaxY() - dp.y0
+        timg = pkres.templateImage.Factory(pkres.templateImage, tbb, afwImage.PARENT)
+        templates.append(np.where(inFootprint[y0:y1+1, x0:x1+1], timg.getArray(), 0).astype(np.float64))
+        boxes[k] = (x0, x1, y0, y1)
+
+    AtA = np.zeros((nchild, nchild))
+    Atb = np.zeros(nchild)
+    # Only pairs of templates with overlapping bounding boxes contribute to A^T A
+    ox0 = np.maximum.outer(boxes[:, 0], boxes[:, 0])
+    ox1 = np.minimum.outer(boxes[:, 1], boxes[:, 1])
+    oy0 = np.maximum.outer(boxes[:, 2], boxes[:, 2])
+    oy1 = np.minimum.outer(boxes[:, 3], boxes[:, 3])
+    overlaps = np.triu((ox0 <= ox1) & (oy0 <= oy1))
+    for k, l in zip(*np.nonzero(overlaps)):
+        xk, yk, xl, yl = boxes[k, 0], boxes[k, 2], boxes[l, 0], boxes[l, 2]
+        xa, xb, ya, yb = ox0[k, l], ox1[k, l] + 1, oy0[k, l], oy1[k, l] + 1
+        AtA[k, l] = AtA[l, k] = np.vdot(templates[k][ya-yk:yb-yk, xa-xk:xb-xk],
+                                        templates[l][ya-yl:yb-yl, xa-xl:xb-xl])
+    for k, template in enumerate(templates):
+        if template is not None:
+            x0, x1, y0, y1 = boxes[k]
+            Atb[k] = np.vdot(template, b[y0:y1+1, x0:x1+1])
+    return peaks, AtA, Atb
+
+
+def _setTemplateWeights(peaks, weights):
+    """Scale the template of each peak by its weight"""
+    for pkres, weight in zip(peaks, weights):
+        pkres.templateImage *= weight
+        pkres.setTemplateWeight(weight)
+
+
 def _weightTemplates(dp):
     """Weight the templates to best match the parent Footprint in a single filter
 
-    This includes weighting both regular templates and point source templates
+    This includes weighting both regular templates and point source templates.
+    The weights are the least-squares solution of the normal equations
+    calculated by `_templateNormalEquations`.
 
     Parameter
     ---------
@@ -1265,32 +1970,56 @@ def _weightTemplates(dp):
     -------
     None
     """
-    nchild = np.sum([pkres.skip is False for pkres in dp.peaks])
-    A = np.zeros((dp.W*dp.H, nchild))
-    parentImage = afwImage.ImageF(dp.bb)
-    afwDet.copyWithinFootprintImage(dp.fp, dp.img, parentImage)
-    b = parentImage.getArray().ravel()
-
-    index = 0
-    for pkres in dp.peaks:
-        if pkres.skip:
-            continue
-        childImage = afwImage.ImageF(dp.bb)
-        afwDet.copyWithinFootprintImage(dp.fp, pkres.templateImage, childImage)
-        A[:, index] = childImage.getArray().ravel()
-        index += 1
+    peaks, AtA, Atb = _templateNormalEquations(dp)
+    X1, r1, rank1, s1 = np.linalg.lstsq(AtA, Atb, rcond=-1)
+    _setTemplateWeights(peaks, X1)
 
-    X1, r1, rank1, s1 = np.linalg.lstsq(A, b, rcond=-1)
-    del A
-    del b
 
-    index = 0
-    for pkres in dp.peaks:
-        if pkres.skip:
-            continue
-        pkres.templateImage *= X1[index]
-        pkres.setTemplateWeight(X1[index])
-        index += 1
+def _templateDotProducts(peaks):
+    """Compute the dot products between the templates of ``peaks``
+
+    Only the pairs of templates with overlapping bounding boxes are
+    multiplied, on the intersection of their bounding boxes, so the cost
+    does not depend on the size of the parent, as in `_templateNormalEquations`.
+    This gives the same values as `afw.detection.HeavyFootprint.dot`.
+
+    Parameters
+    ----------
+    peaks: list of `lsst.meas.deblender.baseline.DeblendedPeak`
+        Peaks with templates.
+
+    Returns
+    -------
+    gram: `numpy.ndarray`
+        ``(N, N)`` matrix of the dot products between the templates.
+    """
+    nchild = len(peaks)
+    gram = np.zeros((nchild, nchild))
+    if nchild == 0:
+        return gram
+
+    # Template pixels outside of the template footprints are set to zero,
+    # and the bounding boxes are inclusive
+    templates = []
+    boxes = np.zeros((nchild, 4), dtype=int)
+    for k, pkres in enumerate(peaks):
+        tbb = pkres.templateFootprint.getBBox()
+        template = afwImage.ImageF(tbb)
+        pkres.templateFootprint.spans.copyImage(pkres.templateImage, template)
+        templates.append(template.getArray().astype(np.float64))
+        boxes[k] = (tbb.getMinX(), tbb.getMaxX(), tbb.getMinY(), tbb.getMaxY())
+
+    ox0 = np.maximum.outer(boxes[:, 0], boxes[:, 0])
+    ox1 = np.minimum.outer(boxes[:, 1], boxes[:, 1])
+    oy0 = np.maximum.outer(boxes[:, 2], boxes[:, 2])
+    oy1 = np.minimum.outer(boxes[:, 3], boxes[:, 3])
+    overlaps = np.triu((ox0 <= ox1) & (oy0 <= oy1))
+    for k, l in zip(*np.nonzero(overlaps)):
+        xk, yk, xl, yl = boxes[k, 0], boxes[k, 2], boxes[l, 0], boxes[l, 2]
+        xa, xb, ya, yb = ox0[k, l], ox1[k, l] + 1, oy0[k, l], oy1[k, l] + 1
+        gram[k, l] = gram[l, k] = np.vdot(templates[k][ya-yk:yb-yk, xa-xk:xb-xk],
+                                          templates[l][ya-yl:yb-yl, xa-xl:xb-xl])
+    return gram
 
 
 def reconstructTemplates(debResult, log, maxTempDotProd=0.5):
@@ -1304,6 +2033,10 @@ def reconstructTemplates(debResult, log, maxTempDotProd=0.5):
     If only one of the peaks is a PSF template, the other template is used,
     otherwise the one with the maximum template value is kept.
 
+    The matrix of inner products is calculated once and all of the degenerate pairs are
+    removed in a single call, one pair at a time, by removing the rejected template
+    from the matrix, so the plugins after ``onReset`` only need to be run once.
+
     Parameters
     ----------
     debResult: `lsst.meas.deblender.baseline.DeblenderResult`
@@ -1324,71 +2057,48 @@ def reconstructTemplates(debResult, log, maxTempDotProd=0.5):
     foundReject = False
     for fidx in debResult.filters:
         dp = debResult.deblendedParents[fidx]
-        nchild = np.sum([pkres.skip is False for pkres in dp.peaks])
-        indexes = [pkres.pki for pkres in dp.peaks if pkres.skip is False]
-
-        # We build a matrix that stores the dot product between templates.
-        # We convert the template images to HeavyFootprints because they already have a method
-        # to compute the dot product.
-        A = np.zeros((nchild, nchild))
-        maxTemplate = []
-        heavies = []
-        for pkres in dp.peaks:
-            if pkres.skip:
-                continue
-            heavies.append(afwDet.makeHeavyFootprint(pkres.templateFootprint,
-                                                     afwImage.MaskedImageF(pkres.templateImage)))
-            maxTemplate.append(np.max(pkres.templateImage.getArray()))
-
-        for i in range(nchild):
-            for j in range(i + 1):
-                A[i, j] = heavies[i].dot(heavies[j])
-
-        # Normalize the dot products to get the cosine of the angle between templates
-        for i in range(nchild):
-            for j in range(i):
-                norm = A[i, i]*A[j, j]
-                if norm <= 0:
-                    A[i, j] = 0
-                else:
-                    A[i, j] /= np.sqrt(norm)
-
-        # Iterate over pairs of objects and find the maximum non-diagonal element of the matrix.
-        # Exit the loop once we find a single degenerate pair greater than the threshold.
-        rejectedIndex = -1
-        for i in range(nchild):
-            currentMax = 0.
-            for j in range(i):
-                if A[i, j] > currentMax:
-                    currentMax = A[i, j]
-                    if currentMax > maxTempDotProd:
-                        foundReject = True
-                        rejectedIndex = j
-
-            if foundReject:
+        peaks = [pkres for pkres in dp.peaks if pkres.skip is False]
+        nchild = len(peaks)
+        maxTemplate = [np.max(pkres.templateImage.getArray()) for pkres in peaks]
+
+        # Normalize the dot products to get the cosine of the angle between templates,
+        # keeping only the elements below the diagonal
+        A = _templateDotProducts(peaks)
+        diag = np.diag(A)
+        norm = np.outer(diag, diag)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            A = np.where(norm > 0, A/np.sqrt(np.where(norm > 0, norm, 1)), 0)
+        A = np.tril(A, -1)
+
+        while nchild > 1:
+            # Find the first row with an element greater than the threshold,
+            # and the column of the maximum element in that row
+            rowMax = A.max(axis=1)
+            rows = np.flatnonzero(rowMax > max(maxTempDotProd, 0))
+            if len(rows) == 0:
                 break
-
-        del A
-
-        # If one of the objects is identified as a PSF keep the other one, otherwise keep the one
-        # with the maximum template value
-        if foundReject:
-            keep = indexes[i]
-            reject = indexes[rejectedIndex]
-            if dp.peaks[keep].deblendedAsPsf and dp.peaks[reject].deblendedAsPsf is False:
-                keep = indexes[rejectedIndex]
-                reject = indexes[i]
-            elif dp.peaks[keep].deblendedAsPsf is False and dp.peaks[reject].deblendedAsPsf:
-                reject = indexes[rejectedIndex]
-                keep = indexes[i]
-            else:
-                if maxTemplate[rejectedIndex] > maxTemplate[i]:
-                    keep = indexes[rejectedIndex]
-                    reject = indexes[i]
-            log.trace('Removing object with index %d : %f.  Degenerate with %d' % (reject, currentMax,
-                                                                                   keep))
-            dp.peaks[reject].skip = True
-            dp.peaks[reject].degenerate = True
+            i = rows[0]
+            j = int(np.argmax(A[i]))
+            currentMax = A[i, j]
+            foundReject = True
+
+            # If one of the objects is identified as a PSF keep the other one, otherwise keep the one
+            # with the maximum template value
+            keep, reject = i, j
+            if peaks[keep].deblendedAsPsf and peaks[reject].deblendedAsPsf is False:
+                keep, reject = j, i
+            elif peaks[keep].deblendedAsPsf is False and peaks[reject].deblendedAsPsf:
+                keep, reject = i, j
+            elif maxTemplate[j] > maxTemplate[i]:
+                keep, reject = j, i
+            log.trace('Removing object with index %d : %f.  Degenerate with %d' % (peaks[reject].pki,
+                                                                                   currentMax,
+                                                                                   peaks[keep].pki))
+            peaks[reject].skip = True
+            peaks[reject].degenerate = True
+            # Remove the rejected template from the matrix
+            A[reject, :] = 0
+            A[:, reject] = 0
 
     return foundReject
 
@@ -1449,101 +2159,124 @@ def apportionFlux(debResult, log, assignStrayFlux=True, strayFluxAssignment='r-t
         raise ValueError((('strayFluxAssignment: value \"%s\" not in the set of allowed values: ') %
                           strayFluxAssignment) + str(validStrayAssign))
 
-    for fidx in debResult.filters:
-        dp = debResult.deblendedParents[fidx]
-        # Prepare inputs to "apportionFlux" call.
-        # template maskedImages
-        tmimgs = []
-        # template footprints
-        tfoots = []
-        # deblended as psf
-        dpsf = []
-        # peak x,y
-        pkx = []
-        pky = []
-        # indices of valid templates
-        ibi = []
-        bb = dp.fp.getBBox()
-
-        for peaki, pkres in enumerate(dp.peaks):
-            if pkres.skip:
-                continue
-            tmimgs.append(pkres.templateImage)
-            tfoots.append(pkres.templateFootprint)
-            # for stray flux...
-            dpsf.append(pkres.deblendedAsPsf)
-            pk = pkres.peak
-            pkx.append(pk.getIx())
-            pky.append(pk.getIy())
-            ibi.append(pkres.pki)
-
-        # Now apportion flux according to the templates
-        log.trace('Apportioning flux among %i templates', len(tmimgs))
-        sumimg = afwImage.ImageF(bb)
-        # .getDimensions())
-        # sumimg.setXY0(bb.getMinX(), bb.getMinY())
-
-        strayopts = 0
-        if strayFluxAssignment == 'trim':
-            assignStrayFlux = False
-            strayopts |= bUtils.STRAYFLUX_TRIM
-        if assignStrayFlux:
-            strayopts |= bUtils.ASSIGN_STRAYFLUX
-            if strayFluxToPointSources == 'necessary':
-                strayopts |= bUtils.STRAYFLUX_TO_POINT_SOURCES_WHEN_NECESSARY
-            elif strayFluxToPointSources == 'always':
-                strayopts |= bUtils.STRAYFLUX_TO_POINT_SOURCES_ALWAYS
-
-            if strayFluxAssignment == 'r-to-peak':
-                # this is the default
-                pass
-            elif strayFluxAssignment == 'r-to-footprint':
-                strayopts |= bUtils.STRAYFLUX_R_TO_FOOTPRINT
-            elif strayFluxAssignment == 'nearest-footprint':
-                strayopts |= bUtils.STRAYFLUX_NEAREST_FOOTPRINT
-
-        portions, strayflux = bUtils.apportionFlux(dp.maskedImage, dp.fp, tmimgs, tfoots, sumimg, dpsf,
-                                                   pkx, pky, strayopts, clipStrayFluxFraction)
-
-        # Shrink parent to union of children
-        if strayFluxAssignment == 'trim':
+    strayopts = 0
+    if strayFluxAssignment == 'trim':
+        assignStrayFlux = False
+        strayopts |= bUtils.STRAYFLUX_TRIM
+    if assignStrayFlux:
+        strayopts |= bUtils.ASSIGN_STRAYFLUX
+        if strayFluxToPointSources == 'necessary':
+            strayopts |= bUtils.STRAYFLUX_TO_POINT_SOURCES_WHEN_NECESSARY
+        elif strayFluxToPointSources == 'always':
+            strayopts |= bUtils.STRAYFLUX_TO_POINT_SOURCES_ALWAYS
+
+        if strayFluxAssignment == 'r-to-peak':
+            # this is the default
+            pass
+        elif strayFluxAssignment == 'r-to-footprint':
+            strayopts |= bUtils.STRAYFLUX_R_TO_FOOTPRINT
+        elif strayFluxAssignment == 'nearest-footprint':
+            strayopts |= bUtils.STRAYFLUX_NEAREST_FOOTPRINT
+
+    if strayFluxAssignment == 'trim':
+        # The parent footprint is shared by all of the filters and each filter is
+        # apportioned within the footprint trimmed by the previous filters,
+        # so the filters are processed in order
+        for fidx in debResult.filters:
+            dp = debResult.deblendedParents[fidx]
+            sumimg, tfoots = _apportionFlux(dp, log, strayopts, assignStrayFlux, clipStrayFluxFraction)
+            # Shrink parent to union of children
             finalSpanSet = afwGeom.SpanSet()
             for foot in tfoots:
                 finalSpanSet = finalSpanSet.union(foot.spans)
             dp.fp.setSpans(finalSpanSet)
-
-        # Store the template sum in the deblender result
-        if getTemplateSum:
+            if getTemplateSum:
+                debResult.setTemplateSums(sumimg, fidx)
+        return True
+
+    results = _mapFilters(debResult, _apportionFlux, log, strayopts, assignStrayFlux, clipStrayFluxFraction)
+    # Store the template sum in the deblender result
+    if getTemplateSum:
+        for fidx, (sumimg, tfoots) in zip(debResult.filters, results):
             debResult.setTemplateSums(sumimg, fidx)
+    return True
 
-        # Save the apportioned fluxes
-        ii = 0
-        for j, (pk, pkres) in enumerate(zip(dp.fp.getPeaks(), dp.peaks)):
-            if pkres.skip:
-                continue
-            pkres.setFluxPortion(portions[ii])
 
-            if assignStrayFlux:
-                # NOTE that due to a swig bug (https://github.com/swig/swig/issues/59)
-                # we CANNOT iterate over "strayflux", but must index into it.
-                stray = strayflux[ii]
-            else:
-                stray = None
-            ii += 1
+def _apportionFlux(dp, log, strayopts, assignStrayFlux, clipStrayFluxFraction):
+    """Apportion flux to all of the peak templates in a single filter
 
-            pkres.setStrayFlux(stray)
+    See `apportionFlux` for a description of the parameters.
 
-        # Set child footprints to contain the right number of peaks.
-        for j, (pk, pkres) in enumerate(zip(dp.fp.getPeaks(), dp.peaks)):
-            if pkres.skip:
-                continue
+    Returns
+    -------
+    sumimg: `afw.image.ImageF`
+        Sum of the templates.
+    tfoots: list of `afw.detection.Footprint`
+        Template footprints of the peaks that were not skipped.
+    """
+    # Prepare inputs to "apportionFlux" call.
+    # template maskedImages
+    tmimgs = []
+    # template footprints
+    tfoots = []
+    # deblended as psf
+    dpsf = []
+    # peak x,y
+    pkx = []
+    pky = []
+    # indices of valid templates
+    ibi = []
+    bb = dp.fp.getBBox()
+
+    for peaki, pkres in enumerate(dp.peaks):
+        if pkres.skip:
+            continue
+        tmimgs.append(pkres.templateImage)
+        tfoots.append(pkres.templateFootprint)
+        # for stray flux...
+        dpsf.append(pkres.deblendedAsPsf)
+        pk = pkres.peak
+        pkx.append(pk.getIx())
+        pky.append(pk.getIy())
+        ibi.append(pkres.pki)
+
+    # Now apportion flux according to the templates
+    log.trace('Apportioning flux among %i templates', len(tmimgs))
+    sumimg = afwImage.ImageF(bb)
+    # .getDimensions())
+    # sumimg.setXY0(bb.getMinX(), bb.getMinY())
+
+    portions, strayflux = bUtils.apportionFlux(dp.maskedImage, dp.fp, tmimgs, tfoots, sumimg, dpsf,
+                                               pkx, pky, strayopts, clipStrayFluxFraction)
+
+    # Save the apportioned fluxes
+    ii = 0
+    for j, (pk, pkres) in enumerate(zip(dp.fp.getPeaks(), dp.peaks)):
+        if pkres.skip:
+            continue
+        pkres.setFluxPortion(portions[ii])
 
-            for foot, add in [(pkres.templateFootprint, True), (pkres.origFootprint, True),
-                              (pkres.strayFlux, False)]:
-                if foot is None:
-                    continue
-                pks = foot.getPeaks()
-                pks.clear()
-                if add:
-                    pks.append(pk)
-    return True
+        if assignStrayFlux:
+            # NOTE that due to a swig bug (https://github.com/swig/swig/issues/59)
+            # we CANNOT iterate over "strayflux", but must index into it.
+            stray = strayflux[ii]
+        else:
+            stray = None
+        ii += 1
+
+        pkres.setStrayFlux(stray)
+
+    # Set child footprints to contain the right number of peaks.
+    for j, (pk, pkres) in enumerate(zip(dp.fp.getPeaks(), dp.peaks)):
+        if pkres.skip:
+            continue
+
+        for foot, add in [(pkres.templateFootprint, True), (pkres.origFootprint, True),
+                          (pkres.strayFlux, False)]:
+            if foot is None:
+                continue
+            pks = foot.getPeaks()
+            pks.clear()
+            if add:
+                pks.append(pk)
+    return sumimg, tfoots
@@ -0,0 +1,127 @@
+# This file is part of meas_deblender.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""On-disk output of the deblender catalogs
+
+When the deblender output is written to a `CatalogSink`, the children
+are only kept in memory until the batch of parents that they belong to
+has been deblended, so the memory used by the output catalogs does not
+grow with the number of sources in the patch.
+"""
+
+import os
+
+import lsst.afw.table as afwTable
+
+__all__ = ["CatalogSink"]
+
+
+class CatalogSink:
+    """Write the output catalogs of the deblender in each band to disk
+    in batches of parents
+
+    Each call to `write` creates one FITS file per band, named
+    ``<name>_<filter>_<batch>.fits``, containing the parents in the batch
+    followed by their children.
+
+    Parameters
+    ----------
+    directory: `str`
+        Directory in which the catalogs are written; it is created if it
+        does not exist.
+    name: `str`
+        Prefix of the file names, for example ``"flux"`` or ``"template"``.
+    filters: list of `str`
+        Names of the filters.
+    table: `afw.table.SourceTable`
+        Table of the catalog of parents.  It is cloned once for each band,
+        so that the ids of the children are the same in each band and
+        unique across batches.
+    """
+
+    def __init__(self, directory, name, filters, table):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.filters = list(filters)
+        self.tables = {f: table.clone() for f in self.filters}
+        self.filenames = {f: [] for f in self.filters}
+        self.nRecords = 0
+
+    def makeCatalogs(self, parents):
+        """Create the output catalog in each band for a batch of parents
+
+        Parameters
+        ----------
+        parents: `afw.table.SourceCatalog`
+            Parents in the batch.  The records are shared with the output
+            catalogs, as for the catalogs kept in memory by the deblender.
+
+        Returns
+        -------
+        catalogs: `dict`
+            Output catalog in each band, containing the parents.
+        """
+        catalogs = {}
+        for f in self.filters:
+            catalog = afwTable.SourceCatalog(self.tables[f])
+            catalog.extend(parents)
+            catalogs[f] = catalog
+        return catalogs
+
+    def write(self, catalogs):
+        """Write the catalogs of a batch in each band to disk
+
+        Parameters
+        ----------
+        catalogs: `dict`
+            Output catalog in each band, created with `makeCatalogs`.
+        """
+        for f in self.filters:
+            filename = os.path.join(self.directory, "{0}_{1}_{2:05d}.fits".format(
+                self.name, f, len(self.filenames[f])))
+            catalogs[f].writeFits(filename)
+            self.filenames[f].append(filename)
+        self.nRecords += len(catalogs[self.filters[0]])
+
+    def readCatalog(self, f):
+        """Read all of the batches written for a band into a single catalog
+
+        Parameters
+        ----------
+        f: `str`
+            Name of the filter.
+
+        Returns
+        -------
+        catalog: `afw.table.SourceCatalog`
+            Parents and children in the band, in the order they were written.
+        """
+        catalog = None
+        for filename in self.filenames[f]:
+            batch = afwTable.SourceCatalog.readFits(filename)
+            if catalog is None:
+                catalog = batch
+            else:
+                catalog.extend(batch, deep=True)
+        if catalog is None:
+            catalog = afwTable.SourceCatalog(self.tables[f].clone())
+        return catalog
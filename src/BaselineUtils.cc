@@ -1,6 +1,12 @@
+#include <algorithm>
 #include <list>
 #include <cmath>
 #include <cstdint>
+#include <cstdlib>
+#include <iterator>
+#include <limits>
+#include <set>
+#include <vector>
 
 #include "lsst/log/Log.h"
 #include "lsst/meas/deblender/BaselineUtils.h"
@@ -34,6 +40,27 @@ const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::STRAY
 template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
 const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::STRAYFLUX_TRIM;
 
+template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::MONOTONIC_CONE;
+
+template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::MONOTONIC_RADIAL;
+
+template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::TEMPLATE_OUT_OF_BOUNDS;
+
+template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::TEMPLATE_FAILED_SYMMETRIC;
+
+template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::TEMPLATE_PATCHED;
+
+template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::TEMPLATE_RAMPED;
+
+template <typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+const int deblend::BaselineUtils<ImagePixelT, MaskPixelT, VariancePixelT>::TEMPLATE_NO_PSF;
+
 static bool span_compare(afwGeom::Span const & sp1,
                          afwGeom::Span const & sp2) {
     return (sp1 < sp2);
@@ -126,20 +153,244 @@ namespace {
             }
         }
     }
+
+    /*
+     * The values of the pixels in a box that slides over an image, split
+     * into a lower and an upper half so that the median is always known.
+     *
+     * The box is moved by one pixel at a time by removing the row (or column)
+     * of pixels that leaves the box and adding the one that enters it.  Each
+     * value is inserted in or erased from one of the halves, which costs
+     * O(log N) for a box of N pixels, and the halves are rebalanced once per
+     * step.  NaN pixels are never added.
+     */
+    template <typename PixelT>
+    class MedianWindow {
+    public:
+        bool empty() const { return _upper.empty(); }
+
+        // The upper median, ie the median for an odd number of pixels
+        PixelT median() const { return *_upper.begin(); }
+
+        // Remove the *removed* values, which must all be in the window, and add the *added* values
+        void update(std::vector<PixelT> const& removed, std::vector<PixelT> const& added) {
+            for (PixelT const value : removed) {
+                if (!_upper.empty() && !(value < *_upper.begin())) {
+                    _upper.erase(_upper.find(value));
+                } else {
+                    _lower.erase(_lower.find(value));
+                }
+            }
+            for (PixelT const value : added) {
+                if (!_upper.empty() && !(value < *_upper.begin())) {
+                    _upper.insert(value);
+                } else {
+                    _lower.insert(value);
+                }
+            }
+            // The lower half holds the n/2 smallest of the n values
+            size_t const nLower = (_lower.size() + _upper.size())/2;
+            while (_lower.size() > nLower) {
+                typename std::multiset<PixelT>::iterator last = std::prev(_lower.end());
+                _upper.insert(*last);
+                _lower.erase(last);
+            }
+            while (_lower.size() < nLower) {
+                _lower.insert(*_upper.begin());
+                _upper.erase(_upper.begin());
+            }
+        }
+
+    private:
+        std::multiset<PixelT> _lower;
+        std::multiset<PixelT> _upper;
+    };
+
+    /*
+     * Append the non-NaN pixels of *img* in column *x* between rows *y0* and *y1* (inclusive)
+     * to *values*; nothing is appended if *x* is outside of the image.
+     */
+    template <typename ImageT>
+    void getColumn(ImageT const& img, int x, int y0, int y1,
+                   std::vector<typename ImageT::Pixel> & values) {
+        if (x < 0 || x >= img.getWidth()) {
+            return;
+        }
+        for (int y = std::max(y0, 0); y <= std::min(y1, img.getHeight() - 1); ++y) {
+            typename ImageT::Pixel const value = img.row_begin(y)[x];
+            if (!std::isnan(value)) {
+                values.push_back(value);
+            }
+        }
+    }
+
+    /*
+     * Append the non-NaN pixels of *img* in row *y* between columns *x0* and *x1* (inclusive)
+     * to *values*; nothing is appended if *y* is outside of the image.
+     */
+    template <typename ImageT>
+    void getRow(ImageT const& img, int y, int x0, int x1,
+                std::vector<typename ImageT::Pixel> & values) {
+        if (y < 0 || y >= img.getHeight()) {
+            return;
+        }
+        typename ImageT::x_iterator row = img.row_begin(y);
+        for (int x = std::max(x0, 0); x <= std::min(x1, img.getWidth() - 1); ++x) {
+            if (!std::isnan(row[x])) {
+                values.push_back(row[x]);
+            }
+        }
+    }
+
+    /*
+     * Squared Euclidean distance transform of a line of *n* samples of *f*
+     * (0 on the footprint and a large value elsewhere), using the lower
+     * envelope of parabolas of Felzenszwalb & Huttenlocher (2012), written
+     * to *d*.  *v* and *z* are work arrays of *n* and *n* + 1 elements.
+     */
+    void squaredDistance1d(double const* f, int n, double* d, int* v, double* z) {
+        int k = 0;
+        v[0] = 0;
+        z[0] = -std::numeric_limits<double>::infinity();
+        z[1] = std::numeric_limits<double>::infinity();
+        for (int q = 1; q < n; ++q) {
+            double s = ((f[q] + double(q)*q) - (f[v[k]] + double(v[k])*v[k])) / (2.0*(q - v[k]));
+            while (s <= z[k]) {
+                --k;
+                s = ((f[q] + double(q)*q) - (f[v[k]] + double(v[k])*v[k])) / (2.0*(q - v[k]));
+            }
+            ++k;
+            v[k] = q;
+            z[k] = s;
+            z[k + 1] = std::numeric_limits<double>::infinity();
+        }
+        k = 0;
+        for (int q = 0; q < n; ++q) {
+            while (z[k + 1] < q) {
+                ++k;
+            }
+            d[q] = double(q - v[k])*(q - v[k]) + f[v[k]];
+        }
+    }
+
+    /*
+     * Compute the squared Euclidean distance from each of the *pixels*
+     * (in the parent coordinates) to the nearest pixel of the footprint
+     * *foot*, writing the distance for pixel k to r2[k*stride].
+     *
+     * The distance transform is computed over the union of *bbox* (which
+     * must contain all of the *pixels*) and the bounding box of *foot*,
+     * so that it is exact even when the footprint extends beyond *bbox*.
+     * Pixels are given a distance of 1e12 when *foot* is empty.
+     */
+    void footprintDistances(det::Footprint const& foot, afwGeom::Box2I const& bbox,
+                            std::vector<afwGeom::Point2I> const& pixels,
+                            float* r2, size_t stride) {
+        double const far = 1e12;
+        if (foot.getArea() == 0) {
+            for (size_t k = 0; k < pixels.size(); ++k) {
+                r2[k*stride] = far;
+            }
+            return;
+        }
+        afwGeom::Box2I domain(bbox);
+        domain.include(foot.getBBox());
+        int const x0 = domain.getMinX();
+        int const y0 = domain.getMinY();
+        int const W = domain.getWidth();
+        int const H = domain.getHeight();
+        int const N = std::max(W, H);
+
+        std::vector<double> dist(static_cast<size_t>(W)*H, far);
+        for (afwGeom::Span const & sp : *foot.getSpans()) {
+            std::fill(dist.begin() + static_cast<size_t>(sp.getY() - y0)*W + (sp.getX0() - x0),
+                      dist.begin() + static_cast<size_t>(sp.getY() - y0)*W + (sp.getX1() - x0) + 1, 0.);
+        }
+
+        std::vector<double> f(N), d(N), z(N + 1);
+        std::vector<int> v(N);
+        // Columns...
+        for (int x = 0; x < W; ++x) {
+            for (int y = 0; y < H; ++y) {
+                f[y] = dist[static_cast<size_t>(y)*W + x];
+            }
+            squaredDistance1d(f.data(), H, d.data(), v.data(), z.data());
+            for (int y = 0; y < H; ++y) {
+                dist[static_cast<size_t>(y)*W + x] = d[y];
+            }
+        }
+        // ...then rows, but only the rows that contain one of the pixels
+        int lastRow = -1;
+        for (size_t k = 0; k < pixels.size(); ++k) {
+            int const y = pixels[k].getY() - y0;
+            double* row = &dist[static_cast<size_t>(y)*W];
+            if (y != lastRow) {
+                std::copy(row, row + W, f.begin());
+                squaredDistance1d(f.data(), W, row, v.data(), z.data());
+                lastRow = y;
+            }
+            r2[k*stride] = std::min(row[pixels[k].getX() - x0], far);
+        }
+    }
+
+    /*
+     * Clip the Footprint *foot* to the region of *img* containing non-zero
+     * values: spans that are totally zero are dropped and the endpoints of the
+     * other spans are moved to non-zero pixels (spans with internal zeros are
+     * not split).  This is the same as plugins.clipFootprintToNonzeroImpl.
+     */
+    template <typename ImagePixelT>
+    void clipFootprintToNonzero(det::Footprint & foot, image::Image<ImagePixelT> const& img) {
+        int const x0 = img.getX0();
+        int const y0 = img.getY0();
+        int const x1 = x0 + img.getWidth() - 1;
+        int const y1 = y0 + img.getHeight() - 1;
+        std::vector<afwGeom::Span> newSpans;
+        for (afwGeom::Span const & span : *foot.getSpans()) {
+            int const y = span.getY();
+            if (y < y0 || y > y1) {
+                continue;
+            }
+            int const xMin = std::max(span.getX0(), x0);
+            int const xMax = std::min(span.getX1(), x1);
+            if (xMin > xMax) {
+                continue;
+            }
+            int left = xMin;
+            while (left <= xMax && img.get0(left, y) == 0) {
+                ++left;
+            }
+            if (left > xMax) {
+                continue;
+            }
+            int right = xMax;
+            while (img.get0(right, y) == 0) {
+                --right;
+            }
+            newSpans.push_back(afwGeom::Span(y, left, right));
+        }
+        foot.setSpans(std::make_shared<afwGeom::SpanSet>(std::move(newSpans), false));
+        foot.removeOrphanPeaks();
+    }
 } // end anonymous namespace
 
 /**
  Run a spatial median filter over the given input *img*, writing the
  results to *out*.  *halfsize* is half the box size of the filter; ie,
- a halfsize of 50 means that each output ixel will be the median of
+ a halfsize of 50 means that each output pixel will be the median of
  the pixels in a 101 x 101-pixel box in the input image.
 
- Margins are handled horribly: the median is computed only for pixels
- more than *halfsize* away from the edges; pixels near the edges are
- simply copied from the input *img* to *out*.
-
- Mask and variance planes are, likewise, simply copied from *img* to
- *out*.
+ The box slides over the image in a serpentine (boustrophedon) order,
+ keeping the values of the pixels in the box in two sorted halves, so
+ that each step only removes and adds one row or column of pixels, in
+ O(S log S) time for a box of S x S pixels.  Near the edges the
+ median is computed from the part of the box that lies inside the
+ image, and NaN pixels are ignored (a pixel whose box contains only NaN
+ pixels keeps its input value).  When the number of pixels in the box
+ is even, the larger of the two central values is used.
+
+ The output rows are buffered until no later box needs the input rows,
+ so *img* and *out* may be the same image to filter it in place.
  */
 template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
 void
@@ -147,52 +398,73 @@ deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
 medianFilter(ImageT const& img,
              ImageT & out,
              int halfsize) {
-    int S = halfsize*2 + 1;
-    int SS = S*S;
-    typedef typename ImageT::xy_locator xy_loc;
-    xy_loc pix = img.xy_at(halfsize,halfsize);
-    std::vector<typename xy_loc::cached_location_t> locs;
-    for (int i=0; i<S; ++i) {
-        for (int j=0; j<S; ++j) {
-            locs.push_back(pix.cache_location(j-halfsize, i-halfsize));
-        }
-    }
-    int W = img.getWidth();
-    int H = img.getHeight();
-    ImagePixelT vals[S*S];
-    for (int y=halfsize; y<H-halfsize; ++y) {
-        xy_loc inpix = img.xy_at(halfsize, y), end = img.xy_at(W-halfsize, y);
-        for (typename ImageT::x_iterator optr = out.row_begin(y) + halfsize;
-             inpix != end; ++inpix.x(), ++optr) {
-            for (int i=0; i<SS; ++i)
-                vals[i] = inpix[locs[i]];
-            std::nth_element(vals, vals+SS/2, vals+SS);
-            *optr = vals[SS/2];
-        }
-    }
-
-    // grumble grumble margins
-    for (int y=0; y<2*halfsize; ++y) {
-        int iy = y;
-        if (y >= halfsize)
-            iy = H - 1 - (y-halfsize);
-        typename ImageT::x_iterator optr = out.row_begin(iy);
-        typename ImageT::x_iterator iptr = img.row_begin(iy), end=img.row_end(iy);
-        for (; iptr != end; ++iptr,++optr)
-            *optr = *iptr;
-    }
-    for (int y=halfsize; y<H-halfsize; ++y) {
-        typename ImageT::x_iterator optr = out.row_begin(y);
-        typename ImageT::x_iterator iptr = img.row_begin(y), end=img.row_begin(y)+halfsize;
-        for (; iptr != end; ++iptr,++optr)
-            *optr = *iptr;
-        iptr = img.row_begin(y) + ((W-1) - halfsize);
-        end  = img.row_begin(y) + (W-1);
-        optr = out.row_begin(y) + ((W-1) - halfsize);
-        for (; iptr != end; ++iptr,++optr)
-            *optr = *iptr;
+    int const W = img.getWidth();
+    int const H = img.getHeight();
+    if ((out.getWidth() != W) || (out.getHeight() != H)) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+            (boost::format("Output image must be the same size as the input image (%dx%d vs %dx%d)")
+                % out.getWidth() % out.getHeight() % W % H).str());
+    }
+    if (halfsize < 0) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                          (boost::format("halfsize must be non-negative (%d)") % halfsize).str());
+    }
+    if (W == 0 || H == 0) {
+        return;
+    }
+    int const S = halfsize*2 + 1;
+    MedianWindow<ImagePixelT> window;
+    std::vector<ImagePixelT> removed, added;
+    removed.reserve(S);
+    added.reserve(S*S);
+
+    // Output rows that may not be written yet because the input rows
+    // are needed by the boxes of the following rows
+    int const nBuffered = std::min(halfsize + 1, H);
+    std::vector<ImagePixelT> buffer(static_cast<size_t>(nBuffered)*W);
+    auto commitRow = [&](int yOut) {
+        typename std::vector<ImagePixelT>::const_iterator begin = buffer.begin() + (yOut % nBuffered)*W;
+        std::copy(begin, begin + W, out.row_begin(yOut));
+    };
+
+    // Box around pixel (0, 0)
+    for (int y = 0; y <= halfsize; ++y) {
+        getRow(img, y, 0, halfsize, added);
+    }
+    window.update(removed, added);
+
+    for (int y = 0; y < H; ++y) {
+        // Alternate the direction of each row, so that the box only moves by one pixel
+        bool const forward = (y % 2 == 0);
+        int const step = forward ? 1 : -1;
+        int x = forward ? 0 : W - 1;
+        if (y > 0) {
+            // Move the box down from the end of the previous row
+            removed.clear();
+            added.clear();
+            getRow(img, y - 1 - halfsize, x - halfsize, x + halfsize, removed);
+            getRow(img, y + halfsize, x - halfsize, x + halfsize, added);
+            window.update(removed, added);
+            // The input row y - 1 - halfsize is not in any of the remaining boxes
+            if (y > halfsize) {
+                commitRow(y - 1 - halfsize);
+            }
+        }
+        ImagePixelT * outRow = &buffer[static_cast<size_t>(y % nBuffered)*W];
+        for (int i = 0; i < W; ++i, x += step) {
+            if (i > 0) {
+                removed.clear();
+                added.clear();
+                getColumn(img, x - step*(halfsize + 1), y - halfsize, y + halfsize, removed);
+                getColumn(img, x + step*halfsize, y - halfsize, y + halfsize, added);
+                window.update(removed, added);
+            }
+            outRow[x] = window.empty() ? img.row_begin(y)[x] : window.median();
+        }
+    }
+    for (int yOut = std::max(H - 1 - halfsize, 0); yOut < H; ++yOut) {
+        commitRow(yOut);
     }
-
 }
 
 /**
@@ -360,33 +632,92 @@ makeMonotonic(
     }
 }
 
-static double _get_contrib_r_to_footprint(int x, int y,
-                                          PTR(det::Footprint) tfoot) {
-    double minr2 = 1e12;
-    for (afwGeom::Span const & sp : *(tfoot->getSpans())) {
-        int mindx;
-        // span is to right of pixel?
-        int dx = sp.getX0() - x;
-        if (dx >= 0) {
-            mindx = dx;
-        } else {
-            // span is to left of pixel?
-            dx = x - sp.getX1();
-            if (dx >= 0) {
-                mindx = dx;
-            } else {
-                // span contains pixel (in x direction)
-                mindx = 0;
+/**
+ Given an image *img* and Peak location *peak*, overwrite *img* so that
+ the profile is monotonic-decreasing along every ray from the peak, in
+ a single pass over the pixels.
+
+ Each pixel is clipped to the value at the point where the ray from the
+ pixel to the peak crosses the previous row or column of pixels (the
+ one closer to the peak), which is linearly interpolated between the
+ two pixels on either side of the crossing point.  The reference pixels
+ of a pixel depend only on its offset from the peak and are always
+ closer to the peak in both x and y, so each quadrant around the peak
+ is processed in a raster scan outward from the peak, and each pixel is
+ visited once.  Unlike makeMonotonic, the cost is linear in the number
+ of pixels and there is no need for a copy of the image.
+
+ Pixels whose reference pixels are outside of the image are not
+ modified, and NaN pixels are ignored.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+void
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+makeMonotonicRadial(
+    ImageT & img,
+    det::PeakRecord const& peak) {
+
+    int const x0 = img.getX0();
+    int const y0 = img.getY0();
+    int const W = img.getWidth();
+    int const H = img.getHeight();
+    // peak position in the image pixel coordinates
+    int const cx = peak.getIx() - x0;
+    int const cy = peak.getIy() - y0;
+
+    for (int sy = -1; sy <= 1; sy += 2) {
+        for (int sx = -1; sx <= 1; sx += 2) {
+            // Range of |dy| and |dx| of the quadrant that lies inside the image
+            int const dyMin = std::max(0, sy > 0 ? -cy : cy - (H - 1));
+            int const dyMax = sy > 0 ? H - 1 - cy : cy;
+            int const dxMin = std::max(0, sx > 0 ? -cx : cx - (W - 1));
+            int const dxMax = sx > 0 ? W - 1 - cx : cx;
+            for (int dy = dyMin; dy <= dyMax; ++dy) {
+                int const py = cy + sy*dy;
+                typename ImageT::x_iterator row = img.row_begin(py);
+                for (int dx = dxMin; dx <= dxMax; ++dx) {
+                    if (dx == 0 && dy == 0) {
+                        continue;
+                    }
+                    int const px = cx + sx*dx;
+                    // The pixels on either side of the crossing point:
+                    // (ax, ay) on the axis closest to the ray and (bx, by) on the diagonal,
+                    // with the fraction t of the diagonal pixel
+                    int ax, ay, bx, by;
+                    double t;
+                    if (dx >= dy) {
+                        ax = px - sx;
+                        ay = py;
+                        bx = ax;
+                        by = py - sy;
+                        t = double(dy)/dx;
+                    } else {
+                        ax = px;
+                        ay = py - sy;
+                        bx = px - sx;
+                        by = ay;
+                        t = double(dx)/dy;
+                    }
+                    if (ax < 0 || ax >= W || ay < 0 || ay >= H) {
+                        continue;
+                    }
+                    double ref = img(ax, ay);
+                    if (t > 0) {
+                        if (bx < 0 || bx >= W || by < 0 || by >= H) {
+                            continue;
+                        }
+                        ref += t*(img(bx, by) - ref);
+                    }
+                    // comparisons with NaN are false, so NaN pixels and references are skipped
+                    if (row[px] > ref) {
+                        row[px] = ref;
+                    }
+                }
             }
         }
-        int dy = sp.getY() - y;
-        minr2 = std::min(minr2, (double)(mindx*mindx + dy*dy));
     }
-    //printf("stray flux at (%i,%i): dist to t %i is %g\n", x, y, (int)i, sqrt(minr2));
-    return 1. / (1. + minr2);
 }
 
-
 template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
 void
 deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
@@ -458,6 +789,81 @@ _find_stray_flux(det::Footprint const& foot,
         nearestFootprint(*footlist, nearest, dist);
     }
 
+    // For STRAYFLUX_R_TO_FOOTPRINT: the squared distance from each stray
+    // pixel to each template footprint, r2[k*tfoots.size() + i], computed
+    // with one distance transform per template.
+    std::vector<float> r2;
+    if (strayFluxOptions & STRAYFLUX_R_TO_FOOTPRINT) {
+        std::vector<afwGeom::Point2I> strayPixels;
+        for (afwGeom::Span const & s : *foot.getSpans()) {
+            int y = s.getY();
+            typename ImageT::x_iterator tsum_it =
+                tsum->row_begin(y - sumy0) + (s.getX0() - sumx0);
+            typename MaskedImageT::x_iterator in_it =
+                img.row_begin(y - iy0) + (s.getX0() - ix0);
+            for (int x = s.getX0(); x <= s.getX1(); ++x, ++tsum_it, ++in_it) {
+                if ((*tsum_it > 0) || (*in_it).image() <= 0) {
+                    continue;
+                }
+                strayPixels.push_back(afwGeom::Point2I(x, y));
+            }
+        }
+        if (!strayPixels.empty()) {
+            r2.resize(strayPixels.size()*tfoots.size());
+            for (size_t i=0; i<tfoots.size(); ++i) {
+                footprintDistances(*tfoots[i], sumbb, strayPixels, &r2[i], tfoots.size());
+            }
+        }
+    }
+    // Index of the current stray pixel in r2
+    size_t k = 0;
+
+    // For STRAYFLUX_R_TO_PEAK: the templates that may receive stray flux.
+    // The contributions 1/(1+r^2) are never zero, so the point sources are
+    // only used if there are no other templates.
+    bool const rToPeak = !(strayFluxOptions & (STRAYFLUX_R_TO_FOOTPRINT | STRAYFLUX_NEAREST_FOOTPRINT));
+    std::vector<size_t> eligible;
+    if (rToPeak) {
+        for (size_t i=0; i<tfoots.size(); ++i) {
+            if (always || !ispsf.size() || !ispsf[i]) {
+                eligible.push_back(i);
+            }
+        }
+        if (eligible.empty() && (strayFluxOptions & STRAYFLUX_TO_POINT_SOURCES_WHEN_NECESSARY)) {
+            for (size_t i=0; i<tfoots.size(); ++i) {
+                eligible.push_back(i);
+            }
+        }
+    }
+    // The stray pixels are processed in batches of (at most) rToPeakBatch
+    // pixels along each span.  For each batch the eligible templates that are
+    // certain to be clipped everywhere in the batch are culled, and the
+    // remaining ("active") templates are copied into contiguous arrays.
+    int const rToPeakBatch = 32;
+    std::vector<double> dy2(tfoots.size());
+    std::vector<size_t> activeIndex;
+    std::vector<double> activePkx, activeDy2, activeContrib(tfoots.size());
+    // Sum of the largest possible contributions of the culled templates
+    double culledBound = 0.;
+
+    // Give the flux p of the stray pixel (x, y) to template i, extending
+    // the last stray span of the template if the pixels are contiguous.
+    auto addStrayPixel = [&](size_t i, int x, int y, double p, MaskPixelT mask, VariancePixelT var) {
+        if (!strayfoot[i]) {
+            strayfoot[i] = std::make_shared<det::Footprint>();
+            strayfoot[i]->setPeakSchema(foot.getPeaks().getSchema());
+        }
+        std::vector<afwGeom::Span> & spans = straySpans[i];
+        if (!spans.empty() && (spans.back().getY() == y) && (spans.back().getX1() == x - 1)) {
+            spans.back() = afwGeom::Span(y, spans.back().getX0(), x);
+        } else {
+            spans.push_back(afwGeom::Span(y, x, x));
+        }
+        straypix[i].push_back(p);
+        straymask[i].push_back(mask);
+        strayvar[i].push_back(var);
+    };
+
     // Go through the (parent) Footprint looking for stray flux:
     // pixels that are not claimed by any template, and positive.
     for (afwGeom::Span const & s : *foot.getSpans()) {
@@ -470,7 +876,43 @@ _find_stray_flux(det::Footprint const& foot,
             img.row_begin(y - iy0) + (x0 - ix0);
         double contrib[tfoots.size()];
 
+        if (rToPeak) {
+            for (size_t i : eligible) {
+                double dy = pky[i] - y;
+                dy2[i] = dy*dy;
+            }
+        }
+
         for (int x = x0; x <= x1; ++x, ++tsum_it, ++in_it) {
+            if (rToPeak && ((x - x0) % rToPeakBatch == 0)) {
+                int const xa = x;
+                int const xb = std::min(x + rToPeakBatch - 1, x1);
+                // Lower bound of the sum of the contributions at any pixel
+                // in the batch: each template contributes at least as much
+                // as at the end of the batch furthest from its peak.
+                double minsum = 0.;
+                for (size_t i : eligible) {
+                    double dx = std::max(std::abs(pkx[i] - xa), std::abs(pkx[i] - xb));
+                    minsum += 1. / (1. + dx*dx + dy2[i]);
+                }
+                double const cut = clipStrayFluxFraction * minsum;
+                activeIndex.clear();
+                activePkx.clear();
+                activeDy2.clear();
+                culledBound = 0.;
+                for (size_t i : eligible) {
+                    double dx = (pkx[i] < xa) ? (xa - pkx[i]) : ((pkx[i] > xb) ? (pkx[i] - xb) : 0);
+                    double cmax = 1. / (1. + dx*dx + dy2[i]);
+                    if (cmax < cut) {
+                        culledBound += cmax;
+                    } else {
+                        activeIndex.push_back(i);
+                        activePkx.push_back(pkx[i]);
+                        activeDy2.push_back(dy2[i]);
+                    }
+                }
+            }
+
             // Skip pixels that are covered by at least one
             // template (*tsum_it > 0) or the input is not
             // positive (*in_it <= 0).
@@ -478,26 +920,76 @@ _find_stray_flux(det::Footprint const& foot,
                 continue;
             }
 
+            if (rToPeak) {
+                // Split the stray flux by 1/(1+r^2) to peaks
+                size_t const nActive = activeIndex.size();
+                double const * apx = activePkx.data();
+                double const * ady2 = activeDy2.data();
+                double * ac = activeContrib.data();
+                for (size_t j=0; j<nActive; ++j) {
+                    double dx = apx[j] - x;
+                    ac[j] = 1. / (1. + dx*dx + ady2[j]);
+                }
+                double csum = 0.;
+                for (size_t j=0; j<nActive; ++j) {
+                    csum += ac[j];
+                }
+                double strayclip = (clipStrayFluxFraction * csum);
+                if (culledBound > 0.) {
+                    // The culled templates are always clipped, but they
+                    // raise the clipping threshold; that only matters if an
+                    // active template is close to the threshold, in which
+                    // case the full sum is computed.
+                    double const maxclip = clipStrayFluxFraction * (csum + culledBound);
+                    bool exact = false;
+                    for (size_t j=0; j<nActive; ++j) {
+                        if ((ac[j] >= strayclip) && (ac[j] < maxclip)) {
+                            exact = true;
+                            break;
+                        }
+                    }
+                    if (exact) {
+                        csum = 0.;
+                        for (size_t i : eligible) {
+                            int dx = pkx[i] - x;
+                            csum += 1. / (1. + dx*dx + dy2[i]);
+                        }
+                        strayclip = (clipStrayFluxFraction * csum);
+                    }
+                }
+                // Drop small contributions...
+                csum = 0.;
+                for (size_t j=0; j<nActive; ++j) {
+                    if (ac[j] < strayclip) {
+                        ac[j] = 0.;
+                    } else {
+                        csum += ac[j];
+                    }
+                }
+                for (size_t j=0; j<nActive; ++j) {
+                    if (ac[j] == 0.) {
+                        continue;
+                    }
+                    // the stray flux to give to template i
+                    addStrayPixel(activeIndex[j], x, y, (ac[j] / csum) * (*in_it).image(),
+                                  (*in_it).mask(), (*in_it).variance());
+                }
+                continue;
+            }
+
             if (strayFluxOptions & STRAYFLUX_R_TO_FOOTPRINT) {
-                // we'll compute these just-in-time
+                // Split the stray flux by 1/(1+r^2) to the template footprints
                 for (size_t i=0; i<tfoots.size(); ++i) {
-                    contrib[i] = -1.0;
+                    contrib[i] = 1. / (1. + r2[k*tfoots.size() + i]);
                 }
-            } else if (strayFluxOptions & STRAYFLUX_NEAREST_FOOTPRINT) {
+                ++k;
+            } else {
+                // STRAYFLUX_NEAREST_FOOTPRINT
                 for (size_t i=0; i<tfoots.size(); ++i) {
                     contrib[i] = 0.0;
                 }
                 int i = nearest->get0(x, y);
                 contrib[i] = 1.0;
-            } else {
-                // R_TO_PEAK
-                for (size_t i=0; i<tfoots.size(); ++i) {
-                    // Split the stray flux by 1/(1+r^2) to peaks
-                    int dx, dy;
-                    dx = pkx[i] - x;
-                    dy = pky[i] - y;
-                    contrib[i] = 1. / (1. + dx*dx + dy*dy);
-                }
             }
 
             // Round 1: skip point sources unless STRAYFLUX_TO_POINT_SOURCES_ALWAYS
@@ -509,9 +1001,6 @@ _find_stray_flux(det::Footprint const& foot,
                 if ((!ptsrcs) && ispsf.size() && ispsf[i]) {
                     continue;
                 }
-                if (contrib[i] == -1.0) {
-                    contrib[i] = _get_contrib_r_to_footprint(x, y, tfoots[i]);
-                }
                 csum += contrib[i];
             }
             if ((csum == 0.) &&
@@ -521,9 +1010,6 @@ _find_stray_flux(det::Footprint const& foot,
                 //LOGL_DEBUG(_log, "necessary to assign stray flux to point sources");
                 ptsrcs = true;
                 for (size_t i=0; i<tfoots.size(); ++i) {
-                    if (contrib[i] == -1.0) {
-                        contrib[i] = _get_contrib_r_to_footprint(x, y, tfoots[i]);
-                    }
                     csum += contrib[i];
                 }
             }
@@ -551,15 +1037,7 @@ _find_stray_flux(det::Footprint const& foot,
                 }
                 // the stray flux to give to template i
                 double p = (contrib[i] / csum) * (*in_it).image();
-
-                if (!strayfoot[i]) {
-                    strayfoot[i] = std::make_shared<det::Footprint>();
-                    strayfoot[i]->setPeakSchema(foot.getPeaks().getSchema());
-                }
-                straySpans[i].push_back(afwGeom::Span(y, x, x));
-                straypix[i].push_back(p);
-                straymask[i].push_back((*in_it).mask());
-                strayvar[i].push_back((*in_it).variance());
+                addStrayPixel(i, x, y, p, (*in_it).mask(), (*in_it).variance());
             }
         }
     }
@@ -576,28 +1054,12 @@ _find_stray_flux(det::Footprint const& foot,
             /// the HeavyFootprint stores its pixels in the same order that
             /// we iterate over them above (ie, lexicographic).
             HeavyFootprintPtrT heavy(new HeavyFootprint(*strayfoot[i]));
-            ndarray::Array<ImagePixelT,1,1> himg = heavy->getImageArray();
-            typename std::vector<ImagePixelT>::const_iterator spix;
-            typename std::vector<MaskPixelT>::const_iterator smask;
-            typename std::vector<VariancePixelT>::const_iterator svar;
-            typename ndarray::Array<ImagePixelT,1,1>::Iterator hpix;
-            typename ndarray::Array<MaskPixelT,1,1>::Iterator mpix;
-            typename ndarray::Array<VariancePixelT,1,1>::Iterator vpix;
 
             assert((size_t)strayfoot[i]->getArea() == straypix[i].size());
 
-            for (spix = straypix[i].begin(),
-                     smask = straymask[i].begin(),
-                     svar  = strayvar [i].begin(),
-                     hpix = himg.begin(),
-                     mpix = heavy->getMaskArray().begin(),
-                     vpix = heavy->getVarianceArray().begin();
-                 spix != straypix[i].end();
-                 ++spix, ++smask, ++svar, ++hpix, ++mpix, ++vpix) {
-                *hpix = *spix;
-                *mpix = *smask;
-                *vpix = *svar;
-            }
+            std::copy(straypix[i].begin(), straypix[i].end(), heavy->getImageArray().begin());
+            std::copy(straymask[i].begin(), straymask[i].end(), heavy->getMaskArray().begin());
+            std::copy(strayvar[i].begin(), strayvar[i].end(), heavy->getVarianceArray().begin());
             strays.push_back(heavy);
         }
     }
@@ -805,6 +1267,96 @@ apportionFlux(MaskedImageT const& img,
     return portions;
 }
 
+/**
+ Returns a HeavyFootprint containing the flux apportioned to a template:
+ the pixels of the flux portion "portion" (as returned by apportionFlux)
+ within the template footprint "tfoot", plus the stray flux "stray".
+
+ This gives the same result as merging the HeavyFootprint of the flux
+ portion with the stray flux HeavyFootprint (the image and variance are
+ summed and the masks OR'd where they overlap), but the pixels are written
+ directly into a single HeavyFootprint, without the intermediate images
+ covering the bounding box of both footprints.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+typename deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::HeavyFootprintPtrT
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+mergeFluxPortion(MaskedImageT const& portion,
+                 det::Footprint const& tfoot,
+                 HeavyFootprintT const& stray) {
+
+    if (!portion.getBBox().contains(tfoot.getBBox())) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::RuntimeError,
+                          "Flux portion image MUST contain template footprint");
+    }
+    if (tfoot.getPeaks().getSchema() != stray.getPeaks().getSchema()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                          "Template footprint and stray flux must have the same peak schema");
+    }
+
+    det::Footprint foot(tfoot.getSpans()->union_(*stray.getSpans()), tfoot.getPeaks().getSchema());
+    for (det::PeakRecord const & pk : tfoot.getPeaks()) {
+        foot.getPeaks().push_back(pk);
+    }
+    for (det::PeakRecord const & pk : stray.getPeaks()) {
+        foot.getPeaks().push_back(pk);
+    }
+    foot.sortPeaks();
+
+    HeavyFootprintPtrT heavy = std::make_shared<HeavyFootprintT>(foot);
+    ndarray::Array<ImagePixelT,1,1> himg = heavy->getImageArray();
+    ndarray::Array<MaskPixelT,1,1> hmask = heavy->getMaskArray();
+    ndarray::Array<VariancePixelT,1,1> hvar = heavy->getVarianceArray();
+    himg.deep() = 0;
+    hmask.deep() = 0;
+    hvar.deep() = 0;
+
+    // Index of the first pixel of each merged span in the pixel arrays
+    std::vector<afwGeom::Span> spans(foot.getSpans()->begin(), foot.getSpans()->end());
+    std::vector<size_t> start(spans.size());
+    size_t npix = 0;
+    for (size_t i=0; i<spans.size(); ++i) {
+        start[i] = npix;
+        npix += spans[i].getWidth();
+    }
+    // Index of pixel (x, y) in the pixel arrays
+    auto pixelIndex = [&spans, &start](int y, int x) {
+        auto it = std::upper_bound(spans.begin(), spans.end(), std::make_pair(y, x),
+                                   [](std::pair<int,int> const& yx, afwGeom::Span const& sp) {
+                                       return (yx.first < sp.getY()) ||
+                                           ((yx.first == sp.getY()) && (yx.second < sp.getX0()));
+                                   });
+        --it;
+        return start[it - spans.begin()] + (x - it->getX0());
+    };
+
+    int px0 = portion.getX0();
+    int py0 = portion.getY0();
+    for (afwGeom::Span const & sp : *tfoot.getSpans()) {
+        size_t k = pixelIndex(sp.getY(), sp.getX0());
+        typename MaskedImageT::x_iterator in_it = portion.row_begin(sp.getY() - py0) + (sp.getX0() - px0);
+        for (int x = sp.getX0(); x <= sp.getX1(); ++x, ++in_it, ++k) {
+            himg[k] += (*in_it).image();
+            hmask[k] |= (*in_it).mask();
+            hvar[k] += (*in_it).variance();
+        }
+    }
+
+    ndarray::Array<ImagePixelT const,1,1> simg = stray.getImageArray();
+    ndarray::Array<MaskPixelT const,1,1> smask = stray.getMaskArray();
+    ndarray::Array<VariancePixelT const,1,1> svar = stray.getVarianceArray();
+    size_t j = 0;
+    for (afwGeom::Span const & sp : *stray.getSpans()) {
+        size_t k = pixelIndex(sp.getY(), sp.getX0());
+        for (int x = sp.getX0(); x <= sp.getX1(); ++x, ++j, ++k) {
+            himg[k] += simg[j];
+            hmask[k] |= smask[j];
+            hvar[k] += svar[j];
+        }
+    }
+    return heavy;
+}
+
 
 /**
  This is a convenience class used in symmetrizeFootprint, wrapping the
@@ -963,60 +1515,18 @@ private:
      }
  */
 
-/**
- Given a Footprint *foot* and peak *cx*,*cy*, returns a Footprint that
- is symmetric around the peak (with twofold rotational symmetry) --
- the AND of the two symmetric halves.
- */
-template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
-PTR(lsst::afw::detection::Footprint)
-deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
-symmetrizeFootprint(
-    det::Footprint const& foot,
-    int cx, int cy) {
-
-    auto sfoot = std::make_shared<det::Footprint>();
-    sfoot->setPeakSchema(foot.getPeaks().getSchema());
-    afwGeom::SpanSet const & spans = *foot.getSpans();
+namespace {
 
+/*
+ Returns the Spans of the AND of *spans* and its 180-degree rotation
+ around the peak (cx,cy); *peakspan* is the Span containing the peak.
+ */
+std::vector<afwGeom::Span>
+symmetrizeSpans(afwGeom::SpanSet const& spans,
+                afwGeom::SpanSet::const_iterator peakspan,
+                int cx, int cy) {
     LOG_LOGGER _log = LOG_GET("meas.deblender.symmetrizeFootprint");
 
-    // Find the Span containing the peak.
-    afwGeom::Span target(cy, cx, cx);
-    afwGeom::SpanSet::const_iterator peakspan =
-        std::upper_bound(spans.begin(), spans.end(), target, span_compare);
-    // upper_bound returns the last position where "target" could be inserted;
-    // ie, the first Span larger than "target".  The Span containing "target"
-    // should be peakspan-1 or (if the peak is on the first pixel in the span,
-    // peakspan.
-    afwGeom::Span sp;
-    if (peakspan == spans.begin()) {
-        sp = *peakspan;
-        if (!sp.contains(cx, cy)) {
-            LOGL_WARN(_log,
-                "Failed to find span containing (%i,%i): before the beginning of this footprint", cx, cy);
-            return PTR(det::Footprint)();
-        }
-    } else {
-        --peakspan;
-        sp = *peakspan;
-
-        if (!sp.contains(cx, cy)) {
-            ++peakspan;
-            sp = *peakspan;
-            if (!sp.contains(cx, cy)) {
-                afwGeom::Box2I fbb = foot.getBBox();
-                LOGL_WARN(_log, "Failed to find span containing (%i,%i): nearest is %i, [%i,%i].  "
-                          "Footprint bbox is [%i,%i],[%i,%i]",
-                          cx, cy, sp.getY(), sp.getX0(), sp.getX1(),
-                          fbb.getMinX(), fbb.getMaxX(), fbb.getMinY(), fbb.getMaxY());
-                return PTR(det::Footprint)();
-            }
-        }
-    }
-    LOGL_DEBUG(_log, "Span containing (%i,%i): (x=[%i,%i], y=%i)",
-               cx, cy, sp.getX0(), sp.getX1(), sp.getY());
-
     // The symmetric templates are essentially an AND of the footprint
     // pixels and its 180-degree-rotated self, rotated around the
     // peak (cx,cy).
@@ -1166,7 +1676,253 @@ symmetrizeFootprint(
         }
 
     }
-    sfoot->setSpans(std::make_shared<afwGeom::SpanSet>(std::move(tmpSpans)));
+    return tmpSpans;
+}
+
+/*
+ Same as symmetrizeSpans, for a Footprint given as a dense array
+ *inFoot* of the pixels of its bounding box *bbox* that belong to it.
+ */
+std::vector<afwGeom::Span>
+symmetrizeDense(std::vector<char> const& inFoot,
+                afwGeom::Box2I const& bbox,
+                int cx, int cy) {
+    int const x0 = bbox.getMinX();
+    int const y0 = bbox.getMinY();
+    int const W = bbox.getWidth();
+    // the rows and columns whose mirror is also in the bounding box
+    int const ylo = std::max(y0, 2*cy - bbox.getMaxY());
+    int const yhi = std::min(bbox.getMaxY(), 2*cy - y0);
+    int const xlo = std::max(x0, 2*cx - bbox.getMaxX());
+    int const xhi = std::min(bbox.getMaxX(), 2*cx - x0);
+
+    std::vector<afwGeom::Span> sspans;
+    for (int y = ylo; y <= yhi; ++y) {
+        int const fwdrow = (y - y0)*W - x0;
+        int const backrow = (2*cy - y - y0)*W - x0;
+        int start = xhi + 1;
+        for (int x = xlo; x <= xhi; ++x) {
+            bool const in = inFoot[fwdrow + x] && inFoot[backrow + 2*cx - x];
+            if (in && start > xhi) {
+                start = x;
+            } else if (!in && start <= xhi) {
+                sspans.push_back(afwGeom::Span(y, start, x - 1));
+                start = xhi + 1;
+            }
+        }
+        if (start <= xhi) {
+            sspans.push_back(afwGeom::Span(y, start, xhi));
+        }
+    }
+    return sspans;
+}
+
+/*
+ Fills the symmetric template of the symmetric Footprint *sfoot* from
+ the pixels of *img*: pixels (cx + dx, cy + dy) and (cx - dx, cy - dy)
+ are set to the minimum of the two (and at least zero if *minZero*).
+ */
+template<typename ImagePixelT>
+std::shared_ptr<image::Image<ImagePixelT> >
+fillSymmetricTemplate(image::Image<ImagePixelT> const& img,
+                      det::Footprint const& sfoot,
+                      bool minZero) {
+    auto targetimg = std::make_shared<image::Image<ImagePixelT> >(sfoot.getBBox());
+    afwGeom::SpanSet const & spans = *sfoot.getSpans();
+
+    afwGeom::SpanSet::const_iterator fwd  = spans.begin();
+    afwGeom::SpanSet::const_iterator back = spans.end()-1;
+
+    for (; fwd <= back; fwd++, back--) {
+        int fy = fwd->getY();
+        int by = back->getY();
+
+        for (int fx=fwd->getX0(), bx=back->getX1();
+             fx <= fwd->getX1();
+             fx++, bx--) {
+            // FIXME -- CURRENTLY WE IGNORE THE MASK PLANE!  options
+            // include ORing the mask bits, or being clever about
+            // ignoring some masked pixels, or copying the mask bits
+            // of the min pixel
+
+            // We have already checked the bounding box, so this should always be satisfied
+            assert(img.getBBox(image::PARENT).contains(afwGeom::Point2I(fx, fy)));
+            assert(img.getBBox(image::PARENT).contains(afwGeom::Point2I(bx, by)));
+
+            // FIXME -- we could do this with image iterators instead.
+            // But first profile to show that it's necessary and an
+            // improvement.
+            ImagePixelT pixf = img.get0(fx, fy);
+            ImagePixelT pixb = img.get0(bx, by);
+            ImagePixelT pix = std::min(pixf, pixb);
+            if (minZero) {
+                pix = std::max(pix, static_cast<ImagePixelT>(0));
+            }
+            targetimg->set0(fx, fy, pix);
+            targetimg->set0(bx, by, pix);
+
+        }
+    }
+    return targetimg;
+}
+
+/*
+ For a symmetric template *targetimg*, *sfoot* around the peak (cx,cy)
+ of the parent Footprint *foot* that touches an EDGE: finds the spans of
+ *foot* whose mirrors fall outside its bounds, grows *sfoot* to include
+ them and returns a new template image with their pixel values
+ copied from *img*.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+std::shared_ptr<image::Image<ImagePixelT> >
+patchSymmetricTemplate(image::MaskedImage<ImagePixelT, MaskPixelT, VariancePixelT> const& img,
+                       det::Footprint const& foot,
+                       int cx, int cy,
+                       det::Footprint & sfoot,
+                       image::Image<ImagePixelT> const& targetimg) {
+    typedef image::MaskedImage<ImagePixelT, MaskPixelT, VariancePixelT> MaskedImageT;
+    typedef image::Image<ImagePixelT> ImageT;
+
+    LOG_LOGGER _log = LOG_GET("meas.deblender.symmetricFootprint");
+
+    afwGeom::SpanSet::const_iterator fwd;
+    afwGeom::Box2I bb = sfoot.getBBox();
+
+    // Actually, it's not necessarily the IMAGE bounds that count
+    //-- the footprint may not go right to the image edge.
+    //afwGeom::Box2I imbb = img.getBBox();
+    afwGeom::Box2I imbb = foot.getBBox();
+
+    LOGL_DEBUG(_log, "Footprint touches EDGE: start bbox [%i,%i],[%i,%i]",
+               bb.getMinX(), bb.getMaxX(), bb.getMinY(), bb.getMaxY());
+    // original footprint spans
+    const afwGeom::SpanSet & ospans = *foot.getSpans();
+    for (fwd = ospans.begin(); fwd != ospans.end(); ++fwd) {
+        int y = fwd->getY();
+        int x = fwd->getX0();
+        // mirrored coords
+        int ym = cy + (cy - y);
+        int xm = cx + (cx - x);
+        if (!imbb.contains(afwGeom::Point2I(xm, ym))) {
+            bb.include(afwGeom::Point2I(x, y));
+        }
+        x = fwd->getX1();
+        xm = cx + (cx - x);
+        if (!imbb.contains(afwGeom::Point2I(xm, ym))) {
+            bb.include(afwGeom::Point2I(x, y));
+        }
+    }
+    LOGL_DEBUG(_log, "Footprint touches EDGE: grown bbox [%i,%i],[%i,%i]",
+               bb.getMinX(), bb.getMaxX(), bb.getMinY(), bb.getMaxY());
+
+    // New template image
+    auto targetimg2 = std::make_shared<ImageT>(bb);
+    sfoot.getSpans()->copyImage(targetimg, *targetimg2);
+
+    LOGL_DEBUG(_log, "Symmetric footprint spans:");
+    const afwGeom::SpanSet & sspans = *sfoot.getSpans();
+    for (fwd = sspans.begin(); fwd != sspans.end(); ++fwd) {
+        LOGL_DEBUG(_log, "  %s", fwd->toString().c_str());
+    }
+
+    // copy original 'img' pixels for the portion of spans whose
+    // mirrors are out of bounds.
+    std::vector<afwGeom::Span> newSpans(sfoot.getSpans()->begin(), sfoot.getSpans()->end());
+    for (fwd = ospans.begin(); fwd != ospans.end(); ++fwd) {
+        int y   = fwd->getY();
+        int x0  = fwd->getX0();
+        int x1 = fwd->getX1();
+        // mirrored coords
+        int ym  = cy + (cy - y);
+        int xm0 = cx + (cx - x0);
+        int xm1 = cx + (cx - x1);
+        bool in0 = imbb.contains(afwGeom::Point2I(xm0, ym));
+        bool in1 = imbb.contains(afwGeom::Point2I(xm1, ym));
+        if (in0 && in1) {
+            // both endpoints of the symmetric span are in bounds; nothing to do
+            continue;
+        }
+        // clip to the part of the span where the mirror is out of bounds
+        if (in0) {
+            // the mirror of x0 is in-bounds; move x0 to be the first pixel
+            // whose mirror would be out-of-bounds
+            x0 = cx + (cx - (imbb.getMinX() - 1));
+        }
+        if (in1) {
+            x1 = cx + (cx - (imbb.getMaxX() + 1));
+        }
+        LOGL_DEBUG(_log, "Span y=%i, x=[%i,%i] has mirror (%i,[%i,%i]) out-of-bounds; clipped to %i,[%i,%i]",
+                   y, fwd->getX0(), fwd->getX1(), ym, xm1, xm0, y, x0, x1);
+        typename MaskedImageT::x_iterator initer =
+            img.x_at(x0 - img.getX0(), y - img.getY0());
+        typename ImageT::x_iterator outiter =
+            targetimg2->x_at(x0 - targetimg2->getX0(), y - targetimg2->getY0());
+        for (int x=x0; x<=x1; ++x, ++outiter, ++initer) {
+            *outiter = initer.image();
+        }
+        newSpans.push_back(afwGeom::Span(y, x0, x1));
+    }
+    sfoot.setSpans(std::make_shared<afwGeom::SpanSet>(std::move(newSpans)));
+    return targetimg2;
+}
+
+} // end anonymous namespace
+
+/**
+ Given a Footprint *foot* and peak *cx*,*cy*, returns a Footprint that
+ is symmetric around the peak (with twofold rotational symmetry) --
+ the AND of the two symmetric halves.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+PTR(lsst::afw::detection::Footprint)
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+symmetrizeFootprint(
+    det::Footprint const& foot,
+    int cx, int cy) {
+
+    auto sfoot = std::make_shared<det::Footprint>();
+    sfoot->setPeakSchema(foot.getPeaks().getSchema());
+    afwGeom::SpanSet const & spans = *foot.getSpans();
+
+    LOG_LOGGER _log = LOG_GET("meas.deblender.symmetrizeFootprint");
+
+    // Find the Span containing the peak.
+    afwGeom::Span target(cy, cx, cx);
+    afwGeom::SpanSet::const_iterator peakspan =
+        std::upper_bound(spans.begin(), spans.end(), target, span_compare);
+    // upper_bound returns the last position where "target" could be inserted;
+    // ie, the first Span larger than "target".  The Span containing "target"
+    // should be peakspan-1 or (if the peak is on the first pixel in the span,
+    // peakspan.
+    afwGeom::Span sp;
+    if (peakspan == spans.begin()) {
+        sp = *peakspan;
+        if (!sp.contains(cx, cy)) {
+            LOGL_WARN(_log,
+                "Failed to find span containing (%i,%i): before the beginning of this footprint", cx, cy);
+            return PTR(det::Footprint)();
+        }
+    } else {
+        --peakspan;
+        sp = *peakspan;
+
+        if (!sp.contains(cx, cy)) {
+            ++peakspan;
+            sp = *peakspan;
+            if (!sp.contains(cx, cy)) {
+                afwGeom::Box2I fbb = foot.getBBox();
+                LOGL_WARN(_log, "Failed to find span containing (%i,%i): nearest is %i, [%i,%i].  "
+                          "Footprint bbox is [%i,%i],[%i,%i]",
+                          cx, cy, sp.getY(), sp.getX0(), sp.getX1(),
+                          fbb.getMinX(), fbb.getMaxX(), fbb.getMinY(), fbb.getMaxY());
+                return PTR(det::Footprint)();
+            }
+        }
+    }
+    LOGL_DEBUG(_log, "Span containing (%i,%i): (x=[%i,%i], y=%i)",
+               cx, cy, sp.getX0(), sp.getX1(), sp.getY());
+
+    sfoot->setSpans(std::make_shared<afwGeom::SpanSet>(symmetrizeSpans(spans, peakspan, cx, cy)));
     return sfoot;
 }
 
@@ -1195,8 +1951,6 @@ buildSymmetricTemplate(
     bool patchEdge,
     bool* patchedEdges) {
 
-    typedef typename MaskedImageT::const_xy_locator xy_loc;
-
     *patchedEdges = false;
 
     int cx = peak.getIx();
@@ -1249,130 +2003,242 @@ buildSymmetricTemplate(
     }
 
     // The result image:
-    ImagePtrT targetimg(new ImageT(sfoot->getBBox()));
+    ImagePtrT targetimg = fillSymmetricTemplate(*img.getImage(), *sfoot, minZero);
 
-    afwGeom::SpanSet::const_iterator fwd  = spans.begin();
-    afwGeom::SpanSet::const_iterator back = spans.end()-1;
+    if (touchesEdge) {
+        // Find spans whose mirrors fall outside the image bounds,
+        // grow the footprint to include those spans, and plug in
+        // their pixel values.
+        targetimg = patchSymmetricTemplate(img, foot, cx, cy, *sfoot, *targetimg);
+    }
 
-    ImagePtrT theimg = img.getImage();
+    *patchedEdges = touchesEdge;
+    return std::pair<ImagePtrT, FootprintPtrT>(targetimg, sfoot);
+}
 
-    for (; fwd <= back; fwd++, back--) {
-        int fy = fwd->getY();
-        int by = back->getY();
+/**
+ Builds the symmetric templates of the peaks *peakIndices* of the
+ parent Footprint *foot* together, with the same result as calling
+ buildSymmetricTemplate for each of them.
+
+ The work that does not depend on the peak is only done once: the
+ first Span of each row of *foot* is indexed (instead of searching
+ for the Span containing each peak) and the EDGE pixels of *foot* are
+ found in a single pass over the mask (and, for sparse footprints,
+ kept as the columns of the EDGE pixels of each Span rather than as a
+ map of the bounding box).  If the fraction of the
+ bounding box of *foot* covered by its pixels is at least
+ *denseFraction*, the footprint and its image are copied into dense
+ arrays and the symmetric footprints are found by AND-ing the arrays
+ with their mirrors, which is faster than walking the Spans for
+ compact footprints.
+
+ The templates and footprints are returned in *templates* and
+ *tfoots*, which are empty for the peaks that failed, and the status
+ of each peak (TEMPLATE_OUT_OF_BOUNDS, TEMPLATE_FAILED_SYMMETRIC or
+ TEMPLATE_PATCHED) is returned.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+std::vector<int>
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+buildSymmetricTemplates(MaskedImageT const& img,
+                        det::Footprint const& foot,
+                        std::vector<int> const& peakIndices,
+                        bool minZero,
+                        bool patchEdges,
+                        std::vector<ImagePtrT> & templates,
+                        std::vector<FootprintPtrT> & tfoots,
+                        double denseFraction) {
+    LOG_LOGGER _log = LOG_GET("meas.deblender.symmetricFootprint");
 
-        for (int fx=fwd->getX0(), bx=back->getX1();
-             fx <= fwd->getX1();
-             fx++, bx--) {
-            // FIXME -- CURRENTLY WE IGNORE THE MASK PLANE!  options
-            // include ORing the mask bits, or being clever about
-            // ignoring some masked pixels, or copying the mask bits
-            // of the min pixel
+    int const npeaks = peakIndices.size();
+    std::vector<int> status(npeaks, 0);
+    templates.assign(npeaks, ImagePtrT());
+    tfoots.assign(npeaks, FootprintPtrT());
 
-            // We have already checked the bounding box, so this should always be satisfied
-            assert(theimg->getBBox(image::PARENT).contains(afwGeom::Point2I(fx, fy)));
-            assert(theimg->getBBox(image::PARENT).contains(afwGeom::Point2I(bx, by)));
+    afwGeom::Box2I const imbb = img.getBBox(image::PARENT);
+    afwGeom::Box2I const fbb = foot.getBBox();
+    // The symmetric footprints are subsets of the parent footprint,
+    // so they do not need to be checked separately
+    if (!imbb.contains(fbb)) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError, "Image too small for footprint");
+    }
+    afwGeom::SpanSet const & spans = *foot.getSpans();
+    det::PeakCatalog const & peaks = foot.getPeaks();
+    int const x0 = fbb.getMinX();
+    int const y0 = fbb.getMinY();
+    int const W = fbb.getWidth();
+    int const H = fbb.getHeight();
+    ImagePtrT theimg = img.getImage();
 
-            // FIXME -- we could do this with image iterators instead.
-            // But first profile to show that it's necessary and an
-            // improvement.
-            ImagePixelT pixf = theimg->get0(fx, fy);
-            ImagePixelT pixb = theimg->get0(bx, by);
-            ImagePixelT pix = std::min(pixf, pixb);
-            if (minZero) {
-                pix = std::max(pix, static_cast<ImagePixelT>(0));
-            }
-            targetimg->set0(fx, fy, pix);
-            targetimg->set0(bx, by, pix);
+    // Index of the first Span of each row
+    std::vector<std::size_t> rowStart(H + 1, 0);
+    for (afwGeom::SpanSet::const_iterator sp = spans.begin(); sp != spans.end(); ++sp) {
+        ++rowStart[sp->getY() - y0 + 1];
+    }
+    for (int r = 0; r < H; ++r) {
+        rowStart[r + 1] += rowStart[r];
+    }
 
+    bool const dense = foot.getArea() >= denseFraction*fbb.getArea();
+
+    // The EDGE pixels of the parent footprint: a map of its bounding box
+    // on the dense path, and the sorted columns of the EDGE pixels of each
+    // Span (those of Span k are edgeXs[edgeStart[k]:edgeStart[k + 1]])
+    // on the span path, so that a sparse footprint does not allocate an
+    // array the size of its bounding box
+    std::vector<char> edge;
+    std::vector<std::size_t> edgeStart;
+    std::vector<int> edgeXs;
+    bool anyEdge = false;
+    if (patchEdges) {
+        LOGL_DEBUG(_log, "Checking footprint for EDGE bits");
+        MaskPtrT mask = img.getMask();
+        MaskPixelT edgebit = mask->getPlaneBitMask("EDGE");
+        if (dense) {
+            edge.assign(W*H, 0);
+        } else {
+            edgeStart.reserve(spans.size() + 1);
+            edgeStart.push_back(0);
+        }
+        for (afwGeom::SpanSet::const_iterator sp = spans.begin(); sp != spans.end(); ++sp) {
+            typename MaskT::x_iterator xiter =
+                mask->x_at(sp->getX0() - mask->getX0(), sp->getY() - mask->getY0());
+            int const offset = (sp->getY() - y0)*W - x0;
+            for (int x = sp->getX0(); x <= sp->getX1(); ++x, ++xiter) {
+                if ((*xiter) & edgebit) {
+                    anyEdge = true;
+                    if (dense) {
+                        edge[offset + x] = 1;
+                    } else {
+                        edgeXs.push_back(x);
+                    }
+                }
+            }
+            if (!dense) {
+                edgeStart.push_back(edgeXs.size());
+            }
         }
     }
 
-    if (touchesEdge) {
-        // Find spans whose mirrors fall outside the image bounds,
-        // grow the footprint to include those spans, and plug in
-        // their pixel values.
-        afwGeom::Box2I bb = sfoot->getBBox();
-
-        // Actually, it's not necessarily the IMAGE bounds that count
-        //-- the footprint may not go right to the image edge.
-        //afwGeom::Box2I imbb = img.getBBox();
-        afwGeom::Box2I imbb = foot.getBBox();
-
-        LOGL_DEBUG(_log, "Footprint touches EDGE: start bbox [%i,%i],[%i,%i]",
-                   bb.getMinX(), bb.getMaxX(), bb.getMinY(), bb.getMaxY());
-        // original footprint spans
-        const afwGeom::SpanSet & ospans = *foot.getSpans();
-        for (fwd = ospans.begin(); fwd != ospans.end(); ++fwd) {
-            int y = fwd->getY();
-            int x = fwd->getX0();
-            // mirrored coords
-            int ym = cy + (cy - y);
-            int xm = cx + (cx - x);
-            if (!imbb.contains(afwGeom::Point2I(xm, ym))) {
-                bb.include(afwGeom::Point2I(x, y));
-            }
-            x = fwd->getX1();
-            xm = cx + (cx - x);
-            if (!imbb.contains(afwGeom::Point2I(xm, ym))) {
-                bb.include(afwGeom::Point2I(x, y));
-            }
-        }
-        LOGL_DEBUG(_log, "Footprint touches EDGE: grown bbox [%i,%i],[%i,%i]",
-                   bb.getMinX(), bb.getMaxX(), bb.getMinY(), bb.getMaxY());
-
-        // New template image
-        ImagePtrT targetimg2(new ImageT(bb));
-        sfoot->getSpans()->copyImage(*targetimg, *targetimg2);
-
-        LOGL_DEBUG(_log, "Symmetric footprint spans:");
-        const afwGeom::SpanSet & sspans = *sfoot->getSpans();
-        for (fwd = sspans.begin(); fwd != sspans.end(); ++fwd) {
-            LOGL_DEBUG(_log, "  %s", fwd->toString().c_str());
-        }
-
-        // copy original 'img' pixels for the portion of spans whose
-        // mirrors are out of bounds.
-        std::vector<afwGeom::Span> newSpans(sfoot->getSpans()->begin(), sfoot->getSpans()->end());
-        for (fwd = ospans.begin(); fwd != ospans.end(); ++fwd) {
-            int y   = fwd->getY();
-            int x0  = fwd->getX0();
-            int x1 = fwd->getX1();
-            // mirrored coords
-            int ym  = cy + (cy - y);
-            int xm0 = cx + (cx - x0);
-            int xm1 = cx + (cx - x1);
-            bool in0 = imbb.contains(afwGeom::Point2I(xm0, ym));
-            bool in1 = imbb.contains(afwGeom::Point2I(xm1, ym));
-            if (in0 && in1) {
-                // both endpoints of the symmetric span are in bounds; nothing to do
-                continue;
+    // The dense copies of the footprint and its pixels
+    std::vector<char> inFoot;
+    std::vector<ImagePixelT> pix;
+    if (dense) {
+        inFoot.assign(W*H, 0);
+        pix.assign(W*H, 0);
+        for (afwGeom::SpanSet::const_iterator sp = spans.begin(); sp != spans.end(); ++sp) {
+            int const offset = (sp->getY() - y0)*W + sp->getX0() - x0;
+            typename ImageT::x_iterator xiter =
+                theimg->x_at(sp->getX0() - theimg->getX0(), sp->getY() - theimg->getY0());
+            for (int i = offset; i <= offset + sp->getX1() - sp->getX0(); ++i, ++xiter) {
+                inFoot[i] = 1;
+                pix[i] = *xiter;
             }
-            // clip to the part of the span where the mirror is out of bounds
-            if (in0) {
-                // the mirror of x0 is in-bounds; move x0 to be the first pixel
-                // whose mirror would be out-of-bounds
-                x0 = cx + (cx - (imbb.getMinX() - 1));
+        }
+    }
+
+    for (int i = 0; i < npeaks; ++i) {
+        det::PeakRecord const & pk = peaks[peakIndices[i]];
+        int const cx = pk.getIx();
+        int const cy = pk.getIy();
+        if (!imbb.contains(afwGeom::Point2I(cx, cy))) {
+            LOGL_DEBUG(_log, "Peak center (%i, %i) is not inside image", cx, cy);
+            status[i] |= TEMPLATE_OUT_OF_BOUNDS;
+            continue;
+        }
+
+        // Find the symmetric footprint
+        bool found = false;
+        std::vector<afwGeom::Span> sspans;
+        if (fbb.contains(afwGeom::Point2I(cx, cy))) {
+            if (dense) {
+                found = inFoot[(cy - y0)*W + cx - x0];
+                if (found) {
+                    sspans = symmetrizeDense(inFoot, fbb, cx, cy);
+                }
+            } else {
+                afwGeom::SpanSet::const_iterator const rowEnd = spans.begin() + rowStart[cy - y0 + 1];
+                for (afwGeom::SpanSet::const_iterator sp = spans.begin() + rowStart[cy - y0];
+                     sp != rowEnd; ++sp) {
+                    if (sp->contains(cx, cy)) {
+                        sspans = symmetrizeSpans(spans, sp, cx, cy);
+                        found = true;
+                        break;
+                    }
+                }
             }
-            if (in1) {
-                x1 = cx + (cx - (imbb.getMaxX() + 1));
+        }
+        if (!found) {
+            LOGL_WARN(_log, "Failed to find span containing (%i,%i)", cx, cy);
+            status[i] |= TEMPLATE_FAILED_SYMMETRIC;
+            continue;
+        }
+        FootprintPtrT sfoot = std::make_shared<det::Footprint>(
+            std::make_shared<afwGeom::SpanSet>(std::move(sspans)), peaks.getSchema());
+
+        // Fill in the template
+        ImagePtrT timg;
+        if (dense) {
+            timg = std::make_shared<ImageT>(sfoot->getBBox());
+            afwGeom::SpanSet const & sfspans = *sfoot->getSpans();
+            for (afwGeom::SpanSet::const_iterator sp = sfspans.begin(); sp != sfspans.end(); ++sp) {
+                int const y = sp->getY();
+                int fwd = (y - y0)*W + sp->getX0() - x0;
+                int back = (2*cy - y - y0)*W + 2*cx - sp->getX0() - x0;
+                typename ImageT::x_iterator titer =
+                    timg->x_at(sp->getX0() - timg->getX0(), y - timg->getY0());
+                for (int x = sp->getX0(); x <= sp->getX1(); ++x, ++titer, ++fwd, --back) {
+                    ImagePixelT p = std::min(pix[fwd], pix[back]);
+                    if (minZero) {
+                        p = std::max(p, static_cast<ImagePixelT>(0));
+                    }
+                    *titer = p;
+                }
             }
-            LOGL_DEBUG(_log, "Span y=%i, x=[%i,%i] has mirror (%i,[%i,%i]) out-of-bounds; clipped to %i,[%i,%i]",
-                       y, fwd->getX0(), fwd->getX1(), ym, xm1, xm0, y, x0, x1);
-            typename MaskedImageT::x_iterator initer =
-                img.x_at(x0 - img.getX0(), y - img.getY0());
-            typename ImageT::x_iterator outiter =
-                targetimg2->x_at(x0 - targetimg2->getX0(), y - targetimg2->getY0());
-            for (int x=x0; x<=x1; ++x, ++outiter, ++initer) {
-                *outiter = initer.image();
+        } else {
+            timg = fillSymmetricTemplate(*theimg, *sfoot, minZero);
+        }
+
+        // Does the symmetric footprint touch an EDGE?
+        bool touchesEdge = false;
+        if (anyEdge) {
+            afwGeom::SpanSet const & sfspans = *sfoot->getSpans();
+            for (afwGeom::SpanSet::const_iterator sp = sfspans.begin();
+                 sp != sfspans.end() && !touchesEdge; ++sp) {
+                if (dense) {
+                    std::vector<char>::const_iterator eiter =
+                        edge.begin() + (sp->getY() - y0)*W + sp->getX0() - x0;
+                    touchesEdge = std::find(eiter, eiter + sp->getWidth(), 1) != eiter + sp->getWidth();
+                    continue;
+                }
+                // The Spans of the parent footprint in the same row
+                int const row = sp->getY() - y0;
+                for (std::size_t k = rowStart[row]; k < rowStart[row + 1]; ++k) {
+                    afwGeom::Span const & parentSpan = *(spans.begin() + k);
+                    if (parentSpan.getX1() < sp->getX0() || parentSpan.getX0() > sp->getX1()) {
+                        continue;
+                    }
+                    std::vector<int>::const_iterator const begin = edgeXs.begin() + edgeStart[k];
+                    std::vector<int>::const_iterator const end = edgeXs.begin() + edgeStart[k + 1];
+                    std::vector<int>::const_iterator const first = std::lower_bound(begin, end, sp->getX0());
+                    if (first != end && *first <= sp->getX1()) {
+                        touchesEdge = true;
+                        break;
+                    }
+                }
             }
-            newSpans.push_back(afwGeom::Span(y, x0, x1));
         }
-        sfoot->setSpans(std::make_shared<afwGeom::SpanSet>(std::move(newSpans)));
-        targetimg = targetimg2;
-    }
+        if (touchesEdge) {
+            LOGL_DEBUG(_log, "Footprint includes an EDGE pixel.");
+            timg = patchSymmetricTemplate(img, foot, cx, cy, *sfoot, *timg);
+            status[i] |= TEMPLATE_PATCHED;
+        }
 
-    *patchedEdges = touchesEdge;
-    return std::pair<ImagePtrT, FootprintPtrT>(targetimg, sfoot);
+        templates[i] = timg;
+        tfoots[i] = sfoot;
+    }
+    return status;
 }
 
 /**
@@ -1451,6 +2317,226 @@ getSignificantEdgePixels(ImagePtrT img,
     return significant;
 }
 
+/**
+ Ramps the flux of the edge pixels *edgepix* of the template *img* down
+ with the PSF: each pixel of *ramped* is set to the maximum of its value
+ and the value of every edge pixel times the PSF image *psf* centered on
+ that edge pixel (a grey dilation of the edge pixels by the PSF).
+
+ The PSF image is centered on (*cx*, *cy*), only its pixels within
+ *radius* of the center are used, and it is normalized to a maximum of 1.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+void
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+rampEdgePixels(ImageT const& img,
+               det::Footprint const& edgepix,
+               image::Image<double> const& psf,
+               int cx, int cy, int radius,
+               ImageT & ramped) {
+    if (!img.getBBox().contains(edgepix.getBBox())) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                          "Edge pixels extend outside the template image");
+    }
+    // The PSF pixels within radius of the center, as offsets from the edge pixel
+    afwGeom::Box2I kbox(afwGeom::Point2I(cx - radius, cy - radius),
+                        afwGeom::Extent2I(2*radius + 1, 2*radius + 1));
+    kbox.clip(psf.getBBox());
+    if (kbox.isEmpty()) {
+        return;
+    }
+    int const kw = kbox.getWidth();
+    int const kh = kbox.getHeight();
+    int const kx0 = kbox.getMinX() - cx;
+    int const ky0 = kbox.getMinY() - cy;
+    std::vector<double> kernel(kw*kh);
+    for (int j = 0; j < kh; ++j) {
+        typename image::Image<double>::const_x_iterator piter =
+            psf.x_at(kbox.getMinX() - psf.getX0(), kbox.getMinY() + j - psf.getY0());
+        std::copy(piter, piter + kw, kernel.begin() + j*kw);
+    }
+    double const kmax = *std::max_element(kernel.begin(), kernel.end());
+    for (double & k : kernel) {
+        k /= kmax;
+    }
+
+    int const ox0 = ramped.getX0(), oy0 = ramped.getY0();
+    int const ox1 = ox0 + ramped.getWidth(), oy1 = oy0 + ramped.getHeight();
+    for (afwGeom::Span const & span : *edgepix.getSpans()) {
+        int const y = span.getY();
+        // the rows of the kernel that overlap the output image
+        int const j0 = std::max(0, oy0 - (y + ky0));
+        int const j1 = std::min(kh, oy1 - (y + ky0));
+        typename ImageT::const_x_iterator iter = img.x_at(span.getX0() - img.getX0(), y - img.getY0());
+        for (int x = span.getX0(); x <= span.getX1(); ++x, ++iter) {
+            double const value = *iter;
+            int const i0 = std::max(0, ox0 - (x + kx0));
+            int const i1 = std::min(kw, ox1 - (x + kx0));
+            for (int j = j0; j < j1; ++j) {
+                double const* krow = &kernel[j*kw];
+                typename ImageT::x_iterator out =
+                    ramped.x_at(x + kx0 + i0 - ox0, y + ky0 + j - oy0);
+                for (int i = i0; i < i1; ++i, ++out) {
+                    double const v = value*krow[i];
+                    if (v > *out) {
+                        *out = static_cast<ImagePixelT>(v);
+                    }
+                }
+            }
+        }
+    }
+}
+
+/**
+ Builds the templates of the peaks *peakIndices* of the parent
+ Footprint *foot* in a single call, running the same steps as the
+ buildSymmetricTemplates, rampFluxAtEdge, medianSmoothTemplates,
+ makeTemplatesMonotonic and clipFootprintsToNonzero plugins:
+
+ - build the symmetric templates of the peaks with buildSymmetricTemplates
+   (with *patchEdges*);
+ - if *rampRadius* > 0, ramp the templates with significant flux at
+   their edge down with the PSF image *psf*, evaluated at (*psfX*,
+   *psfY*), as in rampEdgePixels.  The parent footprint dilated by
+   *rampRadius* and the image within it are only computed once;
+ - if *medianFilterHalfsize* > 0, median filter the templates that are
+   large enough;
+ - make the templates monotonic if *monotonicOptions* is MONOTONIC_CONE
+   (makeMonotonic) or MONOTONIC_RADIAL (makeMonotonicRadial);
+ - if *clipToNonzero*, clip the template footprints to their non-zero
+   pixels and the template images to the footprints.
+
+ The templates and footprints are returned in *templates* and
+ *tfoots*, which are empty for the peaks that failed, and the status of
+ each peak (a combination of the TEMPLATE_* bits) is returned.
+ TEMPLATE_NO_PSF is set for the peaks that needed to be ramped when
+ *psf* is null, and no template is built for them.
+ */
+template<typename ImagePixelT, typename MaskPixelT, typename VariancePixelT>
+std::vector<int>
+deblend::BaselineUtils<ImagePixelT,MaskPixelT,VariancePixelT>::
+buildTemplates(MaskedImageT const& img,
+               det::Footprint const& foot,
+               std::vector<int> const& peakIndices,
+               double sigma1,
+               bool patchEdges,
+               int rampRadius,
+               std::shared_ptr<image::Image<double>> psf,
+               int psfX, int psfY,
+               int medianFilterHalfsize,
+               int monotonicOptions,
+               bool clipToNonzero,
+               std::vector<ImagePtrT> & templates,
+               std::vector<FootprintPtrT> & tfoots) {
+    LOG_LOGGER _log = LOG_GET("meas.deblender.buildTemplates");
+
+    int const npeaks = peakIndices.size();
+    afwGeom::Box2I const imbb = img.getBBox(image::PARENT);
+    det::PeakCatalog const & peaks = foot.getPeaks();
+    int const filtsize = medianFilterHalfsize*2 + 1;
+
+    // The dilated parent footprint and the image within it,
+    // created the first time a template is ramped
+    std::shared_ptr<afwGeom::SpanSet> dilated;
+    MaskedImagePtrT padded;
+
+    // The symmetric templates of all of the peaks
+    std::vector<int> status = buildSymmetricTemplates(img, foot, peakIndices, true, patchEdges,
+                                                      templates, tfoots);
+
+    for (int i = 0; i < npeaks; ++i) {
+        if (!templates[i]) {
+            continue;
+        }
+        det::PeakRecord const & pk = peaks[peakIndices[i]];
+        int const cx = pk.getIx();
+        int const cy = pk.getIy();
+        ImagePtrT timg = templates[i];
+        FootprintPtrT tfoot = tfoots[i];
+        templates[i].reset();
+        tfoots[i].reset();
+
+        if (rampRadius > 0 && hasSignificantFluxAtEdge(timg, tfoot, 3*sigma1)) {
+            if (!psf) {
+                status[i] |= TEMPLATE_NO_PSF;
+                continue;
+            }
+            LOGL_DEBUG(_log, "Template at (%i, %i) has significant flux at edge: ramping", cx, cy);
+            if (!padded) {
+                dilated = foot.getSpans()->dilated(rampRadius);
+                afwGeom::Box2I pbb = foot.getBBox();
+                pbb.grow(rampRadius);
+                padded = std::make_shared<MaskedImageT>(pbb);
+                dilated->clippedTo(imbb)->copyMaskedImage(img, *padded);
+            }
+            afwGeom::Box2I tbb = tfoot->getBBox();
+            tbb.grow(rampRadius);
+            det::Footprint fpcopy(dilated->clippedTo(tbb), peaks.getSchema());
+            MaskedImagePtrT padim;
+            if (padded->getBBox(image::PARENT).contains(tbb)) {
+                padim = std::make_shared<MaskedImageT>(*padded, tbb, image::PARENT, true);
+            } else {
+                padim = std::make_shared<MaskedImageT>(tbb);
+                fpcopy.getSpans()->clippedTo(imbb)->copyMaskedImage(img, *padim);
+            }
+
+            // Ramp the edge pixels of the template down with the PSF and fill in
+            // the pixels outside the parent footprint with the ramped pixels
+            FootprintPtrT edgepix = getSignificantEdgePixels(timg, tfoot, -1e6);
+            ImageT ramped(tbb);
+            rampEdgePixels(*timg, *edgepix, *psf, psfX, psfY, rampRadius, ramped);
+            for (int y = 0; y < tbb.getHeight(); ++y) {
+                typename ImageT::x_iterator piter = padim->getImage()->row_begin(y);
+                typename ImageT::x_iterator const pend = padim->getImage()->row_end(y);
+                typename ImageT::const_x_iterator riter = ramped.row_begin(y);
+                for (; piter != pend; ++piter, ++riter) {
+                    if (*piter == 0) {
+                        *piter = *riter;
+                    }
+                }
+            }
+
+            bool patched;
+            std::pair<ImagePtrT, FootprintPtrT> tmpl =
+                buildSymmetricTemplate(*padim, fpcopy, pk, sigma1, true, patchEdges, &patched);
+            if (!tmpl.first) {
+                status[i] |= TEMPLATE_FAILED_SYMMETRIC;
+                continue;
+            }
+            status[i] |= TEMPLATE_RAMPED;
+            if (patched) {
+                status[i] |= TEMPLATE_PATCHED;
+            }
+            // The ramped template may extend outside the parent footprint or the image
+            tfoot = tmpl.second;
+            tfoot->clipTo(imbb);
+            timg = std::make_shared<ImageT>(*tmpl.first, tfoot->getBBox(), image::PARENT, true);
+        }
+
+        if (medianFilterHalfsize > 0 && timg->getWidth() >= filtsize && timg->getHeight() >= filtsize) {
+            medianFilter(*timg, *timg, medianFilterHalfsize);
+        }
+
+        if (monotonicOptions == MONOTONIC_CONE) {
+            makeMonotonic(*timg, pk);
+        } else if (monotonicOptions == MONOTONIC_RADIAL) {
+            makeMonotonicRadial(*timg, pk);
+        }
+
+        if (clipToNonzero) {
+            clipFootprintToNonzero(*tfoot, *timg);
+            afwGeom::Box2I const tbb = tfoot->getBBox();
+            if (!tbb.isEmpty() && tbb != timg->getBBox(image::PARENT)) {
+                timg = std::make_shared<ImageT>(*timg, tbb, image::PARENT, true);
+            }
+        }
+
+        templates[i] = timg;
+        tfoots[i] = tfoot;
+    }
+    return status;
+}
+
 
 // Instantiate
 template class deblend::BaselineUtils<float>;
@@ -0,0 +1,127 @@
+#
+# LSST Data Management System
+#
+# Copyright 2018  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Synthetic blends of the tests that run the deblender on a single footprint
+"""
+import numpy as np
+
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.meas.algorithms as measAlg
+
+__all__ = ["doubleGaussianPsf", "gaussianPsf", "makeBlend", "makeDegenerateBlend", "makeEdgeBlend"]
+
+
+def doubleGaussianPsf(W, H, fwhm1, fwhm2, a2):
+    return measAlg.DoubleGaussianPsf(W, H, fwhm1, fwhm2, a2)
+
+
+def gaussianPsf(W, H, fwhm):
+    return measAlg.DoubleGaussianPsf(W, H, fwhm)
+
+
+def makeBlend(XY, blob_psf, threshold, flux=1e6, H=100, W=100):
+    """Add blobs with the profile of ``blob_psf`` at the positions ``XY``
+    to an image with unit variance and detect them
+
+    Returns
+    -------
+    footprints: list of `afw.detection.Footprint`
+        Footprints detected above ``threshold``.
+    afwimg: `afw.image.MaskedImageF`
+        Image of the blobs.
+    """
+    fpbb = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(W - 1, H - 1))
+    afwimg = afwImage.MaskedImageF(fpbb)
+    imgbb = afwimg.getBBox()
+    img = afwimg.getImage().getArray()
+    afwimg.getVariance().getArray()[:, :] = 1.
+
+    for x, y in XY:
+        bim = blob_psf.computeImage(afwGeom.Point2D(x, y))
+        bbb = bim.getBBox()
+        bbb.clip(imgbb)
+        bim = bim.Factory(bim, bbb)
+        img[bbb.getMinY():bbb.getMaxY()+1,
+            bbb.getMinX():bbb.getMaxX()+1] += flux * bim.getArray()
+
+    # Run the detection code to get a ~ realistic footprint
+    thresh = afwDet.createThreshold(threshold, 'value', True)
+    fpSet = afwDet.FootprintSet(afwimg, thresh, 'DETECTED', 1)
+    return list(fpSet.getFootprints()), afwimg
+
+
+def makeDegenerateBlend():
+    """Three overlapping blobs, with additional peaks near the blob peaks
+    that should be identified as degenerate
+
+    Returns
+    -------
+    footprints: list of `afw.detection.Footprint`
+        Detected footprints (one is expected).
+    afwimg: `afw.image.MaskedImageF`
+        Image of the blobs.
+    fakepsf: `afw.detection.Psf`
+        PSF given to the deblender.
+    fakepsf_fwhm: `float`
+        FWHM of ``fakepsf``.
+    """
+    blob_fwhm = 10.
+    blob_psf = doubleGaussianPsf(99, 99, blob_fwhm, 2.*blob_fwhm, 0.03)
+    fakepsf_fwhm = 3.
+    fakepsf = gaussianPsf(11, 11, fakepsf_fwhm)
+    XY = [(75., 35.), (75., 65.), (50., 50.)]
+    footprints, afwimg = makeBlend(XY, blob_psf, 5.)
+    for fp in footprints:
+        for x, y in XY:
+            fp.addPeak(x - 10, y + 6, 10)
+    return footprints, afwimg, fakepsf, fakepsf_fwhm
+
+
+def makeEdgeBlend():
+    """Two overlapping blobs, one of which is truncated by the edge of the
+    image, with the EDGE bit set on the pixels within 5 pixels of the edge
+
+    Returns
+    -------
+    footprints: list of `afw.detection.Footprint`
+        Detected footprints (one is expected).
+    afwimg: `afw.image.MaskedImageF`
+        Image of the blobs.
+    fakepsf: `afw.detection.Psf`
+        PSF given to the deblender.
+    fakepsf_fwhm: `float`
+        FWHM of ``fakepsf``.
+    """
+    blob_fwhm = 15.
+    blob_psf = doubleGaussianPsf(201, 201, blob_fwhm, 3.*blob_fwhm, 0.03)
+    fakepsf_fwhm = 5.
+    S = int(np.ceil(fakepsf_fwhm * 2.)) * 2 + 1
+    fakepsf = gaussianPsf(S, S, fakepsf_fwhm)
+    footprints, afwimg = makeBlend([(50., 50.), (90., 50.)], blob_psf, 10.)
+
+    goodbbox = afwGeom.Box2I(afwimg.getBBox())
+    goodbbox.grow(-5)
+    edgebit = afwimg.getMask().getPlaneBitMask("EDGE")
+    measAlg.SourceDetectionTask.setEdgeBits(afwimg, goodbbox, edgebit)
+    return footprints, afwimg, fakepsf, fakepsf_fwhm
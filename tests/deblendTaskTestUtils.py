@@ -0,0 +1,155 @@
+#
+# LSST Data Management System
+#
+# Copyright 2018  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Fixtures of the tests that run the deblender tasks on the sources
+detected in ticket1738.fits
+"""
+import os
+
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+from lsst.meas.algorithms.detection import SourceDetectionTask
+import lsst.meas.deblender as measDeb
+
+__all__ = ["loadCalexp", "makeDetectionTask", "runSourceDeblend", "runMultibandDeblend",
+           "assertCatalogsEqual"]
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+
+
+def loadCalexp():
+    """Read the test exposure"""
+    return afwImage.ExposureF(os.path.join(DATA_DIR, "ticket1738.fits"))
+
+
+def makeDetectionTask(schema):
+    """Make the detection task that finds the parents in the test exposure"""
+    config = SourceDetectionTask.ConfigClass()
+    config.reEstimateBackground = False
+    return SourceDetectionTask(config=config, schema=schema)
+
+
+def _makeConfig(configClass, overrides):
+    config = configClass()
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    return config
+
+
+def runSourceDeblend(calexp, **overrides):
+    """Detect the sources in a copy of ``calexp`` and deblend them
+
+    Parameters
+    ----------
+    calexp: `lsst.afw.image.ExposureF`
+        Exposure to deblend (it is not modified).
+    overrides:
+        Values of the `SourceDeblendConfig` fields.
+
+    Returns
+    -------
+    sources: `lsst.afw.table.SourceCatalog`
+        Parents and children.
+    task: `SourceDeblendTask`
+        The task, after the run.
+    """
+    schema = afwTable.SourceTable.makeMinimalSchema()
+    detectionTask = makeDetectionTask(schema)
+    config = _makeConfig(measDeb.SourceDeblendConfig, overrides)
+    task = measDeb.SourceDeblendTask(schema, config=config)
+    calexp = calexp.clone()
+    sources = detectionTask.run(afwTable.SourceTable.make(schema), calexp).sources
+    task.run(calexp, sources)
+    return sources, task
+
+
+def runMultibandDeblend(calexp, filters=("g", "r"), scales=None, **overrides):
+    """Detect the sources in a copy of ``calexp`` and deblend them in
+    a multiband exposure made of a copy of ``calexp`` in each band
+
+    Parameters
+    ----------
+    calexp: `lsst.afw.image.ExposureF`
+        Exposure to deblend (it is not modified).
+    filters: sequence of `str`, optional
+        Names of the bands.
+    scales: `dict`, optional
+        Factor by which the image of a band is multiplied after the
+        sources have been detected.
+    overrides:
+        Values of the `MultibandDeblendConfig` fields.
+
+    Returns
+    -------
+    sources: `lsst.afw.table.SourceCatalog`
+        Parents.
+    result: `tuple`
+        The flux and template catalogs (or sinks) returned by the task.
+    task: `MultibandDeblendTask`
+        The task, after the run.
+    """
+    schema = afwTable.SourceTable.makeMinimalSchema()
+    detectionTask = makeDetectionTask(schema)
+    config = _makeConfig(measDeb.MultibandDeblendConfig, overrides)
+    task = measDeb.MultibandDeblendTask(schema, config=config)
+    exposures = [calexp.clone() for f in filters]
+    sources = detectionTask.run(afwTable.SourceTable.make(schema), exposures[0]).sources
+    if scales is not None:
+        for f, exposure in zip(filters, exposures):
+            exposure.getMaskedImage().getImage().getArray()[:] *= scales.get(f, 1.)
+    mExposure = afwImage.MultibandExposure.fromExposures(list(filters), exposures)
+    return sources, task.run(mExposure, sources), task
+
+
+def assertCatalogsEqual(testCase, catalog1, catalog2, ordered=True, fields=("deblend_nChild",)):
+    """Assert that two deblended catalogs have the same parents and children
+
+    Parameters
+    ----------
+    testCase: `lsst.utils.tests.TestCase`
+        The test case.
+    catalog1, catalog2: `lsst.afw.table.SourceCatalog`
+        Catalogs to compare.
+    ordered: `bool`, optional
+        If False, the records are matched by id instead of by position.
+    fields: sequence of `str`, optional
+        Fields of the records that must be equal.
+    """
+    testCase.assertEqual(len(catalog1), len(catalog2))
+    if ordered:
+        pairs = list(zip(catalog1, catalog2))
+    else:
+        records2 = {src.getId(): src for src in catalog2}
+        testCase.assertEqual(len(records2), len(catalog2))
+        testCase.assertEqual(sorted(src.getId() for src in catalog1), sorted(records2.keys()))
+        pairs = [(src, records2[src.getId()]) for src in catalog1]
+    for src1, src2 in pairs:
+        testCase.assertEqual(src1.getId(), src2.getId())
+        testCase.assertEqual(src1.getParent(), src2.getParent())
+        for field in fields:
+            testCase.assertEqual(src1.get(field), src2.get(field))
+        fp1, fp2 = src1.getFootprint(), src2.getFootprint()
+        testCase.assertEqual(fp1.spans, fp2.spans)
+        testCase.assertEqual(fp1.isHeavy(), fp2.isHeavy())
+        if fp1.isHeavy():
+            testCase.assertFloatsEqual(fp1.getImageArray(), fp2.getImageArray())
+            testCase.assertFloatsEqual(fp1.getVarianceArray(), fp2.getVarianceArray())
@@ -0,0 +1,170 @@
+#
+# LSST Data Management System
+#
+# Copyright 2018  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import pickle
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.meas.deblender import DeblendCheckpoint
+from deblendTaskTestUtils import loadCalexp, runMultibandDeblend, assertCatalogsEqual
+
+
+class DeblendCheckpointTestCase(lsst.utils.tests.TestCase):
+    """Test that the results written to a checkpoint are restored when the run is resumed
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, "checkpoint.pickle")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def testResume(self):
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), interval=3600.)
+        checkpoint.add(1, b"1"*100)
+        checkpoint.add(2, b"2"*100)
+        checkpoint.flush()
+        # Only the results that were flushed are in the file
+        checkpoint.add(3, b"3"*100)
+        self.assertEqual(len(checkpoint), 3)
+
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), resume=True)
+        self.assertEqual(len(checkpoint), 2)
+        self.assertIn(1, checkpoint)
+        self.assertNotIn(3, checkpoint)
+        self.assertEqual(checkpoint.get(2), b"2"*100)
+        self.assertIsNone(checkpoint.get(3))
+        self.assertEqual(checkpoint.restored, 1)
+        # With an interval of 0 each result is written as soon as it is added
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), interval=0., resume=True)
+        checkpoint.add(3, b"3"*100)
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), resume=True)
+        self.assertEqual([checkpoint.get(i) for i in (1, 2, 3)], [b"1"*100, b"2"*100, b"3"*100])
+
+        # A checkpoint of a different run is replaced
+        checkpoint = DeblendCheckpoint(self.filename, ("b",), resume=True)
+        self.assertEqual(len(checkpoint), 0)
+        # So is an existing checkpoint when the run is not resumed
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), resume=False)
+        self.assertEqual(len(checkpoint), 0)
+
+    def testInterruptedFlush(self):
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), interval=0.)
+        checkpoint.add(1, b"1"*100)
+        checkpoint.add(2, b"2"*100)
+        # Simulate a run that was stopped while the last result was written
+        size = os.path.getsize(self.filename)
+        with open(self.filename, "r+b") as f:
+            f.truncate(size - 10)
+
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), interval=0., resume=True)
+        self.assertEqual(len(checkpoint), 1)
+        self.assertIsNone(checkpoint.get(2))
+        checkpoint.add(2, b"2"*100)
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), resume=True)
+        self.assertEqual(checkpoint.get(1), b"1"*100)
+        self.assertEqual(checkpoint.get(2), b"2"*100)
+
+        # A flush cut just after its first bytes fails to load with EOFError
+        checkpoint = DeblendCheckpoint(self.filename, ("a",), interval=0., resume=True)
+        size = os.path.getsize(self.filename)
+        checkpoint.add(3, b"3"*2**20)
+        for cut in [2, 16, os.path.getsize(self.filename) - size - 16]:
+            with open(self.filename, "r+b") as f:
+                f.truncate(size + cut)
+            checkpoint = DeblendCheckpoint(self.filename, ("a",), interval=0., resume=True)
+            self.assertEqual(len(checkpoint), 2)
+            self.assertEqual(os.path.getsize(self.filename), size)
+            # The results flushed after the interrupted flush can be restored
+            checkpoint.add(3, b"3"*2**20)
+            checkpoint = DeblendCheckpoint(self.filename, ("a",), resume=True)
+            self.assertEqual(len(checkpoint), 3)
+            self.assertEqual(checkpoint.get(3), b"3"*2**20)
+
+
+class ResumeDeblendTestCase(lsst.utils.tests.TestCase):
+    """Test that a `MultibandDeblendTask` run resumed from a partial
+    checkpoint gives the same catalogs as an uninterrupted run
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, "checkpoint.pickle")
+        self.calexp = loadCalexp()
+
+    def tearDown(self):
+        del self.calexp
+        self.tempdir.cleanup()
+
+    def _deblend(self, numProcesses, checkpointFile=None, resumeFromCheckpoint=False, scale=1.):
+        _, (fluxCatalogs, _), task = runMultibandDeblend(
+            self.calexp, scales={"r": scale}, numProcesses=numProcesses, checkpointFile=checkpointFile,
+            checkpointInterval=0., resumeFromCheckpoint=resumeFromCheckpoint)
+        return fluxCatalogs, task
+
+    def _truncateCheckpoint(self, nFlushes):
+        """Keep the header and the first ``nFlushes`` flushes of the checkpoint
+        """
+        with open(self.filename, "r+b") as f:
+            pickle.load(f)
+            for i in range(nFlushes):
+                pickle.load(f)
+            f.truncate(f.tell())
+
+    def testResume(self):
+        expected, _ = self._deblend(1)
+        for numProcesses in [1, 2]:
+            _, task = self._deblend(numProcesses, self.filename)
+            self.assertEqual(task.metadata.get("checkpointRestored"), 0)
+            nParents = len(task.checkpoint)
+            self.assertGreater(nParents, 1)
+            # Simulate a run that was interrupted after deblending half of the parents
+            self._truncateCheckpoint(nParents//2)
+            catalogs, task = self._deblend(numProcesses, self.filename, resumeFromCheckpoint=True)
+            self.assertEqual(task.metadata.get("checkpointRestored"), nParents//2)
+            self.assertEqual(len(task.checkpoint), nParents)
+            for f, catalog in expected.items():
+                assertCatalogsEqual(self, catalog, catalogs[f])
+
+    def testChangedInputs(self):
+        self._deblend(1, self.filename)
+        # The checkpoint of different input pixels is not restored
+        _, task = self._deblend(1, self.filename, resumeFromCheckpoint=True, scale=2.)
+        self.assertEqual(task.metadata.get("checkpointRestored"), 0)
+        _, task = self._deblend(1, self.filename, resumeFromCheckpoint=True, scale=2.)
+        self.assertGreater(task.metadata.get("checkpointRestored"), 0)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
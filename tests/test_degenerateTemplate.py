@@ -25,10 +25,10 @@ import numpy as np
 
 import lsst.utils.tests
 import lsst.afw.detection as afwDet
-import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
-from lsst.meas.deblender.baseline import deblend
-import lsst.meas.algorithms as measAlg
+from lsst.meas.deblender.baseline import deblend, makeDeblendPlugins
+from lsst.meas.deblender.plugins import _templateDotProducts, _templateNormalEquations
+from blendTestUtils import makeDegenerateBlend
 
 
 def imExt(img):
@@ -36,75 +36,74 @@ def imExt(img):
     return [bbox.getMinX(), bbox.getMaxX(), bbox.getMinY(), bbox.getMaxY()]
 
 
-def doubleGaussianPsf(W, H, fwhm1, fwhm2, a2):
-    return measAlg.DoubleGaussianPsf(W, H, fwhm1, fwhm2, a2)
-
-
-def gaussianPsf(W, H, fwhm):
-    return measAlg.DoubleGaussianPsf(W, H, fwhm)
-
-
 class DegenerateTemplateTestCase(lsst.utils.tests.TestCase):
 
+    def _makeBlend(self):
+        fps, afwimg, fakepsf, fakepsf_fwhm = makeDegenerateBlend()
+        self.assertEqual(len(fps), 1)
+        return fps[0], afwimg, fakepsf, fakepsf_fwhm
+
     def testPeakRemoval(self):
         '''
         A simple example: three overlapping blobs (detected as 1
         footprint with three peaks).  Additional peaks are added near
         the blob peaks that should be identified as degenerate.
         '''
-        H, W = 100, 100
-
-        fpbb = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(W - 1, H - 1))
-
-        afwimg = afwImage.MaskedImageF(fpbb)
-        imgbb = afwimg.getBBox()
-        img = afwimg.getImage().getArray()
-
-        var = afwimg.getVariance().getArray()
-        var[:, :] = 1.
-
-        blob_fwhm = 10.
-        blob_psf = doubleGaussianPsf(99, 99, blob_fwhm, 2.*blob_fwhm, 0.03)
-
-        fakepsf_fwhm = 3.
-        fakepsf = gaussianPsf(11, 11, fakepsf_fwhm)
-
-        blobimgs = []
-        x = 75.
-        XY = [(x, 35.), (x, 65.), (50., 50.)]
-        flux = 1e6
-        for x, y in XY:
-            bim = blob_psf.computeImage(afwGeom.Point2D(x, y))
-            bbb = bim.getBBox()
-            bbb.clip(imgbb)
-
-            bim = bim.Factory(bim, bbb)
-            bim2 = bim.getArray()
-
-            blobimg = np.zeros_like(img)
-            blobimg[bbb.getMinY():bbb.getMaxY()+1, bbb.getMinX():bbb.getMaxX()+1] += flux*bim2
-            blobimgs.append(blobimg)
-
-            img[bbb.getMinY():bbb.getMaxY()+1,
-                bbb.getMinX():bbb.getMaxX()+1] += flux * bim2
-
-        # Run the detection code to get a ~ realistic footprint
-        thresh = afwDet.createThreshold(5., 'value', True)
-        fpSet = afwDet.FootprintSet(afwimg, thresh, 'DETECTED', 1)
-        fps = fpSet.getFootprints()
-
-        self.assertTrue(len(fps) == 1)
-
-        # Add new peaks near to the first peaks that will be degenerate
-        fp0 = fps[0]
-        for x, y in XY:
-            fp0.addPeak(x - 10, y + 6, 10)
-
+        fp0, afwimg, fakepsf, fakepsf_fwhm = self._makeBlend()
         deb = deblend(fp0, afwimg, fakepsf, fakepsf_fwhm, verbose=True, removeDegenerateTemplates=True)
 
         self.assertTrue(deb.deblendedParents[0].peaks[3].degenerate)
         self.assertTrue(deb.deblendedParents[0].peaks[4].degenerate)
         self.assertTrue(deb.deblendedParents[0].peaks[5].degenerate)
+        for i in range(3):
+            self.assertFalse(deb.deblendedParents[0].peaks[i].degenerate)
+
+        # The dot products of the templates should match the HeavyFootprint dot products
+        peaks = deb.deblendedParents[0].peaks
+        heavies = [afwDet.makeHeavyFootprint(pkres.templateFootprint,
+                                             afwImage.MaskedImageF(pkres.templateImage))
+                   for pkres in peaks]
+        gram = _templateDotProducts(peaks)
+        for i in range(len(peaks)):
+            for j in range(len(peaks)):
+                self.assertFloatsAlmostEqual(gram[i, j], heavies[i].dot(heavies[j]), rtol=1e-5)
+
+    def testTemplateNormalEquations(self):
+        '''
+        Compare the normal equations used to weight the templates to
+        the full least-squares design matrix.
+        '''
+        fp0, afwimg, fakepsf, fakepsf_fwhm = self._makeBlend()
+        deb = deblend(fp0, afwimg, fakepsf, fakepsf_fwhm)
+        dp = deb.deblendedParents[0]
+        peaks, AtA, Atb = _templateNormalEquations(dp)
+        self.assertEqual(len(peaks), len([pkres for pkres in dp.peaks if not pkres.skip]))
+
+        parentImage = afwImage.ImageF(dp.bb)
+        afwDet.copyWithinFootprintImage(dp.fp, dp.img, parentImage)
+        b = parentImage.getArray().ravel()
+        A = np.zeros((dp.W*dp.H, len(peaks)))
+        for index, pkres in enumerate(peaks):
+            childImage = afwImage.ImageF(dp.bb)
+            afwDet.copyWithinFootprintImage(dp.fp, pkres.templateImage, childImage)
+            A[:, index] = childImage.getArray().ravel()
+        self.assertFloatsAlmostEqual(AtA, np.dot(A.T, A), rtol=1e-10)
+        self.assertFloatsAlmostEqual(Atb, np.dot(A.T, b), rtol=1e-10)
+
+    def testPluginStatistics(self):
+        '''
+        Every plugin that runs should be timed once per call.
+        '''
+        fp0, afwimg, fakepsf, fakepsf_fwhm = self._makeBlend()
+        deb = deblend(fp0, afwimg, fakepsf, fakepsf_fwhm, removeDegenerateTemplates=True)
+        names = [plugin.func.__name__ for plugin in makeDeblendPlugins(removeDegenerateTemplates=True)]
+        self.assertEqual(list(deb.pluginStatistics.keys()), names)
+        for name, stats in deb.pluginStatistics.items():
+            self.assertEqual(stats.name, name)
+            self.assertEqual(stats.calls, 1)
+            self.assertEqual(stats.resets, 0)
+            self.assertGreaterEqual(stats.time, 0)
+        self.assertGreater(deb.maxRss, 0)
 
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
@@ -31,6 +31,8 @@ import lsst.afw.image as afwImage
 import lsst.meas.algorithms as measAlg
 from lsst.log import Log
 from lsst.meas.deblender.baseline import deblend
+from lsst.meas.deblender.baselineUtils import BaselineUtilsF as bUtils
+from blendTestUtils import doubleGaussianPsf, gaussianPsf, makeEdgeBlend
 
 doPlot = False
 if doPlot:
@@ -54,14 +56,6 @@ def imExt(img):
             bbox.getMinY(), bbox.getMaxY()]
 
 
-def doubleGaussianPsf(W, H, fwhm1, fwhm2, a2):
-    return measAlg.DoubleGaussianPsf(W, H, fwhm1, fwhm2, a2)
-
-
-def gaussianPsf(W, H, fwhm):
-    return measAlg.DoubleGaussianPsf(W, H, fwhm)
-
-
 class RampEdgeTestCase(lsst.utils.tests.TestCase):
 
     def test1(self):
@@ -361,6 +355,111 @@ class RampEdgeTestCase(lsst.utils.tests.TestCase):
             plt.savefig(fn)
             print('Wrote', fn)
 
+    def testRampEdgePixels(self):
+        """Compare the edge ramp to the maximum of the PSF stamps of each edge pixel
+        """
+        rng = np.random.RandomState(42)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(10, 20), afwGeom.Extent2I(30, 25))
+        spans = afwGeom.SpanSet.fromShape(10, afwGeom.Stencil.CIRCLE, afwGeom.Point2I(25, 32))
+        tfoot = afwDet.Footprint(spans.clippedTo(bbox))
+        timg = afwImage.ImageF(bbox)
+        timg.getArray()[:] = rng.uniform(0, 100, size=timg.getArray().shape)
+        edgepix = bUtils.getSignificantEdgePixels(timg, tfoot, -1e6)
+
+        cx, cy = 100, 200
+        psfim = gaussianPsf(21, 21, 4.).computeImage(afwGeom.Point2D(cx, cy))
+        for S in [3, 7, 15]:
+            tbb = tfoot.getBBox()
+            tbb.grow(S)
+            ramped = afwImage.ImageF(tbb)
+            bUtils.rampEdgePixels(timg, edgepix, psfim, cx, cy, S, ramped)
+
+            pbb = psfim.getBBox()
+            Sbox = afwGeom.Box2I(afwGeom.Point2I(cx - S, cy - S), afwGeom.Extent2I(2*S + 1, 2*S + 1))
+            Sbox.clip(pbb)
+            P = psfim.Factory(psfim, Sbox, afwImage.PARENT, True).getArray()
+            P /= P.max()
+            px0, py0 = Sbox.getMinX() - cx - tbb.getMinX(), Sbox.getMinY() - cy - tbb.getMinY()
+            expected = np.zeros_like(ramped.getArray())
+            for span in edgepix.getSpans():
+                y = span.getY()
+                for x in range(span.getX0(), span.getX1() + 1):
+                    slc = (slice(y + py0, y + py0 + P.shape[0]), slice(x + px0, x + px0 + P.shape[1]))
+                    value = timg.getArray()[y - bbox.getMinY(), x - bbox.getMinX()]
+                    expected[slc] = np.maximum(expected[slc], value*P)
+            self.assertFloatsEqual(ramped.getArray(), expected)
+
+    def testBuildSymmetricTemplates(self):
+        """Compare the batched symmetric templates to the templates of each peak
+        """
+        rng = np.random.RandomState(42)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(60, 50))
+        afwimg = afwImage.MaskedImageF(bbox)
+        afwimg.getImage().getArray()[:] = rng.uniform(-10, 100, size=afwimg.getImage().getArray().shape)
+        edgebit = afwimg.getMask().getPlaneBitMask("EDGE")
+        afwimg.getMask().getArray()[:, :5] = edgebit
+
+        spans = afwGeom.SpanSet.fromShape(12, afwGeom.Stencil.CIRCLE, afwGeom.Point2I(15, 25))
+        spans = spans.union(afwGeom.SpanSet.fromShape(8, afwGeom.Stencil.CIRCLE, afwGeom.Point2I(42, 25)))
+        foot = afwDet.Footprint(spans.clippedTo(bbox))
+        # The last peak is not in the footprint
+        for x, y in [(15, 25), (6, 30), (20, 20), (42, 25), (45, 28), (29, 14)]:
+            foot.addPeak(x, y, 1.)
+        peakIndices = list(range(len(foot.getPeaks())))
+
+        for patchEdges in [False, True]:
+            # Force the dense and the span paths
+            for denseFraction in [0., 2.]:
+                templates, tfoots, status = bUtils.buildSymmetricTemplates(
+                    afwimg, foot, peakIndices, True, patchEdges, denseFraction)
+                for pk, timg, tfoot, flags in zip(foot.getPeaks(), templates, tfoots, status):
+                    timg2, tfoot2, patched = bUtils.buildSymmetricTemplate(afwimg, foot, pk, 1., True,
+                                                                           patchEdges)
+                    if timg2 is None:
+                        self.assertEqual(flags, bUtils.TEMPLATE_FAILED_SYMMETRIC)
+                        self.assertIsNone(timg)
+                        continue
+                    self.assertEqual(bool(flags & bUtils.TEMPLATE_PATCHED), patched)
+                    self.assertEqual(tfoot.getSpans(), tfoot2.getSpans())
+                    self.assertEqual(timg.getBBox(), timg2.getBBox())
+                    self.assertFloatsEqual(timg.getArray(), timg2.getArray())
+                self.assertEqual(status[-1], bUtils.TEMPLATE_FAILED_SYMMETRIC)
+                self.assertEqual(bool(status[1] & bUtils.TEMPLATE_PATCHED), patchEdges)
+
+    def testNativeTemplates(self):
+        """Compare the templates built by the native driver to the templates
+        built by the Python plugins, for each edge treatment
+        """
+        fps, afwimg, fakepsf, fakepsf_fwhm = makeEdgeBlend()
+        self.assertEqual(len(fps), 1)
+        fp = fps[0]
+
+        edgeModes = [dict(), dict(rampFluxAtEdge=True), dict(patchEdges=True),
+                     dict(rampFluxAtEdge=True, patchEdges=True)]
+        variants = [dict(), dict(monotonicAlgorithm='radial', medianSmoothTemplate=False)]
+        for edgeMode in edgeModes:
+            for variant in variants:
+                kwargs = dict(edgeMode, **variant)
+                deb = deblend(fp, afwimg, fakepsf, fakepsf_fwhm, **kwargs)
+                native = deblend(fp, afwimg, fakepsf, fakepsf_fwhm, nativeTemplates=True, **kwargs)
+                peaks = deb.deblendedParents[0].peaks
+                nativePeaks = native.deblendedParents[0].peaks
+                self.assertEqual(len(peaks), len(nativePeaks))
+                for pkres, nativeres in zip(peaks, nativePeaks):
+                    self.assertEqual(pkres.skip, nativeres.skip)
+                    self.assertEqual(pkres.deblendedAsPsf, nativeres.deblendedAsPsf)
+                    self.assertEqual(pkres.hasRampedTemplate, nativeres.hasRampedTemplate)
+                    self.assertEqual(pkres.patched, nativeres.patched)
+                    if pkres.skip:
+                        continue
+                    self.assertEqual(pkres.templateFootprint.spans, nativeres.templateFootprint.spans)
+                    self.assertEqual(pkres.templateImage.getBBox(), nativeres.templateImage.getBBox())
+                    self.assertFloatsEqual(pkres.templateImage.getArray(),
+                                           nativeres.templateImage.getArray())
+                    heavy = pkres.getFluxPortion()
+                    nativeHeavy = nativeres.getFluxPortion()
+                    self.assertFloatsEqual(heavy.getImageArray(), nativeHeavy.getImageArray())
+
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
@@ -26,11 +26,12 @@ import numpy as np
 import lsst.utils.tests
 import lsst.afw.detection as afwDet
 import lsst.afw.geom as afwGeom
+import lsst.afw.geom.ellipses as afwEll
 import lsst.afw.image as afwImage
 from lsst.log import Log
 import lsst.meas.algorithms as measAlg
-from lsst.meas.deblender.plugins import _fitPsf
-from lsst.meas.deblender.baseline import DeblendedPeak, CachingPsf
+from lsst.meas.deblender.plugins import _fitPsf, _buildPsfFit, _fitPsfBatch, _lstsqBatch, _PeakIndex
+from lsst.meas.deblender.baseline import DeblendedPeak, CachingPsf, PsfPropertyMap
 
 doPlot = False
 if doPlot:
@@ -167,6 +168,171 @@ class FitPsfTestCase(unittest.TestCase):
                 continue
             print('  ', k, getattr(pkres, k))
 
+    def testBatch(self):
+        """Test that fitting all of the peaks at once gives the same result
+        as fitting them one at a time
+        """
+        spans = afwGeom.SpanSet.fromShape(45, offset=(50, 50))
+        fp = afwDet.Footprint(spans)
+        fbb = fp.getBBox()
+        fmask = afwImage.Mask(fbb)
+        fmask.setXY0(fbb.getMinX(), fbb.getMinY())
+        fp.spans.setMask(fmask, 1)
+
+        psfsig = 1.5
+        psffwhm = psfsig * 2.35
+        psf = measAlg.DoubleGaussianPsf(11, 11, psfsig)
+        sig1 = 10.
+        np.random.seed(1)
+        img = afwImage.ImageF(fbb)
+        img.getArray()[:] = np.random.normal(0, sig1, size=(fbb.getHeight(), fbb.getWidth()))
+        varimg = afwImage.ImageF(fbb)
+        varimg.set(sig1**2)
+
+        peaks = afwDet.PeakCatalog(afwDet.PeakTable.makeMinimalSchema())
+        for x, y, flux in [(20., 30., 10000.), (24.3, 31.6, 5000.), (50.2, 49.7, 8000.), (92., 50., 5000.)]:
+            pk = peaks.addNew()
+            pk.setFx(x)
+            pk.setFy(y)
+            pk.setIx(int(x))
+            pk.setIy(int(y))
+            psfim = psf.computeImage(afwGeom.Point2D(x, y)).convertF()
+            psfim *= flux
+            img[psfim.getBBox()] += psfim
+        peaksF = [pk.getF() for pk in peaks]
+        log = Log.getLogger('tests.fit_psf')
+
+        serial = [DeblendedPeak(pk, i, None) for i, pk in enumerate(peaks)]
+        for pk, pkF, pkres in zip(peaks, peaksF, serial):
+            _fitPsf(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, CachingPsf(psf), psffwhm,
+                    img, varimg, 1.5, 1.5, 1.5)
+
+        batch = [DeblendedPeak(pk, i, None) for i, pk in enumerate(peaks)]
+        fits = [_buildPsfFit(fp, fmask, pk, pkF, pkres, fbb, peaks, peaksF, log, CachingPsf(psf), psffwhm,
+                             img, varimg) for pk, pkF, pkres in zip(peaks, peaksF, batch)]
+        fits = [fit for fit in fits if fit is not None]
+        self.assertGreater(len(fits), 0)
+        _fitPsfBatch(fits, fp, fbb, log, CachingPsf(psf), img, varimg, 1.5, 1.5, 1.5)
+
+        for pkres1, pkres2 in zip(serial, batch):
+            self.assertEqual(pkres1.deblendedAsPsf, pkres2.deblendedAsPsf)
+            self.assertEqual(pkres1.psfFitWithDecenter, pkres2.psfFitWithDecenter)
+            self.assertEqual(pkres1.psfFitNOthers, pkres2.psfFitNOthers)
+            for attr in ("psfFit1", "psfFit2", "psfFit3", "psfFitBest", "psfFitCenter"):
+                value1, value2 = getattr(pkres1, attr), getattr(pkres2, attr)
+                if value1 is None:
+                    self.assertIsNone(value2)
+                else:
+                    np.testing.assert_allclose(value1, value2, rtol=1e-8)
+            if pkres1.psfFitParams is not None:
+                np.testing.assert_allclose(pkres1.psfFitParams, pkres2.psfFitParams, rtol=1e-6, atol=1e-8)
+
+    def testPeakIndex(self):
+        """Test that the peak index finds the same neighbours as a brute
+        force search
+        """
+        np.random.seed(3)
+        xy = np.random.uniform(-20, 300, size=(500, 2))
+        peaksF = [afwGeom.Point2D(x, y) for x, y in xy]
+        for cellSize in [0.5, 7., 25., 1000.]:
+            index = _PeakIndex(peaksF, cellSize)
+            for x, y, radius in [(0., 0., 10.), (150.3, 90.1, 17.5), (310., -30., 40.), (50., 60., 0.)]:
+                r2 = np.sum((xy - (x, y))**2, axis=1)
+                np.testing.assert_array_equal(index.query(x, y, radius), np.flatnonzero(r2 <= radius**2))
+            # The peak itself is always found
+            for i in [0, 17, 499]:
+                self.assertIn(i, index.query(xy[i, 0], xy[i, 1], 3.))
+
+    def testCachingPsf(self):
+        """Test the hit/miss counters, key rounding and eviction of the PSF cache
+        """
+        psf = measAlg.DoubleGaussianPsf(11, 11, 1.5)
+        cache = CachingPsf(psf)
+        im1 = cache.computeImage(20.3, 30.1)
+        self.assertIs(cache.computeImage(20.3, 30.1), im1)
+        cache.computeImage(20.31, 30.1)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 2, 2))
+        expect = psf.computeImage(afwGeom.Point2D(20.3, 30.1))
+        np.testing.assert_array_equal(im1.getArray(), expect.getArray())
+
+        # Nearby positions share an image evaluated at the rounded position
+        cache = CachingPsf(psf, tolerance=0.25)
+        im1 = cache.computeImage(20.3, 30.1)
+        self.assertIs(cache.computeImage(20.2, 30.05), im1)
+        self.assertIsNot(cache.computeImage(20.4, 30.1), im1)
+        expect = psf.computeImage(afwGeom.Point2D(20.25, 30.0))
+        np.testing.assert_array_equal(im1.getArray(), expect.getArray())
+
+        # The least recently used images are evicted
+        nbytes = im1.getArray().nbytes
+        cache = CachingPsf(psf, maxBytes=2*nbytes)
+        im1 = cache.computeImage(10., 10.)
+        cache.computeImage(11., 10.)
+        cache.computeImage(10., 10.)
+        cache.computeImage(12., 10.)
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.nbytes, 2*nbytes)
+        self.assertIs(cache.computeImage(10., 10.), im1)
+        misses = cache.misses
+        cache.computeImage(11., 10.)
+        self.assertEqual(cache.misses, misses + 1)
+
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, len(cache), cache.nbytes), (0, 0, 0, 0))
+
+    def testPsfPropertyMap(self):
+        """Test the interpolation of the PSF properties over an exposure
+        """
+        bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(1000, 700))
+        psf = measAlg.DoubleGaussianPsf(11, 11, 1.5)
+        shape = psf.computeShape()
+        for gridSize in [0, 128, 5000]:
+            psfMap = PsfPropertyMap(psf, bbox, gridSize)
+            for x, y in [(100, 200), (612.3, 455.1), (1099, 899), (0, 0)]:
+                position = afwGeom.Point2D(x, y)
+                self.assertEqual(psfMap.computeFwhm(position), shape.getDeterminantRadius()*2.35)
+                self.assertEqual(psfMap.computeShape(position).getIxx(), shape.getIxx())
+
+        class LinearPsf:
+            """PSF whose second moments vary linearly over the exposure"""
+            def computeShape(self, position=afwGeom.Point2D(0, 0)):
+                x, y = position.getX(), position.getY()
+                return afwEll.Quadrupole(2 + 0.001*x, 3 + 0.002*y, 0.0001*(x - y))
+
+        psfMap = PsfPropertyMap(LinearPsf(), bbox, 128)
+        for x, y in [(100, 200), (612.3, 455.1), (1099, 899)]:
+            position = afwGeom.Point2D(x, y)
+            expect = LinearPsf().computeShape(position)
+            shape = psfMap.computeShape(position)
+            self.assertAlmostEqual(shape.getIxx(), expect.getIxx())
+            self.assertAlmostEqual(shape.getIyy(), expect.getIyy())
+            self.assertAlmostEqual(shape.getIxy(), expect.getIxy())
+            self.assertAlmostEqual(psfMap.computeFwhm(position), expect.getDeterminantRadius()*2.35,
+                                   delta=1e-3)
+        # Only the nodes around the requested positions are evaluated
+        self.assertLessEqual(len(psfMap._nodes), 12)
+
+    def testLstsqBatch(self):
+        """Test the batched least-squares solver against numpy
+        """
+        np.random.seed(2)
+        As, bs = [], []
+        for nRows, nCols in [(30, 4), (12, 6), (50, 9), (5, 8), (20, 5)]:
+            As.append(np.random.normal(size=(nRows, nCols)))
+            bs.append(np.random.normal(size=nRows))
+        # Rank deficient problem
+        As[-1][:, -1] = 0
+        As.append(As[0].copy())
+        As[-1][0, 0] = np.nan
+        bs.append(bs[0])
+
+        X, chisq, failed = _lstsqBatch(As, bs)
+        np.testing.assert_array_equal(failed, [False]*5 + [True])
+        for A, b, x, c in zip(As[:-1], bs[:-1], X, chisq):
+            x0, r, rank, s = np.linalg.lstsq(A, b, rcond=-1)
+            np.testing.assert_allclose(x, x0, rtol=1e-8, atol=1e-10)
+            self.assertAlmostEqual(c, r[0] if len(r) > 0 else 1e30, delta=1e-8*abs(c))
+
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
@@ -0,0 +1,117 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.meas.deblender.baselineUtils import BaselineUtilsF as bUtils
+
+
+def bruteForceMedian(arr, halfsize):
+    '''
+    Median of the non-NaN pixels in the part of the box around each pixel
+    that lies inside the image, using the larger central value for an even
+    number of pixels.
+    '''
+    H, W = arr.shape
+    out = arr.copy()
+    for y in range(H):
+        for x in range(W):
+            box = arr[max(y - halfsize, 0):y + halfsize + 1, max(x - halfsize, 0):x + halfsize + 1]
+            values = np.sort(box[np.isfinite(box)])
+            if len(values) > 0:
+                out[y, x] = values[len(values)//2]
+    return out
+
+
+class MedianFilterTestCase(lsst.utils.tests.TestCase):
+    '''
+    Compare the sliding window median filter with a brute force median,
+    including the margins of the image.
+    '''
+    def setUp(self):
+        np.random.seed(12)
+
+    def makeImage(self, W, H):
+        img = afwImage.ImageF(afwGeom.Box2I(afwGeom.Point2I(-3, 5), afwGeom.Extent2I(W, H)))
+        arr = img.getArray()
+        arr[:] = np.random.normal(size=(H, W))
+        # Repeated values and NaNs
+        arr[np.random.uniform(size=arr.shape) < 0.2] = 1.
+        arr[np.random.uniform(size=arr.shape) < 0.05] = np.nan
+        return img
+
+    def testMedianFilter(self):
+        for W, H, halfsize in [(20, 15, 2), (7, 9, 3), (1, 6, 2), (12, 1, 0), (30, 30, 5)]:
+            img = self.makeImage(W, H)
+            expected = bruteForceMedian(img.getArray(), halfsize)
+            out = afwImage.ImageF(img.getBBox())
+            bUtils.medianFilter(img, out, halfsize)
+            self.assertFloatsEqual(out.getArray(), expected, ignoreNaNs=True)
+
+            # Filtering in place gives the same result
+            bUtils.medianFilter(img, img, halfsize)
+            self.assertFloatsEqual(img.getArray(), expected, ignoreNaNs=True)
+
+    def testMarginsAndNaNs(self):
+        # Near the edges the median is taken over the part of the box inside the image,
+        # using the larger central value for an even number of pixels
+        img = afwImage.ImageF(3, 3)
+        img.getArray()[:] = np.arange(9).reshape(3, 3)
+        out = afwImage.ImageF(3, 3)
+        bUtils.medianFilter(img, out, 1)
+        self.assertFloatsEqual(out.getArray(), np.array([[3, 3, 4], [4, 4, 5], [6, 6, 7]]))
+
+        # NaN pixels are ignored, including the pixel being filtered
+        img = afwImage.ImageF(2, 2)
+        img.getArray()[:] = [[np.nan, 2], [5, 7]]
+        bUtils.medianFilter(img, img, 1)
+        self.assertFloatsEqual(img.getArray(), 5.)
+
+        # A pixel whose box only contains NaN pixels keeps its value
+        img = afwImage.ImageF(1, 1)
+        img.getArray()[:] = np.nan
+        bUtils.medianFilter(img, img, 1)
+        self.assertTrue(np.isnan(img.getArray()[0, 0]))
+
+    def testMismatchedImages(self):
+        img = self.makeImage(10, 10)
+        out = afwImage.ImageF(9, 10)
+        with self.assertRaises(Exception):
+            bUtils.medianFilter(img, out, 2)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,87 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.meas.deblender.baselineUtils import BaselineUtilsF as bUtils
+
+
+class MonotonicTestCase(lsst.utils.tests.TestCase):
+    '''
+    Check the single pass (radial) monotonic projection of a template.
+    '''
+    def setUp(self):
+        np.random.seed(3)
+        peaks = afwDet.PeakCatalog(afwDet.PeakTable.makeMinimalSchema())
+        self.peak = peaks.addNew()
+        self.peak.setIx(20)
+        self.peak.setIy(-4)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(5, -30), afwGeom.Extent2I(31, 41))
+
+    def testMonotonicRadial(self):
+        img = afwImage.ImageF(self.bbox)
+        img.getArray()[:] = np.random.uniform(size=img.getArray().shape)
+        orig = img.getArray().copy()
+        bUtils.makeMonotonicRadial(img, self.peak)
+        arr = img.getArray()
+        # Pixels can only be clipped
+        self.assertTrue(np.all(arr <= orig))
+        # The peak is never modified
+        x, y = self.peak.getIx() - self.bbox.getMinX(), self.peak.getIy() - self.bbox.getMinY()
+        self.assertEqual(arr[y, x], orig[y, x])
+        # Along the rows and columns through the peak the profile decreases away from the peak
+        self.assertTrue(np.all(np.diff(arr[y, x:]) <= 0))
+        self.assertTrue(np.all(np.diff(arr[y, :x + 1]) >= 0))
+        self.assertTrue(np.all(np.diff(arr[y:, x]) <= 0))
+        self.assertTrue(np.all(np.diff(arr[:y + 1, x]) >= 0))
+        # A monotonic template is not modified
+        result = arr.copy()
+        bUtils.makeMonotonicRadial(img, self.peak)
+        self.assertFloatsEqual(img.getArray(), result)
+
+    def testGaussian(self):
+        img = afwImage.ImageF(self.bbox)
+        yy, xx = np.mgrid[self.bbox.getMinY():self.bbox.getMaxY() + 1,
+                          self.bbox.getMinX():self.bbox.getMaxX() + 1]
+        img.getArray()[:] = np.exp(-((xx - self.peak.getIx())**2 + (yy - self.peak.getIy())**2)/50.)
+        orig = img.getArray().copy()
+        bUtils.makeMonotonicRadial(img, self.peak)
+        self.assertFloatsEqual(img.getArray(), orig)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,85 @@
+#
+# LSST Data Management System
+#
+# Copyright 2018  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.meas.deblender import NoiseModel
+
+
+class NoiseModelTestCase(lsst.utils.tests.TestCase):
+    """Test the noise measured once for an exposure by `NoiseModel`
+    """
+
+    def setUp(self):
+        bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(400, 300))
+        self.maskedImage = afwImage.MaskedImageF(bbox)
+        # The variance increases from left to right
+        x = np.arange(bbox.getWidth())
+        self.maskedImage.getVariance().getArray()[:, :] = (1. + x/100.)[np.newaxis, :]**2
+        # Masked pixels with a large variance must be ignored
+        mask = self.maskedImage.getMask()
+        mask.getArray()[:50, :] = mask.getPlaneBitMask("SAT")
+        self.maskedImage.getVariance().getArray()[:50, :] = 1e6
+
+    def tearDown(self):
+        del self.maskedImage
+
+    def testExposureNoise(self):
+        mask = self.maskedImage.getMask()
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setAndMask(mask.getPlaneBitMask(["SAT"]))
+        stats = afwMath.makeStatistics(self.maskedImage.getVariance(), mask, afwMath.MEDIAN, statsCtrl)
+        model = NoiseModel(self.maskedImage, ["SAT"])
+        self.assertFloatsAlmostEqual(model.sigma, np.sqrt(stats.getValue(afwMath.MEDIAN)), rtol=1e-7)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(110, 300), afwGeom.Extent2I(10, 10))
+        self.assertEqual(model.computeSigma(bbox), model.sigma)
+        self.assertEqual(model.computeSigma(), model.sigma)
+
+    def testNoiseGrid(self):
+        model = NoiseModel(self.maskedImage, ["SAT"], gridSize=50)
+        x0 = self.maskedImage.getX0()
+        for x in [110, 175, 260, 333, 490]:
+            bbox = afwGeom.Box2I(afwGeom.Point2I(x - 2, 300), afwGeom.Extent2I(5, 5))
+            # The noise is linear in x, so it is recovered by the interpolation,
+            # except within half a cell of the edges
+            expected = np.clip(1. + (x - x0)/100., 1. + 24.5/100., 1. + 374.5/100.)
+            self.assertFloatsAlmostEqual(model.computeSigma(bbox), expected, rtol=1e-4)
+        self.assertEqual(model.computeSigma(), model.sigma)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,57 @@
+#
+# LSST Data Management System
+#
+# Copyright 2018  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import lsst.utils.tests
+from deblendTaskTestUtils import loadCalexp, runSourceDeblend, assertCatalogsEqual
+
+
+class ParallelDeblendTestCase(lsst.utils.tests.TestCase):
+    """Test that deblending parents in worker processes gives the same
+    catalog as the serial deblender.
+    """
+
+    def setUp(self):
+        self.calexp = loadCalexp()
+
+    def tearDown(self):
+        del self.calexp
+
+    def testParallelMatchesSerial(self):
+        serial, _ = runSourceDeblend(self.calexp, numProcesses=1)
+        parallel, _ = runSourceDeblend(self.calexp, numProcesses=2)
+        self.assertGreater(len(serial), 0)
+        assertCatalogsEqual(self, serial, parallel, fields=("deblend_nChild", "deblend_deblendedAsPsf"))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,145 @@
+#
+# LSST Data Management System
+#
+# Copyright 2018  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+import lsst.meas.deblender as measDeb
+from deblendTaskTestUtils import loadCalexp, makeDetectionTask, runSourceDeblend, assertCatalogsEqual
+
+
+class ResultCacheTestCase(lsst.utils.tests.TestCase):
+    """Test that the deblender results are restored from the result cache
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.calexp = loadCalexp()
+
+    def tearDown(self):
+        del self.calexp
+        self.tempdir.cleanup()
+
+    def testEviction(self):
+        cache = measDeb.ResultCache(self.tempdir.name, maxBytes=0)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"a"*1000)
+        self.assertEqual(cache.get("a"), b"a"*1000)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hitRate, 0.5)
+        size = cache.nbytes
+
+        # The least recently used results are removed when the cache is full
+        cache = measDeb.ResultCache(self.tempdir.name, maxBytes=2*size)
+        self.assertEqual(len(cache), 1)
+        cache.put("b", b"b"*1000)
+        cache.get("a")
+        cache.put("c", b"c"*1000)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"a"*1000)
+        self.assertEqual(cache.get("c"), b"c"*1000)
+        self.assertLessEqual(cache.nbytes, 2*size)
+
+    def testRestoredMatchesDeblended(self):
+        expected, _ = runSourceDeblend(self.calexp)
+        cacheDir = os.path.join(self.tempdir.name, "results")
+        for numProcesses in [1, 2]:
+            for run in range(2):
+                sources, task = runSourceDeblend(self.calexp, numProcesses=numProcesses,
+                                                 resultCacheDir=cacheDir)
+                hits = task.metadata.get("resultCacheHits")
+                misses = task.metadata.get("resultCacheMisses")
+                self.assertGreater(hits + misses, 0)
+                if run == 1:
+                    # All of the parents are restored from the cache
+                    self.assertEqual(misses, 0)
+                assertCatalogsEqual(self, expected, sources)
+
+    def testMultibandRampMargin(self):
+        filters = ["g", "r"]
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        detectionTask = makeDetectionTask(schema)
+        debConfig = measDeb.MultibandDeblendConfig()
+        debConfig.edgeHandling = "ramp"
+        debTask = measDeb.MultibandDeblendTask(schema, config=debConfig)
+        debTask.resultCache = measDeb.ResultCache(self.tempdir.name)
+        exposures = {"g": self.calexp.clone(), "r": self.calexp.clone()}
+        sources = detectionTask.run(afwTable.SourceTable.make(schema), exposures["g"]).sources
+        expBBox = self.calexp.getBBox()
+        psfs = {f: exposures[f].getPsf() for f in filters}
+
+        # A parent with pixels outside of its bounding box on both sides
+        for src in sources:
+            foot = src.getFootprint()
+            bbox = foot.getBBox()
+            bbox.grow(2)
+            if expBBox.contains(bbox):
+                break
+        bbox = foot.getBBox()
+        fwhms = {f: debTask._getPsfFwhm(psfs[f], bbox) for f in filters}
+        sigmas = {f: 1. for f in filters}
+
+        def getKey():
+            mExposure = afwImage.MultibandExposure.fromExposures(filters, [exposures[f] for f in filters])
+            mMaskedImage = afwImage.MultibandMaskedImage(filters=mExposure.filters, image=mExposure.image,
+                                                         mask=mExposure.mask, variance=mExposure.variance)
+            key, _ = debTask._lookupResult(foot, mMaskedImage, psfs, fwhms, sigmas)
+            return key
+
+        def addFlux(x, y):
+            x0, y0 = exposures["r"].getXY0()
+            exposures["r"].getMaskedImage().getImage().getArray()[y - y0, x - x0] += 100.
+
+        key = getKey()
+        # The ramped templates use the pixels next to the bounding box of the parent
+        addFlux(bbox.getMaxX() + 1, bbox.getMinY())
+        self.assertNotEqual(getKey(), key)
+        key = getKey()
+        addFlux(bbox.getMinX() - 1, bbox.getMaxY())
+        self.assertNotEqual(getKey(), key)
+        key = getKey()
+        # The pixels outside of the ramp margin do not change the key
+        rampSize = measDeb.getRampSize(max(fwhms.values()))
+        x, y = bbox.getMaxX() + rampSize + 1, bbox.getMaxY()
+        if expBBox.contains(afwGeom.Point2I(x, y)):
+            addFlux(x, y)
+            self.assertEqual(getKey(), key)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
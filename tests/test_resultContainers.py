@@ -0,0 +1,105 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import pickle
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.meas.deblender.baseline import deblend, DeblendedPeak
+import lsst.meas.algorithms as measAlg
+
+
+class ResultContainerTestCase(lsst.utils.tests.TestCase):
+    '''
+    Test the attributes of the deblender result containers, which use
+    __slots__ and only allocate the rarely used attributes when they are set.
+    '''
+
+    def testDeblendedPeak(self):
+        pkres = DeblendedPeak(None, 3, None)
+        # The lazy attributes are None until they are set
+        for name in DeblendedPeak._lazyAttributes:
+            self.assertIsNone(getattr(pkres, name))
+        self.assertEqual(pkres.templateWeight, 1.0)
+        with self.assertRaises(AttributeError):
+            pkres.notAnAttribute
+        with self.assertRaises(AttributeError):
+            pkres.notAnAttribute = 1
+
+        pkres.skip = True
+        pkres.psfFitFlux = 2.5
+        pkres.psfFitBest = (4., 2)
+        restored = pickle.loads(pickle.dumps(pkres))
+        self.assertEqual(restored.pki, 3)
+        self.assertTrue(restored.skip)
+        self.assertEqual(restored.psfFitFlux, 2.5)
+        self.assertEqual(restored.psfFitChisq, 4.)
+        self.assertIsNone(restored.origTemplate)
+        self.assertIsNone(restored.peak)
+        with self.assertRaises(AttributeError):
+            restored.notAnAttribute
+
+    def testDeblendedParent(self):
+        W, H = 40, 30
+        mimg = afwImage.MaskedImageF(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(W, H)))
+        mimg.getVariance().set(4.)
+        yy, xx = np.mgrid[:H, :W]
+        foot = afwDet.Footprint(afwGeom.SpanSet(mimg.getBBox()))
+        for x, y in [(15, 15), (25, 14)]:
+            mimg.getImage().getArray()[:] += 1000*np.exp(-((xx - x)**2 + (yy - y)**2)/(2*2.**2))
+            foot.addPeak(x, y, 1000)
+        psf = measAlg.DoubleGaussianPsf(11, 11, 3.)
+
+        deb = deblend(foot, mimg, psf, 3.)
+        dp = deb.deblendedParents[0]
+        # The noise is estimated from the variance plane when it is first used
+        self.assertFloatsAlmostEqual(dp.avgNoise, 2.)
+        with self.assertRaises(AttributeError):
+            dp.notAnAttribute
+        with self.assertRaises(AttributeError):
+            dp.notAnAttribute = 1
+        for pkres in dp.peaks:
+            # The PSF fit debugging outputs are only set when debugging
+            self.assertIsNone(pkres.psfFitDebugPsf0Img)
+            with self.assertRaises(AttributeError):
+                pkres.notAnAttribute
+        multiPeak = deb.peaks[0]
+        with self.assertRaises(AttributeError):
+            multiPeak.notAnAttribute = 1
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,79 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import lsst.utils.tests
+from lsst.meas.deblender.baseline import deblend
+from blendTestUtils import makeEdgeBlend
+
+
+class SaveDebugTemplatesTestCase(lsst.utils.tests.TestCase):
+
+    def testSaveDebugTemplates(self):
+        '''
+        Not keeping the intermediate templates should not change the result.
+        '''
+        fps, afwimg, fakepsf, fakepsf_fwhm = makeEdgeBlend()
+        self.assertEqual(len(fps), 1)
+        fp0 = fps[0]
+        # An additional peak near the first blob, that is degenerate
+        fp0.addPeak(40, 56, 10)
+        for kwargs in [dict(rampFluxAtEdge=True, removeDegenerateTemplates=True),
+                       dict(patchEdges=True, removeDegenerateTemplates=True),
+                       dict(monotonicAlgorithm='radial', medianSmoothTemplate=False)]:
+            deb = deblend(fp0, afwimg, fakepsf, fakepsf_fwhm, **kwargs)
+            lean = deblend(fp0, afwimg, fakepsf, fakepsf_fwhm, saveDebugTemplates=False, **kwargs)
+            for pkres, leanres in zip(deb.deblendedParents[0].peaks, lean.deblendedParents[0].peaks):
+                self.assertEqual(pkres.skip, leanres.skip)
+                self.assertEqual(pkres.hasRampedTemplate, leanres.hasRampedTemplate)
+                self.assertIsNone(leanres.origTemplate)
+                self.assertIsNone(leanres.rampedTemplate)
+                self.assertIsNone(leanres.medianFilteredTemplate)
+                self.assertIsNone(leanres.psfTemplate)
+                if pkres.skip:
+                    continue
+                if pkres.deblendedAsPsf:
+                    self.assertIsNotNone(pkres.psfTemplate)
+                else:
+                    self.assertIsNotNone(pkres.origTemplate)
+                if kwargs.get('medianSmoothTemplate', True) and not pkres.deblendedAsPsf:
+                    self.assertIsNotNone(pkres.medianFilteredTemplate)
+                if pkres.hasRampedTemplate:
+                    self.assertIsNotNone(pkres.rampedTemplate)
+                self.assertFloatsEqual(pkres.templateImage.getArray(), leanres.templateImage.getArray())
+                heavy = pkres.getFluxPortion()
+                leanHeavy = leanres.getFluxPortion()
+                self.assertFloatsEqual(heavy.getImageArray(), leanHeavy.getImageArray())
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,130 @@
+#
+# LSST Data Management System
+#
+# Copyright 2018  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+from lsst.meas.deblender import CatalogSink
+from deblendTaskTestUtils import loadCalexp, runMultibandDeblend, assertCatalogsEqual
+
+
+class CatalogSinkTestCase(lsst.utils.tests.TestCase):
+    """Test that the catalogs written in batches by a `CatalogSink` can be
+    read back with consistent parent and child ids in every band.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        table = afwTable.SourceTable.make(schema, afwTable.IdFactory.makeSimple())
+        self.sources = afwTable.SourceCatalog(table)
+        for i in range(5):
+            src = self.sources.addNew()
+            spans = afwGeom.SpanSet(afwGeom.Box2I(afwGeom.Point2I(10*i, 0), afwGeom.Extent2I(5, 5)))
+            src.setFootprint(afwDet.Footprint(spans))
+
+    def tearDown(self):
+        del self.sources
+        self.tempdir.cleanup()
+
+    def testBatches(self):
+        filters = ["g", "r"]
+        sink = CatalogSink(self.tempdir.name, "flux", filters, self.sources.table)
+        for start in range(0, len(self.sources), 2):
+            catalogs = sink.makeCatalogs(self.sources[start:start + 2])
+            for f in filters:
+                for parent in list(catalogs[f]):
+                    child = catalogs[f].addNew()
+                    child.setParent(parent.getId())
+                    foot = afwDet.Footprint(parent.getFootprint().getSpans())
+                    mimg = afwImage.MaskedImageF(foot.getBBox())
+                    mimg.getImage().set(float(parent.getId()))
+                    child.setFootprint(afwDet.makeHeavyFootprint(foot, mimg))
+            sink.write(catalogs)
+
+        self.assertEqual(sink.nRecords, 10)
+        childIds = None
+        for f in filters:
+            self.assertEqual(len(sink.filenames[f]), 3)
+            catalog = sink.readCatalog(f)
+            self.assertEqual(len(catalog), 10)
+            parents = [src for src in catalog if src.getParent() == 0]
+            children = [src for src in catalog if src.getParent() != 0]
+            self.assertEqual([src.getId() for src in parents], [src.getId() for src in self.sources])
+            ids = [src.getId() for src in children]
+            self.assertEqual(len(set(ids) | set(src.getId() for src in parents)), 10)
+            if childIds is not None:
+                self.assertEqual(ids, childIds)
+            childIds = ids
+            for child in children:
+                heavy = child.getFootprint()
+                self.assertTrue(heavy.isHeavy())
+                self.assertFloatsEqual(heavy.getImageArray(), float(child.getParent()))
+
+
+class BatchedOutputTestCase(lsst.utils.tests.TestCase):
+    """Test that the catalogs written in batches by `MultibandDeblendTask`
+    are the catalogs returned by a run that keeps them in memory.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.calexp = loadCalexp()
+
+    def tearDown(self):
+        del self.calexp
+        self.tempdir.cleanup()
+
+    def testBatchedMatchesInMemory(self):
+        sources, expected, _ = runMultibandDeblend(self.calexp)
+        outputBatchSize = 3
+        self.assertGreater(len(sources), outputBatchSize)
+        for numProcesses in [1, 2]:
+            outputDir = os.path.join(self.tempdir.name, "output{0}".format(numProcesses))
+            _, sinks, _ = runMultibandDeblend(self.calexp, numProcesses=numProcesses, outputDir=outputDir,
+                                              outputBatchSize=outputBatchSize)
+            for catalogs, sink in zip(expected, sinks):
+                self.assertEqual(catalogs is None, sink is None)
+                if catalogs is None:
+                    continue
+                for f, catalog in catalogs.items():
+                    self.assertEqual(len(sink.filenames[f]), (len(sources) - 1)//outputBatchSize + 1)
+                    assertCatalogsEqual(self, catalog, sink.readCatalog(f), ordered=False)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -29,7 +29,8 @@ import lsst.afw.detection as afwDet
 import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 from lsst.log import Log
-from lsst.meas.deblender.baseline import deblend
+from lsst.meas.deblender.baseline import deblend, makeDeblendPlugins, newDeblend
+from lsst.meas.deblender.baselineUtils import BaselineUtilsF as bUtils
 import lsst.meas.algorithms as measAlg
 
 doPlot = False
@@ -371,6 +372,207 @@ class StrayFluxTestCase(lsst.utils.tests.TestCase):
         self.assertLess(np.max(np.abs(s1 - strays[0])/np.maximum(1e-3, s1)), 1e-6)
         self.assertLess(np.max(np.abs(s2 - strays[1])/np.maximum(1e-3, s2)), 1e-6)
 
+    def test3(self):
+        '''
+        Compare the stray flux assigned by distance to the template
+        footprints with a brute force calculation of the distances,
+        including a template footprint that extends beyond the parent.
+        '''
+        np.random.seed(7)
+        fpbb = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(29, 19))
+        afwimg = afwImage.MaskedImageF(fpbb)
+        afwimg.getImage().getArray()[:] = np.random.uniform(1., 2., size=(20, 30))
+        afwimg.getVariance().set(1.)
+        parent = afwDet.Footprint(afwGeom.SpanSet(fpbb))
+
+        tspans = [afwGeom.SpanSet(afwGeom.Box2I(afwGeom.Point2I(3, 3), afwGeom.Point2I(7, 6))),
+                  # The second span is outside of the parent, but it is the closest
+                  # part of the template to the pixels in the lower right corner
+                  afwGeom.SpanSet([afwGeom.Span(2, 32, 34), afwGeom.Span(10, 25, 34)])]
+        tfoots = []
+        timgs = []
+        for spans in tspans:
+            tfoots.append(afwDet.Footprint(spans))
+            timg = afwImage.ImageF(spans.getBBox())
+            spans.setImage(timg, 1.)
+            timgs.append(timg)
+        tsum = afwImage.ImageF(fpbb)
+        strayopts = bUtils.ASSIGN_STRAYFLUX | bUtils.STRAYFLUX_R_TO_FOOTPRINT
+        portions, strays = bUtils.apportionFlux(afwimg, parent, timgs, tfoots, tsum, [False, False],
+                                                [5, 30], [4, 10], strayopts, 0.001)
+
+        # Brute force distance from every pixel to the closest pixel of each template
+        yy, xx = np.mgrid[0:20, 0:30]
+        contrib = []
+        for spans in tspans:
+            r2 = np.full(xx.shape, np.inf)
+            for span in spans:
+                for x in range(span.getX0(), span.getX1() + 1):
+                    r2 = np.minimum(r2, (xx - x)**2 + (yy - span.getY())**2)
+            contrib.append(1./(1. + r2))
+        contrib = np.array(contrib)
+        contrib[contrib < 0.001*contrib.sum(axis=0)] = 0.
+        isStray = tsum.getArray() <= 0
+        for i, stray in enumerate(strays):
+            simg = afwImage.ImageF(fpbb)
+            stray.insert(simg)
+            expected = contrib[i]/contrib.sum(axis=0)*afwimg.getImage().getArray()
+            expected[~isStray] = 0.
+            self.assertFloatsAlmostEqual(simg.getArray(), expected, rtol=1e-6, atol=1e-6)
+
+    def test4(self):
+        '''
+        Compare the stray flux assigned by distance to the peaks with a
+        brute force calculation, for a wide parent with many peaks so that
+        most of the distant peaks are clipped.
+        '''
+        np.random.seed(11)
+        W, H, N = 200, 20, 40
+        fpbb = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(W - 1, H - 1))
+        afwimg = afwImage.MaskedImageF(fpbb)
+        afwimg.getImage().getArray()[:] = np.random.uniform(-0.5, 2., size=(H, W))
+        afwimg.getVariance().set(1.)
+        parent = afwDet.Footprint(afwGeom.SpanSet(fpbb))
+
+        pkx = [int(x) for x in np.random.randint(0, W, size=N)]
+        pky = [int(y) for y in np.random.randint(0, H, size=N)]
+        tfoots = []
+        timgs = []
+        for x, y in zip(pkx, pky):
+            box = afwGeom.Box2I(afwGeom.Point2I(x - 1, y - 1), afwGeom.Point2I(x + 1, y + 1))
+            spans = afwGeom.SpanSet(box).clippedTo(fpbb)
+            tfoots.append(afwDet.Footprint(spans))
+            timg = afwImage.ImageF(spans.getBBox())
+            spans.setImage(timg, 1.)
+            timgs.append(timg)
+
+        yy, xx = np.mgrid[0:H, 0:W]
+        contrib = np.array([1./(1. + (xx - x)**2 + (yy - y)**2) for x, y in zip(pkx, pky)])
+        ispsf = [bool(p) for p in np.random.uniform(size=N) < 0.2]
+        for clip in [0.001, 0.05]:
+            for psfs, strayopts in [(ispsf, bUtils.ASSIGN_STRAYFLUX),
+                                    ([True]*N, (bUtils.ASSIGN_STRAYFLUX |
+                                                bUtils.STRAYFLUX_TO_POINT_SOURCES_WHEN_NECESSARY))]:
+                tsum = afwImage.ImageF(fpbb)
+                portions, strays = bUtils.apportionFlux(afwimg, parent, timgs, tfoots, tsum, psfs,
+                                                        pkx, pky, strayopts, clip)
+
+                expected = contrib.copy()
+                if not all(psfs):
+                    expected[np.array(psfs)] = 0.
+                expected[expected < clip*expected.sum(axis=0)] = 0.
+                expected *= afwimg.getImage().getArray()/expected.sum(axis=0)
+                expected[:, (tsum.getArray() > 0) | (afwimg.getImage().getArray() <= 0)] = 0.
+                for i, stray in enumerate(strays):
+                    simg = afwImage.ImageF(fpbb)
+                    if stray is not None:
+                        stray.insert(simg)
+                    self.assertFloatsAlmostEqual(simg.getArray(), expected[i], rtol=1e-6, atol=1e-6)
+
+    def test5(self):
+        '''
+        Write the flux portion and the stray flux of a template into a
+        single HeavyFootprint, and compare with mergeHeavyFootprints,
+        including pixels that are in both footprints.
+        '''
+        np.random.seed(5)
+
+        def randomMaskedImage(bbox):
+            mimg = afwImage.MaskedImageF(bbox)
+            shape = mimg.getImage().getArray().shape
+            mimg.getImage().getArray()[:] = np.random.uniform(size=shape)
+            mimg.getMask().getArray()[:] = np.random.randint(0, 4, size=shape)
+            mimg.getVariance().getArray()[:] = np.random.uniform(1., 2., size=shape)
+            return mimg
+
+        portion = randomMaskedImage(afwGeom.Box2I(afwGeom.Point2I(2, 3), afwGeom.Extent2I(15, 12)))
+        tfoot = afwDet.Footprint(afwGeom.SpanSet.fromShape(4).shiftedBy(9, 9))
+        tfoot.addPeak(9, 9, 1.)
+        sspans = afwGeom.SpanSet([afwGeom.Span(5, 10, 20), afwGeom.Span(6, 0, 3),
+                                  afwGeom.Span(13, 8, 12), afwGeom.Span(25, 1, 2)])
+        stray = afwDet.makeHeavyFootprint(afwDet.Footprint(sspans, tfoot.getPeaks().getSchema()),
+                                          randomMaskedImage(sspans.getBBox()))
+
+        heavy = bUtils.mergeFluxPortion(portion, tfoot, stray)
+        expected = afwDet.mergeHeavyFootprints(afwDet.makeHeavyFootprint(tfoot, portion), stray)
+        self.assertEqual(heavy.getSpans(), expected.getSpans())
+        self.assertFloatsEqual(heavy.getImageArray(), expected.getImageArray())
+        self.assertFloatsEqual(heavy.getMaskArray(), expected.getMaskArray())
+        self.assertFloatsEqual(heavy.getVarianceArray(), expected.getVarianceArray())
+        self.assertEqual([(pk.getIx(), pk.getIy()) for pk in heavy.getPeaks()], [(9, 9)])
+
+    def test6(self):
+        '''
+        Trim the stray flux of a multiband parent.  The parent footprint is
+        shared by the bands, so each band is apportioned within the footprint
+        trimmed by the previous bands, as in the serial deblender, even when
+        the bands are deblended in parallel.
+        '''
+        np.random.seed(6)
+        filters = ["g", "r"]
+        H, W = 80, 80
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(W, H))
+        psf_fwhm = 3.
+        psf = gaussianPsf(11, 11, psf_fwhm)
+        blob = doubleGaussianPsf(59, 59, 8., 16., 0.03)
+        XY = [(25., 30.), (50., 35.), (40., 55.)]
+        fluxes = {"g": [1e5, 3e5, 2e5], "r": [3e5, 1e5, 2e5]}
+        exposures = []
+        for f in filters:
+            mimg = afwImage.MaskedImageF(bbox)
+            mimg.getVariance().set(1.)
+            img = mimg.getImage().getArray()
+            for (x, y), flux in zip(XY, fluxes[f]):
+                bim = blob.computeImage(afwGeom.Point2D(x, y))
+                bbb = bim.getBBox()
+                bbb.clip(bbox)
+                bim = bim.Factory(bim, bbb)
+                img[bbb.getMinY():bbb.getMaxY()+1, bbb.getMinX():bbb.getMaxX()+1] += flux*bim.getArray()
+            img += np.random.normal(size=img.shape)
+            exposures.append(afwImage.ExposureF(mimg))
+        mExposure = afwImage.MultibandExposure.fromExposures(filters, exposures)
+        mMaskedImage = afwImage.MultibandMaskedImage(filters=mExposure.filters, image=mExposure.image,
+                                                     mask=mExposure.mask, variance=mExposure.variance)
+
+        fpSet = afwDet.FootprintSet(exposures[0].getMaskedImage(), afwDet.Threshold(20.), 'DETECTED', 1)
+        foot = max(fpSet.getFootprints(), key=lambda fp: len(fp.getPeaks()))
+        self.assertGreater(len(foot.getPeaks()), 1)
+
+        debPlugins = makeDeblendPlugins(strayFluxAssignment='trim')
+        log = Log.getLogger('meas.deblender.test_strayFlux')
+
+        def deblendTemplates(numThreads):
+            return newDeblend(debPlugins[:-1], afwDet.Footprint(foot), mMaskedImage, [psf]*len(filters),
+                              [psf_fwhm]*len(filters), numThreads=numThreads)
+
+        deb = deblendTemplates(2)
+        debPlugins[-1].run(deb, log)
+
+        # Apportion the flux of the bands one at a time, as in the serial deblender
+        expected = deblendTemplates(1)
+        for f in expected.filters:
+            dp = expected.deblendedParents[f]
+            peaks = [pkres for pkres in dp.peaks if not pkres.skip]
+            sumimg = afwImage.ImageF(dp.fp.getBBox())
+            portions, strays = bUtils.apportionFlux(
+                dp.maskedImage, dp.fp, [pkres.templateImage for pkres in peaks],
+                [pkres.templateFootprint for pkres in peaks], sumimg,
+                [pkres.deblendedAsPsf for pkres in peaks], [pkres.peak.getIx() for pkres in peaks],
+                [pkres.peak.getIy() for pkres in peaks], bUtils.STRAYFLUX_TRIM, 0.001)
+            spans = afwGeom.SpanSet()
+            for pkres in peaks:
+                spans = spans.union(pkres.templateFootprint.spans)
+            dp.fp.setSpans(spans)
+
+            result = [pkres for pkres in deb.deblendedParents[f].peaks if not pkres.skip]
+            self.assertEqual(len(result), len(peaks))
+            for pkres, portion in zip(result, portions):
+                self.assertIsNone(pkres.strayFlux)
+                self.assertEqual(pkres.fluxPortion.getBBox(), portion.getBBox())
+                self.assertFloatsEqual(pkres.fluxPortion.getImage().getArray(),
+                                       portion.getImage().getArray())
+            self.assertEqual(deb.deblendedParents[f].fp.spans, dp.fp.spans)
+
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass